@@ -108,6 +108,7 @@ from pytadbit.modelling.structuralmodels import StructuralModels
 from pytadbit.modelling.structuralmodels import load_structuralmodels
 from pytadbit.parsers.hic_parser         import load_hic_data_from_reads
 from pytadbit.parsers.hic_parser         import load_hic_data_from_bam
+from pytadbit.parsers.hic_parser         import load_hic_data_from_npz
 from pytadbit.modelling.impmodel         import load_impmodel_from_cmm
 from pytadbit.modelling.impmodel         import load_impmodel_from_xyz
 from pytadbit.modelling.impmodel         import IMPmodel
@@ -12,7 +12,9 @@ from collections                    import OrderedDict
 from warnings                       import warn
 from bisect                         import bisect_right as bisect
 from pickle                         import HIGHEST_PROTOCOL, dump, load
+import multiprocessing as mu
 
+import numpy as np
 from numpy.linalg                   import LinAlgError
 from numpy                          import corrcoef, nansum, array, isnan, mean
 from numpy                          import meshgrid, asarray, exp, linspace, std
@@ -22,16 +24,17 @@ from scipy.stats                    import ttest_ind, spearmanr
 from scipy.special                  import gammaincc
 from scipy.cluster.hierarchy        import linkage, fcluster, dendrogram
 from scipy.sparse.linalg            import eigsh
-from scipy.sparse                   import csr_matrix
+from scipy.sparse                   import csr_matrix, coo_matrix, triu
 from scipy.ndimage                  import median_filter
 
 from pytadbit.utils.extraviews      import plot_compartments
 from pytadbit.utils.extraviews      import plot_compartments_summary
 from pytadbit.utils.hic_filtering   import filter_by_mean, filter_by_zero_count
 from pytadbit.utils.normalize_hic   import iterative, expected
-from pytadbit.parsers.genome_parser import parse_fasta
+from pytadbit.parsers.genome_parser import parse_fasta, chromosome_lengths
 from pytadbit.parsers.bed_parser    import parse_bed
 from pytadbit.utils.file_handling   import mkdir
+from pytadbit.parsers.npz_parser    import write_npz
 from pytadbit.utils.hmm             import gaussian_prob, best_path, train
 from pytadbit.utils.tadmaths        import calinski_harabasz
 try:
@@ -50,16 +53,78 @@ def isclose(a, b, rel_tol=1e-09, abs_tol=0.0):
     """
     return abs(a-b) <= max(rel_tol * max(abs(a), abs(b)), abs_tol)
 
+# number of cells set one by one that are kept in a dictionary before being
+# merged into the sorted arrays of a HiC_data object
+_BUFFER_SIZE = 2**20
 
-class HiC_data(dict):
+_INT32 = np.iinfo(np.int32)
+
+# number of rows extracted at once by HiC_data.yield_matrix
+_YIELD_ROWS = 256
+
+# number of rows of the correlation matrix computed at once by
+# HiC_data.find_compartments
+_CORR_ROWS = 512
+
+
+def _values_dtype(vals):
     """
+    Smallest dtype storing the values without loss: raw counts are stored as
+    32 bit integers when possible, anything else as 64 bit floats.
+    """
+    if vals.dtype.kind in 'iub':
+        if not vals.shape[0] or (_INT32.min <= vals.min() and
+                                 vals.max() <= _INT32.max):
+            return np.int32
+        return np.int64
+    return np.float64
+
+
+def _aggregate(keys, vals):
+    """
+    Sort cells by position and sum the values of repeated positions.
+
+    :param keys: numpy array of positions (row * size + col)
+    :param vals: numpy array of values
+
+    :returns: sorted unique positions and corresponding values
+    """
+    if keys.shape[0] < 2 or (keys[1:] > keys[:-1]).all():
+        return keys, vals
+    order = keys.argsort(kind='mergesort')
+    keys = keys[order]
+    vals = vals[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    if starts.shape[0] == keys.shape[0]:
+        return keys, vals
+    return keys[starts], np.add.reduceat(vals, starts)
+
+
+class HiC_data(object):
+    """
+    Sparse Hi-C matrix.
+
+    Non-zero cells are stored in two numpy arrays sorted by position
+    (row * size + col), one with the positions (int64) and one with the values
+    (int32/int64 for raw counts, float64 otherwise). Cells set one by one are
+    first buffered in a small dictionary and merged into the arrays when
+    needed.
+
+    The object can be used as the dictionary {row * size + col: value}: cells
+    can be accessed with `hic_data[i, j]` or `hic_data[pos]`, and `get`,
+    `items`, `keys`, `values`, `in` and iteration work as for a dictionary
+    (positions are yielded sorted). `len` returns the number of rows.
+
     This may also hold the print/write-to-file matrix functions
     """
     def __init__(self, items, size, chromosomes=None, dict_sec=None,
                  resolution=1, masked=None, symmetricized=False):
-        super(HiC_data, self).__init__(items)
         self.__size = size
         self._size2 = size**2
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._vals = np.zeros(0, dtype=np.int32)
+        self._buffer = {}
+        self.update(items)
         self._symmetricize()
         self.bias = None
         self.bads = masked or {}
@@ -80,42 +145,95 @@ class HiC_data(dict):
             self.sections = dict([((None, i), i)
                                   for i in range(0, self.__size)])
 
+    def _consolidate(self):
+        """
+        Merge cells of the buffer into the sorted arrays
+        """
+        if not self._buffer:
+            return
+        keys = np.fromiter(self._buffer.keys(), dtype=np.int64,
+                           count=len(self._buffer))
+        vals = np.array(list(self._buffer.values()))
+        self._buffer = {}
+        order = keys.argsort()
+        self._merge(keys[order], vals[order])
+
+    def _merge(self, keys, vals):
+        """
+        Store values at the given positions, replacing previous ones.
+
+        :param keys: sorted numpy array of unique positions
+        :param vals: numpy array of values
+        """
+        if self._keys.shape[0]:
+            keep = ~self._lookup_index(self._keys, keys)[1]
+            keys = np.concatenate((self._keys[keep], keys))
+            vals = np.concatenate((self._vals[keep], vals))
+            order = keys.argsort(kind='mergesort')
+            keys = keys[order]
+            vals = vals[order]
+        self._keys = np.ascontiguousarray(keys)
+        self._vals = np.ascontiguousarray(
+            vals.astype(_values_dtype(vals), copy=False))
+
+    @staticmethod
+    def _lookup_index(keys, sorted_keys):
+        """
+        :returns: index of each key in sorted_keys, and whether it was found
+        """
+        idx = sorted_keys.searchsorted(keys)
+        if not sorted_keys.shape[0]:
+            return idx, np.zeros(idx.shape, dtype=bool)
+        idx[idx == sorted_keys.shape[0]] = 0
+        return idx, sorted_keys[idx] == keys
+
+    def _arrays(self):
+        """
+        :returns: sorted numpy arrays of positions and values of the stored
+           cells (not to be modified)
+        """
+        self._consolidate()
+        return self._keys, self._vals
+
+    def _lookup(self, keys):
+        """
+        Vectorized get.
+
+        :param keys: numpy array of positions
+
+        :returns: the values at these positions (0 for empty cells), and
+           whether each cell was found
+        """
+        skeys, svals = self._arrays()
+        idx, found = self._lookup_index(keys, skeys)
+        if not skeys.shape[0]:
+            return np.zeros(idx.shape, dtype=svals.dtype), found
+        return np.where(found, svals[idx], 0), found
+
     def _symmetricize(self):
         """
-        Check if matrix is symmetric (check first 10 non-zero values) and,
-        if not, make it symmetric
+        Check if matrix is symmetric and, if not, make it symmetric
          - if matrix is half empty, copy values on one side to the other side
          - if matrix is asymmetric, sum non-diagonal values
         """
-        to_sum = False
-        symmetric = True
-        count  = 0
-        for n in self:
-            i = n // self.__size
-            j = n % self.__size
-            if i == j or self[i, j] == self[i, j] == 0:
-                continue
-            if not isclose(self[i, j], self[j, i]):
-                if self[i, j] != 0 and self[j, i] != 0:
-                    to_sum = True
-                symmetric = False
-                break
-            if count > 10:
-                return
-            count += 1
-        if symmetric:  # may not reach 10 values
+        keys, vals = self._arrays()
+        if not keys.shape[0]:
             return
-        if to_sum:
-            for n in list(self.keys())[:]:
-                i = n // self.__size
-                j = n % self.__size
-                if i != j:
-                    self[j, i] = self[i, j] = self[j, i] + self[i, j]
+        rows, cols = np.divmod(keys, self.__size)
+        tkeys = cols * self.__size + rows
+        tvals, found = self._lookup(tkeys)
+        asym = ~np.isclose(vals, tvals, rtol=1e-09, atol=0., equal_nan=True)
+        asym &= rows != cols
+        if not asym.any():
+            return
+        if (asym & (vals != 0) & (tvals != 0)).any():
+            mirror = rows != cols
         else:
-            for n in list(self.keys())[:]:
-                i = n // self.__size
-                j = n % self.__size
-                self[j, i] = self[i, j] = self[n]
+            # stored zeros are copied too
+            mirror = asym | (~found & (rows != cols))
+        self._keys, self._vals = _aggregate(
+            np.concatenate((keys, tkeys[mirror])),
+            np.concatenate((vals, vals[mirror])))
 
     def _update_size(self, size):
         self.__size +=  size
@@ -135,18 +253,18 @@ class HiC_data(dict):
             if pos > self._size2:
                 raise IndexError(
                     'ERROR: row or column larger than %s' % self.__size)
-            return self.get(pos, 0)
         except TypeError:
-            if row_col > self._size2:
+            pos = row_col
+            if pos > self._size2:
                 raise IndexError(
                     'ERROR: position %d larger than %s^2' % (row_col,
                                                              self.__size))
-            return self.get(row_col, 0)
+        return self.get(pos, 0)
 
     def __setitem__(self, row_col, val):
         """
         slow one... for user
-        for fast item getting, use self.get()
+        for fast item setting, use self.update_from_arrays()
         """
         try:
             row, col = row_col
@@ -155,13 +273,206 @@ class HiC_data(dict):
                 print(row, col, pos)
                 raise IndexError(
                     'ERROR: row or column larger than %s' % self.__size)
-            super(HiC_data, self).__setitem__(pos, val)
         except TypeError:
-            if hasattr(self, '_size2') and row_col > self._size2:
+            pos = row_col
+            if hasattr(self, '_size2') and pos > self._size2:
                 raise IndexError(
                     'ERROR: position %d larger than %s^2' % (row_col,
                                                              self.__size))
-            super(HiC_data, self).__setitem__(row_col, val)
+        try:
+            self._buffer[pos] = val
+        except AttributeError:
+            # unpickling HiC_data saved as a dictionary: cells are set before
+            # the attributes
+            self._keys = np.zeros(0, dtype=np.int64)
+            self._vals = np.zeros(0, dtype=np.int32)
+            self._buffer = {pos: val}
+        if len(self._buffer) >= _BUFFER_SIZE:
+            self._consolidate()
+
+    def __reduce__(self):
+        """
+        Pickled with the cells merged into the sorted arrays
+        """
+        self._consolidate()
+        return (self.__class__, ([], self.__size), self.__dict__)
+
+    def __setstate__(self, state):
+        """
+        Restores the attributes of a pickled HiC_data, either stored in arrays
+        or, as formerly, as a dictionary (with the cells already set)
+        """
+        if not '_keys' in self.__dict__:
+            self._keys = np.zeros(0, dtype=np.int64)
+            self._vals = np.zeros(0, dtype=np.int32)
+            self._buffer = {}
+        buffered = self._buffer
+        self.__dict__.update(state)
+        if buffered is not self._buffer:
+            self._buffer = dict(self._buffer)
+            self._buffer.update(buffered)
+
+    def __delitem__(self, pos):
+        keys, _ = self._arrays()
+        idx, found = self._lookup_index(np.array([pos], dtype=np.int64), keys)
+        if not found[0]:
+            raise KeyError(pos)
+        self._keys = np.delete(self._keys, idx)
+        self._vals = np.delete(self._vals, idx)
+
+    def __contains__(self, pos):
+        if pos in self._buffer:
+            return True
+        idx = self._keys.searchsorted(pos)
+        return idx < self._keys.shape[0] and self._keys[idx] == pos
+
+    def __iter__(self):
+        return self.keys()
+
+    def __eq__(self, other):
+        """
+        Compares stored cells, as done for dictionaries
+        """
+        if isinstance(other, HiC_data):
+            keys1, vals1 = self._arrays()
+            keys2, vals2 = other._arrays()
+            return (np.array_equal(keys1, keys2) and
+                    np.array_equal(vals1, vals2))
+        if isinstance(other, dict):
+            return dict(self.items()) == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def get(self, pos, default=None):
+        """
+        Value of a cell.
+
+        :param pos: position of the cell (row * size + col)
+        :param None default: returned if the cell is empty
+        """
+        try:
+            return self._buffer[pos]
+        except KeyError:
+            pass
+        idx = self._keys.searchsorted(pos)
+        if idx < self._keys.shape[0] and self._keys[idx] == pos:
+            return self._vals[idx].item()
+        return default
+
+    def keys(self):
+        """
+        Iterates over positions of stored cells (sorted)
+        """
+        keys, _ = self._arrays()
+        for beg in range(0, keys.shape[0], _BUFFER_SIZE):
+            for key in keys[beg:beg + _BUFFER_SIZE].tolist():
+                yield key
+
+    def values(self):
+        """
+        Iterates over values of stored cells (sorted by position)
+        """
+        _, vals = self._arrays()
+        for beg in range(0, vals.shape[0], _BUFFER_SIZE):
+            for val in vals[beg:beg + _BUFFER_SIZE].tolist():
+                yield val
+
+    def items(self):
+        """
+        Iterates over (position, value) of stored cells (sorted by position)
+        """
+        keys, vals = self._arrays()
+        for beg in range(0, keys.shape[0], _BUFFER_SIZE):
+            end = beg + _BUFFER_SIZE
+            for item in zip(keys[beg:end].tolist(), vals[beg:end].tolist()):
+                yield item
+
+    def update(self, items):
+        """
+        Set the values of many cells.
+
+        :param items: a dictionary, a HiC_data object or an iterable of
+           (position, value). A numpy structured array with two fields
+           (position and value) is stored directly, summing the values of
+           repeated positions.
+        """
+        if isinstance(items, HiC_data):
+            keys, vals = items._arrays()
+            self.update_from_arrays(keys.copy(), vals.copy())
+            return
+        if isinstance(items, np.ndarray) and items.dtype.names:
+            pos, val = items.dtype.names[:2]
+            self.update_from_arrays(items[pos], items[val])
+            return
+        if hasattr(items, 'items'):
+            items = items.items()
+        buf = self._buffer
+        for key, val in items:
+            buf[key] = val
+            if len(buf) >= _BUFFER_SIZE:
+                self._consolidate()
+                buf = self._buffer
+
+    def update_from_arrays(self, keys, values, add=False):
+        """
+        Set the values of many cells at once.
+
+        :param keys: array of positions (row * size + col), values of repeated
+           positions are summed
+        :param values: array of values
+        :param False add: add the values to the ones already stored instead of
+           replacing them
+
+        Sorted arrays of unique positions may be stored without being copied,
+        they should not be modified afterwards.
+        """
+        keys, vals = _aggregate(np.asarray(keys, dtype=np.int64),
+                                np.asarray(values))
+        if not keys.shape[0]:
+            return
+        if keys[-1] > self._size2:
+            raise IndexError('ERROR: position %d larger than %s^2' % (
+                keys[-1], self.__size))
+        if add:
+            vals = vals + self._lookup(keys)[0]
+        else:
+            self._consolidate()
+        self._merge(keys, vals)
+
+    def _bins_mask(self, bads):
+        """
+        :returns: a boolean array, False for the bins in bads
+        """
+        good = np.ones(self.__size, dtype=bool)
+        good[[b for b in bads if b < self.__size]] = False
+        return good
+
+    def _bias_array(self, bias):
+        """
+        :returns: an array of biases (NaN where missing)
+        """
+        arr = np.empty(self.__size)
+        arr.fill(np.nan)
+        for i, b in bias.items():
+            if i < self.__size:
+                arr[i] = b
+        return arr
+
+    def get_hic_data_as_arrays(self):
+        """
+        Returns the rows, columns and values of the non-zero cells of the
+        matrix, sorted by row and column.
+
+        :returns: three numpy arrays
+        """
+        keys, vals = self._arrays()
+        rows, cols = np.divmod(keys, self.__size)
+        return rows, cols, vals
 
     def get_hic_data_as_csr(self):
         """
@@ -169,16 +480,9 @@ class HiC_data(dict):
 
         :returns: scipy sparse matrix in Compressed Sparse Row format
         """
-        values = []
-        cols = []
-        rows = []
-        for key, value in self.items():
-            row, col = round(key // self.__size), key % self.__size
-            values.append(float(value))
-            cols.append(col)
-            rows.append(row)
-
-        return csr_matrix((values, (rows, cols)), shape=(self.__size,self.__size))
+        rows, cols, vals = self.get_hic_data_as_arrays()
+        return csr_matrix((vals.astype(float), (rows, cols)),
+                          shape=(self.__size,self.__size))
 
     def add_sections_from_fasta(self, fasta):
         """
@@ -187,12 +491,12 @@ class HiC_data(dict):
 
         :param fasta: path to a FASTA file
         """
-        genome = parse_fasta(fasta, verbose=False)
+        genome = chromosome_lengths(parse_fasta(fasta, verbose=False))
         sections = []
         genome_seq = OrderedDict()
         size = 0
         for crm in  genome:
-            genome_seq[crm] = int(len(genome[crm])) // self.resolution + 1
+            genome_seq[crm] = int(genome[crm]) // self.resolution + 1
             size += genome_seq[crm]
         section_sizes = {}
         for crm in genome_seq:
@@ -274,7 +578,6 @@ class HiC_data(dict):
             exclude = []
         if equals == None:
             equals = lambda x, y: x == y
-        intra = 0
         if not self.chromosomes:
             return float('nan')
         # define chromosomes to be merged
@@ -291,25 +594,23 @@ class HiC_data(dict):
         bads = set(self.bads.keys())
         for c in exclude:
             bads.update(i for i in range(*self.section_pos[c]))
+        rows, cols, vals = self.get_hic_data_as_arrays()
+        # same chromosome
+        sections = np.array(sections)
+        keep = (sections.searchsorted(rows, side='right') ==
+                sections.searchsorted(cols, side='right'))
+        good = self._bins_mask(bads)
+        keep &= good[rows] & good[cols]
         # diagonal
-        if diagonal:
-            valid = lambda x, y: True
-        else:
-            valid = lambda x, y: x != y
-        # normalization
+        if not diagonal:
+            keep &= rows != cols
+        rows, cols, vals = rows[keep], cols[keep], vals[keep]
+        # compute ratio
         if normalized:
-            transform = lambda x, y, z: x / self.bias[y] / self.bias[z]
+            bias = self._bias_array(self.bias)
+            intra = (vals / bias[rows] / bias[cols]).sum()
         else:
-            transform = lambda x, y, z: x
-        # compute ratio
-        for k, v in self.items():
-            i, j = divmod(k, self.__size)
-            if bisect(sections, i) != bisect(sections, j):
-                continue
-            if i in bads or j in bads:
-                continue
-            if valid(i, j):  # diagonal thing
-                intra += transform(v, i, j)
+            intra = vals.sum()
         try:
             return float(intra) / self.sum(bias=self.bias if normalized else None, bads=bads)
         except ZeroDivisionError:
@@ -357,22 +658,15 @@ class HiC_data(dict):
 
         :returns: the sum of the Hi-C matrix skipping bad columns
         """
-        N = self.__size
-        norm_sum = 0
         bads = bads or self.bads
+        rows, cols, vals = self.get_hic_data_as_arrays()
+        good = self._bins_mask(bads)
+        keep = good[rows] & good[cols]
+        rows, cols, vals = rows[keep], cols[keep], vals[keep]
         if bias:
-            for k, v in self.items():
-                i, j = divmod(k, N)
-                if i in bads or j in bads:
-                    continue
-                norm_sum += v / (bias[i] * bias[j])
-        else:
-            for k, v in self.items():
-                i, j = divmod(k, N)
-                if i in bads or j in bads:
-                    continue
-                norm_sum += v
-        return norm_sum
+            bias = self._bias_array(bias)
+            return (vals / (bias[rows] * bias[cols])).sum().item()
+        return vals.sum().item()
 
     def normalize_expected(self, **kwargs):
         self.expected = expected(self, bads=self.bads, **kwargs)
@@ -444,9 +738,7 @@ class HiC_data(dict):
         self.bads     = biases['badcol']
 
     def get_as_tuple(self):
-        return tuple([self[i, j]
-                      for j in range(len(self))
-                      for i in range(len(self))])
+        return tuple(self._get_block(0, len(self), 0, len(self)).T.ravel().tolist())
 
     def write_coord_table(self, fname, focus=None, diagonal=True,
                           normalized=False, format='BED'):
@@ -466,7 +758,13 @@ class HiC_data(dict):
            or "long-range" format:
                chr1:111-222   \t   chr2:333-444   \t   55
                chr2:333-444   \t   chr1:111-222   \t   55
+           or "npz", binary format with the coordinates of the non-zero cells
+           (see :mod:`pytadbit.parsers.npz_parser`)
         """
+        if format == 'npz':
+            self._write_npz(fname, focus=focus, diagonal=diagonal,
+                            normalized=normalized)
+            return
         if focus:
             if isinstance(focus, tuple) and isinstance(focus[0], int):
                 if len(focus) == 2:
@@ -540,6 +838,28 @@ class HiC_data(dict):
             raise Exception('ERROR: format "%s" not found\n' % format)
         out.close()
 
+    def _write_npz(self, fname, focus=None, diagonal=True, normalized=False):
+        """
+        writes the matrix in binary format (only squared windows of data).
+        """
+        start1, start2, end1, end2 = self._focus_coords(focus)
+        if (start1, end1) != (start2, end2):
+            raise Exception('ERROR: only matrices centered on the diagonal '
+                            'can be written in npz format')
+        matrix = self.get_matrix(focus=focus, normalized=normalized,
+                                 sparse=True)
+        # diagonal replaced by zeroes, as in the text format
+        if not diagonal:
+            matrix.setdiag(0)
+        matrix.eliminate_zeros()
+        matrix = matrix.tocoo()
+        size = end1 - start1
+        keys, vals = _aggregate(matrix.row.astype(np.int64) * size + matrix.col,
+                                matrix.data)
+        write_npz(fname, keys, vals, size, resolution=self.resolution,
+                  sections=self.sections, masked=self.bads,
+                  symmetricized=self.symmetricized, start=start1)
+
     def write_cooler(self, fname, normalized=False):
         """
         writes the hic_data to a cooler file.
@@ -551,7 +871,7 @@ class HiC_data(dict):
                             'you need to install h5py\n')
         if normalized and not self.bias:
             raise Exception('ERROR: data not normalized yet')
-        if not all(isinstance(val, int) for _, val in self.items()):
+        if self._arrays()[1].dtype.kind not in 'iu':
             raise Exception('ERROR: raw hic data (integer values) is needed for cooler format')
         if self.chromosomes:
             if len(self.chromosomes) > 1:
@@ -576,7 +896,8 @@ class HiC_data(dict):
                        for i in range(self.__size)]
             out.write_weights(weights, weights)
 
-    def write_matrix(self, fname, focus=None, diagonal=True, normalized=False):
+    def write_matrix(self, fname, focus=None, diagonal=True, normalized=False,
+                     format='text'):
         """
         writes the matrix to a file.
 
@@ -587,7 +908,17 @@ class HiC_data(dict):
            region
         :param True diagonal: if False, diagonal is replaced by zeroes
         :param False normalized: get normalized data
+        :param text format: either "text" (tab separated matrix) or "npz"
+           (binary format, see :mod:`pytadbit.parsers.npz_parser`), much
+           faster to write and to load with
+           :func:`pytadbit.parsers.hic_parser.read_matrix`
         """
+        if format == 'npz':
+            self._write_npz(fname, focus=focus, diagonal=diagonal,
+                            normalized=normalized)
+            return
+        if format != 'text':
+            raise Exception('ERROR: format "%s" not found\n' % format)
         if focus:
             if isinstance(focus, tuple) and isinstance(focus[0], int):
                 if len(focus) == 2:
@@ -630,7 +961,7 @@ class HiC_data(dict):
         out.close()
 
     def get_matrix(self, focus=None, diagonal=True, normalized=False,
-                   masked=False):
+                   masked=False, as_array=False, sparse=False):
         """
         returns a matrix.
 
@@ -644,47 +975,108 @@ class HiC_data(dict):
         :param False normalized: get normalized data
         :param False masked: return masked arrays using the definition of bad
            columns
+        :param False as_array: return a numpy array instead of a list of lists
+        :param False sparse: return a scipy sparse matrix in Compressed Sparse
+           Row format (not compatible with masked)
 
         :returns: matrix (a list of lists of values)
         """
         if normalized and not self.bias:
             raise Exception('ERROR: experiment not normalized yet')
+        if sparse and masked:
+            raise Exception('ERROR: sparse matrices can not be masked')
         start1, start2, end1, end2 = self._focus_coords(focus)
-        if normalized:
-            if diagonal:
-                matrix = [[self[i, j] / self.bias[i] / self.bias[j]
-                           for i in range(start2, end2)]
-                          for j in range(start1, end1)]
+        # as with dictionaries, empty cells of float matrices are integers
+        int_zeros = (not (normalized or sparse or masked or as_array) and
+                     self._arrays()[1].dtype.kind == 'f')
+        matrix = self._get_block(start2, end2, start1, end1,
+                                 normalized=normalized, sparse=sparse,
+                                 stored=int_zeros)
+        if int_zeros:
+            matrix, found = matrix
+            found = found.T
+        matrix = matrix.T
+        if not diagonal and start1 == start2:
+            diag = matrix.diagonal()
+            if not normalized:
+                diag = (diag != 0).astype(diag.dtype)
             else:
-                matrix = [[self[i, j] / self.bias[i] / self.bias[j]
-                           for i in range(start2, end2)]
-                          for j in range(start1, end1)]
-                if start1 == start2:
-                    for i in range(len(matrix)):
-                        matrix[i][i] = 0
-        else:
-            if diagonal:
-                matrix = [[self[i, j] for i in range(start2, end2)]
-                          for j in range(start1, end1)]
+                diag = zeros_like(diag)
+            if sparse:
+                matrix = matrix.tocsr()
+                matrix.setdiag(diag)
+                matrix.eliminate_zeros()
             else:
-                matrix = [[self[i, j] for i in range(start2, end2)]
-                          for j in range(start1, end1)]
-                if start1 == start2:
-                    for i in range(len(matrix)):
-                        matrix[i][i] = 1 if matrix[i][i] else 0
+                matrix = matrix.copy()
+                np.fill_diagonal(matrix, diag)
+        if sparse:
+            return matrix.tocsr()
 
         if masked:
+            # same types as formerly, from lists of values
+            if matrix.dtype.kind in 'iub':
+                matrix = matrix.astype(int)
             bads1 = [b - start1 for b in self.bads if start1 <= b < end1]
             bads2 = [b - start2 for b in self.bads if start2 <= b < end2]
             m = zeros_like(matrix)
-            for bad1 in bads1:
-                m[:,bad1] = 1
-                for bad2 in bads2:
-                    m[bad2,:] = 1
-            matrix = ma.masked_array(matrix, m)
-
+            if bads1:
+                m[:,bads1] = 1
+                m[bads2,:] = 1
+            return ma.masked_array(matrix, m)
+        if as_array:
+            return matrix
+        if int_zeros:
+            lines = np.zeros(matrix.shape, dtype=object)
+            lines[found] = matrix[found].tolist()
+            matrix = lines
+        matrix = matrix.tolist()
+        if not diagonal and start1 == start2:
+            for i in range(min(end1 - start1, end2 - start2)):
+                matrix[i][i] = 0 if normalized else int(matrix[i][i] != 0)
         return matrix
 
+    def _get_block(self, start1, end1, start2, end2, normalized=False,
+                   sparse=False, stored=False):
+        """
+        Extracts a region of the matrix.
+
+        :param start1: first row
+        :param end1: last row (not included)
+        :param start2: first column
+        :param end2: last column (not included)
+        :param False normalized: divide each cell by the biases of its row and
+           column
+        :param False sparse: return a scipy sparse matrix (COO format)
+        :param False stored: also return a boolean array marking stored cells
+
+        :returns: a numpy array, or a sparse matrix
+        """
+        keys, vals = self._arrays()
+        size = self.__size
+        beg, end = keys.searchsorted([start1 * size, end1 * size])
+        rows, cols = np.divmod(keys[beg:end], size)
+        keep = (start2 <= cols) & (cols < end2)
+        rows = rows[keep] - start1
+        cols = cols[keep] - start2
+        vals = vals[beg:end][keep]
+        shape = (max(0, end1 - start1), max(0, end2 - start2))
+        if normalized:
+            bias = self._bias_array(self.bias)
+        if sparse:
+            if normalized:
+                vals = vals / bias[rows + start1] / bias[cols + start2]
+            return coo_matrix((vals, (rows, cols)), shape=shape)
+        block = np.zeros(shape, dtype=vals.dtype)
+        block[rows, cols] = vals
+        if normalized:
+            # empty cells too: NaN in rows or columns without bias
+            block = (block / bias[start1:end1, None]) / bias[None, start2:end2]
+        if stored:
+            found = np.zeros(shape, dtype=bool)
+            found[rows, cols] = True
+            return block, found
+        return block
+
     def _focus_coords(self, focus):
         siz = len(self)
         if focus:
@@ -737,7 +1129,7 @@ class HiC_data(dict):
                           savecorr=None, show=False, suffix='', ev_index=None,
                           rich_in_A=None, format='png', savedir=None, 
                           max_ev=3, show_compartment_labels=False, 
-                          smoothing_window=0, **kwargs):
+                          smoothing_window=0, n_cpus=1, **kwargs):
         """
         Search for A/B compartments in each chromosome of the Hi-C matrix.
         Hi-C matrix is normalized by the number interaction expected at a given
@@ -767,7 +1159,9 @@ class HiC_data(dict):
            eigenvector is also rotated according to the prediction if a
            `rich_in_A` array was given.
         :param None savecorr: path to a directory where to save correlation
-           matrices of each chromosome
+           matrices of each chromosome (computed in double precision as
+           products of normalized rows, the values may differ from those of
+           numpy.corrcoef in the last digits)
         :param -1 vmin: for the color scale of the plotted map (use vmin='auto',
            and vmax='auto' to color according to the absolute maximum found).
         :param 1 vmax: for the color scale of the plotted map (use vmin='auto',
@@ -792,8 +1186,7 @@ class HiC_data(dict):
            scipy.ndimage. The parameter is passed as `size` to the median_filter 
            function.
         :param False show_compartment_labels: if True draw A and B compartment blocks.
-
-        TODO: this is really slow...
+        :param 1 n_cpus: number of chromosomes to process in parallel
 
         Notes: building the distance matrix using the amount of interactions
                instead of the mean correlation, gives generally worse results.
@@ -842,49 +1235,63 @@ class HiC_data(dict):
         count = 0
         richA_stats = dict((sec, None) for sec in self.section_pos)
 
+        # normalized matrices are built and decomposed in parallel
+        csr = self.get_hic_data_as_csr()
+        bias = np.full(len(self), np.nan)
+        bias[list(self.bias.keys())] = list(self.bias.values())
+        good = np.ones(len(self), dtype=bool)
+        good[[b for b in self.bads if b < len(self)]] = False
+        keep_corr = bool(savecorr)
+        keep_matrix = bool(savefig or show)
+        if n_cpus > 1:
+            pool = mu.Pool(n_cpus)
+        procs = {}
+        for sec in self.section_pos:
+            if crms and sec not in crms:
+                continue
+            beg, end = self.section_pos[sec]
+            if sec in self.expected:
+                this_decay = self.expected[sec]
+            else:
+                this_decay = self.expected
+            if not this_decay:
+                procs[sec] = None
+                continue
+            decay = np.full(end - beg, np.nan)
+            for d in range(end - beg):
+                try:
+                    decay[d] = this_decay[d]
+                except (KeyError, IndexError):
+                    pass
+            args = (csr[beg:end, beg:end], bias[beg:end], good[beg:end],
+                    decay, max_ev, smoothing_window, keep_corr, keep_matrix)
+            if n_cpus > 1:
+                procs[sec] = pool.apply_async(_chromosome_eigenvectors, args)
+            else:
+                procs[sec] = args
+        if n_cpus > 1:
+            pool.close()
+
         for sec in self.section_pos:
             if crms and sec not in crms:
                 continue
             if kwargs.get('verbose', False):
                 print('Processing chromosome', sec)
-            # get chromosomal matrix
-            try:
-                matrix = [[(float(self[i,j]) / self.expected[sec][abs(j-i)]
-                            / self.bias[i] / self.bias[j])
-                        for i in range(*self.section_pos[sec])
-                        if not i in self.bads]
-                        for j in range(*self.section_pos[sec])
-                        if not j in self.bads]
-            except KeyError:
-                if sec in self.expected and not self.expected[sec]:
-                    matrix = []
-                else:
-                    matrix = [[(float(self[i,j]) / self.expected[abs(j-i)]
-                                / self.bias[i] / self.bias[j])
-                            for i in range(*self.section_pos[sec])
-                            if not i in self.bads]
-                            for j in range(*self.section_pos[sec])
-                            if not j in self.bads]
-            if not matrix: # MT chromosome will fall there
-                warn('Chromosome %s is probably MT :)' % (sec))
-                cmprts[sec] = []
-                count += 1
-                continue
-            # enforce symmetry
-            for i in range(len(matrix)):
-                for j in range(i+1, len(matrix)):
-                    matrix[i][j] = matrix[j][i]
-            # compute correlation coefficient
-            try:
-                matrix = [list(m) for m in corrcoef(matrix)]
-            except TypeError:
-                # very small chromosome?
+            if procs[sec] is None:
+                result = 'MT'
+            elif n_cpus > 1:
+                result = procs[sec].get()
+            else:
+                result = _chromosome_eigenvectors(*procs[sec])
+            procs[sec] = None
+            if result == 'MT':  # MT chromosome will fall there
                 warn('Chromosome %s is probably MT :)' % (sec))
                 cmprts[sec] = []
                 count += 1
                 continue
-            # replace nan in correlation matrix
-            matrix = [[0. if isnan(v) else v for v in l] for l in matrix]
+            corr, matrix, evals, evect, peak = result
+            if kwargs.get('verbose', False):
+                print('  - peak memory: %.1f Mb' % (peak / 1024.**2))
             # write correlation matrix to file. replaces filtered row/columns by NaN
             if savecorr:
                 out = open(os.path.join(savecorr, '%s_corr-matrix%s.tsv' % (sec, suffix)),
@@ -899,45 +1306,29 @@ class HiC_data(dict):
                           for k in sorted(self.sections,
                                           key=lambda x: self.sections[x])
                           if k[0] == sec]
-                length = self.section_pos[sec][1] - self.section_pos[sec][0]
+                goods = good[start1:end1]
+                length = end1 - start1
                 empty = 'NaN\t' * (length - 1) + 'NaN\n'
-                badrows = 0
-                for row, posx in enumerate(range(self.section_pos[sec][0],
-                                                  self.section_pos[sec][1])):
-                    if posx in self.bads:
+                vals = np.full(length, 'NaN', dtype=object)
+                row = 0
+                for posx in range(length):
+                    if not goods[posx]:
                         out.write(rownam.pop(0) + '\t' + empty)
-                        badrows += 1
                         continue
-                    vals = []
-                    badcols = 0
-                    for col, posy in enumerate(range(self.section_pos[sec][0],
-                                                      self.section_pos[sec][1])):
-                        if posy in self.bads:
-                            vals.append('NaN')
-                            badcols += 1
-                            continue
-                        vals.append(str(matrix[row-badrows][col-badcols]))
+                    vals[goods] = [str(v) for v in corr[row]]
+                    row += 1
                     out.write(rownam.pop(0) + '\t' +'\t'.join(vals) + '\n')
                 out.close()
+                corr = None
 
-            if smoothing_window:
-                matrix = [[v for v in l] for l in median_filter(
-                    matrix, size=smoothing_window)]
-
-            # get eigenvectors
-            try:
-                # This eighs is very very fast, only ask for one eigenvector
-                evals, evect = eigsh(array(matrix),
-                                     k=max_ev if max_ev else (len(matrix) - 1))
-            except (LinAlgError, ValueError):
+            if evals is None:
                 warn('Chromosome %s too small to compute PC1' % (sec))
                 cmprts[sec] = [] # Y chromosome, or so...
                 count += 1
                 continue
             # define breakpoints, and store first EVs
             n_first = [list(evect[:, -i])
-                       for i in range(1, (max_ev + 1)
-                                       if max_ev else len(matrix))]
+                       for i in range(1, evect.shape[1] + 1)]
             ev_num = (ev_index[count] - 1) if ev_index else 0
             breaks = [i for i, (a, b) in
                       enumerate(zip(n_first[ev_num][1:], n_first[ev_num][:-1]))
@@ -950,10 +1341,6 @@ class HiC_data(dict):
             bads = [k - beg for k in sorted(self.bads) if beg <= k <= end]
             for evect in n_first:
                 _ = [evect.insert(b, float('nan')) for b in bads]
-            _ = [matrix.insert(b, [float('nan')] * len(matrix[0]))
-                 for b in bads]
-            _ = [matrix[i].insert(b, float('nan'))
-                 for b in bads for i in range(len(n_first[0]))]
             for b in bads:  # they are sorted
                 for brk in breaks:
                     if brk['start'] >= b:
@@ -1030,6 +1417,9 @@ class HiC_data(dict):
                     warn(('WARNING: chromosome %s too small for plotting.'
                           'Skipping image creation.') % sec)
 
+        if n_cpus > 1:
+            pool.join()
+
         self.compartments = cmprts
         if savedata:
             self.write_compartments(savedata, chroms=list(self.compartments.keys()),
@@ -1526,60 +1916,128 @@ class HiC_data(dict):
 
         :yields: matrix line by line (a line being a list of values)
         """
-        siz = len(self)
         if normalized and not self.bias:
             raise Exception('ERROR: experiment not normalized yet')
-        if focus:
-            if isinstance(focus, tuple) and isinstance(focus[0], int):
-                if len(focus) == 2:
-                    start1, end1 = focus
-                    start2, end2 = focus
-                    start1 -= 1
-                    start2 -= 1
-                else:
-                    start1, end1, start2, end2 = focus
-                    start1 -= 1
-                    start2 -= 1
-            elif isinstance(focus, tuple) and isinstance(focus[0], basestring):
-                start1, end1 = self.section_pos[focus[0]]
-                start2, end2 = self.section_pos[focus[1]]
-            else:
-                start1, end1 = self.section_pos[focus]
-                start2, end2 = self.section_pos[focus]
-        else:
-            start1 = start2 = 0
-            end1   = end2   = siz
-        if normalized:
-            for i in range(start2, end2):
-                # if bad column:
-                if i in self.bads:
-                    yield [0.0 for j in range(start1, end1)]
-                # if we want the diagonal, or we don't but are looking at a
-                # region that is not symmetric
-                elif diagonal or start1 != start2:
-                    yield [self[i, j] / self.bias[i] / self.bias[j]
-                           for j in range(start1, end1)]
-                # diagonal replaced by zeroes
-                else:
-                    yield ([self[i, j] / self.bias[i] / self.bias[j]
-                            for j in range(start1, i)] +
-                           [0.0] +
-                           [self[i, j] / self.bias[i] / self.bias[j]
-                            for j in range(i + 1, end1)])
-        else:
-            for i in range(start2, end2):
+        start1, start2, end1, end2 = self._focus_coords(focus)
+        zero = 0.0 if normalized else 0
+        # as with dictionaries, empty cells of float matrices are integers
+        int_zeros = not normalized and self._arrays()[1].dtype.kind == 'f'
+        for beg in range(start2, end2, _YIELD_ROWS):
+            end = min(end2, beg + _YIELD_ROWS)
+            block = self._get_block(beg, end, start1, end1,
+                                    normalized=normalized, stored=int_zeros)
+            if int_zeros:
+                block, found = block
+                lines = np.zeros(block.shape, dtype=object)
+                lines[found] = block[found].tolist()
+                block = lines
+            for i, line in enumerate(block.tolist(), beg):
                 # if bad column:
                 if i in self.bads:
-                    yield [0 for j in range(start1, end1)]
-                # if we want the diagonal, or we don't but are looking at a
-                # region that is not symmetric
-                elif diagonal or start1 != start2:
-                    yield [self[i, j] for j in range(start1, end1)]
-                # diagonal replaced by zeroes
-                else:
-                    yield ([self[i, j] for j in range(start1, i)] +
-                           [0] +
-                           [self[i, j] for j in range(i + 1, end1)])
+                    yield [zero] * (end1 - start1)
+                    continue
+                # diagonal replaced by zeroes, if we are looking at a symmetric
+                # region
+                if not diagonal and start1 == start2 and i < end1:
+                    line[i - start1] = zero
+                yield line
+
+
+def _nbytes(*arrays):
+    """
+    Memory used by numpy arrays and scipy sparse matrices (None are skipped).
+    """
+    total = 0
+    for arr in arrays:
+        if arr is None:
+            continue
+        try:
+            total += arr.nbytes
+        except AttributeError:  # sparse matrix
+            total += arr.data.nbytes + arr.indices.nbytes + arr.indptr.nbytes
+    return total
+
+
+def _chromosome_eigenvectors(matrix, bias, good, decay, max_ev,
+                             smoothing_window, keep_corr, keep_matrix):
+    """
+    Compute the correlation matrix of the observed/expected matrix of one
+    chromosome and its first eigenvectors.
+
+    :param matrix: scipy sparse matrix with the interactions of the chromosome
+    :param bias: array of biases of the bins of the chromosome
+    :param good: boolean array, False for bad columns
+    :param decay: array of expected values, indexed by distance
+    :param max_ev: number of eigenvectors to compute (all if 0)
+    :param smoothing_window: size of the median filter applied to the
+       correlation matrix before computing eigenvectors
+    :param keep_corr: return the correlation matrix (without bad columns)
+    :param keep_matrix: return the (smoothed) correlation matrix, with bad
+       columns as NaNs
+
+    :returns: 'MT' if the chromosome is too small to compute correlations,
+       otherwise the correlation matrix, the smoothed correlation matrix, the
+       eigenvalues and eigenvectors (both None if the chromosome is too small)
+       and the peak of memory used by the matrices, in bytes
+    """
+    idx = np.flatnonzero(good)
+    size = len(idx)
+    if size < 2:
+        return 'MT'
+    # observed/expected, from the upper half of the matrix
+    matrix = triu(matrix).tocoo()
+    keep = good[matrix.row] & good[matrix.col]
+    rows = matrix.row[keep]
+    cols = matrix.col[keep]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vals = matrix.data[keep] / decay[cols - rows] / bias[rows] / bias[cols]
+    new_idx = np.cumsum(good) - 1
+    rows = new_idx[rows]
+    cols = new_idx[cols]
+    diag = rows == cols
+    matrix = csr_matrix((np.r_[vals, vals[~diag]],
+                         (np.r_[rows, cols[~diag]], np.r_[cols, rows[~diag]])),
+                        shape=(size, size))
+    # rows centered and scaled to unit norm, so that the Pearson correlation
+    # is their dot product
+    normed = np.empty((size, size))
+    for beg in range(0, size, _CORR_ROWS):
+        block = matrix[beg:beg + _CORR_ROWS].toarray()
+        block -= block.mean(axis=1)[:, None]
+        norm = np.sqrt((block**2).sum(axis=1))
+        norm[norm == 0] = np.inf  # no variance: correlation set to 0
+        normed[beg:beg + _CORR_ROWS] = block / norm[:, None]
+    peak = _nbytes(matrix, normed) + 2 * _nbytes(block)
+    del matrix
+    corr = np.empty((size, size))
+    for beg in range(0, size, _CORR_ROWS):
+        np.dot(normed[beg:beg + _CORR_ROWS], normed.T,
+               out=corr[beg:beg + _CORR_ROWS])
+    peak = max(peak, _nbytes(normed, corr))
+    del normed
+    np.clip(corr, -1, 1, out=corr)
+    corr[np.isnan(corr)] = 0.
+    if smoothing_window:
+        matrix = median_filter(corr, size=smoothing_window)
+    else:
+        matrix = corr
+    # get eigenvectors
+    try:
+        # This eighs is very very fast, only ask for max_ev eigenvectors
+        evals, evect = eigsh(matrix, k=max_ev if max_ev else (size - 1))
+    except (LinAlgError, ValueError):
+        evals = evect = None
+    if keep_matrix:
+        full = np.full((len(good), len(good)), np.nan)
+        full[np.ix_(idx, idx)] = matrix
+        matrix = full
+    else:
+        matrix = None
+    if not keep_corr:
+        corr = None
+    peak = max(peak, _nbytes(corr, matrix, evect) +
+               (_nbytes(corr) if smoothing_window else 0))
+    return corr, matrix, evals, evect, peak
 
 
 def _hmm_refine_compartments(xsec, models, bads, verbose):
@@ -1,11 +1,18 @@
 from __future__ import print_function
 from itertools                    import combinations
-from os                           import path, system
+from os                           import path, system, remove
+from heapq                        import merge
+from operator                     import itemgetter
+from shutil                       import copyfileobj
+from array                        import array
 from sys                          import stdout
 from collections                  import OrderedDict
 from multiprocessing              import cpu_count
 from distutils.version            import LooseVersion
 from subprocess                   import Popen, PIPE
+import multiprocessing as mu
+
+import numpy as np
 
 from pytadbit.utils.file_handling import mkdir, magic_open, which
 
@@ -127,7 +134,8 @@ def merge_bams(bam1, bam2, output_bam, cpus = cpu_count(), samtools = 'samtools'
         system(samtools  + ' index %s' % (output_bam))
 
 
-def get_intersection(fname1, fname2, out_path, verbose=False, compress=False):
+def get_intersection(fname1, fname2, out_path, verbose=False, compress=False,
+                     ncpus=1, buffer_size=1000000, max_open_files=128):
     """
     Merges the two files corresponding to each reads sides. Reads found in both
        files are merged and written in an output file.
@@ -150,6 +158,12 @@ def get_intersection(fname1, fname2, out_path, verbose=False, compress=False):
        the inputs
     :param False compress: compress (gzip) input files. This is done in the
        background while next input files are parsed.
+    :param 1 ncpus: number of CPUs to use. The genome is divided in as many
+       partitions, sorted and merged in parallel
+    :param 1000000 buffer_size: number of pairs of reads to keep in memory
+       before writing them, sorted, to temporary files
+    :param 128 max_open_files: maximum number of files opened at once when
+       merging the temporary files
 
     :returns: final number of pair of interacting fragments, and a dictionary with
        the number of multiple contacts (keys of the dictionary being the number of
@@ -177,9 +191,8 @@ def get_intersection(fname1, fname2, out_path, verbose=False, compress=False):
     if header1 != header2:
         raise Exception('seems to be mapped onover different chromosomes\n')
 
-    # prepare to write read pairs into different files
-    # depending on genomic position
-    nchunks = 1024
+    # prepare to write read pairs into different partitions of the genome,
+    # one per CPU
     global CHROM_START
     CHROM_START = {}
     cum_pos = 0
@@ -188,17 +201,18 @@ def get_intersection(fname1, fname2, out_path, verbose=False, compress=False):
             _, _, crm, pos = line.split()
             CHROM_START[crm] = cum_pos
             cum_pos += int(pos)
-    lchunk = cum_pos // nchunks
-    buf = dict([(i, []) for i in range(nchunks + 1)])
-    # prepare temporary directories
+    nparts = max(1, ncpus)
+    lchunk = cum_pos // nparts + 1
+    buf = [[] for _ in range(nparts)]
+    runs = [[] for _ in range(nparts)]
+    # prepare temporary directory
     tmp_dir = out_path + '_tmp_files'
     mkdir(tmp_dir)
-    for i in range(nchunks // int(nchunks**0.5) + 1):
-        mkdir(path.join(tmp_dir, 'rep_%03d' % i))
+    pool = mu.Pool(ncpus) if ncpus > 1 else None
+    pending = []
 
-    # iterate over reads in each of the two input files
-    # and store them into a dictionary and then into temporary files
-    # dicitonary ois emptied each 1 milion entries
+    # iterate over reads in each of the two input files, store them in memory
+    # and, each buffer_size pairs, spill them sorted into temporary files
     if verbose:
         print ('Getting intersection of reads 1 and reads 2:')
     count = 0
@@ -211,18 +225,19 @@ def get_intersection(fname1, fname2, out_path, verbose=False, compress=False):
                     stdout.write(' ')
                 if not count_dots % 50:
                     stdout.write('%s\n  ' % (
-                        ('  %4d milion reads' % (count_dots)) if
+                        ('  %12d pairs of reads' % (count)) if
                         count_dots else ''))
                 if count_dots >= 0:
                     stdout.write('.')
                     stdout.flush()
                 count_dots += 1
-            for _ in range(1000000): # iterate 1 million times, write to files
+            nbuf = 0
+            while nbuf < buffer_size:
                 # same read id in both lianes, we store put the more upstream
                 # before and store them
                 if eq_reads(read1, read2):
                     count += 1
-                    _process_lines(line1, line2, buf, multiples, lchunk)
+                    nbuf += _process_lines(line1, line2, buf, multiples, lchunk)
                     line1 = next(reads1)
                     read1 = line1.split('\t', 1)[0]
                     line2 = next(reads2)
@@ -234,11 +249,13 @@ def get_intersection(fname1, fname2, out_path, verbose=False, compress=False):
                 else:
                     line1 = next(reads1)
                     read1 = line1.split('\t', 1)[0]
-            write_to_files(buf, tmp_dir, nchunks)
+            _spill_runs(buf, runs, tmp_dir, pool, pending)
     except StopIteration:
         reads1.close()
         reads2.close()
-    write_to_files(buf, tmp_dir, nchunks)
+    _spill_runs(buf, runs, tmp_dir, pool, pending)
+    for proc in pending:
+        proc.get()
     if verbose:
         print('\nFound %d pair of reads mapping uniquely' % count)
 
@@ -247,24 +264,30 @@ def get_intersection(fname1, fname2, out_path, verbose=False, compress=False):
         if verbose:
             print('compressing input files')
         procs = [Popen(['gzip', f]) for f in (fname1, fname2)]
-    # sort each tmp file according to first element (idx) and write them
-    # to output file (without the idx)
-    # sort also according to read 2 (to filter duplicates)
-    #      and also according to strand
+    # merge the sorted temporary files of each partition of the genome, sorted
+    # by the genomic coordinate of read 1 and then of read 2 (to filter
+    # duplicates)
     if verbose:
-        print('Sorting each temporary file by genomic coordinate')
+        print('Merging sorted temporary files by genomic coordinate')
+    parts = [path.join(tmp_dir, 'part_%03d.tsv' % i) for i in range(nparts)]
+    args = [(part_runs, part, max_open_files)
+            for part_runs, part in zip(runs, parts)]
+    if pool:
+        procs_merge = [pool.apply_async(_merge_partition, args=arg)
+                       for arg in args]
+        pool.close()
+        pool.join()
+        for proc in procs_merge:
+            proc.get()
+    else:
+        for arg in args:
+            _merge_partition(*arg)
 
     out = open(out_path, 'w')
     out.write(header1)
-    for b in buf:
-        if verbose:
-            stdout.write('\r    %4d/%d sorted files' % (b + 1, len(buf)))
-            stdout.flush()
-        with open(path.join(tmp_dir, 'rep_%03d' % (b // int(nchunks**0.5)),
-                            'tmp_%05d.tsv' % b)) as f_tmp:
-            out.write(''.join(['\t'.join(l[1:]) for l in sorted(
-                [l.split('\t') for l in f_tmp],
-                key=lambda x: (x[0], x[8], x[9], x[6]))]))
+    for part in parts:
+        with open(part) as f_part:
+            copyfileobj(f_part, out)
     out.close()
 
     if compress:
@@ -280,25 +303,112 @@ def get_intersection(fname1, fname2, out_path, verbose=False, compress=False):
 
 def _loc_reads(r1, r2):
     """
-    Put upstream read before, get position in buf
+    Put upstream read before, get position in the genome of both
     """
     pos1 = CHROM_START[r1[1]] + int(r1[2])
     pos2 = CHROM_START[r2[1]] + int(r2[2])
     if pos1 > pos2:
         r1, r2 = r2, r1
         pos1, pos2 = pos2, pos1
-    return r1, r2, pos1
+    return r1, r2, pos1, pos2
+
+
+def _spill_runs(buf, runs, tmp_dir, pool, pending):
+    """
+    Write the pairs of reads of each partition as a sorted temporary file,
+    (in a worker process if pool) and empty the buffers.
+    """
+    for part, records in enumerate(buf):
+        if not records:
+            continue
+        fname = path.join(tmp_dir, 'run_%03d_%06d' % (part, len(runs[part])))
+        runs[part].append(fname)
+        if pool:
+            pending.append(pool.apply_async(_write_run, args=(records, fname)))
+        else:
+            _write_run(records, fname)
+        buf[part] = []
+    # do not keep in memory more buffers than workers
+    while len(pending) > len(buf):
+        pending.pop(0).get()
+
+
+def _write_run(records, fname):
+    """
+    Sort pairs of reads by genomic coordinates of read 1 and read 2 (keeping
+    the input order otherwise) and write their lines to fname, and their
+    coordinates to fname + '.npy'
+    """
+    nrecs = len(records)
+    pos1 = np.fromiter((r[0] for r in records), dtype=np.int64, count=nrecs)
+    pos2 = np.fromiter((r[1] for r in records), dtype=np.int64, count=nrecs)
+    order = np.lexsort((pos2, pos1))
+    with open(fname, 'w') as out:
+        out.writelines(records[i][2] for i in order.tolist())
+    np.save(fname + '.npy', np.column_stack((pos1[order], pos2[order])))
+
 
+def _iter_run(fname, block=100000):
+    """
+    Iterate over the pairs of reads of a sorted temporary file
+
+    :yields: genomic coordinate of read 1, of read 2, and line
+    """
+    coords = np.load(fname + '.npy', mmap_mode='r')
+    with open(fname) as fhandler:
+        for beg in range(0, len(coords), block):
+            for (pos1, pos2), line in zip(coords[beg:beg + block].tolist(),
+                                          fhandler):
+                yield pos1, pos2, line
+    del coords
+
+
+def _write_merged(fnames, outfile, coords=False):
+    """
+    Heap-merge sorted temporary files (removed afterwards) into outfile.
+
+    :param False coords: also write the genomic coordinates (outfile + '.npy')
+       so that outfile can be merged again
+    """
+    merged = merge(*[_iter_run(fname) for fname in fnames],
+                   key=itemgetter(0, 1))
+    pos1s = array('q')
+    pos2s = array('q')
+    with open(outfile, 'w') as out:
+        if coords:
+            for pos1, pos2, line in merged:
+                pos1s.append(pos1)
+                pos2s.append(pos2)
+                out.write(line)
+        else:
+            out.writelines(line for _, _, line in merged)
+    if coords:
+        np.save(outfile + '.npy', np.column_stack((
+            np.frombuffer(pos1s, dtype=np.int64) if pos1s else [],
+            np.frombuffer(pos2s, dtype=np.int64) if pos2s else [])).astype(
+                np.int64))
+    for fname in fnames:
+        remove(fname)
+        remove(fname + '.npy')
 
-def write_to_files(buf, tmp_dir, nchunks):
-    for b in buf:
-        out = open(path.join(tmp_dir, 'rep_%03d' % (b // int(nchunks**0.5)),
-                             'tmp_%05d.tsv' % b), 'a')
-        out.write('\n'.join(buf[b]))
-        if buf[b]: # case the file was empty
-            out.write('\n')
-        out.close()
-        del(buf[b][:])
+
+def _merge_partition(fnames, outfile, max_open_files):
+    """
+    Merge the sorted temporary files of a partition of the genome, in several
+    rounds if they are more than allowed to be opened at once (each temporary
+    file uses 2).
+    """
+    fan_in = max(2, (max_open_files - 1) // 2)
+    level = 0
+    while len(fnames) > fan_in:
+        merged = []
+        for i in range(0, len(fnames), fan_in):
+            fname = '%s_%d_%06d' % (outfile, level, i // fan_in)
+            _write_merged(fnames[i:i + fan_in], fname, coords=True)
+            merged.append(fname)
+        fnames = merged
+        level += 1
+    _write_merged(fnames, outfile)
 
 
 def _process_lines(line1, line2, buf, multiples, lchunk):
@@ -355,16 +465,22 @@ def _process_lines(line1, line2, buf, multiples, lchunk):
             multiples[contacts] += 1
             prod_cont = contacts * (contacts + 1) // 2
             for i, (r1, r2) in enumerate(combinations(list(elts.values()), 2)):
-                r1, r2, idx = _loc_reads(r1, r2)
-                buf[idx // lchunk].append('%d\t%s#%d/%d\t%s\t%s' % (
-                    idx, r1[0], i + 1, prod_cont, '\t'.join(r1[1:]),
+                r1, r2, pos1, pos2 = _loc_reads(r1, r2)
+                _to_buffer(buf, lchunk, pos1, pos2, '%s#%d/%d\t%s\t%s\n' % (
+                    r1[0], i + 1, prod_cont, '\t'.join(r1[1:]),
                     '\t'.join(r2[1:])))
+            return prod_cont
         elif contacts == 1:
-            r1, r2, idx = _loc_reads(list(elts.values())[0], list(elts.values())[1])
-            buf[idx // lchunk].append('%d\t%s\t%s' % (idx, '\t'.join(r1), '\t'.join(r2[1:])))
+            r1, r2, pos1, pos2 = _loc_reads(list(elts.values())[0], list(elts.values())[1])
+            _to_buffer(buf, lchunk, pos1, pos2, '%s\t%s\n' % ('\t'.join(r1), '\t'.join(r2[1:])))
         else:
-            r1, r2, idx = _loc_reads(list(elts1.values())[0], list(elts2.values())[0])
-            buf[idx // lchunk].append('%d\t%s\t%s' % (idx, '\t'.join(r1), '\t'.join(r2[1:])))
+            r1, r2, pos1, pos2 = _loc_reads(list(elts1.values())[0], list(elts2.values())[0])
+            _to_buffer(buf, lchunk, pos1, pos2, '%s\t%s\n' % ('\t'.join(r1), '\t'.join(r2[1:])))
     else:
-        r1, r2, idx = _loc_reads(line1.strip().split('\t'), line2.strip().split('\t'))
-        buf[idx // lchunk].append('%d\t%s\t%s' % (idx, '\t'.join(r1), '\t'.join(r2[1:])))
+        r1, r2, pos1, pos2 = _loc_reads(line1.strip().split('\t'), line2.strip().split('\t'))
+        _to_buffer(buf, lchunk, pos1, pos2, '%s\t%s\n' % ('\t'.join(r1), '\t'.join(r2[1:])))
+    return 1
+
+
+def _to_buffer(buf, lchunk, pos1, pos2, line):
+    buf[min(pos1 // lchunk, len(buf) - 1)].append((pos1, pos2, line))
@@ -10,6 +10,7 @@ from pysam                        import AlignmentFile
 from scipy.stats                  import norm as sc_norm, skew, kurtosis
 from scipy.stats                  import pearsonr, spearmanr, linregress
 from scipy.sparse.linalg          import eigsh
+from scipy.sparse                 import diags, identity
 from numpy.linalg                 import eigh
 import numpy as np
 
@@ -909,8 +910,135 @@ def plot_genomic_distribution(fnam, first_read=None, resolution=10000,
         out.close()
 
 
-def _unitize(vals):
-    return np.argsort(vals) / float(len(vals))
+def _scc_weights(counts):
+    """
+    Weight of each distance in the SCC: the product of the standard deviations
+    of the values of both diagonals, converted to uniform ranks, times their
+    length. As ranks are a permutation of 0..n-1, this only depends on the
+    number n of values, as (n + 1) / 12 (NaN for less than 2 values).
+    """
+    counts = np.asarray(counts, dtype=float)
+    with np.errstate(invalid='ignore'):
+        return np.where(counts > 1, (counts + 1) / 12., np.nan)
+
+
+def _group_starts(counts):
+    return np.r_[0, np.cumsum(counts)[:-1]].astype(int)
+
+
+def _pearson_by_group(x, y, counts):
+    """
+    Pearson correlation coefficient between x and y, in groups of consecutive
+    values, as returned by scipy.stats.pearsonr (NaN for groups with less than
+    2 values or with constant values).
+
+    :param x: array of values
+    :param y: array of values
+    :param counts: number of values in each group
+
+    :returns: an array with one coefficient per group
+    """
+    counts = np.asarray(counts, dtype=int)
+    ngroups = len(counts)
+    groups = np.repeat(np.arange(ngroups), counts)
+    num = counts.astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dx = x - (np.bincount(groups, x, ngroups) / num)[groups]
+        dy = y - (np.bincount(groups, y, ngroups) / num)[groups]
+        corr = (np.bincount(groups, dx * dy, ngroups) /
+                np.sqrt(np.bincount(groups, dx * dx, ngroups) *
+                        np.bincount(groups, dy * dy, ngroups)))
+    corr = np.clip(corr, -1, 1)
+    corr[counts < 2] = np.nan
+    full = np.flatnonzero(counts > 0)
+    if len(full):
+        starts = _group_starts(counts)[full]
+        const = ((np.minimum.reduceat(x, starts) == np.maximum.reduceat(x, starts)) |
+                 (np.minimum.reduceat(y, starts) == np.maximum.reduceat(y, starts)))
+        corr[full[const]] = np.nan
+    # two values are perfectly correlated, or anti-correlated
+    pair = np.flatnonzero(counts == 2)
+    pair = pair[~np.isnan(corr[pair])]
+    starts = _group_starts(counts)[pair]
+    corr[pair] = (np.sign(x[starts + 1] - x[starts]) *
+                  np.sign(y[starts + 1] - y[starts]))
+    return corr
+
+
+def _rank_by_group(vals, counts):
+    """
+    Rank values in groups of consecutive values (ties get the average of their
+    ranks, as in scipy.stats.rankdata).
+    """
+    groups = np.repeat(np.arange(len(counts)), counts)
+    order = np.lexsort((vals, groups))
+    svals = vals[order]
+    sgroups = groups[order]
+    new = np.r_[True, (sgroups[1:] != sgroups[:-1]) | (svals[1:] != svals[:-1])]
+    run_beg = np.flatnonzero(new)
+    run_end = np.r_[run_beg[1:], len(vals)]
+    ranks = np.empty(len(vals))
+    ranks[order] = (((run_beg + run_end - 1) / 2.)[np.cumsum(new) - 1] -
+                    _group_starts(counts)[sgroups] + 1)
+    return ranks
+
+
+def _spearman_by_group(x, y, counts):
+    """
+    Spearman rank correlation coefficient between x and y, in groups of
+    consecutive values.
+    """
+    return _pearson_by_group(_rank_by_group(x, counts),
+                             _rank_by_group(y, counts), counts)
+
+
+def _get_diagonals(hic_data1, hic_data2, dists, normalized, bads, intra):
+    """
+    Extract the diagonals of two Hi-C matrices, in a single pass over their
+    non-zero cells.
+
+    :param dists: list of consecutive distances to the diagonal
+    :param normalized: divide values by the biases of their columns
+    :param bads: columns to skip
+    :param intra: only keep cells from the same chromosome
+
+    :returns: two arrays with the values of the first and second matrix, one
+       diagonal after the other, and the number of values in each diagonal
+    """
+    size = len(hic_data1)
+    good = np.ones(size, dtype=bool)
+    good[[b for b in bads if b < size]] = False
+    if intra:
+        crms = np.full(size, -1)
+        for num, crm in enumerate(hic_data1.section_pos):
+            crms[slice(*hic_data1.section_pos[crm])] = num
+    bands = []
+    for hic_data in (hic_data1, hic_data2):
+        rows, cols, vals = hic_data.get_hic_data_as_arrays()
+        keep = (cols - rows >= dists[0]) & (cols - rows <= dists[-1])
+        rows = rows[keep]
+        cols = cols[keep]
+        vals = vals[keep].astype(float)
+        if normalized:
+            bias = np.full(size, np.nan)
+            bias[list(hic_data.bias.keys())] = list(hic_data.bias.values())
+            vals = vals / bias[cols] / bias[rows]
+        band = np.zeros((len(dists), size))
+        band[cols - rows - dists[0], rows] = vals
+        bands.append(band)
+    diags1 = []
+    diags2 = []
+    counts = []
+    for num, dist in enumerate(dists):
+        pos = np.arange(max(0, size - dist))
+        keep = good[pos] & good[pos + dist]
+        if intra:
+            keep &= (crms[pos] == crms[pos + dist]) & (crms[pos] >= 0)
+        pos = pos[keep]
+        diags1.append(bands[0][num, pos])
+        diags2.append(bands[1][num, pos])
+        counts.append(len(pos))
+    return np.concatenate(diags1), np.concatenate(diags2), counts
 
 
 def correlate_matrices(hic_data1, hic_data2, max_dist=10, intra=False, axe=None,
@@ -943,65 +1071,30 @@ def correlate_matrices(hic_data1, hic_data2, max_dist=10, intra=False, axe=None,
     :returns: list of correlations, list of genomic distances, SCC and standard
        deviation of SCC
     """
-    spearmans = []
-    pearsons = []
-    dists = []
-    weigs = []
-
-    if normalized:
-        get_the_guy1 = lambda i, j: (hic_data1[j, i] / hic_data1.bias[i] /
-                                     hic_data1.bias[j])
-        get_the_guy2 = lambda i, j: (hic_data2[j, i] / hic_data2.bias[i] /
-                                     hic_data2.bias[j])
-    else:
-        get_the_guy1 = lambda i, j: hic_data1[j, i]
-        get_the_guy2 = lambda i, j: hic_data2[j, i]
-
     if remove_bad_columns:
         # union of bad columns
         bads = hic_data1.bads.copy()
         bads.update(hic_data2.bads)
+    else:
+        bads = {}
 
     if (intra and hic_data1.sections and hic_data2.sections and
         hic_data1.sections == hic_data2.sections):
-        for dist in range(1, max_dist + 1):
-            diag1 = []
-            diag2 = []
-            for crm in hic_data1.section_pos:
-                for j in range(hic_data1.section_pos[crm][0],
-                                hic_data1.section_pos[crm][1] - dist):
-                    i = j + dist
-                    if j in bads or i in bads:
-                        continue
-                    diag1.append(get_the_guy1(i, j))
-                    diag2.append(get_the_guy2(i, j))
-            spearmans.append(spearmanr(diag1, diag2)[0])
-            pearsons.append(spearmanr(diag1, diag2)[0])
-            r1 = _unitize(diag1)
-            r2 = _unitize(diag2)
-            weigs.append((np.var(r1, ddof=1) *
-                          np.var(r2, ddof=1))**0.5 * len(diag1))
-            dists.append(dist)
+        dists = list(range(1, max_dist + 1))
     else:
         if intra:
             warn('WARNING: hic_dta does not contain chromosome coordinates, ' +
                  'intra set to False')
-        for dist in range(min_dist, max_dist + min_dist):
-            diag1 = []
-            diag2 = []
-            for j in range(len(hic_data1) - dist):
-                i = j + dist
-                if j in bads or i in bads:
-                    continue
-                diag1.append(get_the_guy1(i, j))
-                diag2.append(get_the_guy2(i, j))
-            spearmans.append(spearmanr(diag1, diag2)[0])
-            pearsons.append(pearsonr(diag1, diag2)[0])
-            r1 = _unitize(diag1)
-            r2 = _unitize(diag2)
-            weigs.append((np.var(r1, ddof=1) *
-                          np.var(r2, ddof=1))**0.5 * len(diag1))
-            dists.append(dist)
+            intra = False
+        dists = list(range(min_dist, max_dist + min_dist))
+    diag1, diag2, counts = _get_diagonals(hic_data1, hic_data2, dists,
+                                          normalized, bads, intra)
+    spearmans = _spearman_by_group(diag1, diag2, counts).tolist()
+    if intra:
+        pearsons = spearmans
+    else:
+        pearsons = _pearson_by_group(diag1, diag2, counts).tolist()
+    weigs = _scc_weights(counts).tolist()
     # compute scc
     # print pearsons
     # print weigs
@@ -1045,25 +1138,25 @@ def scc(mat1, mat2, max_dist=50, min_dist=2):
     dists = []
     weigs=[]
 
-    for dist in range(min_dist, max_dist + min_dist):
-        diag1 = []
-        diag2 = []
-        for j in range(len(mat1) - dist):
-            i = j + dist
-            if np.isnan(mat1[i][j]) or np.isnan(mat1[i][j]):
-                continue
-            diag1.append(mat1[i][j])
-            diag2.append(mat2[i][j])
-        if len(diag1) > 1:
-            with catch_warnings():
-                simplefilter("ignore")
-                p_corr = pearsonr(diag1, diag2)[0]
+    mat1 = np.asarray(mat1, dtype=float)
+    mat2 = np.asarray(mat2, dtype=float)
+    dist_list = list(range(min_dist, max_dist + min_dist))
+    diags1 = []
+    diags2 = []
+    for dist in dist_list:
+        diag1 = np.diagonal(mat1, -dist)
+        keep = ~np.isnan(diag1)
+        diags1.append(diag1[keep])
+        diags2.append(np.diagonal(mat2, -dist)[keep])
+    counts = [len(d) for d in diags1]
+    p_corrs = _pearson_by_group(np.concatenate(diags1), np.concatenate(diags2),
+                                counts)
+    for dist, p_corr, weig, count in zip(dist_list, p_corrs,
+                                         _scc_weights(counts), counts):
+        if count > 1:
             if not np.isnan(p_corr):
                 pearsons.append(p_corr)
-                r1 = _unitize(diag1)
-                r2 = _unitize(diag2)
-                weigs.append((np.var(r1, ddof=1) *
-                              np.var(r2, ddof=1))**0.5 * len(diag1))
+                weigs.append(weig)
                 dists.append(dist)
             else:
                 return 0, 0
@@ -1089,17 +1182,33 @@ def _evec_dist(v1,v2):
 
 
 def _get_Laplacian(M):
-    S=M.sum(1)
+    """
+    Normalized Laplacian (as a scipy sparse matrix) of the rows and columns of
+    M with interactions.
+    """
+    S=np.asarray(M.sum(1)).ravel()
     i_nz=np.where(S>0)[0]
     S=S[i_nz]
-    M=(M[i_nz].T)[i_nz].T
-    S=1/np.sqrt(S)
-    M=S*M
-    M=(S*M.T).T
+    M=M[i_nz][:,i_nz]
     n=np.size(S)
-    M=np.identity(n)-M
+    S=diags(1/np.sqrt(S))
+    M=S.dot(M).dot(S)
+    M=identity(n)-M
     M=(M+M.T)/2
-    return M
+    return M.tocsr()
+
+
+def _smallest_eigenvectors(L, k):
+    """
+    Eigenvectors of the k smallest eigenvalues of a normalized Laplacian,
+    sorted by increasing eigenvalue.
+
+    Computed as the largest eigenvalues of 2*I - L (the spectrum of L is in
+    [0, 2]), for which Lanczos converges much faster than for the smallest
+    ones.
+    """
+    a, b = eigsh(identity(L.shape[0]) * 2 - L, k=k, which="LA")
+    return 2 - a[::-1], b[:, ::-1]
 
 
 def get_ipr(evec):
@@ -1119,50 +1228,42 @@ def get_reproducibility(hic_data1, hic_data2, num_evec, verbose=True,
 
     :returns: reproducibility score (bellow 0.5 ~ different cell types)
     """
-    M1 = hic_data1.get_matrix(normalized=normalized)
-    M2 = hic_data2.get_matrix(normalized=normalized)
+    M1 = hic_data1.get_matrix(normalized=normalized, sparse=True)
+    M2 = hic_data2.get_matrix(normalized=normalized, sparse=True)
 
     if remove_bad_columns:
         # union of bad columns
         bads = hic_data1.bads.copy()
         bads.update(hic_data2.bads)
         # remove them form both matrices
-        for bad in sorted(bads, reverse=True):
-            del(M1[bad])
-            del(M2[bad])
-            for i in range(len(M1)):
-                _ = M1[i].pop(bad)
-                _ = M2[i].pop(bad)
+        keep = np.ones(M1.shape[0], dtype=bool)
+        keep[[b for b in bads if b < M1.shape[0]]] = False
+        M1 = M1[keep][:,keep]
+        M2 = M2[keep][:,keep]
 
-    M1 = np.matrix(M1)
-    M2 = np.matrix(M2)
-
-    k1=np.sign(M1.A).sum(1)
-    d1=np.diag(M1.A)
+    k1=np.asarray(M1.sign().sum(1)).ravel()
+    d1=M1.diagonal()
     kd1=~((k1==1)*(d1>0))
-    k2=np.sign(M2.A).sum(1)
-    d2=np.diag(M2.A)
+    k2=np.asarray(M2.sign().sum(1)).ravel()
+    d2=M2.diagonal()
     kd2=~((k2==1)*(d2>0))
     iz=np.nonzero((k1+k2>0)*(kd1>0)*(kd2>0))[0]
-    M1b=(M1[iz].A.T)[iz].T
-    M2b=(M2[iz].A.T)[iz].T
+    M1b=M1[iz][:,iz]
+    M2b=M2[iz][:,iz]
 
-    i_nz1=np.where(M1b.sum(1)>0)[0]
-    i_nz2=np.where(M2b.sum(1)>0)[0]
-    i_z1=np.where(M1b.sum(1)==0)[0]
-    i_z2=np.where(M2b.sum(1)==0)[0]
+    i_nz1=np.where(np.asarray(M1b.sum(1)).ravel()>0)[0]
+    i_nz2=np.where(np.asarray(M2b.sum(1)).ravel()>0)[0]
 
     M1b_L=_get_Laplacian(M1b)
     M2b_L=_get_Laplacian(M2b)
 
-    a1, b1=eigsh(M1b_L,k=num_evec,which="SM")
-    a2, b2=eigsh(M2b_L,k=num_evec,which="SM")
+    a1, b1=_smallest_eigenvectors(M1b_L,num_evec)
+    a2, b2=_smallest_eigenvectors(M2b_L,num_evec)
 
-    b1_extend=np.zeros((np.size(M1b,0),num_evec))
-    b2_extend=np.zeros((np.size(M2b,0),num_evec))
-    for i in range(num_evec):
-        b1_extend[i_nz1,i]=b1[:,i]
-        b2_extend[i_nz2,i]=b2[:,i]
+    b1_extend=np.zeros((M1b.shape[0],num_evec))
+    b2_extend=np.zeros((M2b.shape[0],num_evec))
+    b1_extend[i_nz1]=b1
+    b2_extend[i_nz2]=b2
 
     ipr_cut=5
     ipr1=np.zeros(num_evec)
@@ -1188,7 +1289,7 @@ def get_reproducibility(hic_data1, hic_data2, num_evec, verbose=True,
         if (np.sum(ipr1>N/100)<=1)|(np.sum(ipr2>N/100)<=1):
             print("at least one of the maps does not look like typical Hi-C maps")
         else:
-            print("size of maps: %d" %(np.size(M1,0)))
+            print("size of maps: %d" %(M1.shape[0]))
             print("reproducibility score: %6.3f " %(evs))
             print("num_evec_eff: %d" %(num_evec_eff))
 
@@ -5,9 +5,12 @@
 """
 from __future__ import print_function
 from builtins   import next
+from array      import array
+from shutil     import copyfileobj
+import os
 import multiprocessing as mu
 
-from pytadbit.mapping.restriction_enzymes import count_re_fragments
+import numpy as np
 
 
 MASKED = {1 : {'name': 'self-circle'       , 'reads': 0},
@@ -22,6 +25,13 @@ MASKED = {1 : {'name': 'self-circle'       , 'reads': 0},
           10: {'name': 'random breaks'     , 'reads': 0},
           11: {'name': 'trans-chromosomic' , 'reads': 0}}
 
+# bit of each filter in the bitmask, same as in the FLAG of TADbit BAMs
+_FLAG = dict((k, 1 << (k - 1)) for k in MASKED)
+
+_SHARD_DTYPE = np.dtype([('mask', np.uint16), ('offset', np.int64),
+                         ('frag1', np.int32), ('frag2', np.int32)])
+
+
 
 def apply_filter(fnam, outfile, masked, filters=None, reverse=False,
                  verbose=True):
@@ -41,6 +51,17 @@ def apply_filter(fnam, outfile, masked, filters=None, reverse=False,
     :returns: number of reads kept
     """
     filters = filters or list(masked.keys())
+    # filters not computed (e.g. trans-chromosomic) have nothing to remove
+    filters = [k for k in filters if 'mask' in masked[k] or 'fnam' in masked[k]]
+    mask_fnams = set(masked[k].get('mask') for k in filters)
+    if len(mask_fnams) == 1 and None not in mask_fnams:
+        count = _apply_filter_mask(fnam, outfile, mask_fnams.pop(),
+                                   sum(_FLAG[k] for k in filters), reverse)
+        if verbose:
+            print('    saving to file {:,} {} reads.'.format(
+                count, 'filtered' if reverse else 'valid'))
+        return count
+
     filter_handlers = {}
     for k in filters:
         try:
@@ -107,11 +128,68 @@ def apply_filter(fnam, outfile, masked, filters=None, reverse=False,
     return count
 
 
+def load_filter_mask(fnam, mask_fnam=None):
+    """
+    Load the bitmask of the filters applied to a file of pairs of reads, as
+    generated by :func:`pytadbit.mapping.filter.filter_reads`.
+
+    :param fnam: path to the file of pairs of reads that was filtered
+    :param None mask_fnam: path to the bitmask file. Uses fnam + '_filters.npy'
+       by default
+
+    :returns: the bitmask (one uint16 per pair of reads, in the order of the
+       file, with the bit k-1 set if the pair was caught by filter k), and
+       the read-ID index (the byte offset in fnam of each pair of reads, plus
+       the size of fnam)
+    """
+    mask_fnam = mask_fnam or fnam + '_filters.npy'
+    mask  = np.load(mask_fnam, mmap_mode='r')
+    index = np.load(_index_fname(mask_fnam), mmap_mode='r')
+    if len(index) != len(mask) + 1 or index[-1] != os.path.getsize(fnam):
+        raise Exception('ERROR: filter mask %s does not correspond to %s\n' % (
+            mask_fnam, fnam))
+    return mask, index
+
+
+def _index_fname(mask_fnam):
+    return mask_fnam[:-len('.npy')] + '_index.npy'
+
+
+def _apply_filter_mask(fnam, outfile, mask_fnam, bits, reverse, chunk=1000000):
+    """
+    Copy to outfile the lines of fnam with (or without if not reverse) any of
+    the bits of the mask set, copying directly the runs of consecutive lines.
+
+    :returns: number of reads kept
+    """
+    mask, index = load_filter_mask(fnam, mask_fnam)
+    fhandler = open(fnam, 'rb')
+    out = open(outfile, 'wb')
+    out.write(fhandler.read(index[0]))  # header
+    count = 0
+    for beg in range(0, len(mask), chunk):
+        keep = (mask[beg:beg + chunk] & bits) != 0
+        if not reverse:
+            keep = ~keep
+        count += int(np.count_nonzero(keep))
+        # limits of the runs of lines to keep
+        edges = np.flatnonzero(np.diff(np.r_[0, keep.view(np.int8), 0])) + beg
+        for start, end in zip(index[edges[::2]], index[edges[1::2]]):
+            fhandler.seek(start)
+            while start < end:
+                size = min(end - start, 1 << 26)
+                out.write(fhandler.read(size))
+                start += size
+    out.close()
+    fhandler.close()
+    return count
+
+
 def filter_reads(fnam, output=None, max_molecule_length=500,
                  over_represented=0.005, max_frag_size=100000,
                  min_frag_size=100, re_proximity=5, verbose=True,
                  savedata=None, min_dist_to_re=750, strict_duplicates=False,
-                 fast=True):
+                 fast=True, ncpus=4, text_output=True):
     """
     Filter mapped pair of reads in order to remove experimental artifacts (e.g.
     dangling-ends, self-circle, PCR artifacts...)
@@ -145,7 +223,9 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
 
     :param fnam: path to file containing the pair of reads in tsv format, file
        generated by :func:`pytadbit.mapping.mapper.get_intersection`
-    :param None output: PATH where to write files containing IDs of filtered
+    :param None output: PATH where to write the bitmask of the filtered reads
+       (output + '_filters.npy', with its read-ID index in
+       output + '_filters_index.npy') and the files containing IDs of filtered
        reads. Uses fnam by default.
     :param 500 max_molecule_length: facing reads that are within
        max_molecule_length, will be classified as 'extra dangling-ends'
@@ -161,14 +241,21 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
        from a RE site (usually 1.5 times the insert size). Applied in filter 10
     :param None savedata: PATH where to write the number of reads retained by
        each filter
-    :param True fast: parallel version, requires 4 CPUs and more RAM memory
+    :param True fast: parallel version, the file is cut into ncpus pieces
+       filtered at the same time
+    :param 4 ncpus: number of CPUs to use in the parallel version
     :param False strict_duplicates: by default reads are considered duplicates if
        they coincide in genomic coordinates and strand; with strict_duplicates
        enabled, we also ask to consider read length (WARNING: this option is
        called strict, but it is more permissive).
+    :param True text_output: also write, for each filter, a file with the IDs
+       of the filtered reads (output + '_' + name of the filter + '.tsv'). If
+       False only the bitmask is written (see
+       :func:`pytadbit.mapping.filter.load_filter_mask` to read it)
 
     :return: dictionary with, as keys, the kind of filter applied, and as values
-       a set of read IDs to be removed
+       the number of reads filtered and the path to the bitmask (and to the
+       file of read IDs if text_output)
 
     *Note: Filtering is not exclusive, one read can be filtered several times.*
     """
@@ -176,44 +263,11 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
     if not output:
         output = fnam
 
-    if strict_duplicates:
-        _filter_duplicates = _filter_duplicates_strict
-    else:
-        _filter_duplicates = _filter_duplicates_loose
-
-    if not fast: # mainly for debugging
-        if verbose:
-            print('filtering duplicates')
-        sub_mask, total = _filter_duplicates(fnam, output)
-        MASKED.update(sub_mask)
-        if verbose:
-            print('filtering same fragments')
-        MASKED.update(_filter_same_frag(fnam, max_molecule_length, output))
-        if verbose:
-            print('filtering fro RE')
-        MASKED.update(_filter_from_res(fnam, max_frag_size, min_dist_to_re,
-                                       re_proximity, min_frag_size, output))
-        if verbose:
-            print('filtering over represented')
-        MASKED.update(_filter_over_represented(fnam, over_represented, output))
-    else:
-        pool = mu.Pool(4)
-        a = pool.apply_async(_filter_same_frag,
-                             args=(fnam, max_molecule_length, output))
-        b = pool.apply_async(_filter_from_res,
-                             args=(fnam, max_frag_size, min_dist_to_re,
-                                   re_proximity, min_frag_size, output))
-        c = pool.apply_async(_filter_over_represented,
-                             args=(fnam, over_represented, output))
-        d = pool.apply_async(_filter_duplicates,
-                             args=(fnam, output))
-        pool.close()
-        pool.join()
-        sub_mask, total = d.get()
-        MASKED.update(sub_mask)
-        MASKED.update(b.get())
-        MASKED.update(c.get())
-        MASKED.update(a.get())
+    sub_mask, total, _ = _filter_all(
+        fnam, output, max_molecule_length, over_represented, max_frag_size,
+        min_frag_size, re_proximity, min_dist_to_re, strict_duplicates,
+        nshards=ncpus if fast else 1, text_output=text_output)
+    MASKED.update(sub_mask)
 
     # if savedata or verbose:
     #     bads = len(frozenset().union(*[masked[k]['reads'] for k in masked]))
@@ -235,215 +289,291 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
     return MASKED
 
 
-def _filter_same_frag(fnam, max_molecule_length, output):
-    # t0 = time()
-    masked = {1 : {'name': 'self-circle'       , 'reads': 0},
-              2 : {'name': 'dangling-end'      , 'reads': 0},
-              3 : {'name': 'error'             , 'reads': 0},
-              4 : {'name': 'extra dangling-end', 'reads': 0}}
-    outfil = {}
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k] = open(masked[k]['fnam'], 'w')
-    fhandler = open(fnam)
-    line = next(fhandler)
-    while line.startswith('#'):
-        line = next(fhandler)
-    try:
-        while True:
-            (read,
-             cr1, pos1, sd1, _, _, re1,
-             cr2, pos2, sd2, _, _, re2) = line.split('\t')
-            ps1, ps2, sd1, sd2 = list(map(int, (pos1, pos2, sd1, sd2)))
-            if cr1 == cr2:
-                if re1 == re2.rstrip():
-                    if sd1 != sd2:
-                        if (ps2 > ps1) == sd2:
-                            # ----<===---===>---                   self-circles
-                            masked[1]["reads"] += 1
-                            outfil[1].write(read + '\n')
-                        else:
-                            # ----===>---<===---                   dangling-ends
-                            masked[2]["reads"] += 1
-                            outfil[2].write(read + '\n')
-                    else:
-                        # --===>--===>-- or --<===--<===-- or same errors
-                        masked[3]["reads"] += 1
-                        outfil[3].write(read + '\n')
-                elif (abs(ps1 - ps2) < max_molecule_length
-                      and sd2 != sd1
-                      and (ps2 > ps1) != sd2):
-                    # different fragments but facing and very close
-                    masked[4]["reads"] += 1
-                    outfil[4].write(read + '\n')
-            line = next(fhandler)
-    except StopIteration:
-        pass
-    fhandler.close()
-    # print 'done 1', time() - t0
+def _filter_all(fnam, output, max_molecule_length, over_represented,
+                max_frag_size, min_frag_size, re_proximity, min_dist_to_re,
+                strict_duplicates, nshards=1, text_output=False):
+    """
+    Evaluate all filters in a single pass over the file of pairs of reads,
+    cut in shards of lines processed in parallel.
+
+    :returns: the dictionary of filters, with the number of reads, the path
+       to the bitmask and, if text_output, the path to the file of read IDs of
+       each one, the total number of pairs of reads, and the path to the
+       bitmask file
+    """
+    masked = dict((k, {'name': MASKED[k]['name'], 'reads': 0})
+                  for k in range(1, 11))
+    shards = _shard_offsets(fnam, nshards)
+    params = (max_molecule_length, max_frag_size, min_frag_size, re_proximity,
+              min_dist_to_re, strict_duplicates)
+    args = [(fnam, beg, end, '%s_shard%d_filters.npz' % (output, i)) + params +
+            (('%s_shard%d' % (output, i)) if text_output else None, )
+            for i, (beg, end) in enumerate(zip(shards[:-1], shards[1:]))]
+    if len(args) > 1:
+        pool = mu.Pool(len(args))
+        procs = [pool.apply_async(_filter_shard, args=arg) for arg in args]
+        pool.close()
+        results = (proc.get() for proc in procs)
+    else:
+        pool = None
+        results = (_filter_shard(*arg) for arg in args)
+
+    # reduce the results of each shard as they arrive: only the fragment
+    # counts and the duplicate keys at the borders of the shards are kept
+    frag_count = {}
+    tmpfiles = []
+    sizes = []
+    border_dups = []
+    prev_last = None
+    for tmpfile, first, last, nlines in results:
+        with np.load(tmpfile) as shard:
+            for frag, count in zip(zip(shard['crms'].tolist(),
+                                       shard['starts'].tolist()),
+                                   shard['counts'].tolist()):
+                frag_count[frag] = frag_count.get(frag, 0) + count
+        # duplicates spanning two shards
+        border_dups.append(first is not None and first == prev_last)
+        if last is not None:
+            prev_last = last
+        tmpfiles.append(tmpfile)
+        sizes.append(nlines)
+    if pool:
+        pool.join()
+    if frag_count:
+        cut = int((1 - over_represented) * len(frag_count) + 0.5)
+        # use cut-1 because it represents the length of the list
+        cut = sorted(frag_count.values())[cut - 1]
+
+    # bitmask and read-ID index written one shard at a time
+    mask_fnam = output + '_filters.npy'
+    total = sum(sizes)
+    mask = np.lib.format.open_memmap(mask_fnam, mode='w+', dtype=np.uint16,
+                                     shape=(total, ))
+    index = np.lib.format.open_memmap(_index_fname(mask_fnam), mode='w+',
+                                      dtype=np.int64, shape=(total + 1, ))
+    beg = 0
+    for tmpfile, size, border_dup in zip(tmpfiles, sizes, border_dups):
+        end = beg + size
+        with np.load(tmpfile) as shard:
+            lines = shard['lines']
+            mask[beg:end] = lines['mask']
+            index[beg:end] = lines['offset']
+            if size:
+                over = np.array([frag_count[frag] > cut for frag in zip(
+                    shard['crms'].tolist(), shard['starts'].tolist())])
+                mask[beg:end][over[lines['frag1']] | over[lines['frag2']]] |= (
+                    _FLAG[8])
+        os.remove(tmpfile)
+        if border_dup:
+            mask[beg] |= _FLAG[9]
+        for k in masked:
+            masked[k]['reads'] += int(np.count_nonzero(
+                mask[beg:end] & _FLAG[k]))
+        beg = end
+    index[total] = shards[-1]
     for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k].close()
-    return masked
+        masked[k]['mask'] = mask_fnam
+    if text_output:
+        _merge_filtered_ids(fnam, output, len(args), masked, mask, index,
+                            dict((i, int(index[sum(sizes[:i])]))
+                                 for i, dup in enumerate(border_dups) if dup))
+    mask.flush()
+    index.flush()
+    return masked, len(mask), mask_fnam
 
 
-def _filter_duplicates_strict(fnam, output):
-    total = 0
-    masked = {9 : {'name': 'duplicated'        , 'reads': 0}}
-    outfil = {}
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k] = open(masked[k]['fnam'], 'w')
-    fhandler = open(fnam)
-    line = next(fhandler)
-    while line.startswith('#'):
-        line = next(fhandler)
-    (read,
-     cr1, pos1, sd1, l1 , _, _,
-     cr2, pos2, sd2, l2 , _, _) = line.split('\t')
-    prev_elts = cr1, pos1, cr2, pos2, sd1, sd2, l1, l2
-    for line in fhandler:
-        (read,
-         cr1, pos1, sd1, l1 , _, _,
-         cr2, pos2, sd2, l2 , _, _) = line.split('\t')
-        new_elts = cr1, pos1, cr2, pos2, sd1, sd2, l1, l2
-        if prev_elts == new_elts:
-            masked[9]["reads"] += 1
-            outfil[9].write(read + '\n')
-        total += 1
-        prev_elts = new_elts
-    fhandler.close()
-    # print 'done 4', time() - t0
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k].close()
-    return masked, total
+def _header_end(fnam):
+    """
+    :returns: the byte offset of the first line after the header
+    """
+    pos = 0
+    with open(fnam, 'rb') as fhandler:
+        for line in fhandler:
+            if not line.startswith(b'#'):
+                break
+            pos += len(line)
+    return pos
 
 
-def _filter_duplicates_loose(fnam, output):
-    total = 0
-    masked = {9 : {'name': 'duplicated'        , 'reads': 0}}
-    outfil = {}
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k] = open(masked[k]['fnam'], 'w')
-    fhandler = open(fnam)
-    line = next(fhandler)
-    while line.startswith('#'):
-        line = next(fhandler)
-    (read,
-     cr1, pos1, sd1, _ , _, _,
-     cr2, pos2, sd2, _ , _, _) = line.split('\t')
-    prev_elts = cr1, pos1, cr2, pos2, sd1, sd2
-    for line in fhandler:
-        (read,
-         cr1, pos1, sd1, _ , _, _,
-         cr2, pos2, sd2, _ , _, _) = line.split('\t')
-        new_elts = cr1, pos1, cr2, pos2, sd1, sd2
-        if prev_elts == new_elts:
-            masked[9]["reads"] += 1
-            outfil[9].write(read + '\n')
-        total += 1
-        prev_elts = new_elts
-    fhandler.close()
-    # print 'done 4', time() - t0
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k].close()
-    return masked, total
+def _shard_offsets(fnam, nshards):
+    """
+    :returns: the byte offsets delimiting nshards pieces of the file, each
+       starting at the beginning of a line
+    """
+    beg = _header_end(fnam)
+    end = os.path.getsize(fnam)
+    offsets = [beg]
+    with open(fnam, 'rb') as fhandler:
+        for i in range(1, nshards):
+            fhandler.seek(beg + (end - beg) * i // nshards - 1)
+            fhandler.readline()  # move to the start of next line
+            pos = fhandler.tell()
+            if offsets[-1] < pos < end:
+                offsets.append(pos)
+    offsets.append(end)
+    return offsets
+
+
+def _filter_shard(fnam, beg, end, tmpfile, max_molecule_length, max_frag_size,
+                  min_frag_size, re_proximity, min_dist_to_re,
+                  strict_duplicates, ids_prefix=None):
+    """
+    Evaluate all the filters, but the over-represented fragments, on the lines
+    between two byte offsets.
 
+    If ids_prefix, the IDs of the reads caught by each filter are written, as
+    the lines are filtered, in files named after ids_prefix and the filter.
 
-def _filter_from_res(fnam, max_frag_size, min_dist_to_re,
-                     re_proximity, min_frag_size, output):
-    # t0 = time()
-    masked = {5 : {'name': 'too close from RES', 'reads': 0},
-              6 : {'name': 'too short'         , 'reads': 0},
-              7 : {'name': 'too large'         , 'reads': 0},
-              10: {'name': 'random breaks'     , 'reads': 0}}
-    outfil = {}
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k] = open(masked[k]['fnam'], 'w')
-    fhandler = open(fnam)
-    line = next(fhandler)
-    while line.startswith('#'):
-        line = next(fhandler)
-    try:
-        while True:
-            (read,
-             _, pos1, _, _, rs1, re1,
-             _, pos2, _, _, rs2, re2) = line.split('\t')
-            ps1, ps2, re1, rs1, re2, rs2 = list(map(int, (pos1, pos2, re1, rs1, re2, rs2)))
-            diff11 = re1 - ps1
-            diff12 = ps1 - rs1
-            diff21 = re2 - ps2
-            diff22 = ps2 - rs2
-            if ((diff11 < re_proximity) or
-                (diff12 < re_proximity) or
-                (diff21 < re_proximity) or
-                (diff22 < re_proximity)):
-                # multicontacts excluded if fragment is internal (not the first)
-                if not '~' in read:
-                    masked[5]["reads"] += 1
-                    outfil[5].write(read + '\n')
-            # random breaks
-            if (((diff11 > min_dist_to_re) and
-                 (diff12 > min_dist_to_re)) or
-                ((diff21 > min_dist_to_re) and
-                 (diff22 > min_dist_to_re))):
-                masked[10]["reads"] += 1
-                outfil[10].write(read + '\n')
-            dif1 = re1 - rs1
-            dif2 = re2 - rs2
-            if (dif1 < min_frag_size) or (dif2 < min_frag_size):
-                masked[6]["reads"] += 1
-                outfil[6].write(read + '\n')
-            if (dif1 > max_frag_size) or (dif2 > max_frag_size):
-                masked[7]["reads"] += 1
-                outfil[7].write(read + '\n')
-            line = next(fhandler)
-    except StopIteration:
-        pass
+    :returns: the path to a file with the bitmask of each line, the
+       fragments of each read-end and the fragments with their counts, the
+       duplicate keys of the first and last lines, and the number of lines
+    """
+    masks = array('H')
+    offsets = array('q')
+    frags1 = array('i')
+    frags2 = array('i')
+    frag_ids = {}
+    frag_counts = []
+    first = prev = None
+    nkey = 8 if strict_duplicates else 6
+    if ids_prefix:
+        outfil = [(_FLAG[k], open(_ids_fname(ids_prefix, k), 'wb'))
+                  for k in range(1, 11) if k != 8]
+    fhandler = open(fnam, 'rb')
+    fhandler.seek(beg)
+    pos = beg
+    for line in fhandler:
+        if pos >= end:
+            break
+        offsets.append(pos)
+        pos += len(line)
+        (read,
+         cr1, pos1, sd1, l1, rs1, re1,
+         cr2, pos2, sd2, l2, rs2, re2) = line.split(b'\t')
+        ps1, ps2, sd1, sd2, rs1, re1, rs2, re2 = map(
+            int, (pos1, pos2, sd1, sd2, rs1, re1, rs2, re2))
+        flag = 0
+        # same fragment
+        if cr1 == cr2:
+            if re1 == re2:
+                if sd1 != sd2:
+                    if (ps2 > ps1) == sd2:
+                        # ----<===---===>---                   self-circles
+                        flag |= 1
+                    else:
+                        # ----===>---<===---                   dangling-ends
+                        flag |= 2
+                else:
+                    # --===>--===>-- or --<===--<===-- or same errors
+                    flag |= 4
+            elif (abs(ps1 - ps2) < max_molecule_length
+                  and sd2 != sd1
+                  and (ps2 > ps1) != sd2):
+                # different fragments but facing and very close
+                flag |= 8
+        # distance to RE sites
+        diff11 = re1 - ps1
+        diff12 = ps1 - rs1
+        diff21 = re2 - ps2
+        diff22 = ps2 - rs2
+        if ((diff11 < re_proximity) or
+            (diff12 < re_proximity) or
+            (diff21 < re_proximity) or
+            (diff22 < re_proximity)):
+            # multicontacts excluded if fragment is internal (not the first)
+            if not b'~' in read:
+                flag |= 16
+        # random breaks
+        if (((diff11 > min_dist_to_re) and
+             (diff12 > min_dist_to_re)) or
+            ((diff21 > min_dist_to_re) and
+             (diff22 > min_dist_to_re))):
+            flag |= 512
+        dif1 = re1 - rs1
+        dif2 = re2 - rs2
+        if (dif1 < min_frag_size) or (dif2 < min_frag_size):
+            flag |= 32
+        if (dif1 > max_frag_size) or (dif2 > max_frag_size):
+            flag |= 64
+        # duplicates
+        key = (cr1, pos1, cr2, pos2, sd1, sd2, l1, l2)[:nkey]
+        if key == prev:
+            flag |= 256
+        elif prev is None:
+            first = key
+        prev = key
+        # fragments, to search for over-represented ones
+        for frag, frags in (((cr1, rs1), frags1), ((cr2, rs2), frags2)):
+            try:
+                fid = frag_ids[frag]
+                frag_counts[fid] += 1
+            except KeyError:
+                fid = frag_ids[frag] = len(frag_counts)
+                frag_counts.append(1)
+            frags.append(fid)
+        masks.append(flag)
+        if flag and ids_prefix:
+            for bit, out in outfil:
+                if flag & bit:
+                    out.write(read + b'\n')
     fhandler.close()
-    # print 'done 2', time() - t0
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k].close()
-    return masked
+    if ids_prefix:
+        for _, out in outfil:
+            out.close()
+    lines = np.empty(len(masks), dtype=_SHARD_DTYPE)
+    lines['mask'  ] = np.frombuffer(masks, dtype=np.uint16) if masks else []
+    lines['offset'] = np.frombuffer(offsets, dtype=np.int64) if masks else []
+    lines['frag1' ] = np.frombuffer(frags1, dtype=np.int32) if masks else []
+    lines['frag2' ] = np.frombuffer(frags2, dtype=np.int32) if masks else []
+    frags = [None] * len(frag_counts)
+    for frag, fid in frag_ids.items():
+        frags[fid] = frag
+    np.savez(tmpfile, lines=lines,
+             crms=np.array([crm for crm, _ in frags], dtype=bytes),
+             starts=np.array([start for _, start in frags], dtype=np.int64),
+             counts=np.array(frag_counts, dtype=np.int64))
+    return tmpfile, first, prev, len(masks)
+
+
+def _ids_fname(prefix, k):
+    return prefix + '_' + MASKED[k]['name'].replace(' ', '_') + '.tsv'
+
+
+def _merge_filtered_ids(fnam, output, nshards, masked, mask, index,
+                        border_dups):
+    """
+    Write, for each filter, the file with the IDs of the filtered reads,
+    concatenating the files written by each shard. Over-represented fragments
+    and duplicates spanning two shards are only known once all shards are
+    filtered, the IDs of these reads are read directly at their offset.
+
+    :param border_dups: dictionary with the shards whose first line is a
+       duplicate of the last line of the previous shard, and the offset of
+       this line
+    """
+    fhandler = open(fnam, 'rb')
 
+    def read_id(offset):
+        fhandler.seek(offset)
+        return fhandler.readline().split(b'\t', 1)[0] + b'\n'
 
-def _filter_over_represented(fnam, over_represented, output):
-    # t0 = time()
-    frag_count = count_re_fragments(fnam)
-    num_frags = len(frag_count)
-    cut = int((1 - over_represented) * num_frags + 0.5)
-    # use cut-1 because it represents the length of the list
-    cut = sorted([frag_count[crm] for crm in frag_count])[cut - 1]
-    masked = {8 : {'name': 'over-represented'  , 'reads': 0}}
-    outfil = {}
     for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k] = open(masked[k]['fnam'], 'w')
-    fhandler = open(fnam)
-    line = next(fhandler)
-    while line.startswith('#'):
-        line = next(fhandler)
-    try:
-        while True:
-            read, cr1,  _, _, _, rs1, _, cr2, _, _, _, rs2, _ = line.split('\t')
-            if (frag_count.get((cr1, rs1), 0) > cut or
-                  frag_count.get((cr2, rs2), 0) > cut):
-                masked[8]["reads"] += 1
-                outfil[8].write(read + '\n')
-            line = next(fhandler)
-    except StopIteration:
-        pass
+        masked[k]['fnam'] = _ids_fname(output, k)
+        out = open(masked[k]['fnam'], 'wb')
+        if k == 8:
+            for offset in index[:-1][(mask & _FLAG[8]) != 0].tolist():
+                out.write(read_id(offset))
+            out.close()
+            continue
+        for i in range(nshards):
+            shard_fnam = _ids_fname('%s_shard%d' % (output, i), k)
+            if k == 9 and i in border_dups:
+                out.write(read_id(border_dups[i]))
+            with open(shard_fnam, 'rb') as shard:
+                copyfileobj(shard, out)
+            os.remove(shard_fnam)
+        out.close()
     fhandler.close()
-    # print 'done 3', time() - t0
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k].close()
-    return masked
 
 
 def _filter_yannick(fnam, maxlen, de_left, de_right, output):
@@ -18,8 +18,9 @@ from pytadbit.utils.file_handling import magic_open, get_free_space_mb
 from pytadbit.parsers.sam_parser import parse_gem_3c, merge_sort
 from pytadbit.mapping.restriction_enzymes import religateds
 from pytadbit.mapping.restriction_enzymes import RESTRICTION_ENZYMES
-from pytadbit.mapping.restriction_enzymes import map_re_sites
+from pytadbit.mapping.restriction_enzymes import re_sites_index
 from pytadbit.mapping.restriction_enzymes import iupac2regex
+from pytadbit.parsers.genome_parser import chromosome_lengths
 
 try:
     basestring
@@ -748,7 +749,7 @@ def full_mapping(mapper_index_path, fastq_path, out_map_dir, mapper='gem',
 def fast_fragment_mapping(mapper_index_path, fastq_path1, fastq_path2, r_enz,
                           genome_seq, out_map, clean=True, get_nread=False,
                           mapper_binary=None, mapper_params=None,
-                          samtools = 'samtools', **kwargs):
+                          samtools = 'samtools', re_cache=None, **kwargs):
     """
     Maps FASTQ reads to an indexed reference genome with the knowledge of
     the restriction enzyme used (fragment-based mapping).
@@ -772,6 +773,10 @@ def fast_fragment_mapping(mapper_index_path, fastq_path1, fastq_path2, r_enz,
     :param gem-mapper mapper_binary: path to the binary mapper
     :param None mapper_params: extra parameters for the mapper
     :param samtools samtools: path to samtools binary.
+    :param None re_cache: path prefix of the index of RE sites (see
+       :func:`pytadbit.mapping.restriction_enzymes.re_sites_index`), that is
+       memory mapped by the parsing workers instead of being copied to each of
+       them
 
     :returns: outfile with the intersected read pairs
     """
@@ -846,9 +851,8 @@ def fast_fragment_mapping(mapper_index_path, fastq_path1, fastq_path2, r_enz,
     #sort sam file
     os.system(samtools + ' sort -n -O SAM -@ %d -T %s -o %s %s'
                       % (nthreads, out_map_path, out_map_path, out_map_path))
-    genome_lengths = dict((crm, len(genome_seq[crm])) for crm in genome_seq)
-    frag_chunk = kwargs.get('frag_chunk', 100000)
-    frags = map_re_sites(r_enz, genome_seq, frag_chunk=frag_chunk)
+    genome_lengths = chromosome_lengths(genome_seq)
+    frags = re_sites_index(r_enz, genome_seq, cache=re_cache)
     if samtools and nthreads > 1:
         print('Splitting sam file')
         # headers
@@ -871,11 +875,10 @@ def fast_fragment_mapping(mapper_index_path, fastq_path1, fastq_path2, r_enz,
         procs = []
         pool = mu.Pool(nthreads)
         for i in range(nthreads):
-            frags_shared = copy.deepcopy(frags)
             procs.append(pool.apply_async(
                 parse_gem_3c, args=('%s_%d' % (out_map_path,(i+1)),
                                     '%s_parsed_%d' % (out_map_path,(i+1)),
-                                    copy.deepcopy(genome_lengths), frags_shared,
+                                    copy.deepcopy(genome_lengths), frags,
                                     False, True), kwds=kwargs))
             #results.append('%s_parsed_%d' % (out_map_path,(i+1)))
         pool.close()
@@ -903,7 +906,7 @@ def fast_fragment_mapping(mapper_index_path, fastq_path1, fastq_path2, r_enz,
         map_out = open(out_map, 'w')
         tmp_reads_fh = open(results[0],'r')
         for crm in genome_seq:
-            map_out.write('# CRM %s\t%d\n' % (crm, len(genome_seq[crm])))
+            map_out.write('# CRM %s\t%d\n' % (crm, genome_lengths[crm]))
         for read_line in tmp_reads_fh:
             read = read_line.split('\t')
             map_out.write('\t'.join([read[0]]+read[2:8]+read[9:]))
@@ -7,11 +7,20 @@ from __future__ import print_function
 
 from re import compile
 from warnings import warn
+from hashlib import md5
+import json
+import os
 
 from collections import OrderedDict
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 from scipy.stats import binom_test
+import numpy as np
 
-from pytadbit.utils.file_handling import magic_open
+from pytadbit.utils.file_handling import magic_open, mkdir
+from pytadbit.parsers.genome_parser import chromosome_lengths, CachedGenome
 
 try:
     basestring
@@ -199,6 +208,183 @@ def map_re_sites(enzyme_name, genome_seq, frag_chunk=100000, verbose=False):
     return frags
 
 
+def re_sites_index(enzyme_name, genome_seq, cache=None, verbose=False):
+    """
+    Index of all restriction enzyme (RE) sites of a given enzyme, or
+    combination of enzymes, in a genome. Position of a RE site is defined as in
+    :func:`pytadbit.mapping.restriction_enzymes.map_re_sites`.
+
+    :param enzyme_name: name of the enzyme to map (upper/lower case are
+       important), or list of names
+    :param genome_seq: a dictionary containing the genomic sequence by
+       chromosome
+    :param None cache: path prefix (usually the one of the genome cache,
+       see :func:`pytadbit.parsers.genome_parser.get_genome_cache_path`) of the
+       directory where to save the index, one .npy file per chromosome. If the
+       index was already saved, for the same enzymes and the same sequence
+       (checked with its md5 checksum), it is loaded memory-mapped, read-only.
+
+    :returns: a dictionary with, for each chromosome, a sorted int64 array of
+       RE sites, starting with 1 and ending with the chromosome length. With a
+       cache, a :class:`pytadbit.mapping.restriction_enzymes.CachedREIndex`
+    """
+    if isinstance(enzyme_name, basestring):
+        enzyme_names = [enzyme_name]
+    elif isinstance(enzyme_name, list):
+        enzyme_names = enzyme_name
+    enzymes = dict((n, RESTRICTION_ENZYMES[n]) for n in enzyme_names)
+    if cache:
+        cache = '%s_RE_%s' % (cache, '-'.join(sorted(enzyme_names)))
+        mkdir(cache)
+        index = _read_index_info(cache)
+        checksums = index['checksums'] if index.get('enzymes') == enzymes else {}
+    enz_pattern = None
+    frags = OrderedDict()
+    count = 0
+    lengths = chromosome_lengths(genome_seq)
+    for crm in genome_seq:
+        fnam = os.path.join(cache, crm + '.npy') if cache else None
+        if fnam:
+            checksum = _sequence_checksum(genome_seq, crm)
+            if checksums.get(crm) == checksum and os.path.exists(fnam):
+                sites = np.load(fnam, mmap_mode='r')
+                if sites[-1] == lengths[crm]:
+                    frags[crm] = sites
+                    count += len(sites) - 2
+                    continue
+        seq = genome_seq[crm]
+        if enz_pattern is None:
+            restring = '|'.join(['(?<=%s(?=%s))' % tuple(
+                RESTRICTION_ENZYMES[n].split('|')) for n in enzyme_names])
+            enz_pattern = compile(iupac2regex(restring))
+        sites = np.fromiter((match.end() + 1
+                             for match in enz_pattern.finditer(seq)),
+                            dtype=np.int64)
+        count += len(sites)
+        sites = np.unique(np.r_[1, sites[sites < len(seq)], len(seq)])
+        if fnam:
+            # write and rename, as other processes may be reading it
+            tmp_fnam = '%s_%d_tmp.npy' % (fnam, os.getpid())
+            np.save(tmp_fnam, sites)
+            os.rename(tmp_fnam, fnam)
+            sites = np.load(fnam, mmap_mode='r')
+            # re-read, other processes may have indexed other chromosomes
+            index = _read_index_info(cache)
+            if index.get('enzymes') != enzymes:
+                index = {'enzymes': enzymes, 'checksums': {}}
+            index['checksums'][crm] = checksum
+            _write_index_info(cache, index)
+        frags[crm] = sites
+    if verbose:
+        print('Found %d RE sites' % count)
+    if cache:
+        return CachedREIndex(cache, list(frags))
+    return frags
+
+
+class CachedREIndex(Mapping):
+    """
+    Index of RE sites saved by
+    :func:`pytadbit.mapping.restriction_enzymes.re_sites_index`.
+
+    Behaves as the (read-only) dictionary of arrays of RE sites per chromosome,
+    memory mapped when accessed. Pickling only stores the path to the index,
+    so it can be cheaply passed to other processes.
+
+    :param cache: path to the directory of the index
+    :param chromosomes: chromosomes in the index
+    """
+    def __init__(self, cache, chromosomes):
+        self.cache = cache
+        self._chromosomes = list(chromosomes)
+        self._known = set(self._chromosomes)
+        self._sites = {}
+
+    def __getstate__(self):
+        return self.cache, self._chromosomes
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __getitem__(self, crm):
+        try:
+            return self._sites[crm]
+        except KeyError:
+            if not crm in self._known:
+                raise
+        sites = self._sites[crm] = np.load(
+            os.path.join(self.cache, crm + '.npy'), mmap_mode='r')
+        return sites
+
+    def __iter__(self):
+        return iter(self._chromosomes)
+
+    def __len__(self):
+        return len(self._chromosomes)
+
+    def __contains__(self, crm):
+        return crm in self._known
+
+
+def _sequence_checksum(genome_seq, crm):
+    """
+    :returns: the md5 checksum of the sequence of a chromosome
+    """
+    if isinstance(genome_seq, CachedGenome):
+        seq = genome_seq.array(crm)
+    else:
+        seq = genome_seq[crm]
+        if not isinstance(seq, bytes):
+            seq = seq.encode('ascii')
+    return md5(seq).hexdigest()
+
+
+def _read_index_info(cache):
+    """
+    :returns: the enzymes (names and sites) of an index of RE sites, and the
+       checksums of the chromosome sequences indexed
+    """
+    try:
+        with open(os.path.join(cache, 'index.json')) as f_open:
+            return json.load(f_open)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _write_index_info(cache, index):
+    fnam = os.path.join(cache, 'index.json')
+    tmp_fnam = '%s_%d_tmp' % (fnam, os.getpid())
+    with open(tmp_fnam, 'w') as out:
+        json.dump(index, out)
+    os.rename(tmp_fnam, fnam)
+
+
+def locate_re_sites(sites, pos, len_seq):
+    """
+    Search, for a block of reads, the closest RE sites upstream and
+    downstream of their position.
+
+    :param sites: sorted array of RE sites of a chromosome, as returned by
+       :func:`pytadbit.mapping.restriction_enzymes.re_sites_index`
+    :param pos: array of positions of the reads in this chromosome
+    :param len_seq: array of mapped lengths of the reads
+
+    :returns: the positions (moved inside the chromosome in case part of a read
+       is mapped outside), the upstream and the downstream RE sites
+    """
+    pos = np.array(pos, dtype=np.int64)
+    outside = pos >= sites[-1]
+    if outside.any():
+        # case where part of the read is mapped outside chromosome
+        if (pos[outside] - sites[-1] + 1 >=
+            np.asarray(len_seq)[outside]).any():
+            raise Exception('Read mapped mostly outside ' +
+                            'chromosome\n(also reference genome can be truncated)')
+        pos[outside] = sites[-1] - 1
+    idx = np.searchsorted(sites, pos, side='right')
+    return pos, sites[np.maximum(idx - 1, 0)], sites[idx]
+
+
 def complementary(seq):
     trs = dict([(nt1, nt2) for nt1, nt2 in zip('ATGCN', 'TACGN')])
     return ''.join([trs[s] for s in seq[::-1]])
@@ -367,8 +367,10 @@ class StructuralModel(dict):
 
         """
 
+        # as python floats (coordinates may be stored in numpy arrays)
         points, dots, superdots, points2dots = build_mesh(
-            self['x'], self['y'], self['z'], len(self), nump, radius,
+            list(map(float, self['x'])), list(map(float, self['y'])),
+            list(map(float, self['z'])), len(self), nump, radius,
             superradius, include_edges)
 
         # calculates the number of inaccessible peaces of surface
@@ -9,16 +9,14 @@ try:
 except ImportError:
     from pickle                       import load
 from pickle                           import dump, HIGHEST_PROTOCOL
-from subprocess                       import Popen, PIPE
 from math                             import acos, degrees, pi, sqrt
 from warnings                         import warn, catch_warnings, simplefilter    
 from sys                              import version_info
 if (version_info > (3, 0)):
-    from string                           import ascii_uppercase as uc, ascii_lowercase as lc
+    from string                           import ascii_lowercase as lc
 else:
-    from string                           import uppercase as uc, lowercase as lc
+    from string                           import lowercase as lc
 from random                           import random
-from os.path                          import exists
 from itertools                        import combinations
 from uuid                             import uuid5, UUID
 from hashlib                          import md5
@@ -28,11 +26,11 @@ from numpy                            import exp as np_exp
 from numpy                            import median as np_median
 from numpy                            import mean as np_mean
 from numpy                            import std as np_std, log2
-from numpy                            import array, cross, dot, ma, isnan
+from numpy                            import array, cross, ma, isnan
 from numpy                            import histogram, linspace, errstate
 from numpy                            import nanmin, nanmax
 from numpy                            import seterr
-from numpy.linalg                     import norm
+import numpy as np
 
 from scipy.optimize                   import curve_fit
 from scipy.stats                      import spearmanr, pearsonr, chisquare
@@ -47,9 +45,13 @@ from pytadbit                         import get_dependencies_version
 from pytadbit.utils                   import printime
 from pytadbit.utils.three_dim_stats   import calc_consistency, mass_center
 from pytadbit.utils.three_dim_stats   import dihedral, calc_eqv_rmsd
-from pytadbit.utils.three_dim_stats   import get_center_of_mass, distance
-from pytadbit.utils.tadmaths          import calinski_harabasz, nozero_log_list
+from pytadbit.utils.three_dim_stats   import compare_models, score_matrix
+from pytadbit.utils.three_dim_stats   import contact_frequencies
+from pytadbit.utils.three_dim_stats   import median_distances
+from pytadbit.utils.tadmaths          import calinski_harabasz_cuts
+from pytadbit.utils.tadmaths          import nozero_log_list
 from pytadbit.utils.tadmaths          import mean_none
+from pytadbit.utils.mcl               import markov_clustering, mcl_options
 from pytadbit.utils.extraviews        import plot_3d_model, setup_plot
 from pytadbit.utils.extraviews        import chimera_view, tadbit_savefig
 from pytadbit.utils.extraviews        import augmented_dendrogram, plot_hist_box
@@ -58,6 +60,8 @@ from pytadbit.utils.extraviews        import tad_border_coloring
 from pytadbit.utils.extraviews        import color_residues
 from pytadbit.mapping.analyze         import scc
 from pytadbit.modelling.impmodel      import IMPmodel
+from pytadbit.parsers.models_parser   import Deferred, is_models_dir
+from pytadbit.parsers.models_parser   import read_models, remove_models, write_models
 from pytadbit.centroid                import centroid_wrapper
 from pytadbit.aligner3d               import aligner3d_wrapper
 from pytadbit.squared_distance_matrix import squared_distance_matrix_calculation_wrapper
@@ -92,6 +96,30 @@ def R2_vs_L(L, P):
     """
     return 2.0 * P * ( L - P * ( 1.0 - np_exp( - L / P ) ) )
 
+def _square_distance_matrix(coords):
+    """
+    Squared distances between all pairs of particles of a model.
+
+    :param coords: array of coordinates (particles, 3)
+
+    :returns: array (particles, particles)
+    """
+    dists = (coords[:, None, 0] - coords[None, :, 0])**2
+    dists += (coords[:, None, 1] - coords[None, :, 1])**2
+    dists += (coords[:, None, 2] - coords[None, :, 2])**2
+    return dists
+
+
+def _warn_mcl_options(mcl_bin, tmp_file):
+    """
+    Warn if the former options of the external MCL program are passed
+    """
+    if mcl_bin != 'mcl' or tmp_file is not None:
+        warn("WARNING: mcl_bin and tmp_file are not used, MCL clustering " +
+             "is done by pytadbit.utils.mcl", category=DeprecationWarning,
+             stacklevel=3)
+
+
 def load_structuralmodels(input_):
     """
     Loads :class:`pytadbit.modelling.structuralmodels.StructuralModels` from a file
@@ -99,11 +127,16 @@ def load_structuralmodels(input_):
     :class:`pytadbit.modelling.structuralmodels.StructuralModels.save_models`).
 
     :param input: path to the pickled StructuralModels object or dictionary
-       containing all the information.
+       containing all the information. It can also be the path to a directory
+       of models saved in columnar format, in which case coordinates are
+       memory mapped, and original data, z-scores and restraints are only read
+       when needed.
 
     :returns: a :class:`pytadbit.modelling.imp_model.StructuralModels`.
     """
-    if isinstance(input_, basestring):
+    if isinstance(input_, basestring) and is_models_dir(input_):
+        svd = read_models(input_)
+    elif isinstance(input_, basestring):
         with open(input_,'rb') as f_input_:
             svd = load(f_input_)
     else:
@@ -114,7 +147,9 @@ def load_structuralmodels(input_):
             resolution=svd['resolution'], original_data=svd['original_data'],
             clusters=svd['clusters'], config=svd['config'], zscores=svd['zscore'],
             zeros=svd['zeros'], restraints=svd.get('restraints', None),
-            description=svd.get('description', None))
+            description=svd.get('description', None),
+            comparisons=svd.get('comparisons', None),
+            coords=svd.get('coords', None))
     except KeyError:  # old version
         return StructuralModels(
             nloci=svd['nloci'], models=svd['models'], bad_models=svd['bad_models'],
@@ -123,6 +158,27 @@ def load_structuralmodels(input_):
             restraints=svd.get('restraints', None))
 
 
+class _Deferrable(object):
+    """
+    Attribute of StructuralModels that can be set to a
+    :class:`pytadbit.parsers.models_parser.Deferred` value, only read when
+    first accessed.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        value = obj.__dict__.get(self.name)
+        if isinstance(value, Deferred):
+            value = obj.__dict__[self.name] = value()
+        return value
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = value
+
+
 class StructuralModels(object):
     """
     This class contains three-dimensional models generated from a single Hi-C
@@ -146,13 +202,21 @@ class StructuralModels(object):
        :class:`pytadbit.modelling.structuralmodels.ClusterOfModels`
     :param None config: a dictionary containing the parameter to be used for the
        generation of three dimensional models.
+    :param None comparisons: a dictionary of all against all comparisons of
+       models, by region and distance cutoff (as computed by
+       :func:`pytadbit.utils.three_dim_stats.compare_models`)
+    :param None coords: array (models, particles, 3) with the coordinates of
+       the models, used instead of their 'x', 'y' and 'z' values
 
     """
+    _original_data = _Deferrable('_original_data')
+    _zscores       = _Deferrable('_zscores')
+    _restraints    = _Deferrable('_restraints')
 
     def __init__(self, nloci, models, bad_models, resolution,
                  original_data=None, zscores=None, clusters=None,
                  config=None, experiment=None, zeros=None, restraints=None,
-                 description=None):
+                 description=None, comparisons=None, coords=None):
 
         self.__models       = models
         self._bad_models    = bad_models
@@ -166,14 +230,74 @@ class StructuralModels(object):
         self.experiment     = experiment
         self._restraints    = restraints
         self.description    = description
+        self._comparisons   = comparisons or {}
+        self._update_arrays(coords)
+
+    def _update_arrays(self, coords=None):
+        """
+        Stores the coordinates of all models in a single array (models,
+        particles, 3), the 'x', 'y' and 'z' of each model being replaced by
+        views of this array.
+
+        :param None coords: array already holding the coordinates of the
+           models, in order
+        """
+        models = [self.__models[m] for m in range(len(self.__models))]
+        if coords is None:
+            coords = np.empty((len(models), self.nloci, 3))
+            for i, mdl in enumerate(models):
+                for k, axis in enumerate('xyz'):
+                    coords[i, :, k] = mdl[axis]
+        self._coords = coords
+        for i, mdl in enumerate(models):
+            for k, axis in enumerate('xyz'):
+                mdl[axis] = coords[i, :, k]
+        self._update_metadata()
+
+    def _update_metadata(self):
+        """
+        Stores objective function, random initial number and cluster (-1 for
+        singletons) of each model in arrays.
+        """
+        models = [self.__models[m] for m in range(len(self.__models))]
+        self._objfun = np.array([mdl.get('objfun') for mdl in models],
+                                dtype=float)
+        self._rand_init = np.array([str(mdl.get('rand_init')) for mdl in models],
+                                   dtype=object)
+        self._cluster = np.array(
+            [-1 if mdl.get('cluster', 'Singleton') == 'Singleton'
+             else int(mdl['cluster']) for mdl in models], dtype=int)
+
+    def _model_comparison(self, beg, end, dcutoff, n_cpus=1):
+        """
+        All against all comparison of the models over a region (see
+        :func:`pytadbit.utils.three_dim_stats.compare_models`). Comparisons are
+        kept by region and distance cutoff, and reused for any set of models
+        already compared.
+
+        :returns: an array (3, models, models) with the number of equivalent
+           positions, the RMSD and the dRMSD of each pair of models
+        """
+        rand_inits = self._rand_init.tolist()
+        key = (beg, end, float(dcutoff))
+        if key in self._comparisons:
+            compared, comparison = self._comparisons[key]
+            index = dict((r, i) for i, r in enumerate(compared))
+            if all(r in index for r in rand_inits):
+                index = [index[r] for r in rand_inits]
+                return comparison[:, index][:, :, index]
+        keep = array([bool(z) for z in self._zeros[beg:end]])
+        comparison = compare_models(self._coords[:, beg:end][:, keep], dcutoff,
+                                    n_cpus=n_cpus)
+        self._comparisons[key] = (rand_inits, comparison)
+        return comparison
 
     def __getitem__(self, nam):
         if isinstance(nam, basestring):
-            for m in self.__models:
-                if self.__models[m]['rand_init'] == nam:
-                    return self.__models[m]
-            else:
-                raise KeyError('Model %s not found\n' % (nam))
+            found = np.flatnonzero(self._rand_init == nam)
+            if len(found):
+                return self.__models[int(found[0])]
+            raise KeyError('Model %s not found\n' % (nam))
         try:
             return self.__models[nam]
         except TypeError:
@@ -285,16 +409,12 @@ class StructuralModels(object):
                 if not in_place:
                     for midx in range(len(self.__models)):
                         if not aligned_coords[midx]:
-                            aligned_coords[midx] = [self[midx]['x'][:],
-                                                    self[midx]['y'][:],
-                                                    self[midx]['z'][:]]
+                            aligned_coords[midx] = self._coords[midx].T.tolist()
                 return aligned_coords if not in_place else None
             else:
                 models = [m for m in self.__models]
         ref_model = models[0] if reference_model is None else reference_model
-        firstx, firsty, firstz = (self[ref_model]['x'][:],
-                                  self[ref_model]['y'][:],
-                                  self[ref_model]['z'][:])
+        firstx, firsty, firstz = self._coords[ref_model].T.tolist()
         mass_center(firstx, firsty, firstz, self._zeros)
         aligned = []
         for sec in models:
@@ -302,14 +422,13 @@ class StructuralModels(object):
                 if not in_place:
                     aligned.append([firstx, firsty, firstz])
                 continue
+            secx, secy, secz = self._coords[sec].T.tolist()
             coords = aligner3d_wrapper(firstx, firsty, firstz,
-                                       self[sec]['x'],
-                                       self[sec]['y'],
-                                       self[sec]['z'],
+                                       secx, secy, secz,
                                        self._zeros,
                                        self.nloci)
             if in_place:
-                self[sec]['x'], self[sec]['y'], self[sec]['z'] = coords
+                self._coords[sec] = array(coords).T
             else:
                 aligned.append(coords)
 
@@ -450,14 +569,16 @@ class StructuralModels(object):
            implementation of this hierarchical clustering, and selects the best
            number of clusters using the
            :func:`pytadbit.utils.tadmaths.calinski_harabasz` function.
-        :param 'mcl' mcl_bin: path to the mcl executable file, in case of the
-           'mcl is not in the PATH' warning message
-        :param None tmp_file: path to a temporary file created during
-           the clustering computation. Default will be created in /tmp/ folder
+        :param 'mcl' mcl_bin: deprecated, not used, MCL clustering is done by
+           :func:`pytadbit.utils.mcl.markov_clustering`
+        :param None tmp_file: deprecated, not used, no temporary file is
+           needed anymore
         :param True verbose: same as print StructuralModels.clusters
-        :param 1 n_cpus: number of cpus to use in MCL clustering
-        :param mclargs: list with any other command line argument to be passed
-           to mcl (i.e,: mclargs=['-pi', '10', '-I', '2.0'])
+        :param 1 n_cpus: number of cpus to use in the comparison of models
+           and in MCL clustering
+        :param mclargs: list with mcl command line arguments, of which
+           inflation, pre-inflation, pruning and selection are used (i.e,:
+           mclargs=['-pi', '10', '-I', '2.0'])
         :param False external: if True returns the cluster found instead of
            storing it as StructuralModels.clusters
         :param 'score' what: Statistic used for clustering. Can be one of
@@ -467,8 +588,7 @@ class StructuralModels(object):
             the form: "chr3:110000000-120000000"
 
         """
-        tmp_file = '/tmp/tadbit_tmp_%s.txt' % (
-            ''.join([(uc + lc)[int(random() * 52)] for _ in range(4)]))
+        _warn_mcl_options(mcl_bin, tmp_file)
         if not dcutoff:
             dcutoff = int(1.5 * self.resolution * self._config['scale'])
         crm = None
@@ -503,12 +623,9 @@ class StructuralModels(object):
         nloci = end - beg
         if verbose:
             printime('Computing Equivalent RMSD positions')
-        scores = calc_eqv_rmsd(self.__models, beg, end, self._zeros, dcutoff,
-                               what=what, normed=True)
-        from distutils.spawn import find_executable
-        if not find_executable(mcl_bin):
-            print('\nWARNING: MCL not found in path using WARD clustering\n')
-            method = 'ward'
+        scores = score_matrix(
+            self._model_comparison(beg, end, dcutoff, n_cpus=n_cpus),
+            what=what, normed=True)
         if verbose:
             printime('Clustering')
         # Initialize cluster definition of models:
@@ -517,23 +634,21 @@ class StructuralModels(object):
         new_singles = 0
         if method == 'ward':
 
-            matrix = [[0.0 for _ in range(len(self))]
-                      for _ in range(len(self))]
-            for (i, j), score in list(scores.items()):
-                matrix[i][j] = score if score > fact * nloci else 0.0
+            matrix = np.where(scores > fact * nloci, scores, 0.0)
             clust = linkage(squareform(matrix), method='ward')
-            # score each possible cut in hierarchical clustering
-            solutions = {}
-            for k in clust[:, 2]:
-                clusters = ClusterOfModels()
-                [clusters.setdefault(j, []).append(i) for i, j in
-                 enumerate(fcluster(clust, k, criterion='distance'))]
-                solutions[k] = {'out': clusters}
-                solutions[k]['score'] = calinski_harabasz(scores, clusters)
-            # take best cluster according to calinski_harabasz score
-            clusters = [solutions[s] for s in sorted(
-                solutions, key=lambda x: solutions[x]['score'])
-                if solutions[s]['score'] > 0][-1]['out']
+            # score each possible cut in hierarchical clustering, and take the
+            # best one according to calinski_harabasz score (the last cut of
+            # the merges at a same height)
+            ch_scores = calinski_harabasz_cuts(scores, clust)
+            cuts = np.flatnonzero((np.append(np.diff(clust[:, 2]), 1) > 0) &
+                                  (ch_scores > 0))
+            if not len(cuts):
+                raise Exception('Problem with clustering, try increasing ' +
+                                '"dcutoff", now: %s\n' % (dcutoff))
+            best = cuts[ch_scores[cuts] == ch_scores[cuts].max()][-1]
+            clusters = ClusterOfModels()
+            [clusters.setdefault(j, []).append(i) for i, j in
+             enumerate(fcluster(clust, clust[best, 2], criterion='distance'))]
             # sort clusters, the more populated, the first.
             clusters = dict((i + 1, j) for i, j in
                             enumerate(sorted(list(clusters.values()),
@@ -549,40 +664,32 @@ class StructuralModels(object):
                 self.clusters[cluster].sort(
                     key=lambda x: self[str(x)]['objfun'])
         else:
-            out_f = open(tmp_file, 'w')
-            uniqs = list(set([tuple(sorted((m1, m2))) for m1, m2 in scores]))
             cut = fact * (nloci - self._zeros[beg:end].count(False))
-            for md1, md2 in uniqs:
-                score = scores[(md1, md2)]
-                if score >= cut:
-                    out_f.write('model_%s\tmodel_%s\t%s\n' % (md1, md2, score))
-            out_f.close()
-            Popen('%s %s --abc -te %s -V all -o %s.mcl %s' % (
-                mcl_bin, tmp_file, n_cpus, tmp_file, ' '.join(
-                    mclargs or [])), stdout=PIPE, stderr=PIPE,
-                  shell=True, universal_newlines=True).communicate()
-            clusters = ClusterOfModels()
-            if not exists(tmp_file + '.mcl'):
+            matrix = np.where(scores >= cut, scores, 0.0)
+            # models without any similar model are left out of the clustering
+            nodes = np.flatnonzero(matrix.any(axis=0))
+            if not len(nodes):
                 raise Exception('Problem with clustering, try increasing ' +
                                 '"dcutoff", now: %s\n' % (dcutoff))
-            with open(tmp_file + '.mcl') as f_tmp_file:
-                for cluster, line in enumerate(f_tmp_file):
-                    models = line.split()
-                    if len(models) == 1:
-                        new_singles += 1
-                    else:
-                        clusters[cluster + 1] = []
-                        for model in models:
-                            model = int(model.split('_')[1])
-                            if not external:
-                                self[model]['cluster'] = cluster + 1
-                            clusters[cluster + 1].append(
-                                str(self[model]['rand_init']))
-                        clusters[cluster + 1].sort(
-                            key=lambda x: self[str(x)]['objfun'])
+            clusters = ClusterOfModels()
+            for cluster, models in enumerate(markov_clustering(
+                    matrix[np.ix_(nodes, nodes)], n_cpus=n_cpus,
+                    **mcl_options(mclargs))):
+                if len(models) == 1:
+                    new_singles += 1
+                else:
+                    clusters[cluster + 1] = []
+                    for model in nodes[models].tolist():
+                        if not external:
+                            self[model]['cluster'] = cluster + 1
+                        clusters[cluster + 1].append(
+                            str(self[model]['rand_init']))
+                    clusters[cluster + 1].sort(
+                        key=lambda x: self[str(x)]['objfun'])
             if external:
                 return clusters
             self.clusters = clusters
+        self._update_metadata()
         if verbose:
             printime('Done.')
             singletons = len([1 for m in self
@@ -613,12 +720,25 @@ class StructuralModels(object):
                     if md2['cluster'] == cl2:
                         # the first one found is the best :)
                         break
-                matrix[i][j + i + 1] = calc_eqv_rmsd({0: md1, 1: md2},
-                                                     0,
-                                                     self.nloci,
-                                                     self._zeros, one=True)
+                matrix[i][j + i + 1] = self.__drmsd(md1, md2)
         return clust_count, objfun, matrix
 
+    def __drmsd(self, md1, md2):
+        """
+        dRMSD between two models, taken from a previous comparison of all
+        models if any (it does not depend on the distance cutoff)
+        """
+        for (beg, end, _), (compared, comparison) in self._comparisons.items():
+            if (beg, end) != (0, self.nloci):
+                continue
+            try:
+                return float(comparison[2, compared.index(md1['rand_init']),
+                                        compared.index(md2['rand_init'])])
+            except ValueError:
+                continue
+        return calc_eqv_rmsd({0: md1, 1: md2}, 0, self.nloci, self._zeros,
+                             one=True)
+
     def cluster_analysis_dendrogram(self, n_best_clusters=None, color=False,
                                     axe=None, savefig=None, **kwargs):
         """
@@ -672,7 +792,7 @@ class StructuralModels(object):
         return d
 
     def get_contact_matrix(self, models=None, cluster=None, cutoff=None,
-                           distance=False, show_bad_columns=True):
+                           distance=False, show_bad_columns=True, n_cpus=1):
         """
         Returns a matrix with the number of interactions observed below a given
         cutoff distance.
@@ -686,9 +806,11 @@ class StructuralModels(object):
            are in contact or not, default is 2 times resolution, times scale.
            Cutoff can also be a list of values, in wich case the returned object
            will be a dictionnary of matrices (keys being square cutoffs)
-        :param False distance: returns the distance matrix of all_angles against
-           all_angles particles instead of a contact_map matrix using the cutoff
+        :param False distance: returns the matrix of median distances between
+           particles instead of a contact_map matrix using the cutoff
         :param True show_bad_columns: show bad columns in contact map
+        :param 1 n_cpus: number of threads used to compute distances (by blocks
+           of models)
 
         :returns: matrix frequency of interaction
         """
@@ -700,34 +822,25 @@ class StructuralModels(object):
             models = [self[str(m)]['index'] for m in self.clusters[cluster]]
         else:
             models = [m for m in self.__models]
+        # remove (or not) interactions from bad columns
+        if show_bad_columns:
+            wloci = array([bool(self._zeros[i]) for i in range(self.nloci)])
+        else:
+            wloci = np.ones(self.nloci, dtype=bool)
+        wpairs = wloci[:, None] & wloci[None, :]
+        coords = self._coords[models]
+        if distance:
+            return median_distances(coords, wpairs, n_cpus=n_cpus).tolist()
         cutoff_list = True
+        if cutoff is None:
+            cutoff = float(2 * self.resolution * self._config['scale'])
         if not isinstance(cutoff, list):
             cutoff = [cutoff]
             cutoff_list = False
         cutoff.sort(reverse=True)
-        if not cutoff:
-            cutoff = [float(2 * self.resolution * self._config['scale'])]
         cutoff = [c**2 for c in cutoff]
-        matrix = dict([(c, [[0. for _ in range(self.nloci)]
-                            for _ in range(self.nloci)]) for c in cutoff])
-        # remove (or not) interactions from bad columns
-        if show_bad_columns:
-            wloci = [i for i in range(self.nloci) if self._zeros[i]]
-        else:
-            wloci = [i for i in range(self.nloci)]
-        models = [self[mdl] for mdl in models]
-
-        frac = 1.0 / len(models)
-
-        for model in models:
-            squared_distance_matrix = squared_distance_matrix_calculation_wrapper(
-                model['x'], model['y'], model['z'], self.nloci)
-            #print model, len(x), len(y), len(z)
-            for c in cutoff:
-                for i, j in combinations(wloci, 2):
-                    if squared_distance_matrix[i][j] <= c:
-                        matrix[c][i][j] += frac  # * 100
-                        matrix[c][j][i] += frac  # * 100
+        matrices = contact_frequencies(coords, cutoff, wpairs, n_cpus=n_cpus)
+        matrix = dict((c, m.tolist()) for c, m in zip(cutoff, matrices))
         if cutoff_list:
             return matrix
         return list(matrix.values())[0]
@@ -750,6 +863,7 @@ class StructuralModels(object):
         self.__models = dict((i, tmp_models[i]) for i in range(nbest))
         self._bad_models = dict((i, tmp_models[i]) for i in
                                 range(nbest, len(tmp_models)))
+        self._update_arrays()
 
     def deconvolve(self, fact=0.75, dcutoff=None, method='mcl',
                    mcl_bin='mcl', tmp_file=None, verbose=True, n_cpus=1,
@@ -777,14 +891,15 @@ class StructuralModels(object):
            implementation of this hierarchical clustering, and selects the best
            number of clusters using the
            :func:`pytadbit.utils.tadmaths.calinski_harabasz` function.
-        :param 'mcl' mcl_bin: path to the mcl executable file, in case of the
-           'mcl is not in the PATH' warning message
-        :param None tmp_file: path to a temporary file created during
-           the clustering computation. Default will be created in /tmp/ folder
+        :param 'mcl' mcl_bin: deprecated, not used, MCL clustering is done by
+           :func:`pytadbit.utils.mcl.markov_clustering`
+        :param None tmp_file: deprecated, not used, no temporary file is
+           needed anymore
         :param True verbose: same as print StructuralModels.clusters
         :param 1 n_cpus: number of cpus to use in MCL clustering
-        :param mclargs: list with any other command line argument to be passed
-           to mcl (i.e,: mclargs=['-pi', '10', '-I', '2.0'])
+        :param mclargs: list with mcl command line arguments, of which
+           inflation, pre-inflation, pruning and selection are used (i.e,:
+           mclargs=['-pi', '10', '-I', '2.0'])
         :param 10 n_best_clusters: number of clusters to represent
         :param None clusters: provide clusters as a dictionary with keys=cluster
            number, or name, and values list of model numbers.
@@ -798,13 +913,13 @@ class StructuralModels(object):
            of the file name will determine the desired format).
         :param (11,11) figsize: dimension of the plot
         """
+        _warn_mcl_options(mcl_bin, tmp_file)
         fact /= self.nloci
         if not dcutoff:
             dcutoff = 1.5 * self.resolution * self._config['scale']
         if not clusters:
             clusters = self.cluster_models(fact=fact, dcutoff=dcutoff,
-                                           mcl_bin=mcl_bin,
-                                           method=method, tmp_file=tmp_file,
+                                           method=method,
                                            n_cpus=n_cpus, mclargs=mclargs,
                                            external=True, what=what)
         if len(clusters) <= 1:
@@ -1170,34 +1285,30 @@ class StructuralModels(object):
 
     def _get_density(self, models, interval, use_mass_center):
         dists = [[None] * len(models)] * interval
-        for p in range(interval, self.nloci - interval):
-            part1, part2, part3 = p - interval, p, p + interval
+        coords = self._coords[models]
+        parts = np.arange(interval, self.nloci - interval)
+        if not len(parts):
+            return dists
+        with errstate(divide='ignore', invalid='ignore'):
             if use_mass_center:
-                subdists = []
-                for m in models:
-                    try:
-                        coord1 = get_center_of_mass(
-                            self[m]['x'][part1:part2],
-                            self[m]['y'][part1:part2],
-                            self[m]['z'][part1:part2],
-                            self._zeros)
-                        coord2 = get_center_of_mass(
-                            self[m]['x'][part2:part3],
-                            self[m]['y'][part2:part3],
-                            self[m]['z'][part2:part3],
-                            self._zeros)
-                        subdists.append(distance(coord1, coord2))
-                    except ZeroDivisionError:  # part1==part2 or part2==part3
-                        subdists.append(float('nan'))
-                dists.append([float(interval * self.resolution) / d for d in subdists])
+                # as in get_center_of_mass, weights are the first zeros
+                weights = array([bool(z) for z in self._zeros[:interval]],
+                                dtype=float)
+                if not weights.any():  # part1==part2 or part2==part3
+                    return dists + [[float('nan')] * len(models)] * len(parts)
+                windows = coords[:, parts[:, None] + np.arange(-interval, interval)]
+                center1 = ((windows[:, :, :interval] * weights[:, None]).sum(axis=2)
+                           / weights.sum())
+                center2 = ((windows[:, :, interval:] * weights[:, None]).sum(axis=2)
+                           / weights.sum())
+                dist = np.sqrt(((center1 - center2)**2).sum(axis=2))
+                dists.extend((float(interval * self.resolution) / dist).T.tolist())
             else:
-                dist1 = self.median_3d_dist(part1 + 1, part2 + 1, models,
-                                            plot=False, median=False)
-                dist2 = self.median_3d_dist(part2 + 1, part3 + 1, models,
-                                            plot=False, median=False)
-                dist = [(d1 + d2) for d1, d2 in zip(dist1, dist2)]
-                dists.append([float(interval * self.resolution * 2) / d
-                              for d in dist])
+                dist = (np.sqrt(((coords[:, parts - interval] -
+                                  coords[:, parts])**2).sum(axis=2)) +
+                        np.sqrt(((coords[:, parts] -
+                                  coords[:, parts + interval])**2).sum(axis=2)))
+                dists.extend((float(interval * self.resolution * 2) / dist).T.tolist())
         return dists
 
     def density_plot(self, models=None, cluster=None, steps=(1, 2, 3, 4, 5),
@@ -1269,23 +1380,15 @@ class StructuralModels(object):
         return distsk, errorp, errorn
 
     def _get_interactions(self, models, cutoff):
-        interactions = [[] for _ in range(self.nloci)]
         if not cutoff:
             cutoff = int(2 * self.resolution * self._config['scale'])
         cutoff2 = cutoff**2
-        for i in range(self.nloci):
-            for m in models:
-                val = 0
-                mdl = self[m]
-                for j in range(self.nloci):
-                    if i == j:
-                        continue
-                    val += ((mdl['x'][i] - mdl['x'][j])**2 +
-                            (mdl['y'][i] - mdl['y'][j])**2 +
-                            (mdl['z'][i] - mdl['z'][j])**2) < cutoff2
-                    # val += self.__square_3d_dist(i + 1, j + 1, models=[m])[0] < cutoff2
-                interactions[i].append(val)
-        return interactions
+        interactions = np.zeros((self.nloci, len(models)), dtype=int)
+        for k, m in enumerate(models):
+            close = _square_distance_matrix(self._coords[m]) < cutoff2
+            np.fill_diagonal(close, False)
+            interactions[:, k] = close.sum(axis=1)
+        return interactions.tolist()
 
     def interactions(self, models=None, cluster=None, cutoff=None,
                      steps=(1, 2, 3, 4, 5), axe=None, error=False,
@@ -1601,28 +1704,23 @@ class StructuralModels(object):
         if not isinstance(steps, tuple):
             steps = (steps,)
         models = self._get_models(models, cluster)
-        rads = []
-        ones = array([1., 1., 1.])
-        sign = 1
-        for model in models:
-            mox = self[model]['x']
-            moy = self[model]['y']
-            moz = self[model]['z']
-            subrad = [None] * 3
-            for res in range(1, self.nloci - 5):
-                subrad.append(self.angle_between_3_particles(
-                    res, res + 3, res + 6, models=[model], all_angles=False))
-                if signed:
-                    res1 = array([mox[res - 1], moy[res - 1], moz[res - 1]])  # faster than get_particle coordinate
-                    res2 = array([mox[res + 2], moy[res + 2], moz[res + 2]])
-                    res3 = array([mox[res + 5], moy[res + 5], moz[res + 5]])
-                    vec1 = res1 - res2 / norm(res1 - res2)
-                    vec2 = res1 - res3 / norm(res1 - res3)
-                    sign = dot(ones, cross(vec1, vec2))
-                    sign = -1 if sign < 0 else 1
-                subrad[-1] *= sign
-            subrad += [None] * 3
-            rads.append(subrad)
+        # angle between particles res, res + 3 and res + 6 of all models
+        coords = self._coords[models]
+        res1 = coords[:, 0:max(0, self.nloci - 6)]
+        res2 = coords[:, 3:max(3, self.nloci - 3)]
+        res3 = coords[:, 6:]
+        a2 = ((res2 - res3)**2).sum(axis=2)
+        c2 = ((res1 - res2)**2).sum(axis=2)
+        b2 = ((res1 - res3)**2).sum(axis=2)
+        with errstate(divide='ignore', invalid='ignore'):
+            cosg = (a2 - b2 + c2) / (2 * a2**0.5 * c2**0.5)
+            angles = np.degrees(np.arccos(cosg))
+            angles[abs(cosg) > 1] = 0.
+            if signed:
+                vec1 = res1 - res2 / np.sqrt(((res1 - res2)**2).sum(axis=2))[:, :, None]
+                vec2 = res1 - res3 / np.sqrt(((res1 - res3)**2).sum(axis=2))[:, :, None]
+                angles[cross(vec1, vec2).sum(axis=2) < 0] *= -1
+        rads = [[None] * 3 + subrad + [None] * 3 for subrad in angles.tolist()]
         with catch_warnings():
             simplefilter("ignore", category=RuntimeWarning)
             radsk, errorn, errorp = self._windowize(list(zip(*rads)), steps, interval=0,
@@ -1844,21 +1942,16 @@ class StructuralModels(object):
                                                    cutoff=cutoff, 
                                                    show_bad_columns=show_bad_columns)
         if issparse(self._original_data):
-            self._original_data = self._original_data.tolil()
-        oridata = []
-        moddata = []
-        for i in (v for v, z in enumerate(self._zeros) if z):
-            for j in (v for v, z in list(enumerate(self._zeros))[i + off_diag:] if z):
-                if issparse(self._original_data):
-                    oriv = self._original_data[i,j]
-                else:
-                    oriv = self._original_data[i][j]
-                if oriv <= 0 or isnan(oriv):
-                    continue
-                oridata.append(oriv)
-                moddata.append(model_matrix[i][j])
-        if issparse(self._original_data):
-            self._original_data = self._original_data.tocsr()
+            oridata = self._original_data.toarray()
+        else:
+            oridata = array(self._original_data, dtype=float)
+        # pairs of non-filtered particles, at off_diag or more from diagonal
+        wloci = array([bool(z) for z in self._zeros])
+        wpairs = np.triu(wloci[:, None] & wloci[None, :], off_diag)
+        with errstate(invalid='ignore'):
+            wpairs &= oridata > 0
+        moddata = array(model_matrix, dtype=float)[wpairs].tolist()
+        oridata = oridata[wpairs].tolist()
         # print oridata
         if corr == 'spearman':
             corr = spearmanr(moddata, oridata)
@@ -2337,20 +2430,9 @@ class StructuralModels(object):
         :param None cluster: compute the angle only for the models in the
            cluster number 'cluster'
         """
-        pa -= 1
-        pb -= 1
-        pc -= 1
-        pd -= 1
-        pe -= 1
-        dangles = []
-        for m in models:
-            parta = array([self[m]['x'][pa], self[m]['y'][pa], self[m]['z'][pa]])
-            partb = array([self[m]['x'][pb], self[m]['y'][pb], self[m]['z'][pb]])
-            partc = array([self[m]['x'][pc], self[m]['y'][pc], self[m]['z'][pc]])
-            partd = array([self[m]['x'][pd], self[m]['y'][pd], self[m]['z'][pd]])
-            parte = array([self[m]['x'][pe], self[m]['y'][pe], self[m]['z'][pe]])
-            dangles.append(dihedral(parta, partb, partc, partd, parte))
-        return dangles
+        coords = self._coords[models]
+        return dihedral(coords[:, pa - 1], coords[:, pb - 1], coords[:, pc - 1],
+                        coords[:, pd - 1], coords[:, pe - 1]).tolist()
 
     def median_3d_dist(self, part1, part2, models=None, cluster=None,
                        plot=True, median=True, axe=None, savefig=None):
@@ -2387,9 +2469,9 @@ class StructuralModels(object):
         elif cluster > -1 and len(self.clusters) > 0:
             models = [self[str(m)]['index'] for m in self.clusters[cluster]]
         else:
-            models = self.__models
-        models = [self[mdl] for mdl in models]
-        dists = [mdl.distance(part1, part2) for mdl in models]
+            models = [m for m in self.__models]
+        dists = np.sqrt(((self._coords[models, part1 - 1] -
+                          self._coords[models, part2 - 1])**2).sum(axis=1)).tolist()
         if not plot:
             if median:
                 return np_median(dists)
@@ -2411,11 +2493,8 @@ class StructuralModels(object):
             models = [self[str(m)]['index'] for m in self.clusters[cluster]]
         else:
             models = [m for m in self.__models]
-        models = [self[mdl] for mdl in models]
-        return [(mdl['x'][part1] - mdl['x'][part2])**2 +
-                (mdl['y'][part1] - mdl['y'][part2])**2 +
-                (mdl['z'][part1] - mdl['z'][part2])**2
-                for mdl in models]
+        return ((self._coords[models, part1] -
+                 self._coords[models, part2])**2).sum(axis=1).tolist()
 
     def __fast_square_3d_dist(self, part1, part2, models):
         """
@@ -3046,10 +3125,16 @@ class StructuralModels(object):
             m['x'] = X
             m['y'] = Y
             m['z'] = Z
+        self._update_arrays()
+        self._comparisons = {}
 
-    def save_models(self, outfile, minimal=()):
+    def save_models(self, outfile, minimal=(), format='pickle'):
         """
-        Saves all the models in pickle format (python object written to disk).
+        Saves all the models in pickle format (python object written to disk),
+        or in columnar format (directory of numpy arrays, see
+        :mod:`pytadbit.parsers.models_parser`), that is loaded lazily and to
+        which models can be appended with
+        :func:`pytadbit.parsers.models_parser.append_models`.
 
         :param path_f: path where to save the pickle file
         :param () minimal: list of items to exclude from save. Options:
@@ -3057,14 +3142,22 @@ class StructuralModels(object):
           - 'zscores': used generate restraints common to all models
           - 'original_data': used generate Z-scores common to all models
           - 'log_objfun': generated during modeling model specific
+        :param 'pickle' format: either 'pickle' or 'npy' for the columnar
+           format
 
         """
-
+        if format == 'npy':
+            write_models(outfile, self._reduce_models(minimal=minimal,
+                                                      as_lists=False))
+            return
+        svd = self._reduce_models(minimal=minimal)
+        if is_models_dir(outfile):
+            remove_models(outfile)
         out = open(outfile, 'wb')
-        dump(self._reduce_models(minimal=minimal), out, HIGHEST_PROTOCOL)
+        dump(svd, out, HIGHEST_PROTOCOL)
         out.close()
 
-    def _reduce_models(self, minimal=()):
+    def _reduce_models(self, minimal=(), as_lists=True):
         """
         reduce structural models objects to a dictionary to be saved
 
@@ -3073,6 +3166,9 @@ class StructuralModels(object):
           - 'zscores': used generate restraints common to all models
           - 'original_data': used generate Z-scores common to all models
           - 'objfun': generated during modeling model specific
+        :param True as_lists: convert coordinates, objective function logs and
+           comparisons of models to lists and in-memory arrays (otherwise they
+           might be views of memory mapped arrays)
 
         :returns: this dictionary
         """
@@ -3081,10 +3177,20 @@ class StructuralModels(object):
         if 'objfun' in minimal:
             for m in self.__models:
                 self.__models[m]['log_objfun'] = None
-            to_save['models']    = self.__models
-        else:
-            to_save['models']    = self.__models
-        to_save['bad_models']    = self._bad_models
+        # coordinates are saved as lists, not as views of the array of
+        # coordinates of the models
+        for key, models in (('models', self.__models),
+                            ('bad_models', self._bad_models)):
+            to_save[key] = {}
+            for m, mdl in (models.items() if isinstance(models, dict)
+                           else enumerate(models)):
+                to_save[key][m] = copy(mdl)
+                if not as_lists:
+                    continue
+                for axis in 'xyz':
+                    to_save[key][m][axis] = list(map(float, mdl[axis]))
+                if isinstance(mdl.get('log_objfun'), np.ndarray):
+                    to_save[key][m]['log_objfun'] = mdl['log_objfun'].tolist()
         to_save['description']   = self.description
         to_save['nloci']         = self.nloci
         to_save['clusters']      = self.clusters
@@ -3094,6 +3200,11 @@ class StructuralModels(object):
         to_save['zscore']        = {} if 'zscores' in minimal else self._zscores
         to_save['restraints']    = {} if 'restraints' in minimal else self._restraints
         to_save['zeros']         = self._zeros
+        to_save['comparisons']   = self._comparisons
+        if as_lists:
+            to_save['comparisons'] = dict(
+                (k, (compared, np.array(comparison)))
+                for k, (compared, comparison) in self._comparisons.items())
 
         return to_save
 
@@ -66,8 +66,87 @@ def parse_header(fname, resolution=None):
     
     return chroms
 
+PIXELS_CHUNK = 2**22  # number of pixels read at once from the cooler
+
+
+def _region_bins(root_grp, resolution, region=None):
+    """
+    :param None region: a chromosome name, a tuple (chromosome, start, end)
+       or None for the whole genome
+
+    :returns: the first and last (excluded) bins of the region
+    """
+    if region is None:
+        return 0, root_grp["bins"]["start"].shape[0]
+    if isinstance(region, (list, tuple)):
+        crm, beg, end = region
+    else:
+        crm, beg, end = region, None, None
+    names = root_grp["chroms"]["name"][()]
+    try:
+        names = [c.decode() for c in names]
+    except (UnicodeDecodeError, AttributeError):
+        names = [str(c) for c in names]
+    try:
+        idx = names.index(crm)
+    except ValueError:
+        raise KeyError('ERROR: chromosome %s not in cooler' % crm)
+    chrom_offset = root_grp["indexes"]["chrom_offset"][idx:idx + 2]
+    lo, hi = int(chrom_offset[0]), int(chrom_offset[1])
+    if end is not None:
+        hi = min(hi, lo + int(ceil(end / resolution)))
+    if beg is not None:
+        lo = min(hi, lo + int(beg) // resolution)
+    return lo, hi
+
+
+def _iter_pixels(root_grp, lo, hi, chunksize=PIXELS_CHUNK):
+    """
+    Read the pixels with both bins inside [lo, hi), using the bin1 index to
+    only touch the rows of the region.
+
+    :returns: an iterator of arrays (bin1, bin2, count), with bins relative
+       to lo
+    """
+    pixels = root_grp["pixels"]
+    offsets = root_grp["indexes"]["bin1_offset"][lo:hi + 1]
+    beg, end = int(offsets[0]), int(offsets[-1])
+    full = lo == 0 and hi == root_grp["bins"]["start"].shape[0]
+    for pos in range(beg, end, chunksize):
+        stop = min(pos + chunksize, end)
+        bin1 = pixels["bin1_id"][pos:stop]
+        bin2 = pixels["bin2_id"][pos:stop]
+        count = pixels["count"][pos:stop]
+        if not full:
+            keep = (bin2 >= lo) & (bin2 < hi)
+            bin1, bin2, count = bin1[keep], bin2[keep], count[keep]
+        yield bin1 - lo, bin2 - lo, count
+
+
+def cooler_pixels(fname, resolution=None, region=None,
+                  chunksize=PIXELS_CHUNK):
+    """
+    Iterate over the pixels stored in a cooler, by chunks
+
+    :param fname: path to the cooler file
+    :param None resolution: matrix resolution.
+    :param None region: a chromosome name or a tuple (chromosome, start, end)
+       to read only the interactions inside this region
+    :param PIXELS_CHUNK chunksize: number of pixels read at once
+
+    :returns: an iterator of arrays (bin1, bin2, count), with bins relative
+       to the first bin of the region
+    """
+    with h5py.File(fname, "r") as f:
+        resolution = resolution or list(f['resolutions'].keys())[0]
+        root_grp = f['resolutions'][str(resolution)]
+        lo, hi = _region_bins(root_grp, int(resolution), region)
+        for bin1, bin2, count in _iter_pixels(root_grp, lo, hi, chunksize):
+            yield bin1, bin2, count
+
+
 def parse_cooler(fname, resolution=None, normalized=False,
-                 raw_values = False):
+                 raw_values = False, region=None):
     """
     Read matrix stored in cooler
 
@@ -75,53 +154,63 @@ def parse_cooler(fname, resolution=None, normalized=False,
     :param None resolution: matrix resolution.
     :param False normalized: whether to apply weights
     :param False raw_values: return separated raw and weights
+    :param None region: a chromosome name or a tuple (chromosome, start, end)
+       to read only the interactions inside this region
 
-    :returns: An iterator to be converted in dictionary, matrix size, raw_names
-       as list of tuples (chr, pos), dictionary of masked bins, and boolean
-       reporter of symetric transformation
+    :returns: An array of (position, value) to be converted in dictionary,
+       matrix size, raw_names as list of tuples (chr, pos), dictionary of
+       masked bins, and boolean reporter of symetric transformation
     """
 
     with h5py.File(fname, "r") as f:
 
         resolution = resolution or list(f['resolutions'].keys())[0]
         root_grp = f['resolutions'][str(resolution)]
+        resolution = int(resolution)
+        lo, hi = _region_bins(root_grp, resolution, region)
+        size = hi - lo
 
         chrom = root_grp["chroms"]["name"][()]
-        idregion = dict(list(zip(list(range(len(chrom))), [reg for reg in chrom])))
-
         try:
-            chrom = [idregion[c].decode() for c in root_grp["bins"]["chrom"]]
+            chrom = [c.decode() for c in chrom]
         except (UnicodeDecodeError, AttributeError):
-            chrom = [str(idregion[c]) for c in root_grp["bins"]["chrom"]]
+            chrom = [str(c) for c in chrom]
+        chrom_ids = root_grp["bins"]["chrom"][lo:hi]
+        starts = root_grp["bins"]["start"][lo:hi]
 
         if raw_values:
-            starts = root_grp["bins"]["start"]
             header = OrderedDict()
-            for chromi, starti in zip(chrom, starts):
-                header[chromi] = starti // resolution + 1
-            size = 0
-            for chromi in header:
-                size += header[chromi] 
+            if size:
+                # last bin of each chromosome
+                ends = np.r_[np.flatnonzero(np.diff(chrom_ids)), size - 1]
+                for i in ends:
+                    header[chrom[chrom_ids[i]]] = starts[i] // resolution + 1
         else:
-            starts = ['%d-%d'%(c+1,c+int(resolution)) for c in root_grp["bins"]["start"]]
-            header = [(chromi, starti) for chromi, starti in zip(chrom, starts)]
-            size = len(header)
+            header = [(chrom[c], '%d-%d' % (s + 1, s + resolution))
+                      for c, s in zip(chrom_ids.tolist(), starts.tolist())]
         masked = {}
+        weights = None
         if normalized and "weight" in root_grp["bins"]:
-            weights = root_grp["bins"]["weight"][()]
-        else:
-            weights = [1 for _ in range(size)]
-        bin1_id = root_grp["pixels"]["bin1_id"][()]
-        bin2_id = root_grp["pixels"]["bin2_id"][()]
-        counti = root_grp["pixels"]["count"][()]
-        num = int if not normalized else float
-        if raw_values:
-            items = [(int(row) + int(col) * size, num(val))
-                 for row, col, val in zip(bin1_id, bin2_id, counti)]
-        else:
-            items = [(int(row) + int(col) * size, num(val)*weights[row]*weights[col])
-                     for row, col, val in zip(bin1_id, bin2_id, counti)]
+            weights = root_grp["bins"]["weight"][lo:hi]
+
+        items = []
+        for bin1, bin2, count in _iter_pixels(root_grp, lo, hi):
+            chunk = np.empty(len(count), dtype=[
+                ('pos', np.int64),
+                ('val', np.float64 if normalized else np.int64)])
+            chunk['pos'] = bin1 + bin2 * size
+            chunk['val'] = count
+            if weights is not None and not raw_values:
+                chunk['val'] *= weights[bin1]
+                chunk['val'] *= weights[bin2]
+            items.append(chunk)
+    if items:
+        items = np.concatenate(items)
+    else:
+        items = np.empty(0, dtype=[('pos', np.int64), ('val', np.int64)])
     if raw_values:
+        if weights is None:
+            weights = [1 for _ in range(size)]
         return items, weights, size, header
     else:
         return items, size, header, masked, False
@@ -341,6 +430,31 @@ class cooler_file(object):
         self.nbuff += 1
         self.ichunk = ichunk
 
+    def write_pixels(self, bin1, bin2, counts):
+        """
+        Write a block of pixels to the h5py file. Pixels must be sorted by
+        row and column, and come after the ones already written.
+
+        :param bin1: array of row numbers
+        :param bin2: array of column numbers
+        :param counts: array of interaction values
+
+        """
+        nblock = len(counts)
+        if not nblock:
+            return
+        with h5py.File(self.outcool, "r+") as f:
+            root_grp = f[self.root_grp][str(self.resolution)]
+            grp = root_grp["pixels"]
+            for dset, data in (
+                    ("bin1_id", np.asarray(bin1, dtype=np.int64) + (self.startj - self.sec_offset)),
+                    ("bin2_id", np.asarray(bin2, dtype=np.int64) + (self.startk - self.sec_offset)),
+                    ("count"  , counts)):
+                grp[dset].resize((self.nnz + nblock,))
+                grp[dset][self.nnz : self.nnz + nblock] = data
+        self.nnz += nblock
+        self.ncontacts += int(np.sum(counts, dtype=np.int64))
+
     def close(self):
         """
         Copy remaining buffer to file, index the pixelsand complete information
@@ -8,10 +8,17 @@ from __future__ import print_function
 from collections import OrderedDict
 import multiprocessing as mu
 from os import path
+import os
 import re
+import json
+try:
+    from collections.abc import Mapping
+except ImportError:  # python 2
+    from collections import Mapping
+
+import numpy as np
 
 from pytadbit.utils.file_handling import magic_open
-from functools import reduce
 
 try:
     basestring
@@ -41,11 +48,28 @@ def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
     if isinstance(f_names, basestring):
         f_names = [f_names]
 
-    if len(f_names) == 1:
-        fname = f_names[0] + '_genome.TADbit'
+    if chr_filter:
+        bad_chrom = lambda x: not x in chr_filter
     else:
-        fname = path.join(path.commonprefix(f_names), 'genome.TADbit')
+        bad_chrom = lambda x: False
+
+    if chr_regexp:
+        chr_regexp = re.compile(chr_regexp)
+    else:
+        chr_regexp = re.compile('.*')
+
+    fname = get_genome_cache_path(f_names)
+    if path.exists(fname + '.idx') and not reload_cache:
+        if verbose:
+            print('Loading cached genome')
+        genome_seq = CachedGenome(fname)
+        wanted = [c for c in genome_seq
+                  if not bad_chrom(c) and chr_regexp.match(c)]
+        if only_length:
+            return OrderedDict((c, genome_seq.length(c)) for c in wanted)
+        return CachedGenome(fname, chromosomes=wanted)
     if path.exists(fname) and not reload_cache:
+        # genome cached as text by previous versions
         if verbose:
             print('Loading cached genome')
         genome_seq = OrderedDict()
@@ -63,16 +87,6 @@ def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
     if isinstance(chr_names, basestring):
         chr_names = [chr_names]
 
-    if chr_filter:
-        bad_chrom = lambda x: not x in chr_filter
-    else:
-        bad_chrom = lambda x: False
-
-    if chr_regexp:
-        chr_regexp = re.compile(chr_regexp)
-    else:
-        chr_regexp = re.compile('.*')
-
     genome_seq = OrderedDict()
     if len(f_names) == 1:
         header = None
@@ -133,17 +147,127 @@ def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
     if save_cache and not only_length:
         if verbose:
             print('saving genome in cache')
-        if len(f_names) == 1:
-            fname = f_names[0] + '_genome.TADbit'
-        else:
-            fname = path.join(path.commonprefix(f_names), 'genome.TADbit')
-        out = open(fname, 'w')
-        for c in genome_seq:
-            out.write('>%s\n%s\n' % (c, genome_seq[c]))
-        out.close()
+        write_genome_cache(fname, genome_seq)
     return genome_seq
 
 
+def write_genome_cache(fname, genome_seq):
+    """
+    Save a genome in binary format: the sequences, one byte per nucleotide,
+    are concatenated in the file fname + '.seq', and their names, offsets and
+    lengths are stored as JSON in the file fname + '.idx'
+
+    :param fname: path prefix of the cache
+    :param genome_seq: a dictionary containing the genomic sequence by
+       chromosome
+    """
+    index = []
+    offset = 0
+    # write and rename, as other processes may be reading it
+    with open(fname + '.seq_tmp', 'wb') as out:
+        for crm in genome_seq:
+            seq = genome_seq[crm]
+            if not isinstance(seq, bytes):
+                seq = seq.encode('ascii')
+            out.write(seq)
+            index.append([crm, offset, len(seq)])
+            offset += len(seq)
+    with open(fname + '.idx_tmp', 'w') as out:
+        json.dump(index, out)
+    os.rename(fname + '.seq_tmp', fname + '.seq')
+    os.rename(fname + '.idx_tmp', fname + '.idx')
+
+
+class CachedGenome(Mapping):
+    """
+    Genome loaded from the binary cache written by
+    :func:`pytadbit.parsers.genome_parser.write_genome_cache`.
+
+    Behaves as the (read-only) dictionary of sequences returned by
+    :func:`pytadbit.parsers.genome_parser.parse_fasta`, but sequences are only
+    read, from a memory mapped file, when accessed. Pickling only stores the
+    path to the cache, so it can be cheaply passed to other processes.
+
+    :param fname: path prefix of the cache
+    :param None chromosomes: only use these chromosomes
+    """
+    def __init__(self, fname, chromosomes=None):
+        self.fname = fname
+        with open(fname + '.idx') as f_open:
+            index = json.load(f_open)
+        if chromosomes is not None:
+            chromosomes = set(chromosomes)
+        self._index = OrderedDict(
+            (crm, (offset, length)) for crm, offset, length in index
+            if chromosomes is None or crm in chromosomes)
+        self._chromosomes = chromosomes
+        self._seqs = None
+
+    def __getstate__(self):
+        return self.fname, self._chromosomes
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def array(self, crm):
+        """
+        :returns: the sequence of a chromosome as a read-only array of bytes
+           (uint8), memory mapped
+        """
+        offset, length = self._index[crm]
+        if not length:
+            return np.zeros(0, dtype=np.uint8)
+        if self._seqs is None:
+            self._seqs = np.memmap(self.fname + '.seq', dtype=np.uint8,
+                                   mode='r')
+        return self._seqs[offset:offset + length]
+
+    def length(self, crm):
+        """
+        :returns: the length of a chromosome
+        """
+        return self._index[crm][1]
+
+    def __getitem__(self, crm):
+        seq = self.array(crm).tobytes()
+        return seq if isinstance(seq, str) else seq.decode('ascii')
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, crm):
+        return crm in self._index
+
+
+def chromosome_lengths(genome_seq):
+    """
+    :param genome_seq: a dictionary containing the genomic sequence by
+       chromosome
+
+    :returns: a dictionary with the length of each chromosome (sequences of
+       cached genomes are not read)
+    """
+    if isinstance(genome_seq, CachedGenome):
+        return OrderedDict((crm, genome_seq.length(crm)) for crm in genome_seq)
+    return OrderedDict((crm, len(genome_seq[crm])) for crm in genome_seq)
+
+
+def get_genome_cache_path(f_names):
+    """
+    :param f_names: list of pathes to fasta files, or just a single path
+
+    :returns: path to the cached version of the parsed genome
+    """
+    if isinstance(f_names, basestring):
+        f_names = [f_names]
+    if len(f_names) == 1:
+        return f_names[0] + '_genome.TADbit'
+    return path.join(path.commonprefix(f_names), 'genome.TADbit')
+
+
 def get_gc_content(genome, resolution, chromosomes=None, n_cpus=None, by_chrom=False):
     """
     Get GC content by bins of a given size. Ns are nottaken into account in the
@@ -156,42 +280,159 @@ def get_gc_content(genome, resolution, chromosomes=None, n_cpus=None, by_chrom=F
        chromosomes)
     :param False by_chrom: if False returns a unique list for the full genome
     """
+    features = get_bin_features(genome, resolution, chromosomes=chromosomes,
+                                n_cpus=n_cpus, by_chrom=True)
+    if by_chrom:
+        return dict((crm, dict(enumerate(features[crm]['gc'].tolist())))
+                    for crm in features)
+    return np.concatenate([features[crm]['gc'] for crm in features]).tolist()
+
+
+def get_bin_features(genome, resolution, chromosomes=None, re_site=None,
+                     re_margin=200, mappability=None, n_cpus=1,
+                     by_chrom=False):
+    """
+    Get the features of the sequence of each bin of a given size, used by
+    oneD normalization:
+      - gc: GC content (Gs and Cs over As, Ts, Gs and Cs, NaN if only Ns)
+      - n_frac: proportion of Ns
+      - n_rsites: number of restriction sites (if re_site), counted in the bin
+        and in the 2 * re_margin following nucleotides
+      - mappability: average mappability (if mappability), NaN for the bins
+        without value
+
+    :param genome: a TADbit parsed genome object
+    :param resolution: size of the bins
+    :param None chromosomes: features only calculated over these chromosomes
+    :param None re_site: sequence of the restriction site
+    :param 200 re_margin: extra nucleotides considered to count restriction
+       sites
+    :param None mappability: dictionary of chromosomes with the list of
+       mappability values per bin (as returned by
+       :func:`pytadbit.parsers.bed_parser.parse_mappability_bedGraph`)
+    :param 1 n_cpus: parallelize (can't parallelize more than the number of
+       chromosomes)
+    :param False by_chrom: if False returns arrays for the full genome
+
+    :returns: a dictionary of numpy arrays, or a dictionary of these
+       dictionaries per chromosome
+    """
     chromosomes = chromosomes if chromosomes else list(genome.keys())
     if not n_cpus:
         n_cpus = mu.cpu_count()
-    pool = mu.Pool(n_cpus)
-    get_chr_gc = _get_chr_gc_dico if by_chrom else _get_chr_gc_list
-    jobs = {}
-    for crm in chromosomes:
-        jobs[crm] = pool.apply_async(get_chr_gc, args=(genome[crm], resolution))
-    pool.close()
-    pool.join()
+    if n_cpus > 1 and len(chromosomes) > 1:
+        pool = mu.Pool(min(n_cpus, len(chromosomes)))
+        if isinstance(genome, CachedGenome):
+            # only the path to the cache is sent to the workers
+            jobs = dict((crm, pool.apply_async(_cached_bin_features, args=(
+                genome, crm, resolution, re_site, re_margin)))
+                        for crm in chromosomes)
+        else:
+            jobs = dict((crm, pool.apply_async(_chr_bin_features, args=(
+                genome[crm], resolution, re_site, re_margin)))
+                        for crm in chromosomes)
+        pool.close()
+        pool.join()
+        features = OrderedDict((crm, jobs[crm].get()) for crm in chromosomes)
+    else:
+        features = OrderedDict((crm, _cached_bin_features(
+            genome, crm, resolution, re_site, re_margin))
+                               for crm in chromosomes)
+    if mappability is not None:
+        for crm in chromosomes:
+            nbins = features[crm]['gc'].shape[0]
+            values = np.full(nbins, np.nan)
+            crm_map = mappability.get(crm, [])[:nbins]
+            values[:len(crm_map)] = crm_map
+            features[crm]['mappability'] = values
     if by_chrom:
-        gc_content = dict((crm, jobs[crm].get()) for crm in chromosomes)
+        return features
+    return dict((k, np.concatenate([features[crm][k] for crm in chromosomes]))
+                for k in features[chromosomes[0]]) if chromosomes else {}
+
+
+def _non_overlapping(sites, length):
+    """
+    Remove occurrences overlapping the previous one (as str.count).
+    """
+    keep = [sites[0]]
+    for site in sites[1:].tolist():
+        if site >= keep[-1] + length:
+            keep.append(site)
+    return np.array(keep, dtype=sites.dtype)
+
+
+def _count_per_bin(mask, resolution):
+    """
+    Number of True values in each bin of a boolean array.
+    """
+    full = mask.shape[0] // resolution * resolution
+    counts = np.count_nonzero(mask[:full].reshape(-1, resolution), axis=1)
+    if full < mask.shape[0]:
+        counts = np.r_[counts, np.count_nonzero(mask[full:])]
+    return counts
+
+
+def _cached_bin_features(genome, crm, resolution, re_site=None, re_margin=200):
+    if isinstance(genome, CachedGenome):
+        return _chr_bin_features(genome.array(crm), resolution, re_site,
+                                 re_margin)
+    return _chr_bin_features(genome[crm], resolution, re_site, re_margin)
+
+
+def _chr_bin_features(chrom, resolution, re_site=None, re_margin=200,
+                      block=2**24):
+    """
+    GC content, proportion of Ns and number of restriction sites per bin of a
+    chromosome, computed by blocks of bins over a bytes view of the sequence
+    (or directly over an array of bytes).
+    """
+    if isinstance(chrom, np.ndarray):
+        seq = chrom
     else:
-        gc_content = reduce(lambda x,y: x + y, (jobs[crm].get() for crm in chromosomes))
-    return gc_content
-
-
-def _get_chr_gc_list(chrom, resolution):
-    gc_content = []
-    for pos in range(0, len(chrom), resolution):
-        seq = chrom[pos:pos + resolution]
-        try:
-            gc_content.append(float(seq.count('G') + seq.count('C')) /
-                              (len(seq) - seq.count('N')))
-        except ZeroDivisionError:
-            gc_content.append(float('nan'))
-    return gc_content
-
-
-def _get_chr_gc_dico(chrom, reso):
-    gc_content = {}
-    for pos in range(0, len(chrom), reso):
-        seq = chrom[pos:pos + reso]
-        try:
-            gc_content[pos  /reso] = (float(seq.count('G') + seq.count('C')) /
-                                      (len(seq) - seq.count('N')))
-        except ZeroDivisionError:
-            gc_content[pos  /reso] = float('nan')
-    return gc_content
+        if not isinstance(chrom, bytes):
+            chrom = chrom.encode('ascii')
+        seq = np.frombuffer(chrom, dtype=np.uint8)
+    size = seq.shape[0]
+    nbins = -(-size // resolution)
+    lens = np.full(nbins, resolution, dtype=np.int64)
+    if nbins:
+        lens[-1] = size - (nbins - 1) * resolution
+    gcs = np.zeros(nbins, dtype=np.int64)
+    nns = np.zeros(nbins, dtype=np.int64)
+    sites = []
+    if re_site:
+        re_seq = np.frombuffer(re_site.encode('ascii'), dtype=np.uint8)
+    step = max(1, block // resolution) * resolution
+    for beg in range(0, size, step):
+        end = min(beg + step, size)
+        sub = seq[beg:end]
+        is_gc = sub == ord('G')
+        is_gc |= sub == ord('C')
+        counts = _count_per_bin(is_gc, resolution)
+        gcs[beg // resolution:beg // resolution + counts.shape[0]] = counts
+        counts = _count_per_bin(sub == ord('N'), resolution)
+        nns[beg // resolution:beg // resolution + counts.shape[0]] = counts
+        if re_site:
+            # restriction sites starting in this block
+            nstart = min(end, size - len(re_seq) + 1) - beg
+            if nstart > 0:
+                match = np.ones(nstart, dtype=bool)
+                for i, nt in enumerate(re_seq):
+                    match &= seq[beg + i:beg + i + nstart] == nt
+                sites.append(np.flatnonzero(match) + beg)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        gc_content = gcs / (lens - nns).astype(float)
+    features = {'gc'    : gc_content,
+                'n_frac': nns / lens.astype(float)}
+    if re_site:
+        sites = np.concatenate(sites) if sites else np.zeros(0, dtype=np.int64)
+        if sites.shape[0] and (np.diff(sites) < len(re_seq)).any():
+            sites = _non_overlapping(sites, len(re_seq))
+        # sites fully contained in the bin extended by 2 * re_margin
+        win_beg = np.arange(nbins, dtype=np.int64) * resolution
+        win_end = np.minimum(win_beg + resolution + 2 * re_margin, size)
+        features['n_rsites'] = np.maximum(
+            0, sites.searchsorted(win_end - len(re_seq) + 1) -
+            sites.searchsorted(win_beg))
+    return features
@@ -22,9 +22,12 @@ from io                           import StringIO
 from shutil                       import copyfile
 from sys                          import stdout, stderr, exc_info, modules
 from distutils.version            import LooseVersion
+from array                        import array
 import os
 import multiprocessing as mu
 
+import numpy as np
+
 try:
     from lockfile                 import LockFile
 except ImportError:
@@ -39,8 +42,12 @@ from pysam                        import AlignmentFile
 from pytadbit.utils                 import printime
 from pytadbit.utils.file_handling   import mkdir, which
 from pytadbit.utils.extraviews      import nicer
-from pytadbit.mapping.filter        import MASKED
+from pytadbit.mapping.filter        import MASKED, load_filter_mask
+from pytadbit.utils.normalize_hic   import iterative_from_pixels
+from pytadbit.parsers.matrix_cache  import load_cached_pixels, store_cached_pixels
+from pytadbit.parsers.matrix_cache  import CACHE_MAX_SIZE
 try:
+    import h5py
     from pytadbit.parsers.cooler_parser import cooler_file
 except ImportError:
     pass
@@ -213,7 +220,7 @@ def bed2D_to_BAMhic(infile, valid, ncpus, outbam, frmt, masked=None, samtools='s
     2D beds into compressed BAM format.
 
     Gets the *_both_filled_map.tsv contacts from TADbit (and the corresponding
-    filter files) and outputs a modified indexed BAM with the following fields:
+    filter bitmask, or filter files) and outputs a modified indexed BAM with the following fields:
 
        - read ID
        - filtering flag (see codes in header)
@@ -278,9 +285,14 @@ def bed2D_to_BAMhic(infile, valid, ncpus, outbam, frmt, masked=None, samtools='s
     output += ("\t".join(("@CO" ,"S1:i", "Strand of the 1st read-end (1: positive, 0: negative)\n")))
     output += ("\t".join(("@CO" ,"S2:i", "Strand of the 2nd read-end  (1: positive, 0: negative)\n")))
 
-    # open and init filter files
+    # open and init filter bitmask, or filter files
+    mask = None
     if not valid:
-        filter_line, filter_handler = get_filters(infile, masked)
+        mask_fnam = get_filter_mask(infile, masked)
+        if mask_fnam:
+            mask, _ = load_filter_mask(infile, mask_fnam)
+        else:
+            filter_line, filter_handler = get_filters(infile, masked)
     fhandler.seek(pos_fh)
     # check samtools version number and modify command line
     version = LooseVersion([l.split()[1]
@@ -306,6 +318,12 @@ def bed2D_to_BAMhic(infile, valid, ncpus, outbam, frmt, masked=None, samtools='s
             flag = 0
             # get output in sam format
             proc.stdin.write(map2sam(line, flag))
+    elif mask is not None:
+        # bits of the mask are the FLAG values
+        flags = (flag for beg in range(0, len(mask), 1000000)
+                 for flag in mask[beg:beg + 1000000].tolist())
+        for line, flag in zip(fhandler, flags):
+            proc.stdin.write(map2sam(line, flag))
     else:
         for line in fhandler:
             flag = 0
@@ -328,11 +346,29 @@ def bed2D_to_BAMhic(infile, valid, ncpus, outbam, frmt, masked=None, samtools='s
 
     # close file handlers
     fhandler.close()
-    if not valid:
+    if not valid and mask is None:
         for i in filter_handler:
             filter_handler[i].close()
 
 
+def get_filter_mask(infile, masked):
+    """
+    get the path to the filter bitmask, None if filters are only available as
+    files of read IDs
+    """
+    if masked:
+        mask_fnams = set(masked[i].get('mask') for i in masked
+                         if 'mask' in masked[i] or 'fnam' in masked[i])
+        if len(mask_fnams) == 1:
+            return mask_fnams.pop()
+        return None
+    if os.path.exists(infile + '_filters.npy'):
+        stderr.write('Using filter bitmask:\n   - %s\n' % (
+            infile + '_filters.npy'))
+        return infile + '_filters.npy'
+    return None
+
+
 def get_filters(infile, masked):
     """
     get all filters
@@ -352,7 +388,7 @@ def get_filters(infile, masked):
         filter_files = {}
         stderr.write('Using filter files:\n')
         for fname in os.listdir(dirname):
-            if fname.startswith(basename + "_"):
+            if fname.startswith(basename + "_") and not fname.endswith('.npy'):
                 key = fname.replace(basename + "_", "").replace(".tsv", "")
                 filter_files[key] = dirname + "/" + fname
             stderr.write('   - %-20s %s\n' %(key, fname))
@@ -367,15 +403,89 @@ def get_filters(infile, masked):
     return filter_line, filter_handler
 
 
+# compact record used to spill the pixels of each BAM chunk to disk: crm is
+# the index of the chromosome in the BAM header (-1 for trans interactions)
+PIXEL_DTYPE = np.dtype([('bin1', np.int32), ('bin2', np.int32),
+                        ('crm', np.int32), ('count', np.int32)])
+
+
+def _aggregate_pixels(bins1, bins2, crms):
+    """
+    Sort and count pairs of bins into an array of unique pixels.
+
+    :param bins1: array of row bins, one per read pair
+    :param bins2: array of column bins, one per read pair
+    :param crms: array of chromosome indexes, one per read pair
+
+    :returns: an array of PIXEL_DTYPE sorted by bin1 and bin2
+    """
+    bins1 = np.asarray(bins1, dtype=np.int32)
+    bins2 = np.asarray(bins2, dtype=np.int32)
+    crms  = np.asarray(crms , dtype=np.int32)
+    if not len(bins1):
+        return np.empty(0, dtype=PIXEL_DTYPE)
+    order = np.lexsort((bins2, bins1))
+    bins1 = bins1[order]
+    bins2 = bins2[order]
+    starts = np.flatnonzero(np.r_[True, (bins1[1:] != bins1[:-1]) |
+                                  (bins2[1:] != bins2[:-1])])
+    pixels = np.empty(len(starts), dtype=PIXEL_DTYPE)
+    pixels['bin1' ] = bins1[starts]
+    pixels['bin2' ] = bins2[starts]
+    pixels['crm'  ] = crms[order[starts]]
+    pixels['count'] = np.diff(np.r_[starts, len(bins1)])
+    return pixels
+
+
+def _sum_pixels(pixels):
+    """
+    Sort an array of pixels and sum the counts of repeated pixels.
+    """
+    pixels = pixels[np.lexsort((pixels['bin2'], pixels['bin1']))]
+    bins1 = pixels['bin1']
+    bins2 = pixels['bin2']
+    starts = np.flatnonzero(np.r_[True, (bins1[1:] != bins1[:-1]) |
+                                  (bins2[1:] != bins2[:-1])])
+    if len(starts) >= len(pixels):
+        return pixels
+    counts = np.add.reduceat(pixels['count'], starts)
+    pixels = pixels[starts]
+    pixels['count'] = counts
+    return pixels
+
+
+def _merge_pixels(pixels1, pixels2):
+    """
+    Merge two sorted arrays of pixels, summing the counts of shared pixels.
+    """
+    if not len(pixels1):
+        return pixels2
+    if not len(pixels2):
+        return pixels1
+    return _sum_pixels(np.concatenate((pixels1, pixels2)))
+
+
+def _chunk_fname(tmpdir, rand_hash, region, start, end):
+    return os.path.join(tmpdir, '_tmp_%s' % (rand_hash),
+                        '%s:%d-%d.npy' % (region, start, end))
+
+
 def _read_bam_frag(inbam, filter_exclude, all_bins, sections1, sections2,
                    rand_hash, resolution, tmpdir, region, start, end,
-                   sum_columns=False):
+                   half=False):
     bamfile = AlignmentFile(inbam, 'rb')
     refs = bamfile.references
+    crm_idx = dict((crm, i) for i, crm in enumerate(refs))
     bam_start = start - START_ALIGNMENT
     bam_start = max(0, bam_start)
+    # reads overlapping the borders are fetched by two chunks, only count them
+    # in the one where they start
+    first_bin = start // resolution
+    last_bin  = end   // resolution
     try:
-        dico = {}
+        bins1 = array('i')
+        bins2 = array('i')
+        crms  = array('i')
         for r in bamfile.fetch(region=region,
                                start=bam_start, end=end,  # coords starts at 0
                                multiple_iterators=True):
@@ -385,37 +495,21 @@ def _read_bam_frag(inbam, filter_exclude, all_bins, sections1, sections2,
             pos1 = r.reference_start + 1
             crm2 = refs[r.mrnm]
             pos2 = r.mpos + 1
+            pos1 = pos1 // resolution
+            if not first_bin <= pos1 <= last_bin:
+                continue
             try:
-                pos1 = sections1[(crm1, pos1 // resolution)]
+                pos1 = sections1[(crm1, pos1)]
                 pos2 = sections2[(crm2, pos2 // resolution)]
             except KeyError:
                 continue  # not in the subset matrix we want
-            crm = crm1 * (crm1 == crm2)
-            try:
-                dico[(crm, pos1, pos2)] += 1
-            except KeyError:
-                dico[(crm, pos1, pos2)] = 1
-            # print '%-50s %5s %9s %5s %9s' % (r.query_name,
-            #                                  crm1, r.reference_start + 1,
-            #                                  crm2, r.mpos + 1)
-        out = open(os.path.join(tmpdir, '_tmp_%s' % (rand_hash),
-                                '%s:%d-%d.tsv' % (region, start, end)), 'w')
-        out.write(''.join('%s\t%d\t%d\t%d\n' % (c, a, b, v)
-                          for (c, a, b), v in dico.items()))
-        out.close()
-        if sum_columns:
-            sumcol = {}
-            cisprc = {}
-            for (c, i, j), v in dico.items():
-                # out.write('%d\t%d\t%d\n' % (i, j, v))
-                try:
-                    sumcol[i] += v
-                    cisprc[i][all_bins[i][0] == all_bins[j][0]] += v
-                except KeyError:
-                    sumcol[i]  = v
-                    cisprc[i]  = [0, 0]
-                    cisprc[i][all_bins[i][0] == all_bins[j][0]] += v
-            return sumcol, cisprc
+            if half and pos1 > pos2:
+                continue
+            bins1.append(pos1)
+            bins2.append(pos2)
+            crms.append(crm_idx[crm1] if crm1 == crm2 else -1)
+        np.save(_chunk_fname(tmpdir, rand_hash, region, start, end),
+                _aggregate_pixels(bins1, bins2, crms))
     except Exception as e:
         exc_type, exc_obj, exc_tb = exc_info()
         fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
@@ -424,80 +518,18 @@ def _read_bam_frag(inbam, filter_exclude, all_bins, sections1, sections2,
 
 
 def _read_half_bam_frag(inbam, filter_exclude, all_bins, sections1, sections2,
-                        rand_hash, resolution, tmpdir, region, start, end,
-                        sum_columns=False):
-    bamfile = AlignmentFile(inbam, 'rb')
-    refs = bamfile.references
-    bam_start = start - START_ALIGNMENT
-    bam_start = max(0, bam_start)
-    section_pos = []
-    for sec in sections1:
-        if sec not in section_pos:
-            section_pos.append(sec[0])
-    for sec in sections2:
-        if sec not in section_pos:
-            section_pos.append(sec[0])
-    try:
-        dico = {}
-        for r in bamfile.fetch(region=region,
-                               start=bam_start, end=end,  # coords starts at 0
-                               multiple_iterators=True):
-            if r.flag & filter_exclude:
-                continue
-            crm1 = r.reference_name
-            pos1 = r.reference_start + 1
-            crm2 = refs[r.mrnm]
-            pos2 = r.mpos + 1
-            try:
-                pos1 = sections1[(crm1, pos1 // resolution)]
-                pos2 = sections2[(crm2, pos2 // resolution)]
-            except KeyError:
-                continue  # not in the subset matrix we want
-            if crm1 == crm2:
-                crm = crm1
-                if pos1 > pos2:
-                    continue
-            else:
-                if pos1 > pos2:
-                    continue
-                crm = ''
-            try:
-                dico[(crm, pos1, pos2)] += 1
-            except KeyError:
-                dico[(crm, pos1, pos2)] = 1
-            # print '%-50s %5s %9s %5s %9s' % (r.query_name,
-            #                                  crm1, r.reference_start + 1,
-            #                                  crm2, r.mpos + 1)
-        out = open(os.path.join(tmpdir, '_tmp_%s' % (rand_hash),
-                                '%s:%d-%d.tsv' % (region, start, end)), 'w')
-        out.write(''.join('%s\t%d\t%d\t%d\n' % (c, a, b, v)
-                          for (c, a, b), v in dico.items()))
-        out.close()
-        if sum_columns:
-            sumcol = {}
-            cisprc = {}
-            for (c, i, j), v in dico.items():
-                # out.write('%d\t%d\t%d\n' % (i, j, v))
-                try:
-                    sumcol[i] += v
-                    cisprc[i][all_bins[i][0] == all_bins[j][0]] += v
-                except KeyError:
-                    sumcol[i]  = v
-                    cisprc[i]  = [0, 0]
-                    cisprc[i][all_bins[i][0] == all_bins[j][0]] += v
-            return sumcol, cisprc
-    except Exception as e:
-        exc_type, exc_obj, exc_tb = exc_info()
-        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-        print(e)
-        print(exc_type, fname, exc_tb.tb_lineno)
+                        rand_hash, resolution, tmpdir, region, start, end):
+    return _read_bam_frag(inbam, filter_exclude, all_bins, sections1,
+                          sections2, rand_hash, resolution, tmpdir, region,
+                          start, end, half=True)
 
 
 def read_bam(inbam, filter_exclude, resolution, ncpus=8,
              region1=None, start1=None, end1=None,
              region2=None, start2=None, end2=None, nchunks=100,
              tmpdir='.', verbose=True, normalize=False, max_size=None,
-             chr_order=None, half=False):
+             chr_order=None, half=False, cache_dir=None,
+             cache_size=CACHE_MAX_SIZE):
 
     bamfile = AlignmentFile(inbam, 'rb')
     bam_refs = bamfile.references
@@ -653,14 +685,35 @@ def read_bam(inbam, filter_exclude, resolution, ncpus=8,
         raise Exception(('ERROR: matrix too large ({0}x{1}) should be at most '
                          '{2}x{2}').format(size1, size2, int(max_size**0.5)))
 
-    pool = mu.Pool(ncpus)
     # create random hash associated to the run:
     rand_hash = "%016x" % getrandbits(64)
+    mkdir(os.path.join(tmpdir, '_tmp_%s' % (rand_hash)))
+    bin_coords = start_bin1, end_bin1, start_bin2, end_bin2
+
+    if cache_dir:
+        # only rows in the chunks are read from the BAM
+        cached_rows = dict((k, v) for k, v in bins_dict1.items()
+                           if k[0] in (regions[:1] if region1 else section_pos)
+                           and start_bin1 <= section_pos[k[0]][0] + k[1] < end_bin1)
+        cache_region = '%s:%s-%s %s:%s-%s %s' % (
+            region1, start1, end1, region2, start2, end2,
+            ','.join(chr_order or []))
+        pixels = load_cached_pixels(cache_dir, inbam, resolution,
+                                    filter_exclude, cached_rows, bins_dict2,
+                                    half=half, region=cache_region)
+        if pixels is not None:
+            if verbose:
+                printime('  - Loading binned matrix from cache')
+            chunks = ['cache'], [0], [0]
+            np.save(_chunk_fname(tmpdir, rand_hash, 'cache', 0, 0),
+                    _sum_pixels(pixels))
+            return regions, rand_hash, bin_coords, chunks
+
+    pool = mu.Pool(ncpus)
 
     ## RUN!
     if verbose:
         printime('\n  - Parsing BAM (%d chunks)' % (len(regs)))
-    mkdir(os.path.join(tmpdir, '_tmp_%s' % (rand_hash)))
     # empty all_bins array if we are not going to normalize
     if not normalize:
         all_bins = []
@@ -680,40 +733,80 @@ def read_bam(inbam, filter_exclude, resolution, ncpus=8,
     if verbose:
         print_progress(procs)
     pool.join()
-    bin_coords = start_bin1, end_bin1, start_bin2, end_bin2
     chunks = regs, begs, ends
+    if cache_dir:
+        pixels = [np.empty(0, dtype=PIXEL_DTYPE)]
+        pixels.extend(_iter_pixel_blocks(chunks, tmpdir, rand_hash,
+                                         clean=True, verbose=False))
+        pixels = np.concatenate(pixels)
+        chunks = ['cache'], [0], [0]
+        np.save(_chunk_fname(tmpdir, rand_hash, 'cache', 0, 0), pixels)
+        store_cached_pixels(cache_dir, inbam, resolution, filter_exclude,
+                            cached_rows, bins_dict2, pixels, half=half,
+                            region=cache_region, max_size=cache_size)
     return regions, rand_hash, bin_coords, chunks
 
 
-def _iter_matrix_frags(chunks, tmpdir, rand_hash, clean=False, verbose=True,
-                       include_chunk_count=False):
+def _iter_pixel_blocks(chunks, tmpdir, rand_hash, clean=False, verbose=True):
+    """
+    K-way merge of the sorted pixel arrays spilled by each chunk of the BAM.
+
+    Chunks are visited in the order of their first row, rows smaller than the
+    first row of the next chunk are complete and can be yielded, the rest is
+    carried over and merged with the next chunk.
+
+    :returns: arrays of PIXEL_DTYPE, sorted by bin1 and bin2, with unique
+       pixels
+    """
+    fnames = [_chunk_fname(tmpdir, rand_hash, region, start, end)
+              for region, start, end in zip(*chunks)]
+    firsts = []
+    for fname in fnames:
+        pixels = np.load(fname, mmap_mode='r')
+        firsts.append(int(pixels['bin1'][0]) if len(pixels) else np.inf)
+        del pixels
+    order = sorted(range(len(fnames)), key=lambda i: firsts[i])
     if verbose:
         stdout.write('     ')
     countbin = 0
-    for countbin, (region, start, end) in enumerate(zip(*chunks)):
+    carry = np.empty(0, dtype=PIXEL_DTYPE)
+    for countbin, ichunk in enumerate(order):
         if verbose:
             if not countbin % 10 and countbin:
                 stdout.write(' ')
             if not countbin % 50 and countbin:
-                stdout.write(' %9s\n     ' % ('%s/%s' % (countbin , len(chunks[0]))))
+                stdout.write(' %9s\n     ' % ('%s/%s' % (countbin , len(fnames))))
             stdout.write('.')
             stdout.flush()
-
-        fname = os.path.join(tmpdir, '_tmp_%s' % (rand_hash),
-                             '%s:%d-%d.tsv' % (region, start, end))
-        if include_chunk_count:
-            for l in open(fname):
-                c, a, b, v = l.split('\t')
-                yield countbin, c, int(a), int(b), int(v)
-        else:
-            for l in open(fname):
-                c, a, b, v = l.split('\t')
-                yield c, int(a), int(b), int(v)
+        pixels = _merge_pixels(carry, np.load(fnames[ichunk]))
         if clean:
-            os.system('rm -f %s' % fname)
+            os.remove(fnames[ichunk])
+        if countbin + 1 < len(order):
+            cut = np.searchsorted(pixels['bin1'], firsts[order[countbin + 1]])
+        else:
+            cut = len(pixels)
+        if cut:
+            yield pixels[:cut]
+        carry = pixels[cut:]
     if verbose:
         print('%s %9s\n' % (' ' * (54 - (countbin % 50) - (countbin % 50) // 10),
-                            '%s/%s' % (len(chunks[0]),len(chunks[0]))))
+                            '%s/%s' % (len(fnames), len(fnames))))
+
+
+def _iter_matrix_frags(chunks, tmpdir, rand_hash, crm_names, clean=False,
+                       verbose=True, include_chunk_count=False):
+    # trans interactions are stored with chromosome index -1
+    crm_names = np.array(list(crm_names) + [''], dtype=object)
+    for countbin, pixels in enumerate(_iter_pixel_blocks(
+            chunks, tmpdir, rand_hash, clean=clean, verbose=verbose)):
+        block = zip(crm_names[pixels['crm']].tolist(), pixels['bin1'].tolist(),
+                    pixels['bin2'].tolist(), pixels['count'].tolist())
+        if include_chunk_count:
+            for c, a, b, v in block:
+                yield countbin, c, a, b, v
+        else:
+            for c, a, b, v in block:
+                yield c, a, b, v
 
 
 def get_biases_region(biases, bin_coords, check_resolution=None):
@@ -757,7 +850,8 @@ def get_matrix(inbam, resolution, biases=None,
                region1=None, start1=None, end1=None,
                region2=None, start2=None, end2=None, dico=None, clean=False,
                return_headers=False, tmpdir='.', normalization='raw', ncpus=8,
-               nchunks=100, verbose=False, max_size=None, chr_order=None):
+               nchunks=100, verbose=False, max_size=None, chr_order=None,
+               cache_dir=None, cache_size=CACHE_MAX_SIZE):
     """
     Get matrix from a BAM file containing interacting reads. The matrix
     will be extracted from the genomic BAM, the genomic coordinates of this
@@ -792,6 +886,11 @@ def get_matrix(inbam, resolution, biases=None,
     :param 100 nchunks: maximum number of chunks into which to cut the BAM
     :param None max_size: maximum size of matrix to read
     :param None chr_order: chromosome order
+    :param None cache_dir: path to a working directory where to cache the
+       binned matrices (recorded in its trace.db), a matrix is then read
+       from the cache if it, or one at a finer resolution, was already
+       extracted from the same BAM with the same filters
+    :param CACHE_MAX_SIZE cache_size: maximum size of the cache in bytes
 
     :returns: dictionary with keys being tuples of the indexes of interacting
        bins: dico[(bin1, bin2)] = interactions
@@ -805,7 +904,8 @@ def get_matrix(inbam, resolution, biases=None,
         region1=region1, start1=start1, end1=end1,
         region2=region2, start2=start2, end2=end2,
         tmpdir=tmpdir, nchunks=nchunks, verbose=verbose,
-        max_size=max_size, chr_order=chr_order)
+        max_size=max_size, chr_order=chr_order, cache_dir=cache_dir,
+        cache_size=cache_size)
 
     if region1:
         regions = [region1]
@@ -845,17 +945,29 @@ def get_matrix(inbam, resolution, biases=None,
         raise NotImplementedError(('ERROR: %s normalization not implemented '
                                    'here') % normalization)
 
+    crm_names = AlignmentFile(inbam, 'rb').references
     return_something = False
     if dico is None:
         return_something = True
         dico = dict(((i, j), transform_value(c, i, j, v))
                     for c, i, j, v in _iter_matrix_frags(
-                        chunks, tmpdir, rand_hash, clean=clean, verbose=verbose)
+                        chunks, tmpdir, rand_hash, crm_names, clean=clean,
+                        verbose=verbose)
                     if i not in bads1 and j not in bads2)
         # pull all sub-matrices and write full matrix
-    else: # dico probably an HiC data object
+    elif hasattr(dico, 'update_from_arrays'):  # HiC data object
+        size = len(dico)
+        for pixels in _iter_pixel_blocks(chunks, tmpdir, rand_hash,
+                                         clean=clean, verbose=verbose):
+            if bads1 or bads2:
+                pixels = pixels[~(np.isin(pixels['bin1'], list(bads1)) |
+                                  np.isin(pixels['bin2'], list(bads2)))]
+            dico.update_from_arrays(
+                pixels['bin1'].astype(np.int64) * size + pixels['bin2'],
+                pixels['count'])
+    else:
         for _, i, j, v in _iter_matrix_frags(
-                chunks, tmpdir, rand_hash,
+                chunks, tmpdir, rand_hash, crm_names,
                 clean=clean, verbose=verbose):
             if i not in bads1 and j not in bads2:
                 dico[i, j] = v
@@ -896,7 +1008,8 @@ def write_matrix(inbam, resolution, biases, outdir,
                  region2=None, start2=None, end2=None, extra='',
                  half_matrix=True, nchunks=100, tmpdir='.', append_to_tar=None,
                  ncpus=8, cooler=False, cooler_name=None, row_names=False,
-                 chr_order=None, verbose=True):
+                 chr_order=None, verbose=True, cache_dir=None,
+                 cache_size=CACHE_MAX_SIZE):
     """
     Writes matrix file from a BAM file containing interacting reads. The matrix
     will be extracted from the genomic BAM, the genomic coordinates of this
@@ -938,6 +1051,11 @@ def write_matrix(inbam, resolution, biases, outdir,
        WARNING: results in two extra columns
     :param None chr_order: chromosome order
     :param 100 nchunks: maximum number of chunks into which to cut the BAM
+    :param None cache_dir: path to a working directory where to cache the
+       binned matrices (recorded in its trace.db), a matrix is then read
+       from the cache if it, or one at a finer resolution, was already
+       extracted from the same BAM with the same filters
+    :param CACHE_MAX_SIZE cache_size: maximum size of the cache in bytes
 
     :returns: path to output files
     """
@@ -961,7 +1079,8 @@ def write_matrix(inbam, resolution, biases, outdir,
         region1=region1, start1=start1, end1=end1,
         region2=region2, start2=start2, end2=end2,
         tmpdir=tmpdir, nchunks=nchunks, chr_order=chr_order,
-        verbose=verbose, half=half_matrix)
+        verbose=verbose, half=half_matrix, cache_dir=cache_dir,
+        cache_size=cache_size)
 
     if region1:
         regions = [region1]
@@ -1193,15 +1312,19 @@ def write_matrix(inbam, resolution, biases, outdir,
         write = write_raw_and_expc(write)
 
     if cooler:
-        for ichunk, c, j, k, v in _iter_matrix_frags(chunks, tmpdir, rand_hash,
-                                                     verbose=verbose, clean=clean,
-                                                     include_chunk_count=True):
-            if j not in bads1 and k not in bads2:
-                out_raw.write_iter(ichunk, j, k, v)
+        for pixels in _iter_pixel_blocks(chunks, tmpdir, rand_hash,
+                                         verbose=verbose, clean=clean):
+            if bads1 or bads2:
+                pixels = pixels[~(np.isin(pixels['bin1'], list(bads1)) |
+                                  np.isin(pixels['bin2'], list(bads2)))]
+            out_raw.write_pixels(pixels['bin1'], pixels['bin2'],
+                                 pixels['count'])
         out_raw.close()
     else:
+        crm_names = AlignmentFile(inbam, 'rb').references
         for c, j, k, v in _iter_matrix_frags(chunks, tmpdir, rand_hash,
-                                             verbose=verbose, clean=clean):
+                                             crm_names, verbose=verbose,
+                                             clean=clean):
             if j not in bads1 and k not in bads2:
                 write(c, j, k, v)
 
@@ -1251,3 +1374,136 @@ def write_matrix(inbam, resolution, biases, outdir,
         os.system('rm -rf %s' % (os.path.join(tmpdir, '_tmp_%s' % (rand_hash))))
 
     return fnames
+
+
+def write_cooler_pyramid(inbam, resolutions, outcool,
+                         filter_exclude=(1, 2, 3, 4, 6, 7, 8, 9, 10),
+                         normalize=False, min_count=0, nchunks=100, tmpdir='.',
+                         ncpus=8, clean=True, verbose=True, cache_dir=None,
+                         cache_size=CACHE_MAX_SIZE):
+    """
+    Writes a multi-resolution cooler file with the genome-wide matrices at all
+    the given resolutions. The BAM is parsed only once, at the finest
+    resolution, and each coarser matrix is obtained by summing the pixels of
+    the finest one.
+
+    :param inbam: path to BAM file (generated byt TADbit)
+    :param resolutions: list of resolutions, all should be multiples of the
+       smallest one
+    :param outcool: path to the multi-resolution cooler file to be created
+    :param (1, 2, 3, 4, 6, 7, 8, 9, 10) filter exclude: filters to define the
+       set of valid pair of reads.
+    :param False normalize: compute, for each resolution, ICE biases from the
+       summed matrix, and store them as cooler weights
+    :param 0 min_count: when normalizing, bins with less interactions are
+       masked (weight of 0)
+    :param 100 nchunks: maximum number of chunks into which to cut the BAM
+    :param '.' tmpdir: where to write temporary files
+    :param 8 ncpus: number of cpus to use to read the BAM file
+    :param True clean: remove temporary files
+    :param True verbose: speak
+    :param None cache_dir: path to a working directory where to cache the
+       binned matrices (see get_matrix)
+    :param CACHE_MAX_SIZE cache_size: maximum size of the cache in bytes
+
+    :returns: path to the cooler file
+    """
+    if 'h5py' not in modules:
+        raise Exception('ERROR: cooler output is not available. Probably ' +
+                        'you need to install h5py\n')
+    resolutions = sorted(set(resolutions))
+    finest = resolutions[0]
+    if any(res % finest for res in resolutions):
+        raise Exception('ERROR: all resolutions should be multiples of the '
+                        'smallest one (%d)' % finest)
+
+    if not isinstance(filter_exclude, int):
+        filter_exclude = filters_to_bin(filter_exclude)
+
+    # full matrix, as the diagonal of coarser matrices also contains the
+    # pixels below the diagonal of the finest one
+    _, rand_hash, _, chunks = read_bam(
+        inbam, filter_exclude, finest, ncpus=ncpus, tmpdir=tmpdir,
+        nchunks=nchunks, verbose=verbose, cache_dir=cache_dir,
+        cache_size=cache_size)
+
+    bamfile = AlignmentFile(inbam, 'rb')
+    sections = OrderedDict(list(zip(bamfile.references, bamfile.lengths)))
+    bamfile.close()
+    regions = list(sections)
+
+    # genomic coordinates of the bins of the finest matrix
+    nbins = [l // finest + 1 for l in sections.values()]
+    fine_crm = np.repeat(np.arange(len(nbins)), nbins)
+    fine_bin = np.concatenate([np.arange(n) for n in nbins])
+
+    if os.path.exists(outcool):
+        os.remove(outcool)
+    levels = []
+    for res in resolutions:
+        out = cooler_file(outcool, res, sections, regions)
+        out.create_bins()
+        out.prepare_matrix()
+        # index of each bin of the finest matrix in the cooler bins
+        ncool = np.array([int(np.ceil(l / float(res))) for l in sections.values()])
+        offset = np.r_[0, np.cumsum(ncool)[:-1]]
+        mapping = offset[fine_crm] + np.minimum(fine_bin // (res // finest),
+                                                ncool[fine_crm] - 1)
+        levels.append([out, mapping, np.empty(0, dtype=PIXEL_DTYPE)])
+
+    if verbose:
+        printime('  - Summing matrices at %s' % (
+            ', '.join(nicer(res) for res in resolutions)))
+    for pixels in _iter_pixel_blocks(chunks, tmpdir, rand_hash, clean=clean,
+                                     verbose=verbose):
+        for level in levels:
+            out, mapping, carry = level
+            bins1 = mapping[pixels['bin1']]
+            bins2 = mapping[pixels['bin2']]
+            upper = bins1 <= bins2
+            block = pixels[upper]
+            block['bin1'] = bins1[upper]
+            block['bin2'] = bins2[upper]
+            block = _sum_pixels(np.concatenate((carry, block)))
+            if not len(block):
+                continue
+            # the last row may continue in the next block
+            cut = np.searchsorted(block['bin1'], block['bin1'][-1])
+            out.write_pixels(block['bin1'][:cut], block['bin2'][:cut],
+                             block['count'][:cut])
+            level[2] = block[cut:]
+    for out, _, carry in levels:
+        out.write_pixels(carry['bin1'], carry['bin2'], carry['count'])
+        out.close()
+        if normalize:
+            if verbose:
+                printime('  - Normalizing at %s' % (nicer(out.resolution)))
+            biases = _cooler_biases(out, min_count)
+            out.write_weights(biases, biases, 0, out.nbins, 0, out.nbins)
+
+    if clean:
+        os.system('rm -rf %s' % (os.path.join(tmpdir, '_tmp_%s' % (rand_hash))))
+    return outcool
+
+
+def _cooler_biases(out, min_count=0, chunksize=1000000):
+    """
+    ICE weights (inverse of the biases) of one resolution of a cooler file,
+    computed from its pixels.
+    """
+    with h5py.File(out.outcool, "r") as f:
+        grp = f[out.root_grp][str(out.resolution)]["pixels"]
+        bins1 = grp["bin1_id"][:out.nnz]
+        bins2 = grp["bin2_id"][:out.nnz]
+        counts = grp["count"][:out.nnz]
+    # stored as upper triangle
+    lower = bins1 != bins2
+    rows = np.concatenate((bins1, bins2[lower]))
+    cols = np.concatenate((bins2, bins1[lower]))
+    vals = np.concatenate((counts, counts[lower]))
+    colsum = np.bincount(rows, weights=vals, minlength=out.nbins)
+    bads = dict((b, True) for b in np.flatnonzero(colsum < max(min_count, 1)))
+    biases, _ = iterative_from_pixels([(rows, cols, vals)], out.nbins,
+                                      bads=bads, iterations=100,
+                                      max_dev=0.000001)
+    return [0. if b in bads else 1. / biases[b] for b in range(out.nbins)]
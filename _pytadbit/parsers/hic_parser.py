@@ -12,6 +12,8 @@ from io                              import IOBase
 from collections                     import OrderedDict
 from warnings                        import warn
 from math                            import sqrt, isnan
+from os.path                         import getsize
+import multiprocessing as mu
 try:
     from pickle5                     import load  # python < 3.8
 except ImportError:
@@ -23,6 +25,7 @@ import numpy as np
 from pytadbit.parsers.gzopen         import gzopen
 from pytadbit                        import HiC_data
 from pytadbit.parsers.hic_bam_parser import get_matrix
+from pytadbit.parsers.npz_parser     import parse_npz, is_npz_matrix
 try:
     from pytadbit.parsers.cooler_parser import parse_cooler, is_cooler
 except ImportError:
@@ -44,6 +47,8 @@ except NameError:
 
 HIC_DATA = True
 
+READS_CHUNK = 2**25  # number of bytes of reads parsed at once
+
 
 class AutoReadFail(Exception):
     """
@@ -71,14 +76,8 @@ def is_asymmetric_dico(hic):
     """
     Helper functions for the optimal_reader
     """
-    ncol = len(hic)
-    for i in range(ncol):
-        for j in range(i, ncol):
-            p1 = i * ncol + j
-            p2 = j * ncol + i
-            if hic.get(p1, 0) != hic.get(p2, 0):
-                return True
-    return False
+    csr = hic.get_hic_data_as_csr()
+    return (csr != csr.T).nnz > 0
 
 
 def symmetrize_dico(hic):
@@ -86,14 +85,8 @@ def symmetrize_dico(hic):
     Make an HiC_data object symmetric by summing two halves of the matrix
     """
     ncol = len(hic)
-    for i in range(ncol):
-        incol = i * ncol
-        for j in range(i, ncol):
-            p1 = incol + j
-            p2 = j * ncol + i
-            val = hic.get(p1, 0) + hic.get(p2, 0)
-            if val:
-                hic[p1] = hic[p2] = val
+    rows, cols, vals = hic.get_hic_data_as_arrays()
+    hic.update_from_arrays(cols * ncol + rows, vals, add=True)
 
 
 def symmetrize(matrix):
@@ -138,25 +131,6 @@ def optimal_reader(f, normalized=False, resolution=1):
     num = float if normalized else int
     chromosomes, sections, resolution = _header_to_section(header, resolution)
 
-    #############################################################
-    # monkey patch HiC_data to make it faster
-    def fast_setitem(self, key, val):
-        "Use directly dict setitem"
-        super(HiC_data, self).__setitem__(key, val)
-
-    def fast_getitem(self, key):
-        "Use directly dict setitem"
-        try:
-            return super(HiC_data, self).__getitem__(key)
-        except KeyError:
-            return 0
-
-    original_setitem = HiC_data.__setitem__
-    original_getitem = HiC_data.__getitem__
-    # apply_async the patch
-    HiC_data.__setitem__ = fast_setitem
-    HiC_data.__getitem__ = fast_getitem
-
     hic = HiC_data(((j, num(v))
                     for i, line in enumerate(f)
                     for j, v in enumerate(line.split()[2:], i * ncol)
@@ -169,12 +143,6 @@ def optimal_reader(f, normalized=False, resolution=1):
         hic.symmetricized = True
         symmetrize_dico(hic)
 
-    # undo patching
-    HiC_data.__setitem__ = original_setitem
-    HiC_data.__getitem__ = original_getitem
-    hic.__setitem__ = original_setitem
-    hic.__getitem__ = original_getitem
-    #############################################################
     return hic
 
 
@@ -407,7 +375,9 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
     :func:`pytadbit.parser.hic_parser.autoreader`) or a list.
 
     :param things: might be either a file name, a file handler or a list of
-        list (all with same length)
+        list (all with same length). Files can be text matrices, cooler files
+        or binary matrices written with
+        :func:`pytadbit.hic_data.HiC_data.write_matrix` (format "npz")
     :param None parser: a parser function that returns a tuple of lists
        representing the data matrix,
        with this file example.tsv:
@@ -426,6 +396,9 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
     :param 1 resolution: resolution of the matrix
     :param True hic: if False, TADbit assumes that files contains normalized
        data
+    :param None region: for cooler files, a chromosome name or a tuple
+       (chromosome, start, end) to read only the interactions inside this
+       region
     :returns: the corresponding matrix concatenated into a huge list, also
        returns number or rows
 
@@ -449,11 +422,14 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
                                      chromosomes=chromosomes,
                                      resolution=resolution,
                                      symmetricized=sym, masked=masked))
+        elif isinstance(thing, basestring) and is_npz_matrix(thing):
+            matrices.append(load_hic_data_from_npz(thing))
         elif isinstance(thing, basestring):
             if is_cooler(thing, resolution if resolution > 1 else None):
                 matrix, size, header, masked, sym = parse_cooler(thing,
                                                                  resolution if resolution > 1 else None,
-                                                                 not hic)
+                                                                 not hic,
+                                                                 region=kwargs.get('region'))
             else:
                 try:
                     with gzopen(thing) as f_thing:
@@ -506,6 +482,191 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
         return matrices
 
 
+def load_hic_data_from_npz(fnam):
+    """
+    :param fnam: matrix written in binary format with
+       :func:`pytadbit.hic_data.HiC_data.write_matrix` (format "npz")
+
+    :returns: HiC_data object, with the cells memory mapped from the file
+    """
+    keys, vals, header = parse_npz(fnam)
+    hic = HiC_data((), header['size'], chromosomes=header['chromosomes'],
+                   dict_sec=header['sections'], masked=header['masked'],
+                   resolution=header['resolution'],
+                   symmetricized=header['symmetricized'])
+    hic.update_from_arrays(keys, vals)
+    return hic
+
+
+def _count_pixels(keys, counts):
+    """
+    Sum the counts of repeated pixels.
+
+    :returns: sorted unique pixels and their counts
+    """
+    keys, inverse = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(inverse, weights=counts,
+                             minlength=keys.shape[0]).astype(np.int64)
+
+
+def _tsv_fields(data, columns, min_fields=None):
+    """
+    Locate fields in a block of lines of a TSV file.
+
+    :param data: numpy array of bytes (uint8), complete lines
+    :param columns: list of wanted columns
+    :param None min_fields: minimum number of fields of each line, by default
+       the number needed to reach the last wanted column
+
+    :returns: for each column, an array with the offset of the beginning of
+       the field in each line, and an array with the offset of its end
+    """
+    min_fields = max(min_fields or 0, max(columns) + 1)
+    seps = np.flatnonzero((data == 9) | (data == 10))
+    line_ends = np.flatnonzero(data == 10)
+    # index (in seps) of the end of the first field of each line
+    first = np.r_[0, np.searchsorted(seps, line_ends[:-1], side='right')]
+    nfields = np.diff(np.r_[first, seps.shape[0]])
+    if (nfields < min_fields).any():
+        raise Exception('ERROR: line with less than %d columns found' %
+                        min_fields)
+    fields = []
+    for col in columns:
+        beg = (seps[first + col - 1] + 1 if col else
+               np.r_[0, line_ends[:-1] + 1])
+        fields.append((beg, seps[first + col]))
+    return fields
+
+
+def _parse_ints(data, beg, end):
+    """
+    :returns: the integers written in data between beg and end
+    """
+    if not beg.shape[0]:
+        return np.zeros(0, dtype=np.int64)
+    neg = data[np.minimum(beg, end - 1)] == 45  # '-'
+    beg = beg + neg
+    lens = end - beg
+    if not lens.min() > 0:
+        raise Exception('ERROR: empty integer field found')
+    vals = np.zeros(lens.shape[0], dtype=np.int64)
+    for k in range(lens.max()):
+        digit = lens > k
+        # as bytes, characters before '0' also wrap above 9
+        nums = data[beg[digit] + k] - np.uint8(48)
+        if (nums > 9).any():
+            raise Exception('ERROR: non integer field found')
+        vals[digit] = vals[digit] * 10 + nums
+    vals[neg] *= -1
+    return vals
+
+
+def _parse_names(data, beg, end, name_ids):
+    """
+    :param name_ids: dictionary of names (as bytes) to index
+
+    :returns: the index of the names written in data between beg and end (-1
+       for names not in name_ids)
+    """
+    if not beg.shape[0]:
+        return np.zeros(0, dtype=np.int64)
+    width = (end - beg).max()
+    idx = beg[:, None] + np.arange(width)
+    chars = np.where(idx < end[:, None],
+                     data[np.minimum(idx, data.shape[0] - 1)], 0)
+    names, inverse = np.unique(chars.astype(np.uint8).view('S%d' % width),
+                               return_inverse=True)
+    ids = np.array([name_ids.get(n, -1) for n in names.ravel().tolist()],
+                   dtype=np.int64)
+    return ids[inverse.ravel()]
+
+
+def _bin_reads(fnam, start, end, crm_ids, offsets, nbins, resolution, size,
+               chunk_size=READS_CHUNK):
+    """
+    Count the interactions of the reads in a region of a TSV file of reads.
+
+    :param fnam: tsv file with reads1 and reads2
+    :param start: byte offset in the file, reads start at the first line
+       beginning after it
+    :param end: byte offset of the end of the region, the last read is the
+       one beginning before it
+    :param crm_ids: dictionary of chromosome name (as bytes) to chromosome
+       index
+    :param offsets: array with the index of the first bin of each chromosome,
+       None to bin reads by position only
+    :param nbins: array with the number of bins of each chromosome
+    :param resolution: the resolution of the experiment
+    :param size: the size of the matrix
+    :param READS_CHUNK chunk_size: number of bytes parsed at once
+
+    :returns: sorted pixels (row * size + col) and their counts, both halves of
+       the matrix
+    """
+    keys = np.zeros(0, dtype=np.int64)
+    counts = np.zeros(0, dtype=np.int64)
+    pending_keys, pending_counts = [], []
+    npending = 0
+    fhandler = open(fnam, 'rb')
+    if start:
+        fhandler.seek(start - 1)
+        fhandler.readline()
+    pos = fhandler.tell()
+    rest = b''
+    while pos < end:
+        block = fhandler.read(chunk_size)
+        data = rest + block
+        if not block:
+            if not data:
+                break
+            if not data.endswith(b'\n'):
+                data += b'\n'
+        cut = data.rfind(b'\n') + 1
+        data, rest = np.frombuffer(data[:cut], dtype=np.uint8), data[cut:]
+        if not cut:
+            continue
+        line_ends = np.flatnonzero(data == 10)
+        # keep lines beginning before the end of the region
+        nkeep = int(np.searchsorted(pos + np.r_[0, line_ends[:-1] + 1], end))
+        pos += cut
+        if nkeep < line_ends.shape[0]:
+            data = data[:line_ends[nkeep - 1] + 1] if nkeep else data[:0]
+            pos = end
+        if not data.shape[0]:
+            break
+        (cr1, ps1, cr2, ps2) = _tsv_fields(data, [1, 2, 7, 8], min_fields=10)
+        ps1 = _parse_ints(data, *ps1) // resolution
+        ps2 = _parse_ints(data, *ps2) // resolution
+        if offsets is not None:
+            cr1 = _parse_names(data, cr1[0], cr1[1], crm_ids)
+            cr2 = _parse_names(data, cr2[0], cr2[1], crm_ids)
+            # reads out of the known chromosomes are binned by position only
+            known = (cr1 >= 0) & (cr2 >= 0)
+            known[known] = ((ps1[known] >= 0) & (ps2[known] >= 0) &
+                            (ps1[known] < nbins[cr1[known]]) &
+                            (ps2[known] < nbins[cr2[known]]))
+            ps1[known] += offsets[cr1[known]]
+            ps2[known] += offsets[cr2[known]]
+        chunk_keys, chunk_counts = _count_pixels(
+            np.concatenate((ps1 * size + ps2, ps2 * size + ps1)),
+            np.ones(2 * ps1.shape[0], dtype=np.int64))
+        pending_keys.append(chunk_keys)
+        pending_counts.append(chunk_counts)
+        npending += chunk_keys.shape[0]
+        # merge when pending pixels outgrow the ones already counted
+        if npending > keys.shape[0]:
+            keys, counts = _count_pixels(
+                np.concatenate([keys] + pending_keys),
+                np.concatenate([counts] + pending_counts))
+            pending_keys, pending_counts = [], []
+            npending = 0
+        if not block:
+            break
+    fhandler.close()
+    return _count_pixels(np.concatenate([keys] + pending_keys),
+                         np.concatenate([counts] + pending_counts))
+
+
 def load_hic_data_from_reads(fnam, resolution, **kwargs):
     """
     :param fnam: tsv file with reads1 and reads2
@@ -515,46 +676,60 @@ def load_hic_data_from_reads(fnam, resolution, **kwargs):
        chromosome
     :param False get_sections: for very very high resolution, when the column
        index does not fit in memory
+    :param 1 ncpus: number of processes used to read the file, each one
+       reading a separate part of it
     """
     sections = []
     genome_seq = OrderedDict()
-    fhandler = open(fnam)
+    # in bytes, to get the size of the header whatever the line endings
+    fhandler = open(fnam, 'rb')
     line = next(fhandler)
     size = 0
-    while line.startswith('#'):
-        if line.startswith('# CRM '):
-            crm, clen = line[6:].split()
+    header_size = 0
+    while line.startswith(b'#'):
+        header_size += len(line)
+        if line.startswith(b'# CRM '):
+            crm, clen = line[6:].decode().split()
             genome_seq[crm] = int(clen) // resolution + 1
             size += genome_seq[crm]
         line = next(fhandler)
+    fhandler.close()
+    nbins = np.array(list(genome_seq.values()), dtype=np.int64)
+    crm_ids = dict((crm.encode(), i) for i, crm in enumerate(genome_seq))
     if kwargs.get('get_sections', True):
         for crm in genome_seq:
             len_crm = genome_seq[crm]
             sections.extend([(crm, i) for i in range(len_crm)])
+        offsets = np.r_[0, np.cumsum(nbins)[:-1]].astype(np.int64)
+    else:
+        offsets = None
     dict_sec = dict([(j, i) for i, j in enumerate(sections)])
     imx = HiC_data((), size, genome_seq, dict_sec, resolution=resolution)
-    try:
-        while True:
-            _, cr1, ps1, _, _, _, _, cr2, ps2, _ = line.split('\t', 9)
-            try:
-                ps1 = dict_sec[(cr1, int(ps1) // resolution)]
-                ps2 = dict_sec[(cr2, int(ps2) // resolution)]
-            except KeyError:
-                ps1 = int(ps1) // resolution
-                ps2 = int(ps2) // resolution
-            imx[ps1, ps2] += 1
-            imx[ps2, ps1] += 1
-            line = next(fhandler)
-    except StopIteration:
-        pass
-    fhandler.close()
+    ncpus = kwargs.get('ncpus', 1)
+    fsize = getsize(fnam)
+    if ncpus > 1:
+        step = (fsize - header_size) // ncpus + 1
+        pool = mu.Pool(ncpus)
+        procs = [pool.apply_async(_bin_reads, args=(
+            fnam, beg, min(beg + step, fsize), crm_ids, offsets, nbins,
+            resolution, size)) for beg in range(header_size, fsize, step)]
+        pool.close()
+        results = [proc.get() for proc in procs]
+        pool.join()
+        keys = np.concatenate([r[0] for r in results])
+        counts = np.concatenate([r[1] for r in results])
+    else:
+        keys, counts = _bin_reads(fnam, header_size, fsize, crm_ids, offsets,
+                                  nbins, resolution, size)
+    imx.update_from_arrays(keys, counts)
     imx.symmetricized = True
     return imx
 
 
 def load_hic_data_from_bam(fnam, resolution, biases=None, tmpdir='.', ncpus=8,
                            filter_exclude=(1, 2, 3, 4, 6, 7, 8, 9, 10),
-                           region=None, nchunks=100, verbose=True, clean=True):
+                           region=None, nchunks=100, verbose=True, clean=True,
+                           cache_dir=None):
     """
     :param fnam: TADbit-generated BAM file with read-ends1 and read-ends2
     :param resolution: the resolution of the experiment (size of a bin in
@@ -569,6 +744,8 @@ def load_hic_data_from_bam(fnam, resolution, biases=None, tmpdir='.', ncpus=8,
     :param 100 nchunks: maximum number of chunks into which to cut the BAM
     :param True verbose: speak
     :param True clean: remove temps
+    :param None cache_dir: path to a working directory where to cache the
+       binned matrices (see pytadbit.parsers.hic_bam_parser.get_matrix)
 
     :returns: HiC_data object
     """
@@ -624,7 +801,7 @@ def load_hic_data_from_bam(fnam, resolution, biases=None, tmpdir='.', ncpus=8,
     get_matrix(fnam, resolution, biases=None, filter_exclude=filter_exclude,
                normalization='raw', tmpdir=tmpdir, clean=clean,
                ncpus=ncpus, nchunks=nchunks, dico=imx, region1=region,
-               verbose=verbose)
+               verbose=verbose, cache_dir=cache_dir)
     imx._symmetricize()
     imx.symmetricized = True
 
@@ -3,14 +3,16 @@
 """
 from __future__ import print_function
 
-from bisect                               import bisect_right as bisect
 from warnings                             import warn
 from sys                                  import stdout
 from subprocess                           import Popen
 import os
 
+import numpy as np
+
 from pytadbit.utils.file_handling         import magic_open
-from pytadbit.mapping.restriction_enzymes import map_re_sites
+from pytadbit.mapping.restriction_enzymes import re_sites_index, locate_re_sites
+from pytadbit.parsers.genome_parser        import chromosome_lengths
 
 try:
     basestring
@@ -46,6 +48,9 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
        multiple-contacts
     :param False compress: compress (gzip) input map files. This is done in the
        background while next MAP files are parsed, or while files are sorted.
+    :param None re_cache: path prefix where to save (or load from) the index of
+       RE sites (see
+       :func:`pytadbit.mapping.restriction_enzymes.re_sites_index`)
     """
     # not nice, dirty fix in order to allow this function to only parse
     # one SAM file
@@ -58,15 +63,14 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
     if (f_names2 and not out_file2) or (not f_names2 and out_file2):
         raise Exception('ERROR: out_file2 AND f_names2 needed\n')
 
-    frag_chunk = kwargs.get('frag_chunk', 100000)
     if verbose:
         print('Searching and mapping RE sites to the reference genome')
     if len(re_name) == 1 and re_name[0] in (None, 'None'):
         frags = {}
         read_read = read_read_nofrags
     else:
-        frags = map_re_sites(re_name, genome_seq, frag_chunk=frag_chunk,
-                             verbose=verbose)
+        frags = re_sites_index(re_name, genome_seq,
+                               cache=kwargs.get('re_cache'), verbose=verbose)
         read_read = read_read_frags
 
     if isinstance(f_names1, basestring):
@@ -115,23 +119,25 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
                 while True:
                     for _ in range(max_size):
                         try:
-                            reads.append(read_read(next(fhandler), frags, frag_chunk))
+                            reads.append(read_read(next(fhandler), frags))
                         except KeyError:
                             print("Chromosome not in hash")
                             continue
                         read_count += 1
                     nfile += 1
-                    write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
+                    write_reads_to_file(reads, outfiles[read], tmp_files, nfile,
+                                        frags)
             except StopIteration:
                 fhandler.close()
                 nfile += 1
-                write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
+                write_reads_to_file(reads, outfiles[read], tmp_files, nfile,
+                                    frags)
             windows[read][num] = read_count
             if kwargs.get('compress', False) and fnam.endswith('.map'):
                 print('compressing input MAP file')
                 procs.append(Popen(['gzip', fnam]))
         nfile += 1
-        write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
+        write_reads_to_file(reads, outfiles[read], tmp_files, nfile, frags)
 
         # we have now sorted temporary files
         # we do merge sort for eah pair
@@ -159,8 +165,9 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
         ## Also pipe file header
         # chromosome sizes (in order)
         reads_fh.write('# Chromosome lengths (order matters):\n')
-        for crm in genome_seq:
-            reads_fh.write('# CRM %s\t%d\n' % (crm, len(genome_seq[crm])))
+        genome_lengths = chromosome_lengths(genome_seq)
+        for crm in genome_lengths:
+            reads_fh.write('# CRM %s\t%d\n' % (crm, genome_lengths[crm]))
         reads_fh.write('# Mapped\treads count by iteration\n')
         for size in windows[read]:
             reads_fh.write('# MAPPED %d %d\n' % (size, windows[read][size]))
@@ -204,19 +211,53 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
     return windows, multis
 
 
-def write_reads_to_file(reads, outfiles, tmp_files, nfile):
+def write_reads_to_file(reads, outfiles, tmp_files, nfile, frags=None):
     if not reads: # can be...
         return
+    if frags:
+        lines = add_re_sites(reads, frags)
+    else:
+        lines = reads
     tmp_name = os.path.join(*outfiles.split('/')[:-1] +
                             [('tmp_%03d_' % nfile) + outfiles.split('/')[-1]])
     tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
     tmp_files.append(tmp_name)
     out = open(tmp_name, 'w')
-    out.write(''.join(sorted(reads, key=lambda x: x.split('\t', 1)[0].split('~')[0])))
+    out.write(''.join(sorted(lines, key=lambda x: x.split('\t', 1)[0].split('~')[0])))
     out.close()
     del(reads[:])  # empty list
 
 
+def add_re_sites(reads, frags):
+    """
+    Search the closest RE sites to a block of reads and format them.
+
+    :param reads: list of parsed reads (read ID, chromosome, position, strand,
+       mapped sequence length)
+    :param frags: dictionary of RE sites as returned by
+       :func:`pytadbit.mapping.restriction_enzymes.re_sites_index`
+
+    :returns: list of lines, in the same order as reads
+    """
+    by_crm = {}
+    for i, read in enumerate(reads):
+        by_crm.setdefault(read[1], []).append(i)
+    lines = [None] * len(reads)
+    for crm, idxs in by_crm.items():
+        pos, prev_re, next_re = locate_re_sites(
+            frags[crm],
+            np.fromiter((reads[i][2] for i in idxs), dtype=np.int64,
+                        count=len(idxs)),
+            np.fromiter((reads[i][4] for i in idxs), dtype=np.int64,
+                        count=len(idxs)))
+        for i, p, prv, nxt in zip(idxs, pos.tolist(), prev_re.tolist(),
+                                  next_re.tolist()):
+            name, _, _, positive, len_seq = reads[i]
+            lines[i] = '%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % (
+                name, crm, p, positive, len_seq, prv, nxt)
+    return lines
+
+
 def merge_sort(file1, file2, outfiles, nfile):
     tmp_name = os.path.join(*outfiles.split('/')[:-1] +
                             [('tmp_merged_%03d_' % nfile) + outfiles.split('/')[-1]])
@@ -254,7 +295,7 @@ def merge_sort(file1, file2, outfiles, nfile):
     return tmp_name
 
 
-def read_read_nofrags(r, _, __):
+def read_read_nofrags(r, _):
     name, seq, _, _, ali = r.split('\t')[:5]
     try:
         crm, strand, pos = ali.split(':')[:3]
@@ -273,35 +314,20 @@ def read_read_nofrags(r, _, __):
         name, crm, pos, positive, len_seq))
 
 
-def read_read_frags(r, frags, frag_chunk):
+def read_read_frags(r, frags):
     name, seq, _, _, ali = r.split('\t')[:5]
     try:
         crm, strand, pos = ali.split(':')[:3]
     except ValueError:
         raise KeyError()
     crm = crm.split()[0]
+    if not crm in frags:
+        raise KeyError(crm)
     positive = strand == '+'
     len_seq  = len(seq)
     if positive:
         pos = int(pos)
     else:
         pos = int(pos) + len_seq - 1 # remove 1 because all inclusive
-    frag_piece = frags[crm][pos // frag_chunk]
-    idx = bisect(frag_piece, pos)
-    try:
-        next_re = frag_piece[idx]
-    except IndexError:
-        # case where part of the read is mapped outside chromosome
-        count = 0
-        while idx >= len(frag_piece) and count < len_seq:
-            pos -= 1
-            count += 1
-            frag_piece = frags[crm][pos // frag_chunk]
-            idx = bisect(frag_piece, pos)
-        if count >= len_seq:
-            raise Exception('Read mapped mostly outside ' +
-                            'chromosome\n(also reference genome can be truncated)')
-        next_re = frag_piece[idx]
-    prev_re = frag_piece[idx - 1 if idx else 0]
-    return ('%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % (
-        name, crm, pos, positive, len_seq, prev_re, next_re))
+    # RE sites are searched by blocks of reads (see add_re_sites)
+    return name, crm, pos, positive, len_seq
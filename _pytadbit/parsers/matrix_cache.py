@@ -0,0 +1,274 @@
+"""
+On-disk cache of the binned pixels read from TADbit BAM files.
+
+Each entry stores the pixels of one matrix (as extracted by read_bam) together
+with the genomic coordinates of its rows and columns. Entries are recorded in
+the CACHED_MATRICEs table of the trace.db of the working directory, and are
+evicted, least recently used first, when the cache grows over a given size.
+
+A request is served from any entry computed from the same BAM file (same path,
+size and modification time) with the same filters, at the same or at a finer
+resolution (dividing the requested one), and covering the requested region.
+"""
+
+from os.path  import abspath, join, exists, getsize, getmtime
+from hashlib  import md5
+from time     import time
+import os
+import sqlite3 as lite
+
+import numpy as np
+from pysam    import AlignmentFile
+
+from pytadbit.utils.file_handling import mkdir
+
+
+CACHE_MAX_SIZE = 10 * 1024**3  # in bytes
+
+CACHE_DIRNAME = '_cached_matrices'
+
+
+def _cache_db(cache_dir):
+    con = lite.connect(join(cache_dir, 'trace.db'))
+    with con:
+        con.execute("""
+        create table if not exists CACHED_MATRICEs
+           (Id integer primary key,
+            Key text,
+            BAM text,
+            BAM_size int,
+            BAM_mtime real,
+            Resolution int,
+            Filter int,
+            Region text,
+            Half int,
+            Path text,
+            Bytes int,
+            Last_access real,
+            unique (Key))""")
+    return con
+
+
+def _bam_fingerprint(inbam):
+    inbam = abspath(inbam)
+    return inbam, getsize(inbam), getmtime(inbam)
+
+
+def _genome_offsets(lengths, resolution):
+    """
+    :returns: the index of the first bin of each chromosome in the genome and
+       the number of bins of each chromosome
+    """
+    nbins = np.array([l // resolution + 1 for l in lengths], dtype=np.int64)
+    return np.r_[0, np.cumsum(nbins)[:-1]], nbins
+
+
+def _bins_to_arrays(bins_dict, refs):
+    """
+    :param bins_dict: dictionary of (chromosome name, bin) -> matrix index
+    :returns: two arrays, chromosome index (in BAM header) and bin, indexed
+       by the matrix index (-1 for indexes not in bins_dict)
+    """
+    crm_idx = dict((c, i) for i, c in enumerate(refs))
+    size = max(bins_dict.values()) + 1 if bins_dict else 0
+    crms = np.full(size, -1, dtype=np.int64)
+    bins = np.full(size, -1, dtype=np.int64)
+    for (crm, pos), idx in bins_dict.items():
+        crms[idx] = crm_idx[crm]
+        bins[idx] = pos
+    return crms, bins
+
+
+def _lookup_table(bins_dict, refs, lengths, resolution):
+    """
+    :returns: an array with the matrix index of each bin in the genome, -1 if
+       the bin is not in the matrix
+    """
+    offsets, nbins = _genome_offsets(lengths, resolution)
+    table = np.full(nbins.sum(), -1, dtype=np.int64)
+    crms, bins = _bins_to_arrays(bins_dict, refs)
+    idx = np.flatnonzero(crms >= 0)
+    table[offsets[crms[idx]] + bins[idx]] = idx
+    return table
+
+
+def _covers(crms, bins, cached_crms, cached_bins, factor, lengths,
+            cached_reso):
+    """
+    Check that all the bins of a matrix are fully covered by the finer bins
+    of a cached matrix.
+    """
+    bins = bins[crms >= 0]
+    crms = crms[crms >= 0]
+    if not len(crms):
+        return True
+    cached_bins = cached_bins[cached_crms >= 0]
+    cached_crms = cached_crms[cached_crms >= 0]
+    offsets, nbins = _genome_offsets(lengths, cached_reso)
+    covered = np.zeros(nbins.sum() + 1, dtype=np.int64)
+    covered[offsets[cached_crms] + cached_bins + 1] = 1
+    covered = np.cumsum(covered)
+    beg = bins * factor
+    end = np.minimum(beg + factor, nbins[crms])
+    return bool((covered[offsets[crms] + end] -
+                 covered[offsets[crms] + beg] == end - beg).all())
+
+
+def load_cached_pixels(cache_dir, inbam, resolution, filter_exclude,
+                       bins_dict1, bins_dict2, half=False, region=''):
+    """
+    Search the cache for a matrix from which to extract the wanted one.
+
+    :param cache_dir: working directory containing the trace.db
+    :param inbam: path to BAM file (generated byt TADbit)
+    :param resolution: resolution of the wanted matrix
+    :param filter_exclude: filters (as binary) to define the set of valid pair
+       of reads
+    :param bins_dict1: dictionary of (chromosome name, bin) -> row index of
+       the rows read from the BAM
+    :param bins_dict2: dictionary of (chromosome name, bin) -> column index
+    :param False half: only the upper half of the matrix is wanted
+    :param '' region: description of the region to be extracted
+
+    :returns: array of pixels (with the dtype of the cached one), not sorted
+       and with repeated pixels to be summed, or None if nothing usable was
+       found
+    """
+    inbam, bam_size, bam_mtime = _bam_fingerprint(inbam)
+    key = _cache_key(inbam, bam_size, bam_mtime, resolution, filter_exclude,
+                     half, region)
+    con = _cache_db(cache_dir)
+    with con:
+        cur = con.cursor()
+        cur.execute("""
+        select Id, Key, Resolution, Half, Path from CACHED_MATRICEs
+        where BAM=? and BAM_size=? and BAM_mtime=? and Filter=?
+              and Resolution<=?
+        order by Resolution desc""", (inbam, bam_size, bam_mtime,
+                                      filter_exclude, resolution))
+        candidates = cur.fetchall()
+    bam = AlignmentFile(inbam, 'rb')
+    refs, lengths = bam.references, bam.lengths
+    bam.close()
+    for entry_id, entry_key, entry_reso, entry_half, entry_path in candidates:
+        if resolution % entry_reso or (entry_half and entry_key != key):
+            continue
+        entry_path = join(cache_dir, entry_path)
+        if not exists(entry_path):
+            with con:
+                con.execute("delete from CACHED_MATRICEs where Id=?",
+                            (entry_id, ))
+            continue
+        entry = np.load(entry_path)
+        if entry_key == key:
+            pixels = entry['pixels']
+        else:
+            pixels = _project(entry, entry_reso, resolution, refs, lengths,
+                              bins_dict1, bins_dict2, half)
+            if pixels is None:
+                continue
+        with con:
+            con.execute("update CACHED_MATRICEs set Last_access=? where Id=?",
+                        (time(), entry_id))
+        return pixels
+    return None
+
+
+def _project(entry, entry_reso, resolution, refs, lengths,
+             bins_dict1, bins_dict2, half):
+    """
+    Map the pixels of a cached matrix onto the bins of the wanted one.
+
+    :returns: the array of pixels, None if the cached matrix does not cover the
+       wanted one
+    """
+    factor = resolution // entry_reso
+    for rowcol, bins_dict in (('row', bins_dict1), ('col', bins_dict2)):
+        crms, bins = _bins_to_arrays(bins_dict, refs)
+        if not _covers(crms, bins, entry[rowcol + '_crm'],
+                       entry[rowcol + '_bin'], factor, lengths, entry_reso):
+            return None
+    pixels = entry['pixels']
+    offsets, _ = _genome_offsets(lengths, resolution)
+    new = []
+    for rowcol, field, bins_dict in (('row', 'bin1', bins_dict1),
+                                     ('col', 'bin2', bins_dict2)):
+        table = _lookup_table(bins_dict, refs, lengths, resolution)
+        crms  = entry[rowcol + '_crm'][pixels[field]]
+        bins  = entry[rowcol + '_bin'][pixels[field]]
+        new.append(table[offsets[crms] + bins // factor])
+    keep = (new[0] >= 0) & (new[1] >= 0)
+    if half:
+        keep &= new[0] <= new[1]
+    pixels = pixels[keep]
+    pixels['bin1'] = new[0][keep]
+    pixels['bin2'] = new[1][keep]
+    return pixels
+
+
+def _cache_key(inbam, bam_size, bam_mtime, resolution, filter_exclude, half,
+               region):
+    return md5(('%s %d %f %d %d %d %s' % (
+        inbam, bam_size, bam_mtime, resolution, filter_exclude, int(half),
+        region)).encode('utf-8')).hexdigest()
+
+
+def store_cached_pixels(cache_dir, inbam, resolution, filter_exclude,
+                        bins_dict1, bins_dict2, pixels, half=False, region='',
+                        max_size=CACHE_MAX_SIZE):
+    """
+    Save a matrix in the cache and evict the least recently used entries if
+    the cache grows over max_size.
+
+    :param cache_dir: working directory containing the trace.db
+    :param inbam: path to BAM file (generated byt TADbit)
+    :param resolution: resolution of the matrix
+    :param filter_exclude: filters (as binary) used to extract the matrix
+    :param bins_dict1: dictionary of (chromosome name, bin) -> row index of
+       the rows read from the BAM
+    :param bins_dict2: dictionary of (chromosome name, bin) -> column index
+    :param pixels: array of pixels
+    :param False half: only the upper half of the matrix was extracted
+    :param '' region: description of the extracted region
+    :param CACHE_MAX_SIZE max_size: maximum size of the cache in bytes
+    """
+    inbam, bam_size, bam_mtime = _bam_fingerprint(inbam)
+    key = _cache_key(inbam, bam_size, bam_mtime, resolution, filter_exclude,
+                     half, region)
+    bam = AlignmentFile(inbam, 'rb')
+    refs = bam.references
+    bam.close()
+    row_crm, row_bin = _bins_to_arrays(bins_dict1, refs)
+    col_crm, col_bin = _bins_to_arrays(bins_dict2, refs)
+    mkdir(join(cache_dir, CACHE_DIRNAME))
+    fname = join(CACHE_DIRNAME, '%s.npz' % key)
+    np.savez(join(cache_dir, fname), pixels=pixels,
+             row_crm=row_crm, row_bin=row_bin, col_crm=col_crm, col_bin=col_bin)
+    nbytes = getsize(join(cache_dir, fname))
+    if nbytes > max_size:
+        os.remove(join(cache_dir, fname))
+        return
+    con = _cache_db(cache_dir)
+    with con:
+        cur = con.cursor()
+        cur.execute("""
+        insert or replace into CACHED_MATRICEs
+        (Id, Key, BAM, BAM_size, BAM_mtime, Resolution, Filter, Region, Half,
+         Path, Bytes, Last_access)
+        values
+        (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", (
+            key, inbam, bam_size, bam_mtime, resolution, filter_exclude,
+            region, int(half), fname, nbytes, time()))
+        cur.execute("""
+        select Id, Path, Bytes from CACHED_MATRICEs
+        order by Last_access desc""")
+        total = 0
+        for entry_id, entry_path, entry_bytes in cur.fetchall():
+            if total + entry_bytes <= max_size:
+                total += entry_bytes
+                continue
+            try:
+                os.remove(join(cache_dir, entry_path))
+            except OSError:
+                pass
+            cur.execute("delete from CACHED_MATRICEs where Id=?", (entry_id, ))
@@ -0,0 +1,495 @@
+"""
+Columnar storage of ensembles of 3D models.
+
+An ensemble is saved as a directory of numpy arrays, with a pickled header
+(``header.pickle``) holding the description, configuration, clusters and
+zeros of the ensemble, and the list of chunks of models. Each chunk is a group
+of models saved together (i.e. the results of one modelling job), with the
+arrays:
+  - coords_N.npy: coordinates (models, particles, 3)
+  - objfun_N.npy, rand_init_N.npy, radius_N.npy and cluster_N.npy: one value
+    per model
+  - log_objfun_N.npy and log_objfun_lengths_N.npy: objective function logs of
+    all models concatenated, and their lengths (-1 for no log)
+  - extras_N.pickle: any other value of the models (optional)
+
+Appending models to an ensemble only adds a chunk and rewrites the header.
+
+Original data, z-scores, restraints and comparisons of models are saved in
+separate arrays, and are only read when needed. Coordinates and objective
+function logs are memory mapped.
+"""
+
+from os         import path, remove, rename
+from shutil     import rmtree
+from tempfile   import mkdtemp
+from warnings   import warn
+try:
+    from pickle5 import load, dump, HIGHEST_PROTOCOL  # python < 3.8
+except ImportError:
+    from pickle  import load, dump, HIGHEST_PROTOCOL
+
+import numpy as np
+from scipy.sparse import issparse, csr_matrix, save_npz, load_npz
+
+from pytadbit.modelling.impmodel import IMPmodel
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+MODELS_FORMAT = 'TADbit-models'
+MODELS_VERSION = 1
+
+# values of the models stored in arrays
+_MODEL_KEYS = set(['x', 'y', 'z', 'rand_init', 'objfun', 'log_objfun',
+                   'radius', 'cluster', 'index', 'description'])
+
+
+class Deferred(object):
+    """
+    Value read from a models directory only when first needed
+    """
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __call__(self):
+        return self.func(*self.args)
+
+
+def is_models_dir(fname):
+    """
+    Check if path is an ensemble of models saved in TADbit columnar format
+
+    :param fname: path to directory
+    """
+    header = path.join(fname, 'header.pickle')
+    if not path.isdir(fname) or not path.exists(header):
+        return False
+    try:
+        return _read_header(fname).get('format') == MODELS_FORMAT
+    except Exception:
+        return False
+
+
+def _read_header(dirname):
+    with open(path.join(dirname, 'header.pickle'), 'rb') as handler:
+        return load(handler)
+
+
+def _write_header(dirname, header):
+    """
+    Write the header in a temporary file first, so that readers never find
+    it incomplete.
+    """
+    fname = path.join(dirname, 'header.pickle')
+    with open(fname + '.tmp', 'wb') as out:
+        dump(header, out, HIGHEST_PROTOCOL)
+    rename(fname + '.tmp', fname)
+
+
+def _load(dirname, name, mmap_mode='c'):
+    try:
+        return np.asarray(np.load(path.join(dirname, name + '.npy'),
+                                  mmap_mode=mmap_mode))
+    except ValueError:  # empty arrays can not be memory mapped
+        return np.load(path.join(dirname, name + '.npy'))
+
+
+def _save(dirname, name, array):
+    np.save(path.join(dirname, name + '.npy'), array)
+
+
+def _dump(dirname, name, value):
+    with open(path.join(dirname, name + '.pickle'), 'wb') as out:
+        dump(value, out, HIGHEST_PROTOCOL)
+
+
+def _read_pickle(dirname, name):
+    with open(path.join(dirname, name + '.pickle'), 'rb') as handler:
+        return load(handler)
+
+
+def _write_chunk(dirname, cid, models, description):
+    """
+    :param models: list of models (dictionaries)
+
+    :returns: number of models written
+    """
+    nloci = len(models[0]['x']) if models else 0
+    coords = np.empty((len(models), nloci, 3))
+    lengths = np.empty(len(models), dtype=np.int64)
+    logs = []
+    extras = {}
+    for i, mdl in enumerate(models):
+        for k, axis in enumerate('xyz'):
+            coords[i, :, k] = mdl[axis]
+        log = mdl.get('log_objfun')
+        lengths[i] = -1 if log is None else len(log)
+        if log is not None and len(log):
+            logs.append(np.asarray(log, dtype=float))
+        extra = dict((k, v) for k, v in mdl.items() if k not in _MODEL_KEYS)
+        if mdl.get('description', description) != description:
+            extra['description'] = mdl['description']
+        if extra:
+            extras[i] = extra
+    clusters = []
+    for i, mdl in enumerate(models):
+        cluster = mdl.get('cluster', 'Singleton')
+        try:
+            clusters.append(-1 if cluster == 'Singleton' else int(cluster))
+        except (TypeError, ValueError):
+            clusters.append(-1)
+            extras.setdefault(i, {})['cluster'] = cluster
+    name = '%%s_%d' % cid
+    _save(dirname, name % 'coords', coords)
+    _save(dirname, name % 'objfun', np.array(
+        [np.nan if mdl.get('objfun') is None else mdl['objfun']
+         for mdl in models], dtype=float))
+    _save(dirname, name % 'rand_init', np.array(
+        [str(mdl.get('rand_init')) for mdl in models], dtype=str))
+    _save(dirname, name % 'radius', np.array(
+        [mdl.get('radius', np.nan) for mdl in models], dtype=float))
+    _save(dirname, name % 'cluster', np.array(clusters, dtype=int))
+    _save(dirname, name % 'log_objfun',
+          np.concatenate(logs) if logs else np.zeros(0))
+    _save(dirname, name % 'log_objfun_lengths', lengths)
+    if extras:
+        _dump(dirname, name % 'extras', extras)
+    return len(models)
+
+
+def _read_chunk(dirname, cid, description):
+    """
+    :returns: coordinates (memory mapped) and list of models of a chunk, with
+       coordinates and objective function logs as views of memory mapped
+       arrays
+    """
+    name = '%%s_%d' % cid
+    coords = _load(dirname, name % 'coords')
+    objfun = _load(dirname, name % 'objfun', None)
+    rand_init = _load(dirname, name % 'rand_init', None)
+    radius = _load(dirname, name % 'radius', None)
+    cluster = _load(dirname, name % 'cluster', None)
+    logs = _load(dirname, name % 'log_objfun')
+    lengths = _load(dirname, name % 'log_objfun_lengths', None)
+    starts = np.concatenate(([0], np.cumsum(np.maximum(lengths, 0))))
+    extras = {}
+    if path.exists(path.join(dirname, (name % 'extras') + '.pickle')):
+        extras = _read_pickle(dirname, name % 'extras')
+    models = []
+    for i in range(len(objfun)):
+        mdl = IMPmodel((('x', coords[i, :, 0]), ('y', coords[i, :, 1]),
+                        ('z', coords[i, :, 2]),
+                        ('rand_init', str(rand_init[i])),
+                        ('objfun', None if np.isnan(objfun[i])
+                         else float(objfun[i])),
+                        ('log_objfun', None if lengths[i] < 0
+                         else logs[starts[i]:starts[i + 1]]),
+                        ('cluster', 'Singleton' if cluster[i] < 0
+                         else int(cluster[i])),
+                        ('description', description)))
+        if not np.isnan(radius[i]):
+            mdl['radius'] = float(radius[i])
+        mdl.update(extras.get(i, {}))
+        models.append(mdl)
+    return coords, models
+
+
+def _write_original_data(dirname, data):
+    if data is None:
+        return None
+    if issparse(data):
+        save_npz(path.join(dirname, 'original_data.npz'), csr_matrix(data),
+                 compressed=False)
+        return 'sparse'
+    try:
+        array = np.array(data, dtype=float)
+        if array.ndim != 2:
+            raise ValueError()
+    except (TypeError, ValueError):
+        _dump(dirname, 'original_data', data)
+        return 'pickle'
+    _save(dirname, 'original_data', array)
+    return 'npy'
+
+
+def _read_original_data(dirname, kind):
+    if kind == 'sparse':
+        return load_npz(path.join(dirname, 'original_data.npz'))
+    if kind == 'npy':
+        return _load(dirname, 'original_data')
+    if kind == 'pickle':
+        return _read_pickle(dirname, 'original_data')
+    return None
+
+
+def _write_zscores(dirname, zscores):
+    """
+    z-scores (dictionary of dictionaries of values) are stored as three
+    arrays: first key, second key and value
+    """
+    if zscores is None:
+        return None
+    try:
+        rows, cols, vals = [], [], []
+        for i in zscores:
+            for j, val in zscores[i].items():
+                rows.append(str(i))
+                cols.append(str(j))
+                vals.append(float(val))
+        if not all(isinstance(k, basestring) for k in zscores):
+            raise TypeError()
+    except (AttributeError, TypeError, ValueError):
+        _dump(dirname, 'zscores', zscores)
+        return 'pickle'
+    _save(dirname, 'zscores_rows', np.array(rows, dtype=str))
+    _save(dirname, 'zscores_cols', np.array(cols, dtype=str))
+    _save(dirname, 'zscores_values', np.array(vals, dtype=float))
+    return 'npy'
+
+
+def _read_zscores(dirname, kind):
+    if kind == 'pickle':
+        return _read_pickle(dirname, 'zscores')
+    if kind != 'npy':
+        return None
+    zscores = {}
+    for i, j, val in zip(_load(dirname, 'zscores_rows', None).tolist(),
+                         _load(dirname, 'zscores_cols', None).tolist(),
+                         _load(dirname, 'zscores_values', None).tolist()):
+        zscores.setdefault(i, {})[j] = val
+    return zscores
+
+
+def _write_restraints(dirname, restraints):
+    """
+    restraints (dictionary of pairs of particles to type, distance and force)
+    are stored as three arrays: pairs, types and values
+    """
+    if restraints is None:
+        return None
+    try:
+        pairs = np.array([(int(p1), int(p2)) for p1, p2 in restraints],
+                         dtype=np.int64).reshape(-1, 2)
+        kinds = np.array([str(restraints[k][0]) for k in restraints], dtype=str)
+        values = np.array([(float(restraints[k][1]), float(restraints[k][2]))
+                           for k in restraints], dtype=float).reshape(-1, 2)
+        if any(len(v) != 3 or not isinstance(v[0], basestring)
+               for v in restraints.values()):
+            raise TypeError()
+    except (AttributeError, TypeError, ValueError, IndexError):
+        _dump(dirname, 'restraints', restraints)
+        return 'pickle'
+    _save(dirname, 'restraints_pairs', pairs)
+    _save(dirname, 'restraints_types', kinds)
+    _save(dirname, 'restraints_values', values)
+    return 'npy'
+
+
+def _read_restraints(dirname, kind):
+    if kind == 'pickle':
+        return _read_pickle(dirname, 'restraints')
+    if kind != 'npy':
+        return None
+    return dict(((p1, p2), (kind, dist, kforce))
+                for (p1, p2), kind, (dist, kforce) in zip(
+                    _load(dirname, 'restraints_pairs', None).tolist(),
+                    _load(dirname, 'restraints_types', None).tolist(),
+                    _load(dirname, 'restraints_values', None).tolist()))
+
+
+def _ensemble_models(svd):
+    """
+    :returns: list of models of the ensemble, the best ones first, and the
+       list of flags marking the best models
+    """
+    models, best = [], []
+    for key, is_best in (('models', True), ('bad_models', False)):
+        group = svd.get(key) or {}
+        for m in (sorted(group) if isinstance(group, dict)
+                  else range(len(group))):
+            models.append(group[m])
+            best.append(is_best)
+    return models, best
+
+
+def write_models(dirname, svd):
+    """
+    Write an ensemble of models in TADbit columnar format. The directory is
+    written under a temporary name and then renamed, replacing any previous
+    file or directory with the same name.
+
+    :param dirname: path to the output directory
+    :param svd: dictionary of the ensemble, as returned by
+       :func:`pytadbit.modelling.structuralmodels.StructuralModels._reduce_models`
+    """
+    dirname = dirname.rstrip('/')
+    tmpdir = mkdtemp(prefix=path.basename(dirname) + '.',
+                     dir=path.dirname(path.abspath(dirname)))
+    try:
+        models, best = _ensemble_models(svd)
+        _write_chunk(tmpdir, 0, models, svd.get('description'))
+        comparisons = []
+        for num, (key, (compared, comparison)) in enumerate(
+                (svd.get('comparisons') or {}).items()):
+            _save(tmpdir, 'comparison_%d' % num, comparison)
+            comparisons.append((key, list(compared), num))
+        header = {'format'       : MODELS_FORMAT,
+                  'version'      : MODELS_VERSION,
+                  'nloci'        : svd['nloci'],
+                  'resolution'   : svd['resolution'],
+                  'description'  : svd.get('description'),
+                  'config'       : svd.get('config'),
+                  'clusters'     : svd.get('clusters'),
+                  'zeros'        : svd.get('zeros'),
+                  'chunks'       : [{'id': 0, 'best': best}],
+                  'next_chunk'   : 1,
+                  'comparisons'  : comparisons,
+                  'original_data': _write_original_data(
+                      tmpdir, svd.get('original_data')),
+                  'zscore'       : _write_zscores(tmpdir, svd.get('zscore')),
+                  'restraints'   : _write_restraints(
+                      tmpdir, svd.get('restraints'))}
+        _write_header(tmpdir, header)
+    except Exception:
+        rmtree(tmpdir)
+        raise
+    move_models(tmpdir, dirname)
+
+
+def remove_models(fname):
+    """
+    Remove a file of models, in pickle or columnar format (nothing is done if
+    it does not exist)
+
+    :param fname: path to the file or directory of models
+    """
+    if path.isdir(fname) and not path.islink(fname):
+        rmtree(fname)
+    elif path.lexists(fname):
+        remove(fname)
+
+
+def move_models(src, dst):
+    """
+    Rename a file of models, in pickle or columnar format, replacing any
+    previous file or directory of models at the destination
+
+    :param src: path to the file or directory of models
+    :param dst: new path
+    """
+    remove_models(dst)
+    rename(src, dst)
+
+
+def append_models(dirname, models, silent=False):
+    """
+    Add models to an ensemble saved in TADbit columnar format, without
+    rewriting it. Best models are added to the best models of the ensemble.
+    Models with a random initial number already in the ensemble are skipped.
+
+    :param dirname: path to the directory of the ensemble
+    :param models: a :class:`pytadbit.modelling.structuralmodels.StructuralModels`
+       or path to its file (pickle or columnar format)
+    :param False silent: do not warn about skipped models
+
+    :returns: the number of models added
+    """
+    if isinstance(models, basestring):
+        if is_models_dir(models):
+            svd = read_models(models)
+        else:
+            with open(models, 'rb') as handler:
+                svd = load(handler)
+    else:
+        svd = models._reduce_models(as_lists=False)
+    header = _read_header(dirname)
+    seen = set()
+    for chunk in header['chunks']:
+        seen.update(_load(dirname, 'rand_init_%d' % chunk['id'], None).tolist())
+    new_models, new_best = [], []
+    for mdl, best in zip(*_ensemble_models(svd)):
+        if str(mdl['rand_init']) in seen:
+            if not silent:
+                warn(('WARNING: model with seed: %s already here\n  '
+                      'SKIPPING...') % (mdl['rand_init']))
+            continue
+        seen.add(str(mdl['rand_init']))
+        new_models.append(mdl)
+        new_best.append(best)
+    if not new_models:
+        return 0
+    cid = header['next_chunk']
+    _write_chunk(dirname, cid, new_models, header['description'])
+    header['chunks'].append({'id': cid, 'best': new_best})
+    header['next_chunk'] = cid + 1
+    _write_header(dirname, header)
+    return len(new_models)
+
+
+def read_models(dirname):
+    """
+    Read an ensemble of models saved in TADbit columnar format. Coordinates,
+    objective function logs and comparisons are memory mapped, and original
+    data, z-scores and restraints are returned as
+    :class:`pytadbit.parsers.models_parser.Deferred` values, read when called.
+
+    :param dirname: path to the directory of the ensemble
+
+    :returns: a dictionary as saved by
+       :func:`pytadbit.modelling.structuralmodels.StructuralModels._reduce_models`,
+       plus the coordinates of the best models under the key 'coords', as an
+       array (models, particles, 3)
+    """
+    header = _read_header(dirname)
+    if header.get('format') != MODELS_FORMAT:
+        raise ValueError('ERROR: %s is not a TADbit models file' % dirname)
+    description = header['description']
+    best, bad = [], []
+    for chunk in header['chunks']:
+        coords, models = _read_chunk(dirname, chunk['id'], description)
+        for num, (mdl, is_best) in enumerate(zip(models, chunk['best'])):
+            (best if is_best else bad).append((chunk['id'], num, coords, mdl))
+    # models of different chunks are ranked by objective function (as in
+    # StructuralModels._extend_models), keeping the same number of best models
+    if len(header['chunks']) > 1:
+        nbest = len(best)
+        best = sorted(best + bad, key=lambda x: x[3]['objfun'])
+        best, bad = best[:nbest], best[nbest:]
+    nums = [num for _, num, _, _ in best]
+    if best and nums == list(range(nums[0], nums[0] + len(nums))):
+        coords = best[0][2][nums[0]:nums[0] + len(nums)]
+    else:
+        coords = np.array([chunk_coords[num]
+                           for _, num, chunk_coords, _ in best]).reshape(
+                               -1, header['nloci'], 3)
+    for i, (_, _, _, mdl) in enumerate(best):
+        mdl['index'] = i
+        for k, axis in enumerate('xyz'):
+            mdl[axis] = coords[i, :, k]
+    for i, (_, _, _, mdl) in enumerate(bad):
+        mdl['index'] = len(best) + i
+    comparisons = {}
+    for key, compared, num in header['comparisons']:
+        comparisons[key] = (compared, _load(dirname, 'comparison_%d' % num, 'r'))
+    return {'models'       : dict((i, mdl) for i, (_, _, _, mdl)
+                                  in enumerate(best)),
+            'bad_models'   : dict((len(best) + i, mdl) for i, (_, _, _, mdl)
+                                  in enumerate(bad)),
+            'coords'       : coords,
+            'nloci'        : header['nloci'],
+            'resolution'   : header['resolution'],
+            'description'  : description,
+            'config'       : header['config'],
+            'clusters'     : header['clusters'],
+            'zeros'        : header['zeros'],
+            'comparisons'  : comparisons,
+            'original_data': Deferred(_read_original_data, dirname,
+                                      header['original_data']),
+            'zscore'       : Deferred(_read_zscores, dirname,
+                                      header['zscore']),
+            'restraints'   : Deferred(_read_restraints, dirname,
+                                      header['restraints'])}
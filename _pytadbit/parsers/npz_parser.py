@@ -0,0 +1,152 @@
+"""
+Binary storage of Hi-C matrices.
+
+A matrix is saved as an uncompressed numpy .npz archive with three members:
+  - pos: sorted positions (row * size + col) of the non-zero cells
+  - val: the corresponding values
+  - header: a JSON document with the size, resolution, chromosomes, sections
+    and masked bins of the matrix
+
+As the archive is not compressed, positions and values are memory mapped when
+loaded.
+"""
+
+from __future__ import division
+import json
+import struct
+from collections import OrderedDict
+from zipfile import ZipFile, ZIP_STORED, is_zipfile, BadZipfile
+
+import numpy as np
+from numpy.lib.format import read_magic
+from numpy.lib.format import read_array_header_1_0, read_array_header_2_0
+
+NPZ_FORMAT = 'TADbit-npz'
+NPZ_VERSION = 1
+
+
+def is_npz_matrix(fname):
+    """
+    Check if file is a matrix saved in TADbit binary format
+
+    :param fname: path to file
+    """
+    try:
+        if not is_zipfile(fname):
+            return False
+        with ZipFile(fname) as zfile:
+            return 'header.npy' in zfile.namelist()
+    except (IOError, OSError, BadZipfile, TypeError, ValueError):
+        return False
+
+
+def _sections_to_runs(sections, start, end):
+    """
+    :returns: list of runs of consecutive bins [chromosome, first bin, first
+       index, number of bins], with indexes relative to start
+    """
+    runs = []
+    for (crm, pos), idx in sorted(((k, v) for k, v in sections.items()
+                                   if start <= v < end), key=lambda x: x[1]):
+        if (runs and runs[-1][0] == crm and
+            runs[-1][1] + runs[-1][3] == pos and
+            runs[-1][2] + runs[-1][3] == idx - start):
+            runs[-1][3] += 1
+        else:
+            runs.append([crm, int(pos), int(idx) - start, 1])
+    return runs
+
+
+def _runs_to_sections(runs):
+    sections = {}
+    for crm, pos, idx, length in runs:
+        sections.update(((crm, pos + i), idx + i) for i in range(length))
+    return sections
+
+
+def write_npz(fname, keys, values, size, resolution=1, sections=None,
+              masked=None, symmetricized=False, start=0):
+    """
+    Write a matrix in TADbit binary format
+
+    :param fname: path to the output file
+    :param keys: sorted array of positions (row * size + col)
+    :param values: array of values
+    :param size: number of rows of the matrix
+    :param 1 resolution: resolution of the matrix
+    :param None sections: dictionary of (chromosome, bin) -> index
+    :param None masked: dictionary of masked bins
+    :param False symmetricized: whether the matrix was symmetricized
+    :param 0 start: index of the first row of the matrix in the sections and
+       masked bins
+    """
+    runs = _sections_to_runs(sections or {}, start, start + size)
+    chromosomes = None
+    if runs and runs[0][0] is not None:
+        chromosomes = []
+        for crm, _, _, length in runs:
+            if chromosomes and chromosomes[-1][0] == crm:
+                chromosomes[-1][1] += length
+            else:
+                chromosomes.append([crm, length])
+    header = {'format'       : NPZ_FORMAT,
+              'version'      : NPZ_VERSION,
+              'size'         : int(size),
+              'resolution'   : int(resolution),
+              'chromosomes'  : chromosomes,
+              'sections'     : runs if chromosomes else [],
+              'masked'       : sorted(int(k) - start for k in (masked or {})
+                                      if start <= k < start + size),
+              'symmetricized': bool(symmetricized)}
+    header = np.frombuffer(json.dumps(header).encode('utf-8'), dtype=np.uint8)
+    with open(fname, 'wb') as out:
+        np.savez(out, pos=np.asarray(keys, dtype=np.int64),
+                 val=np.asarray(values), header=header)
+
+
+def _load_member(fname, name):
+    """
+    Memory map an array of a .npz archive (read in memory if compressed).
+    """
+    with ZipFile(fname) as zfile:
+        info = zfile.getinfo(name + '.npy')
+    if info.compress_type != ZIP_STORED:
+        with np.load(fname) as npz:
+            return npz[name]
+    with open(fname, 'rb') as handler:
+        # skip the local file header of the zip member
+        handler.seek(info.header_offset)
+        name_len, extra_len = struct.unpack('<HH', handler.read(30)[26:30])
+        handler.seek(info.header_offset + 30 + name_len + extra_len)
+        if read_magic(handler) == (1, 0):
+            shape, fortran, dtype = read_array_header_1_0(handler)
+        else:
+            shape, fortran, dtype = read_array_header_2_0(handler)
+        offset = handler.tell()
+    if not np.prod(shape):
+        return np.zeros(shape, dtype=dtype)
+    return np.asarray(np.memmap(fname, dtype=dtype, mode='r', offset=offset,
+                                shape=shape, order='F' if fortran else 'C'))
+
+
+def parse_npz(fname):
+    """
+    Read matrix stored in TADbit binary format
+
+    :param fname: path to file
+
+    :returns: positions and values (memory mapped arrays), and the header as a
+       dictionary, with sections converted to a dictionary of
+       (chromosome, bin) -> index, chromosomes to an OrderedDict and masked
+       bins to a dictionary
+    """
+    with np.load(fname) as npz:
+        header = json.loads(npz['header'].tobytes().decode('utf-8'))
+    if header.get('format') != NPZ_FORMAT:
+        raise ValueError('ERROR: %s is not a TADbit matrix' % fname)
+    if header['chromosomes'] is not None:
+        header['chromosomes'] = OrderedDict(
+            (crm, length) for crm, length in header['chromosomes'])
+    header['sections'] = _runs_to_sections(header['sections'])
+    header['masked'] = dict((k, True) for k in header['masked'])
+    return _load_member(fname, 'pos'), _load_member(fname, 'val'), header
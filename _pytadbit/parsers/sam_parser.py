@@ -5,12 +5,14 @@ from __future__ import print_function
 from builtins import next
 
 from itertools import combinations
-from bisect import bisect_right as bisect
 from pysam import Samfile
-from pytadbit.mapping.restriction_enzymes import map_re_sites
+from pytadbit.mapping.restriction_enzymes import re_sites_index, locate_re_sites
+from pytadbit.parsers.genome_parser import chromosome_lengths
+from pytadbit.parsers.map_parser import add_re_sites
 from shutil import copyfileobj
 from warnings import warn
 import os
+import numpy as np
 from sys import stdout
 
 try:
@@ -43,6 +45,9 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
     :param re_name: name of the restriction enzyme used
     :param None mapper: software used to map (supported are GEM and BOWTIE2).
        Guessed from file by default.
+    :param None re_cache: path prefix where to save (or load from) the index of
+       RE sites (see
+       :func:`pytadbit.mapping.restriction_enzymes.re_sites_index`)
     """
     # not nice, dirty fix in order to allow this function to only parse
     # one SAM file
@@ -55,11 +60,10 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
     if (f_names2 and not out_file2) or (not f_names2 and out_file2):
         raise Exception('ERROR: out_file2 AND f_names2 needed\n')
 
-    frag_chunk = kwargs.get('frag_chunk', 100000)
     if verbose:
         print('Searching and mapping RE sites to the reference genome')
-    frags = map_re_sites(re_name, genome_seq, frag_chunk=frag_chunk,
-                         verbose=verbose)
+    frags = re_sites_index(re_name, genome_seq, cache=kwargs.get('re_cache'),
+                           verbose=verbose)
 
     if isinstance(f_names1, basestring):
         f_names1 = [f_names1]
@@ -137,38 +141,20 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
                     pos = r.pos + 1
                 else:
                     pos = r.pos + len_seq
-                try:
-                    frag_piece = frags[crm][pos // frag_chunk]
-                except KeyError:
+                if not crm in frags:
                     # Chromosome not in hash
                     continue
-                idx = bisect(frag_piece, pos)
-                try:
-                    next_re = frag_piece[idx]
-                except IndexError:
-                    # case where part of the read is mapped outside chromosome
-                    count = 0
-                    while idx >= len(frag_piece) and count < len_seq:
-                        pos -= 1
-                        count += 1
-                        frag_piece = frags[crm][pos // frag_chunk]
-                        idx = bisect(frag_piece, pos)
-                    if count >= len_seq:
-                        raise Exception('Read mapped mostly outside ' +
-                                        'chromosome\n(also reference genome can be truncated)')
-                    next_re    = frag_piece[idx]
-                prev_re    = frag_piece[idx - 1 if idx else 0]
-                name       = r.qname
-                reads.append('%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % (
-                    name, crm, pos, positive, len_seq, prev_re, next_re))
+                # RE sites are searched by blocks of reads (see add_re_sites)
+                reads.append((r.qname, crm, pos, positive, len_seq))
                 windows[read][num] += 1
                 sub_count += 1
                 if sub_count >= max_size:
                     sub_count = 0
                     nfile += 1
-                    write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
+                    write_reads_to_file(reads, outfiles[read], tmp_files, nfile,
+                                        frags)
             nfile += 1
-            write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
+            write_reads_to_file(reads, outfiles[read], tmp_files, nfile, frags)
 
 
         # we have now sorted temporary files
@@ -197,8 +183,9 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
         ## Also pipe file header
         # chromosome sizes (in order)
         reads_fh.write('# Chromosome lengths (order matters):\n')
-        for crm in genome_seq:
-            reads_fh.write('# CRM %s\t%d\n' % (crm, len(genome_seq[crm])))
+        genome_lengths = chromosome_lengths(genome_seq)
+        for crm in genome_lengths:
+            reads_fh.write('# CRM %s\t%d\n' % (crm, genome_lengths[crm]))
         reads_fh.write('# Mapped\treads count by iteration\n')
         for size in windows[read]:
             reads_fh.write('# MAPPED %d %d\n' % (size, windows[read][size]))
@@ -250,10 +237,11 @@ def parse_gem_3c(f_name, out_file, genome_lengths, frags, verbose=False,
     :param out_file: path to outfile tab separated format containing paired read information
     :param genome_lengths: a dictionary generated containing the length of the genomic sequence
                            per chromosome
+    :param frags: dictionary of RE sites as returned by
+       :func:`pytadbit.mapping.restriction_enzymes.re_sites_index`
     :param False tmp_format: If True leave the file prepared to be merged with other map files.
     """
 
-    frag_chunk = kwargs.get('frag_chunk', 100000)
     try:
         fhandler = Samfile(f_name)
     except IOError:
@@ -261,6 +249,8 @@ def parse_gem_3c(f_name, out_file, genome_lengths, frags, verbose=False,
 
     # max number of reads in buffer
     max_size = 1000000
+    # number of reads for which RE sites are searched at once
+    block_size = 100000
 
     # getrname chromosome names
     i = 0
@@ -276,6 +266,8 @@ def parse_gem_3c(f_name, out_file, genome_lengths, frags, verbose=False,
     nfile = 0
     tmp_files = []
     reads = []
+    groups = []
+    ngrouped = 0
     cur_name = ''
     write_pairs = False
     read1 = None
@@ -337,70 +329,26 @@ def parse_gem_3c(f_name, out_file, genome_lengths, frags, verbose=False,
                     pos = read.pos + 1
                 else:
                     pos = read.pos + len_seq
-                try:
-                    frag_piece = frags[crm][pos // frag_chunk]
-                except KeyError:
+                if not crm in frags:
                     # Chromosome not in hash
-                    read_multi = []
                     break
-                idx = bisect(frag_piece, pos)
-                try:
-                    next_re = frag_piece[idx]
-                except IndexError:
-                    # case where part of the read is mapped outside chromosome
-                    count = 0
-                    while idx >= len(frag_piece) and count < len_seq:
-                        pos -= 1
-                        count += 1
-                        frag_piece = frags[crm][pos // frag_chunk]
-                        idx = bisect(frag_piece, pos)
-                    if count >= len_seq:
-                        raise Exception('Read mapped mostly outside ' +
-                                        'chromosome\n')
-                    next_re    = frag_piece[idx]
-                prev_re    = frag_piece[idx - 1 if idx else 0]
-                reads_grp.append([read.tid, crm, pos, positive,
-                                  len_seq, prev_re, next_re])
-            if len(reads_grp) > 2:
-                _merge_multis(reads_grp)
-            elif len(reads_grp) < 2:
-                reads_grp = []
-            reads_multi = []
-            for paired_reads in combinations(reads_grp, 2):
-                read_multi = [item for sublist in sorted(paired_reads,key = lambda x: (x[0], x[2]))
-                              for item in sublist]
-                if read_multi:
-                    reads_multi.append(read_multi)
-                sub_count += 1
-
-            paired_total = len(reads_multi)
-            paired_nbr = 0
-            for pair_read in reads_multi:
-                read_name_id = read_id
-                paired_nbr += 1
-                if paired_total > 1:
-                    read_name_id += '#%d/%d' % (paired_nbr,paired_total)
-                reads.append([read_name_id]+pair_read)
-
-            if sub_count >= max_size:
-                sub_count = 0
-                nfile += 1
-                reads = sorted(reads, key = lambda x: (x[1], x[3], x[8], x[10]))
-                read_lines = ['%s\t%d\t%s\t%d\t%d\t%d\t%d\t%d\t%d\t%s\t%d\t%d\t%d\t%d\t%d\n'
-                              % tuple(read) for read in reads]
-                write_paired_reads_to_file(read_lines, out_file, tmp_files, nfile)
-                #map_out.write('\n'.join(reads)+'\n')
-                del reads[:]
+                reads_grp.append([read.tid, crm, pos, positive, len_seq])
+            # RE sites are searched for blocks of reads
+            groups.append((read_id, reads_grp))
+            ngrouped += len(reads_grp)
+            if ngrouped >= block_size:
+                sub_count, nfile = _write_groups(
+                    groups, frags, reads, sub_count, nfile, max_size,
+                    out_file, tmp_files)
+                ngrouped = 0
             write_pairs = False
             read1 = None
             del read2[:]
+    sub_count, nfile = _write_groups(groups, frags, reads, sub_count, nfile,
+                                     max_size, out_file, tmp_files)
     if reads:
         nfile += 1
-        reads = sorted(reads, key = lambda x: (x[1], x[3], x[8], x[10]))
-        read_lines = ['%s\t%d\t%s\t%d\t%d\t%d\t%d\t%d\t%d\t%s\t%d\t%d\t%d\t%d\t%d\n'
-                      % tuple(read) for read in reads]
-        write_paired_reads_to_file(read_lines, out_file, tmp_files, nfile)
-        #map_out.write('\n'.join(reads))
+        _write_paired_reads(reads, out_file, tmp_files, nfile)
 
     #map_out.close()
     # we have now sorted temporary files
@@ -437,15 +385,82 @@ def parse_gem_3c(f_name, out_file, genome_lengths, frags, verbose=False,
 
     return out_file
 
-def write_reads_to_file(reads, outfiles, tmp_files, nfile):
+
+def _write_groups(groups, frags, reads, sub_count, nfile, max_size, out_file,
+                  tmp_files):
+    """
+    Search the RE sites of a block of groups of reads (all the reads with the
+    same ID), pair the reads of each group and write them, sorted, to temporary
+    files each time max_size pairs are reached. The list of groups is emptied.
+
+    :returns: the number of pairs not yet written and the number of temporary
+       files
+    """
+    by_crm = {}
+    for _, reads_grp in groups:
+        for read in reads_grp:
+            by_crm.setdefault(read[1], []).append(read)
+    for crm, crm_reads in by_crm.items():
+        pos, prev_re, next_re = locate_re_sites(
+            frags[crm],
+            np.fromiter((read[2] for read in crm_reads), dtype=np.int64,
+                        count=len(crm_reads)),
+            np.fromiter((read[4] for read in crm_reads), dtype=np.int64,
+                        count=len(crm_reads)))
+        for read, p, prv, nxt in zip(crm_reads, pos.tolist(), prev_re.tolist(),
+                                     next_re.tolist()):
+            read[2] = p
+            read.extend((prv, nxt))
+    for read_id, reads_grp in groups:
+        if len(reads_grp) > 2:
+            _merge_multis(reads_grp)
+        elif len(reads_grp) < 2:
+            reads_grp = []
+        reads_multi = []
+        for paired_reads in combinations(reads_grp, 2):
+            read_multi = [item for sublist in sorted(paired_reads,key = lambda x: (x[0], x[2]))
+                          for item in sublist]
+            if read_multi:
+                reads_multi.append(read_multi)
+            sub_count += 1
+
+        paired_total = len(reads_multi)
+        paired_nbr = 0
+        for pair_read in reads_multi:
+            read_name_id = read_id
+            paired_nbr += 1
+            if paired_total > 1:
+                read_name_id += '#%d/%d' % (paired_nbr,paired_total)
+            reads.append([read_name_id]+pair_read)
+
+        if sub_count >= max_size:
+            sub_count = 0
+            nfile += 1
+            _write_paired_reads(reads, out_file, tmp_files, nfile)
+    del groups[:]
+    return sub_count, nfile
+
+
+def _write_paired_reads(reads, out_file, tmp_files, nfile):
+    reads.sort(key = lambda x: (x[1], x[3], x[8], x[10]))
+    read_lines = ['%s\t%d\t%s\t%d\t%d\t%d\t%d\t%d\t%d\t%s\t%d\t%d\t%d\t%d\t%d\n'
+                  % tuple(read) for read in reads]
+    write_paired_reads_to_file(read_lines, out_file, tmp_files, nfile)
+    del reads[:]
+
+def write_reads_to_file(reads, outfiles, tmp_files, nfile, frags=None):
     if not reads: # can be...
         return
+    if frags:
+        lines = add_re_sites(reads, frags)
+    else:
+        lines = reads
     tmp_name = os.path.join(*outfiles.split('/')[:-1] +
                             [('tmp_%03d_' % nfile) + outfiles.split('/')[-1]])
     tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
     tmp_files.append(tmp_name)
     out = open(tmp_name, 'w')
-    out.write(''.join(sorted(reads, key=lambda x: x.split('\t', 1)[0].split('~')[0])))
+    out.write(''.join(sorted(lines, key=lambda x: x.split('\t', 1)[0].split('~')[0])))
     out.close()
     del(reads[:]) # empty list
 
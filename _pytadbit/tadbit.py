@@ -8,7 +8,8 @@ from pytadbit.parsers.hic_parser  import read_matrix
 from pytadbit.tadbit_py           import _tadbit_wrapper
 from math                         import isnan, sqrt
 from scipy.sparse.csr             import csr_matrix
-from scipy.stats                  import mannwhitneyu
+from scipy.stats                  import mannwhitneyu, rankdata, norm
+import multiprocessing as mu
 import numpy as np
 
 
@@ -197,9 +198,7 @@ def TopDom(hic_data,window_size,statFilter=True):
 
     #Step 1
     csr_mat = hic_data.get_hic_data_as_csr()
-    for i in range(n_bins):
-        diamond_mean = Get_Diamond_Matrix_Mean(data=csr_mat, i=i, size=window_size)
-        mean_cf[i] = diamond_mean
+    mean_cf[:] = Get_Diamond_Matrix_Means(data=csr_mat, size=window_size)
 
     #Step 2
     gap_idx = Which_Gap_Region(data=csr_mat)
@@ -216,31 +215,19 @@ def TopDom(hic_data,window_size,statFilter=True):
 
     if statFilter:
         #Step 3
-        lil_mat = csr_mat.todense()
-        for k in range(1,(2*window_size)):
-
-            mat_row = []
-            mat_column = []
-            my_range = list(range((n_bins*k), (n_bins*n_bins), 1+n_bins))
-            mat_values = np.empty(len(my_range))
-            col_arr = 0
-            for j in my_range:
-                mat_row.append(int(round(j//lil_mat.shape[0])))
-                mat_column.append(j%lil_mat.shape[0])
-                mat_values[col_arr] = lil_mat[int(round(j//lil_mat.shape[0])),j%lil_mat.shape[0]]
-                col_arr = col_arr + 1
-            
-            scale_values = scale(mat_values)
-            
-            for i in range(len(mat_row)):
-                lil_mat[mat_column[i],mat_row[i]] = scale_values[i]
-
+        # upper diagonals replaced by the scaled lower diagonals, only
+        # 2*window_size-1 diagonals are needed by the statistical test
+        band = np.full((2 * window_size, n_bins), np.nan)
+        for k in range(1, 2 * window_size):
+            if k < n_bins:
+                band[k, :n_bins - k] = scale(csr_mat.diagonal(-k))
 
         for key in proc_regions:
             start = proc_regions[key]['start']
             end = proc_regions[key]['end']
 
-            pvalue[start:end] = Get_Pvalue(data=lil_mat[start:end+1, start:end+1], size=window_size, scale=1)
+            pvalue[start:end] = Get_Pvalue(band=band, start=start, end=end,
+                                           size=window_size)
 
         for i in range(len(local_ext)):
             if local_ext[i] == -1 and pvalue[i] < 0.05:
@@ -262,38 +249,58 @@ def TopDom(hic_data,window_size,statFilter=True):
 
     return domains
 
-def Get_Diamond_Matrix_Mean(data, i, size):
+def Get_Diamond_Matrix_Means(data, size):
+    """
+    Mean of the diamond between the upstream and downstream bins of each bin,
+    using prefix sums over the diagonals of the matrix.
 
+    :returns: array of means, the last one is NaN
+    """
     n_bins = data.shape[1]
-    if i==n_bins-1:
-        return
-    
-    lowerbound = max( 0, i-size+1 )
-    upperbound = min( i+size+1, n_bins)
-    
-    return (data[lowerbound:(i+1),(i+1):upperbound].mean())
+    idx = np.arange(n_bins)
+    lowerbound = np.maximum(0, idx - size + 1)
+    upperbound = np.minimum(idx + size + 1, n_bins)
+    total = np.zeros(n_bins)
+    for k in range(1, min(2 * size, n_bins)):
+        cumdiag = np.r_[0, np.cumsum(data.diagonal(k))]
+        # rows of the diamond having a cell in this diagonal
+        beg = np.maximum(lowerbound, idx + 1 - k)
+        end = np.minimum(idx, upperbound - 1 - k)
+        ok = end >= beg
+        total[ok] += cumdiag[end[ok] + 1] - cumdiag[beg[ok]]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = total / ((idx - lowerbound + 1) * (upperbound - idx - 1))
+    means[-1] = np.nan
+    return means
 
 def Which_Gap_Region(data):
 
     n_bins = data.shape[1]
-    
+
+    # for each bin, the closest bin (upstream or itself) interacting with it:
+    # the square from i to j is empty if this is lower than i for all bins
+    coo = data.tocoo()
+    nonzero = coo.data != 0
+    rows = coo.row[nonzero]
+    cols = coo.col[nonzero]
+    closest = np.full(n_bins, -1)
+    np.maximum.at(closest, np.maximum(rows, cols), np.minimum(rows, cols))
+
     gap = np.zeros(n_bins)
-    
+
     i=0
     while i < n_bins:
-    
+
         j = i + 1
-        while j < n_bins:
-            if data[i:j+1, i:j+1].sum() == 0:
-                gap[i:j+1] = -0.5
-                j = j+1
-            else:
-                break
-        
+        empty = closest[i] < i
+        while j < n_bins and empty and closest[j] < i:
+            gap[i:j+1] = -0.5
+            j = j+1
+
         i = j
-    
+
     idx = np.where(gap==-0.5)[0]
-    
+
     #return dict(zip(idx,idx))
     return idx
 
@@ -380,9 +387,10 @@ def Data_Norm(x, y):
     scale_x = 1 / ( np.abs(np.diff(x) ) ).mean()
     scale_y = 1 / ( np.abs(np.diff(y) ) ).mean()
 
-    for i in range(1,len(x)):
-        ret_x[i] = ret_x[i-1] + (diff_x[i-1]*scale_x)
-        ret_y[i] = ret_y[i-1] + (diff_y[i-1]*scale_y)
+    ret_x[1:] = diff_x*scale_x
+    ret_y[1:] = diff_y*scale_y
+    ret_x = np.cumsum(ret_x)
+    ret_y = np.cumsum(ret_y)
 
 
     #return dict(zip(ret_x,ret_y))
@@ -476,65 +484,132 @@ def scale(y):
 
     return x
 
-def Get_Pvalue(data, size, scale):
-
-    n_bins = data.shape[0]
-    pvalue = np.ones(n_bins-1)
-
-    for i in range(1,n_bins):
-        dia = Get_Diamond_Matrix2(data, i, size=size)
-        ups = Get_Upstream_Triangle(data, i, size=size)
-        downs = Get_Downstream_Triangle(data, i, size=size)
-
-        wil_test =  mannwhitneyu(x=dia*scale, y=ups+downs, use_continuity=True, alternative='less')
-        pvalue[i-1] = wil_test.pvalue
+def _diamond_offsets(size):
+    """
+    Offsets, relative to a boundary i, of the first bin and of the distance
+    between bins of the cells in the diamond (upstream bins against
+    downstream bins) and in the upstream and downstream triangles.
+    """
+    dia = [(-k, c + k) for k in range(1, size + 1) for c in range(size)]
+    ups = [(s - size - 1, t - s) for s in range(size + 1)
+           for t in range(s + 1, size + 1)]
+    downs = [(s, t - s) for s in range(size) for t in range(s + 1, size)]
+    return [(np.array([o for o, _ in cells], dtype=int),
+             np.array([d for _, d in cells], dtype=int))
+            for cells in (dia, ups + downs)]
+
+def Get_Pvalue(band, start, end, size):
+    """
+    Wilcoxon rank-sum test, for each boundary of a region, of the diamond
+    against the upstream and downstream triangles. All boundaries are tested
+    at once (as scipy's mannwhitneyu, with alternative 'less' and continuity
+    correction).
 
+    :param band: scaled diagonals of the matrix, band[k, i] being the cell
+       (i, i + k)
+    :param start: first bin of the region
+    :param end: last bin of the region
 
+    :returns: array of p-values, one per boundary between consecutive bins
+    """
+    n_bins = end - start + 1
+    bounds = np.arange(1, n_bins)
+    samples = []
+    for offsets, dists in _diamond_offsets(size):
+        first = bounds[:, None] + offsets[None, :]
+        valid = (first >= 0) & (first + dists[None, :] < n_bins)
+        vals = band[dists[None, :], start + np.where(valid, first, 0)]
+        samples.append((vals, valid))
+    (x, x_ok), (y, y_ok) = samples
+    x_ok &= ~np.isnan(x)
+    y_ok &= y != 0
+    y_nan = (y_ok & np.isnan(y)).any(axis=1)
+    y_ok &= ~np.isnan(y)
+
+    n1 = x_ok.sum(axis=1)
+    n2 = y_ok.sum(axis=1)
+    xy = np.where(np.c_[x_ok, y_ok], np.c_[x, y], np.inf)
+    ranks = rankdata(xy, axis=1)
+    # number of values tied with each value
+    ties = rankdata(xy, method='max', axis=1) - rankdata(xy, method='min', axis=1)
+    ties[~np.c_[x_ok, y_ok]] = 0
+    tie_term = (ties * (ties + 2)).sum(axis=1)
+
+    u2 = n1 * n2 - ((ranks[:, :x.shape[1]] * x_ok).sum(axis=1) -
+                    n1 * (n1 + 1) / 2.)
+    n = n1 + n2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = ((u2 - n1 * n2 / 2. - 0.5) /
+             np.sqrt(n1 * n2 / 12. * ((n + 1) - tie_term / (n * (n - 1.)))))
+    pvalue = np.clip(norm.sf(z), 0, 1)
+    # small samples without ties get an exact p-value
+    for i in np.where(((n1 <= 8) | (n2 <= 8)) & (tie_term == 0) &
+                      (n1 > 0) & (n2 > 0) & ~y_nan)[0]:
+        pvalue[i] = mannwhitneyu(x=x[i][x_ok[i]], y=y[i][y_ok[i]],
+                                 use_continuity=True,
+                                 alternative='less').pvalue
+    pvalue[y_nan | (n1 == 0) | (n2 == 0)] = 1
     pvalue[ np.isnan(pvalue) ] = 1
 
     return(pvalue)
 
-def Get_Diamond_Matrix2(data, i, size):
-
-    n_bins = data.shape[0]
-    #new_mat = np.ones_like(data)*np.NaN
-    new_mat = np.ones(shape=(size,size))*np.NaN
-
-    for k in range(1,size+1):
-        if i-(k-1) >= 1 and i < n_bins:
-            lower = min(i+1, n_bins)
-            upper = min(i+size, n_bins)
-            new_mat[size-(k-1)-1,0:(upper-lower+1)] = data[i-(k-1)-1,lower-1:upper]
-
-    new_mat = new_mat[np.logical_not(np.isnan(new_mat))]
-
-    return ((new_mat.transpose()).flatten()).tolist()
-
-def Get_Upstream_Triangle(data, i, size):
-
-    lower = max(1, i-size)
-    tmp_mat = data[lower-1:i,lower-1:i]
-
-    triag = (np.triu(tmp_mat,k=1).flatten())
-
-    return triag[triag!=0].tolist()
-
-def Get_Downstream_Triangle(data, i, size):
-
-    n_bins = data.shape[0]
-    if i==n_bins:
-        return NaN
+def _insulation_chromosome(matrix, bias, good, decay, dists, normalize):
+    """
+    Compute the insulation score of all the bins of one chromosome.
 
-    upperbound = min(i+size, n_bins)
-    tmp_mat = data[i:upperbound, i:upperbound]
+    Interactions are normalized by bias and decay one diagonal at a time, and
+    the sum of each band is obtained from the prefix sums of the diagonals.
 
-    triag = (np.triu(tmp_mat,k=1).flatten())
+    :param matrix: scipy sparse matrix with the interactions of the chromosome
+    :param bias: array of biases of the bins of the chromosome
+    :param good: boolean array, False for bad columns
+    :param decay: array of expected values, indexed by distance
+    :param dists: list of pairs of distances between which to compute the
+       insulation score
+    :param normalize: normalize by the average of the chromosome (log2 ratio)
 
-    return triag[triag!=0].tolist()
+    :returns: a list, per pair of distances, of the insulation score of the
+       bins from end to n - end
+    """
+    size = matrix.shape[0]
+    diags = {}
+    results = []
+    for dist, end in dists:
+        npos = size - 2 * end
+        if npos <= 0:
+            results.append([])
+            continue
+        pos = np.arange(end, size - end)
+        vals = np.zeros(npos)
+        pairs = np.zeros(npos, dtype=int)
+        for d in range(2 * dist, 2 * end + 1):
+            if not d in diags:
+                valid = good[:size - d] & good[d:]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    diag = matrix.diagonal(d) / bias[:size - d] / bias[d:] / decay[d]
+                diag[~valid] = 0
+                diags[d] = (np.r_[0, np.cumsum(diag)],
+                            np.r_[0, np.cumsum(valid)])
+            csum, cnum = diags[d]
+            beg = np.maximum(pos - end, pos + dist - d)
+            stp = np.minimum(pos - dist, pos + end - d) + 1
+            vals += csum[stp] - csum[beg]
+            pairs += cnum[stp] - cnum[beg]
+        if normalize:
+            total = vals.mean()
+            if total == 0:
+                total = float('nan')
+            with np.errstate(divide='ignore', invalid='ignore'):
+                results.append(np.log2(vals / total).tolist())
+        else:
+            # as with an empty sum, bins without any valid pair are int 0
+            results.append([v if n else 0 for v, n in zip(vals.tolist(), pairs)])
+    return results
 
 
 def insulation_score(hic_data, dists, normalize=False, resolution=1,
-                     delta=0, silent=False, savedata=None, savedeltas=None):
+                     delta=0, silent=False, savedata=None, savedeltas=None,
+                     n_cpus=1):
     """
     Compute insulation score.
 
@@ -550,6 +625,7 @@ def insulation_score(hic_data, dists, normalize=False, resolution=1,
     :param False silent:
     :param None savedata: path to file where to save result
     :param None savedeltas: path to file where to save deltas
+    :param 1 n_cpus: number of chromosomes to process in parallel
 
     :returns: dictionary with insulation score
     """
@@ -560,60 +636,75 @@ def insulation_score(hic_data, dists, normalize=False, resolution=1,
         raise Exception('ERROR: HiC_data should be normalized by visibility '
                         'and by expected')
 
+    size = len(hic_data)
+    bias_arr = np.full(size, np.nan)
+    bias_arr[list(bias.keys())] = list(bias.values())
+    good = np.ones(size, dtype=bool)
+    good[[b for b in bads if b < size]] = False
+    max_dist = 2 * max(end for _, end in dists) + 1
+    matrix = hic_data.get_hic_data_as_csr()
+
+    jobs = []
+    for crm in hic_data.chromosomes:
+        beg, end = hic_data.section_pos[crm]
+        this_decay = decay[crm] if crm in decay else decay
+        decay_arr = np.full(max_dist, np.nan)
+        for d in range(min(max_dist, end - beg)):
+            try:
+                decay_arr[d] = this_decay[d]
+            except (KeyError, IndexError):
+                pass
+        jobs.append((crm, (matrix[beg:end, beg:end], bias_arr[beg:end],
+                           good[beg:end], decay_arr, dists, normalize)))
+    if n_cpus > 1:
+        pool = mu.Pool(n_cpus)
+        procs = [(crm, pool.apply_async(_insulation_chromosome, args=args))
+                 for crm, args in jobs]
+        pool.close()
+        pool.join()
+        results = dict((crm, proc.get()) for crm, proc in procs)
+    else:
+        results = dict((crm, _insulation_chromosome(*args))
+                       for crm, args in jobs)
+
     insidx = {}
     deltas = {}
-    for dist, end in dists:
+    for k, (dist, end) in enumerate(dists):
         if not silent:
             print(' - computing insulation in band %d-%d' % (dist, end))
         insidx[(dist, end)] = {}
         deltas[(dist, end)] = {}
+        values = np.full(size, np.nan)
+        present = np.zeros(size, dtype=bool)
         for crm in hic_data.chromosomes:
-            if crm in decay:
-                this_decay = decay[crm]
-            else:
-                this_decay = decay
-            total = 0
-            count = 0
-            for pos in range(hic_data.section_pos[crm][0] + end,
-                             hic_data.section_pos[crm][1] - end):
-                val = sum(hic_data[i, j] / bias[i] / bias[j] / this_decay[abs(j-i)]
-                          for i in range(pos - end, pos - dist + 1)
-                          if not i in bads
-                          for j in range(pos + dist, pos + end + 1)
-                          if not j in bads)
-                total += val
-                count += 1
-                insidx[(dist, end)][pos] = val
-            if normalize:
-                try:
-                    total /= float(count)
-                except ZeroDivisionError:
-                    pass
-                if total == 0:
-                    total = float('nan')
-                for pos in range(hic_data.section_pos[crm][0] + end,
-                                 hic_data.section_pos[crm][1] - end):
-                    try:
-                        with np.errstate(divide='ignore'):
-                            insidx[(dist, end)][pos] = np.log2(insidx[(dist, end)][pos] / total)
-                    except ZeroDivisionError:
-                        insidx[(dist, end)][pos] = float('nan')
-            if deltas:
-                for pos in range(hic_data.section_pos[crm][0] + end,
-                                 hic_data.section_pos[crm][1] - end):
-                    up_vals = []
-                    dw_vals = []
-                    for spos in range(delta):
-                        try:
-                            up_vals.append(insidx[(dist, end)][pos - delta + spos])
-                        except KeyError:
-                            pass
-                        try:
-                            dw_vals.append(insidx[(dist, end)][pos + delta - spos])
-                        except KeyError:
-                            pass
-                    with np.errstate(invalid='ignore'):
-                        deltas[(dist, end)][pos] = (np.mean(up_vals) - np.mean(dw_vals))
+            beg = hic_data.section_pos[crm][0] + end
+            vals = results[crm][k]
+            insidx[(dist, end)].update(zip(range(beg, beg + len(vals)), vals))
+            values[beg:beg + len(vals)] = vals
+            present[beg:beg + len(vals)] = True
+        # mean of the delta bins upstream minus mean of the delta bins
+        # downstream, the later taken only within the chromosome
+        for crm in hic_data.chromosomes:
+            crm_end = hic_data.section_pos[crm][1]
+            pos = np.arange(hic_data.section_pos[crm][0] + end, crm_end - end)
+            if not len(pos):
+                continue
+            up_sum = np.zeros(len(pos))
+            up_num = np.zeros(len(pos))
+            dw_sum = np.zeros(len(pos))
+            dw_num = np.zeros(len(pos))
+            for spos in range(1, delta + 1):
+                idx = np.maximum(pos - spos, 0)
+                ok = (pos - spos >= 0) & present[idx]
+                up_sum += np.where(ok, values[idx], 0)
+                up_num += ok
+                idx = np.minimum(pos + spos, size - 1)
+                ok = (pos + spos < crm_end) & present[idx]
+                dw_sum += np.where(ok, values[idx], 0)
+                dw_num += ok
+            with np.errstate(invalid='ignore', divide='ignore'):
+                vals = up_sum / up_num - dw_sum / dw_num
+            deltas[(dist, end)].update(zip(pos.tolist(), vals))
 
     if savedata:
         out = open(savedata, 'w')
@@ -198,7 +198,7 @@ def run(opts):
                     return_headers=True,
                     nchunks=opts.nchunks, verbose=not opts.quiet,
                     clean=clean, max_size=max_size,
-                    chr_order=opts.chr_name)
+                    chr_order=opts.chr_name, cache_dir=opts.workdir)
             except NotImplementedError:
                 if norm == "raw&decay":
                     warn('WARNING: raw&decay normalization not implemented '
@@ -314,7 +314,7 @@ def run(opts):
             tmpdir=tmpdir, append_to_tar=None, ncpus=opts.cpus,
             nchunks=opts.nchunks, verbose=not opts.quiet,
             extra=param_hash, cooler=opts.cooler, clean=clean,
-            chr_order=opts.chr_name))
+            chr_order=opts.chr_name, cache_dir=opts.workdir))
 
     if clean:
         printime('Cleaning')
@@ -57,7 +57,8 @@ def run(opts):
             # compute the intersection of the two read ends
             print('Getting intersection between read 1 and read 2')
             count, multiples = get_intersection(fname1, fname2, reads,
-                                                compress=opts.compress_input)
+                                                compress=opts.compress_input,
+                                                ncpus=opts.cpus)
 
         # compute insert size
         print('Get insert size...')
@@ -101,7 +102,8 @@ def run(opts):
                               min_frag_size=opts.min_frag_size,
                               re_proximity=opts.re_proximity,
                               strict_duplicates=opts.strict_duplicates,
-                              min_dist_to_re=min_dist, fast=True)
+                              min_dist_to_re=min_dist, fast=True,
+                              ncpus=opts.cpus, text_output=True)
 
     n_valid_pairs = apply_filter(reads, mreads, masked, filters=opts.apply)
 
@@ -36,7 +36,7 @@ from pytadbit.mapping.restriction_enzymes import RESTRICTION_ENZYMES, identify_r
 from pytadbit.utils.fastq_utils           import quality_plot
 from pytadbit.utils.file_handling         import which, mkdir, is_fastq
 from pytadbit.mapping.full_mapper         import full_mapping, fast_fragment_mapping
-from pytadbit.parsers.genome_parser       import parse_fasta
+from pytadbit.parsers.genome_parser       import parse_fasta, get_genome_cache_path
 from pytadbit.utils.sqlite_utils          import get_path_id, add_path, print_db, retry
 from pytadbit.utils.sqlite_utils          import get_jobid, already_run, digest_parameters
 from pytadbit                             import get_dependencies_version
@@ -93,7 +93,8 @@ def run(opts):
                                 clean=not opts.keep_tmp, get_nread=True,
                                 mapper_binary=opts.mapper_binary,
                                 mapper_params=opts.mapper_param, suffix=param_hash,
-                                temp_dir=temp_dir, nthreads=opts.cpus)
+                                temp_dir=temp_dir, nthreads=opts.cpus,
+                                re_cache=get_genome_cache_path(opts.genome))
     else:
         logging.info('mapping %s read %s to %s', opts.fastq, opts.read, opts.workdir)
         outfiles = full_mapping(opts.index, opts.fastq,
@@ -10,7 +10,7 @@ from __future__ import print_function
 from future import standard_library
 standard_library.install_aliases()
 from argparse                         import HelpFormatter
-from os                               import path, remove, system, rename, makedirs
+from os                               import path, remove, system, makedirs
 from string                           import ascii_letters
 from math                             import ceil
 from random                           import random
@@ -38,6 +38,8 @@ from pytadbit                         import load_structuralmodels
 from pytadbit.modelling.impoptimizer  import IMPoptimizer
 from pytadbit.modelling.structuralmodels import StructuralModels
 from pytadbit.modelling.impmodel      import IMPmodel
+from pytadbit.parsers.models_parser   import append_models, is_models_dir
+from pytadbit.parsers.models_parser   import move_models, remove_models
 from pytadbit                         import Chromosome
 from pytadbit.utils.file_handling     import mkdir, which
 from pytadbit.utils.extraviews        import nicer
@@ -218,7 +220,8 @@ try:
                                         config=optpar, coords=coords, experiment=exp,
                                         zeros=zeros)
 
-    models.save_models(path.join("%s",'results.models'),minimal=%s)
+    models.save_models(path.join("%s",'results.models'),minimal=%s,
+                       format='npy')
 except Exception as e:
     print(e)
     open(path.join("%s",'failed.flag'), 'a').close()
@@ -319,7 +322,7 @@ def run_distributed_jobs(opts, m, u, l, s, outdir, batch_job_hash,
         for n_job in range(n_jobs):
             job_dir = path.join(dirname, '_tmp_results_%s_%s_%s' % (n_job, opts.rand, batch_job_hash))
             results_file = path.join(job_dir,'results.models')
-            if path.isfile(results_file) and not opts.force:
+            if path.exists(results_file) and not opts.force:
                 continue
             if opts.script_template != '':
                 script_name = path.join(job_dir,'_tmp_optim.cmd')
@@ -336,17 +339,20 @@ def run_distributed_jobs(opts, m, u, l, s, outdir, batch_job_hash,
         if job_file_handler:
             return None, None
 
-        models = None
+        # results of each job are appended to the models file, without
+        # loading them
+        remove_models(modelsfile)
         for n_job in range(n_jobs):
             try:
                 job_dir = path.join(dirname, '_tmp_results_%s_%s_%s' % (n_job, opts.rand, batch_job_hash))
                 results_file = path.join(job_dir,'results.models')
-                if path.isfile(results_file):
-                    results = load_structuralmodels(results_file)
-                    if models:
-                        models._extend_models(results, nbest=len(models)+len(results))
-                    else:
-                        models = results
+                if path.exists(modelsfile) and path.exists(results_file):
+                    append_models(modelsfile, results_file)
+                elif is_models_dir(results_file):
+                    move_models(results_file, modelsfile)
+                elif path.isfile(results_file):
+                    load_structuralmodels(results_file).save_models(
+                        modelsfile, format='npy')
                 failed_flag = path.join(job_dir,'failed.flag')
                 logname = path.join(job_dir,'_tmp_log.log')
                 if path.isfile(failed_flag):
@@ -364,6 +370,7 @@ def run_distributed_jobs(opts, m, u, l, s, outdir, batch_job_hash,
         paramsfile = path.join(dirname,'_tmp_common_cfg_params.pickle')
         system('rm %s' % (paramsfile))
 
+        models = load_structuralmodels(modelsfile)
         models.define_best_models(opts.nkeep)
         if isinstance(models.description['start'],list):
             models.description['start'] = [(st + opts.matrix_beg * opts.reso)
@@ -376,7 +383,7 @@ def run_distributed_jobs(opts, m, u, l, s, outdir, batch_job_hash,
         for model in models:
             model['description']['start'] = models.description['start']
             model['description']['end'] = models.description['end']
-        models.save_models(modelsfile)
+        models.save_models(modelsfile, format='npy')
 
     num=1
     results_corr = {}
@@ -519,7 +526,7 @@ def run_distributed_jobs_ptadbit(opts, dirname, batch_job_hash,
         experiment=None, restraints={}, description=description)
     
     modelsfile = path.join(dirname,'models.models')
-    sm.save_models(modelsfile)
+    sm.save_models(modelsfile, format='npy')
     
     num=1
     results_corr = {}
@@ -615,7 +622,7 @@ def run_distributed(exp, batch_job_hash, opts, outdir, optpar,
                                                exp=exp, script_cmd=script_cmd,
                                                script_args=script_args)
     if not job_file_handler:
-        rename(modelsfile, path.join(outdir, '%s_%s.models' % (batch_job_hash, opts.rand)))
+        move_models(modelsfile, path.join(outdir, '%s_%s.models' % (batch_job_hash, opts.rand)))
     return results
 
 def run_distributed_ptadbit(exp, batch_job_hash, opts, outdir, dist = None,
@@ -664,7 +671,7 @@ def run_distributed_ptadbit(exp, batch_job_hash, opts, outdir, dist = None,
                                                        script_args=script_args)
 
     if not job_file_handler:
-        rename(modelsfile, path.join(outdir, '%s_%s.models' % (batch_job_hash, opts.rand)))
+        move_models(modelsfile, path.join(outdir, '%s_%s.models' % (batch_job_hash, opts.rand)))
     return results
 
 def run(opts):
@@ -882,7 +889,8 @@ def run(opts):
                 continue
             break
         logging.info("\tSaving again the models this time with clusters...")
-        models.save_models(path.join(outdir, '%s_%s.models' % (batch_job_hash, opts.rand)))
+        models.save_models(path.join(outdir, '%s_%s.models' % (batch_job_hash, opts.rand)),
+                           format='npy')
         # Plot the clustering
         try:
             models.cluster_analysis_dendrogram(
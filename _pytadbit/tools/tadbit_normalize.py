@@ -23,11 +23,14 @@ import multiprocessing  as mu
 import sqlite3 as lite
 import time
 
+from hashlib                              import md5
+
 from pysam                                import AlignmentFile
+import numpy as np
 from numpy                                import nanmean, isnan, nansum, nanpercentile, seterr
+from numpy                                import array, fromiter
 from matplotlib                           import pyplot as plt
 
-from pytadbit                             import load_hic_data_from_bam
 from pytadbit.utils.sqlite_utils          import already_run, digest_parameters
 from pytadbit.utils.sqlite_utils          import add_path, get_jobid, print_db, retry
 from pytadbit.utils.file_handling         import mkdir
@@ -41,10 +44,9 @@ from pytadbit.utils.extraviews            import nicer
 # from pytadbit.utils.hic_filtering         import filter_by_local_ratio
 from pytadbit.utils.hic_filtering         import plot_filtering
 # from pytadbit.utils.hic_filtering         import filter_by_zero_count
-from pytadbit.utils.normalize_hic         import oneD
+from pytadbit.utils.normalize_hic         import oneD, iterative_from_pixels
 from pytadbit.mapping.restriction_enzymes import RESTRICTION_ENZYMES
-from pytadbit.parsers.genome_parser       import parse_fasta, get_gc_content
-from functools import reduce
+from pytadbit.parsers.genome_parser       import parse_fasta, get_bin_features
 
 # removes annoying message when normalizing...
 seterr(invalid='ignore')
@@ -78,70 +80,7 @@ def run(opts):
         bamfile = AlignmentFile(mreads, 'rb')
         refs = bamfile.references
         bamfile.close()
-
-        # get genome sequence ~1 min
-        printime('  - parsing FASTA')
-        genome = parse_fasta(opts.fasta, verbose=False)
-
-        fas = set(genome.keys())
-        bam = set(refs)
-        if fas - bam:
-            print('WARNING: %d extra chromosomes in FASTA (removing them)' % (len(fas - bam)))
-            if len(fas - bam) <= 50:
-                print('\n'.join([('  - ' + c) for c in (fas - bam)]))
-        if bam - fas:
-            txt = ('\n'.join([('  - ' + c) for c in (bam - fas)])
-                   if len(bam - fas) <= 50 else '')
-            raise Exception('ERROR: %d extra chromosomes in BAM (remove them):\n%s\n' % (
-                len(bam - fas), txt))
-        refs = [crm for crm in refs if crm in genome]
-        if len(refs) == 0:
-            raise Exception("ERROR: chromosomes in FASTA different the ones"
-                            " in BAM")
-
-        # get mappability ~2 min
-        printime('  - Parsing mappability')
-        mappability = parse_mappability_bedGraph(
-            opts.mappability, opts.reso,
-            wanted_chrom=refs[0] if len(refs)==1 else None)
-        # resize chomosomes
-        for c in refs:
-            if not c in mappability:
-                mappability[c] = [float('nan')] * (len(refs) // opts.reso + 1)
-            if len(mappability[c]) < len(refs) // opts.reso + 1:
-                mappability[c] += [float('nan')] * (
-                    (len(refs) // opts.reso + 1) - len(mappability[c]))
-        # concatenates
-        mappability = reduce(lambda x, y: x + y,
-                             (mappability.get(c, []) for c in refs))
-
-        printime('  - Computing GC content per bin (removing Ns)')
-        gc_content = get_gc_content(genome, opts.reso, chromosomes=refs,
-                                    n_cpus=opts.cpus)
-        # pad mappability at the end if the size is close to gc_content
-        if len(mappability)<len(gc_content) and len(mappability)/len(gc_content) > 0.95:
-            mappability += [float('nan')] * (len(gc_content)-len(mappability))
-
-        # compute r_sites ~30 sec
-        # TODO: read from DB
-        printime('  - Computing number of RE sites per bin (+/- 200 bp)')
-        n_rsites  = []
-        re_site = RESTRICTION_ENZYMES[opts.renz].replace('|', '')
-        for crm in refs:
-            for pos in range(200, len(genome[crm]) + 200, opts.reso):
-                seq = genome[crm][pos-200:pos + opts.reso + 200]
-                n_rsites.append(seq.count(re_site))
-
-        ## CHECK TO BE REMOVED
-        # out = open('tmp_mappability.txt', 'w')
-        # i = 0
-        # for crm in refs:
-        #     for pos in xrange(len(genome[crm]) / opts.reso + 1):
-        #         out.write('%s\t%d\t%d\t%f\n' % (crm, pos * opts.reso, pos * opts.reso + opts.reso, mappability[i]))
-        #         i += 1`
-        # out.close()
-        # compute GC content ~30 sec
-        # TODO: read from DB
+        mappability, gc_content, n_rsites = load_bin_features(opts, refs)
     biases, decay, badcol, raw_cisprc, norm_cisprc = read_bam(
         mreads, filter_exclude, opts.reso, min_count=opts.min_count, sigma=2,
         factor=1, outdir=outdir, extra_out=param_hash, ncpus=opts.cpus,
@@ -197,6 +136,69 @@ def run(opts):
         exit(1)
 
 
+def load_bin_features(opts, refs):
+    """
+    Mappability, GC content and number of RE sites per bin, for oneD
+    normalization. These are stored in the working directory for each genome,
+    mappability file, resolution and restriction enzyme, and reloaded from
+    there when available.
+
+    :param opts: options of the normalization
+    :param refs: chromosomes in the BAM file
+
+    :returns: lists of mappability, GC content and number of RE sites per bin
+    """
+    key = md5(' '.join(
+        ['%s %d %f' % (path.realpath(fnam), path.getsize(fnam),
+                       path.getmtime(fnam))
+         for fnam in (opts.fasta, opts.mappability)] +
+        [str(opts.reso), opts.renz] + list(refs)).encode('utf-8')).hexdigest()
+    features_path = path.join(opts.workdir, '04_normalization',
+                              'bin_features_%s_%s.npz' % (
+                                  nicer(opts.reso, sep=''), key[:10]))
+    if path.exists(features_path):
+        printime('  - Loading GC content, RE sites and mappability per bin')
+        with np.load(features_path) as features:
+            return (features['mappability'].tolist(),
+                    features['gc'].tolist(), features['n_rsites'].tolist())
+
+    # get genome sequence ~1 min
+    printime('  - parsing FASTA')
+    genome = parse_fasta(opts.fasta, verbose=False)
+
+    fas = set(genome.keys())
+    bam = set(refs)
+    if fas - bam:
+        print('WARNING: %d extra chromosomes in FASTA (removing them)' % (len(fas - bam)))
+        if len(fas - bam) <= 50:
+            print('\n'.join([('  - ' + c) for c in (fas - bam)]))
+    if bam - fas:
+        txt = ('\n'.join([('  - ' + c) for c in (bam - fas)])
+               if len(bam - fas) <= 50 else '')
+        raise Exception('ERROR: %d extra chromosomes in BAM (remove them):\n%s\n' % (
+            len(bam - fas), txt))
+    refs = [crm for crm in refs if crm in genome]
+    if len(refs) == 0:
+        raise Exception("ERROR: chromosomes in FASTA different the ones"
+                        " in BAM")
+
+    # get mappability ~2 min
+    printime('  - Parsing mappability')
+    mappability = parse_mappability_bedGraph(
+        opts.mappability, opts.reso,
+        wanted_chrom=refs[0] if len(refs)==1 else None)
+
+    printime('  - Computing GC content, number of RE sites (+/- 200 bp) and '
+             'mappability per bin')
+    features = get_bin_features(
+        genome, opts.reso, chromosomes=refs,
+        re_site=RESTRICTION_ENZYMES[opts.renz].replace('|', ''),
+        mappability=mappability, n_cpus=opts.cpus)
+    np.savez(features_path, **features)
+    return (features['mappability'].tolist(), features['gc'].tolist(),
+            features['n_rsites'].tolist())
+
+
 @retry(lite.OperationalError, tries=20, delay=2)
 def save_to_db(opts, bias_file, mreads,
                nbad_columns, ncolumns, raw_cisprc, norm_cisprc,
@@ -601,6 +603,10 @@ def read_bam_frag_valid(inbam, filter_exclude, all_bins, sections,
     
     bamfile = AlignmentFile(inbam, 'rb')
     refs = bamfile.references
+    # reads overlapping the borders are fetched by two chunks, only count them
+    # in the one where they start
+    first_bin = start // resolution
+    last_bin  = end   // resolution
     try:
         dico = {}
         for r in bamfile.fetch(region=region,
@@ -610,8 +616,11 @@ def read_bam_frag_valid(inbam, filter_exclude, all_bins, sections,
             pos1 = r.reference_start + 1
             crm2 = refs[r.mrnm]
             pos2 = r.mpos + 1
+            pos1 = pos1 // resolution
+            if not first_bin <= pos1 <= last_bin:
+                continue
             try:
-                pos1 = sections[(crm1, pos1 // resolution)]
+                pos1 = sections[(crm1, pos1)]
                 pos2 = sections[(crm2, pos2 // resolution)]
             except KeyError:
                 continue  # not in the subset matrix we want
@@ -666,6 +675,10 @@ def read_bam_frag_filter(inbam, filter_exclude, all_bins, sections,
 
     bamfile = AlignmentFile(inbam, 'rb')
     refs = bamfile.references
+    # reads overlapping the borders are fetched by two chunks, only count them
+    # in the one where they start
+    first_bin = start // resolution
+    last_bin  = end   // resolution
     try:
         dico = {}
         for r in bamfile.fetch(region=region,
@@ -677,8 +690,11 @@ def read_bam_frag_filter(inbam, filter_exclude, all_bins, sections,
             pos1 = r.reference_start + 1
             crm2 = refs[r.mrnm]
             pos2 = r.mpos + 1
+            pos1 = pos1 // resolution
+            if not first_bin <= pos1 <= last_bin:
+                continue
             try:
-                pos1 = sections[(crm1, pos1 // resolution)]
+                pos1 = sections[(crm1, pos1)]
                 pos2 = sections[(crm2, pos2 // resolution)]
             except KeyError:
                 continue  # not in the subset matrix we want
@@ -795,7 +811,7 @@ def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
     read_bam_frag = read_bam_frag_valid if only_valid else read_bam_frag_filter
 
     num_regs = len(regs)
-    regs = map(lambda r: r.replace("|", "_"), regs)
+    regs = [r.replace("|", "_") for r in regs]
 
     for i, (region, start, end) in enumerate(zip(regs, begs, ends)):
         num_regs += 1
@@ -907,13 +923,14 @@ def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
 
     if normalization == 'ICE':
         printime('  - ICE normalization')
-        hic_data = load_hic_data_from_bam(
-            inbam, resolution, filter_exclude=filter_exclude,
-            tmpdir=outdir, ncpus=ncpus, nchunks=max_njobs)
-        hic_data.bads = badcol
-        hic_data.normalize_hic(iterations=100, max_dev=0.000001)
-        biases = hic_data.bias.copy()
-        del(hic_data)
+        # biases computed directly from the pixels of each chunk
+        biases, _ = iterative_from_pixels(
+            (pixels_from_pickle(path.join(
+                outdir, 'tmp_%s:%d-%d_%s.pickle' % (region, start, end,
+                                                    extra_out)))
+             for region, start, end in zip(regs, begs, ends)),
+            size, bads=badcol, iterations=100, max_dev=0.000001,
+            verbose=True)
     elif normalization == 'Vanilla':
         printime('  - Vanilla normalization')
         mean_col = nanmean(biases)
@@ -1157,6 +1174,18 @@ def get_cis_perc(fname, biases, badcol, bins):
     return cis, total
 
 
+def pixels_from_pickle(fname):
+    """
+    Loads the pixels of a chunk of the matrix stored as a pickled dictionary.
+
+    :returns: rows, columns and values as numpy arrays
+    """
+    dico = load(open(fname,'rb'))
+    pos = array(list(dico.keys()), dtype=int).reshape(-1, 2)
+    vals = fromiter(dico.values(), dtype=float, count=len(dico))
+    return pos[:, 0], pos[:, 1], vals
+
+
 def sum_nrm_matrix(fname, biases):
     dico = load(open(fname,'rb'))
     sumnrm = nansum([v / biases[i] / biases[j]
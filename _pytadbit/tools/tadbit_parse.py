@@ -23,7 +23,7 @@ import logging
 import sqlite3 as lite
 
 from pytadbit                       import get_dependencies_version
-from pytadbit.parsers.genome_parser import parse_fasta
+from pytadbit.parsers.genome_parser import parse_fasta, get_genome_cache_path
 from pytadbit.parsers.map_parser    import parse_map
 from pytadbit.parsers.sam_parser    import parse_sam
 from pytadbit.utils.file_handling   import mkdir
@@ -86,11 +86,13 @@ def run(opts):
         if opts.mapped1 or opts.mapped2:
             counts, multis = parse_sam(f_names1, f_names2, out_file1=out_file1,
                                        out_file2=out_file2, re_name=renz, verbose=True,
-                                       genome_seq=genome, compress=opts.compress_input)
+                                       genome_seq=genome, compress=opts.compress_input,
+                                       re_cache=get_genome_cache_path(opts.genome))
         else:
             counts, multis = parse_map(f_names1, f_names2, out_file1=out_file1,
                                        out_file2=out_file2, re_name=renz, verbose=True,
-                                       genome_seq=genome, compress=opts.compress_input)
+                                       genome_seq=genome, compress=opts.compress_input,
+                                       re_cache=get_genome_cache_path(opts.genome))
     else:
         counts = {}
         counts[0] = {}
@@ -69,7 +69,8 @@ def run(opts):
     hic_data = load_hic_data_from_bam(mreads, reso, ncpus=opts.cpus,
                                       region=region,
                                       biases=None if opts.all_bins else biases,
-                                      filter_exclude=opts.filter)
+                                      filter_exclude=opts.filter,
+                                      cache_dir=opts.workdir)
 
     # compartments
     cmp_result = {}
@@ -96,6 +97,7 @@ def run(opts):
             savecorr=cmprt_dir if opts.savecorr else None,
             max_ev=n_evs,
             ev_index=opts.ev_index, smoothing_window=opts.smoothing_window,
+            n_cpus=opts.cpus,
             vmin=None if opts.fix_corr_scale else 'auto',
             vmax=None if opts.fix_corr_scale else 'auto')
 
@@ -1,207 +1,253 @@
+"""
+Gaussian Hidden Markov Models, used to refine compartments.
+
+Forward-backward (with scaling factors), Baum-Welch and Viterbi are computed
+with numpy over all states at once. The training processes all observation
+sequences together, padded to the length of the longest one.
+"""
 from __future__ import print_function
-from numpy import log, pi as pi_num, exp
 import sys
 
+import numpy as np
+
+
 def best_path(probs, pi, T):
     """
     Viterbi algorithm with backpointers
-    """
-    n = len(T)
-    m = len(probs[0])
-    log_V     = [[0. for _ in range(m)] for _ in range(n)]
-    backpt    = [[0  for _ in range(m)] for _ in range(n)]
-    states    =  [0  for _ in range(m)]
-    log_pi    =  [float('-inf') if pi[i] < 0. else log(pi[i]) for i in range(len(pi))]
-    log_T     =  [float('-inf') if T [i] < 0. else log(T[i]) for i in range(len(T))]
-    log_probs = [[float('-inf') if probs[i][j] < 0. else log(probs[i][j])
-                  for j in range(m)]
-                 for i in range(n)]
-    for i in range(n):
-        log_V[i][0] = log_probs[i][0] + log_pi[i]
+
+    :param probs: emission probabilities, one row per state (as returned by
+       gaussian_prob)
+    :param pi: initial probabilities of each state
+    :param T: transition probabilities between states
+
+    :returns: the most probable list of states and its log-likelihood
+    """
+    probs = np.asarray(probs, dtype=float)
+    pi = np.asarray(pi, dtype=float)
+    n, m = probs.shape
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_pi    = np.where(pi < 0., float('-inf'), np.log(pi))
+        log_T     = np.log(np.asarray(T, dtype=float))
+        log_probs = np.where(probs < 0., float('-inf'), np.log(probs)).T.copy()
+    log_V  = np.empty((m, n))
+    backpt = np.zeros((m, n), dtype=int)
+    log_V[0] = log_probs[0] + log_pi
     for k in range(1, m):
-        for stat in range(n):
-            log_V[stat][k] = float('-inf')
-            for prev in range(n):
-                # original state prob times transition prob
-                prob = log_V[prev][k-1] + log_T[prev][stat]
-                if prob > log_V[stat][k]:
-                    log_V[stat][k] = prob
-                    backpt[stat][k-1] = prev
-            log_V[stat][k] += log_probs[stat][k]
+        # original state prob times transition prob (previous state in rows)
+        prob = log_V[k - 1][:, None] + log_T
+        prob.argmax(axis=0, out=backpt[k - 1])
+        prob.max(axis=0, out=log_V[k])
+        log_V[k] += log_probs[k]
     # get the likelihood of the most probable path
-    prob = log_V[0][-1]
-    for i in range(1, n):
-        if log_V[i][-1] > prob:
-            prob = log_V[i][-1]
-            states[-1] = i
+    path = [0] * m
+    path[-1] = int(log_V[-1].argmax())
+    prob = log_V[-1][path[-1]]
     # Follow the backtrack: get the path which maximize the path prob.
     for i in range(m - 2, -1, -1):
-        states[i] = backpt[states[i + 1]][i]
-    return states, prob
-
-def baum_welch_optimization(xh, T, E, new_pi, new_T, corrector,
-                            new_E, etas, gammas):
-    """
-    implementation of the baum-welch algorithm
-    """
-    n = len(T)
-    m = len(gammas[0])
-    for i in range(n):
-        for j in range(n):
-            new_pi[i] += etas[i][j][0]
-    for i in range(n):
-        for j in range(n):
-            new_T[i][j] += sum(etas[i][j][k] for k in range(m - 1))
-
-    for k in range(m):
-        for i in range(n):
-            gik = gammas[i][k]
-            corrector[i] += gik
-            new_E[i][0] += gik * xh[k]
-            new_E[i][1] += gik * (xh[k] - E[i][0])**2
+        path[i] = int(backpt[i][path[i + 1]])
+    return path, prob
 
-def update_parameters(corrector, pi, new_pi, T, new_T, E, new_E):
+
+def _emissions(x, E):
     """
-    final round of the baum-welch
+    Gaussian probability of each observation (in any shape) for each state
+    (last dimension).
     """
-    ### update initial probabilities
-    n = len(T)
-    total = 0.
-    delta = 0.
-    for i in range(n):
-        total += new_pi[i]
-    for i in range(n):
-        new_pi[i] /= total
-        delta = max(delta, abs(new_pi[i] - pi[i]))
-        pi[i] = new_pi[i]
-    ### update transitions
-    for i in range(n):
-        total = 0.
-        for j in range(n):
-            total += new_T[i][j]
-        for j in range(n):
-            new_T[i][j] /= total
-            delta = max(delta, abs(new_T[i][j] - T[i][j]))
-            T[i][j] = new_T[i][j]
-    ### update emissions
-    for i in range(n):
-        # update the means
-        if corrector[i] > 0.:
-            new_E[i][0] /= corrector[i]
-            new_E[i][1] /= corrector[i]
-            # corrector[i] = 1.
-            delta = max(delta, abs(new_E[i][0] - E[i][0]))
-            E[i][0] = new_E[i][0]
-            # update the stdevs
-            delta = max(delta, abs(new_E[i][1] - E[i][1]))
-            E[i][1] = new_E[i][1]
-    return delta
+    E = np.asarray(E, dtype=float)
+    pi2sd = (2. * np.pi * E[:, 1])**-0.5
+    inv2sd = 1. / (2. * E[:, 1])
+    return pi2sd * np.exp(-(x[..., None] - E[:, 0])**2 * inv2sd)
 
-def train(pi, T, E, observations, verbose=False, threshold=1e-6, n_iter=1000):
-    delta = float('inf')
-    for it in range(n_iter):
-        # reset for new iteration
-        new_pi = [0. for _ in pi]
-        new_T  = [[0. for _ in i] for i in T]
-        new_E  = [[0. for _ in i] for i in E]
-        corrector = [0. for _ in range(len(T))]
-        for h in range(len(observations)):
-            probs  = gaussian_prob(observations[h], E)
-            alphas, scalars = get_alpha(probs, pi, T)
-            betas  = get_beta(probs, T, scalars)
-            etas   = get_eta(probs, T, alphas, betas)
-            gammas = get_gamma(T, alphas, betas)
-            baum_welch_optimization(observations[h], T, E, new_pi, new_T, corrector,
-                                    new_E, etas, gammas)
-        delta = update_parameters(corrector, pi, new_pi, T, new_T, E, new_E)
-        if verbose:
-            print("\rTraining: %03i/%04i (diff: %.8f)" % (it, n_iter, delta), end=' ')
-            sys.stdout.flush()
-        if delta <= threshold:
-            break
-    if verbose:
-        print("\n")
 
-def get_eta(probs, T, alphas, betas):
-    """
-    for Baum-Welch: probability of being in states i and j at times t and t+1
+def gaussian_prob(x, E):
     """
-    n = len(T)
-    m = len(probs[0])
-    etas = [[[0.  for _ in range(m - 1)] for _ in range(n)] for _ in range(n)]
-    for k in range(m - 1):
-        tot = 0.
-        for i in range(n):
-            for j in range(n):
-                etas[i][j][k] += alphas[i][k] * T[i][j] * probs[j][k+1] * betas[j][k+1]
-                tot += etas[i][j][k]
-        for i in range(n):
-            for j in range(n):
-                etas[i][j][k] /= tot
-    return etas
+    of x to follow the gaussian with given E
+    https://en.wikipedia.org/wiki/Normal_distribution
 
-def get_gamma(T, alphas, betas):
+    :returns: an array with one row of probabilities per state
     """
-    for Baum-Welch: probability of being in state i at time t
+    return _emissions(np.asarray(x, dtype=float), E).T
+
+
+def _forward(probs, pi, T):
     """
-    n = len(T)
-    m = len(alphas[0])
-    return [[alphas[i][k] * betas[i][k]  for k in range(m)] for i in range(n)]
+    Forward algorithm on a batch of sequences.
 
-def gaussian_prob(x, E):
+    :param probs: array of emission probabilities (time, sequence, state)
+
+    :returns: the scaled alphas (time, sequence, state) and the scaling
+       factors (time, sequence)
+    """
+    alphas = np.empty_like(probs)
+    scalars = np.empty(probs.shape[:2])
+    alpha = pi * probs[0]
+    for k in range(probs.shape[0]):
+        if k:
+            # all transition probabilities to become "i" times previous alpha,
+            # times probablity to belong to this states
+            alpha = alphas[k - 1].dot(T) * probs[k]
+        scalars[k] = alpha.sum(axis=1)
+        alphas[k] = alpha / scalars[k][:, None]
+    return alphas, scalars
+
+
+def _backward(probs, T, scalars, lengths):
+    """
+    Backward algorithm on a batch of sequences (betas are 1 at the last
+    observation of each sequence, and meaningless after it).
+    """
+    betas = np.ones_like(probs)
+    last = {}
+    for h, length in enumerate(lengths):
+        last.setdefault(length - 1, []).append(h)
+    Tt = T.T
+    for k in range(probs.shape[0] - 2, -1, -1):
+        np.dot(betas[k + 1] * probs[k + 1], Tt, out=betas[k])
+        betas[k] /= scalars[k + 1][:, None]
+        if k in last:
+            betas[k, last[k]] = 1.
+    return betas
+
+
+def _eta(probs, T, alphas, betas):
     """
-    of x to follow the gaussian with given E
-    https://en.wikipedia.org/wiki/Normal_distribution
+    Probability of being in states i and j at times t and t+1 (time, sequence,
+    state i, state j).
     """
-    probs = []
-    for d, (mu, sd) in enumerate(E):
-        pi2sd = (2. * pi_num * sd)**-0.5
-        inv2sd = 1. / (2. * sd)
-        probs.append([])
-        for obs in x:
-            p = pi2sd * exp(-(obs - mu)**2 * inv2sd)
-            probs[d].append(p)
-    return probs
+    etas = (alphas[:-1, :, :, None] * T *
+            (probs[1:] * betas[1:])[:, :, None, :])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        etas /= etas.sum(axis=(2, 3))[:, :, None, None]
+    return etas
+
 
 def get_alpha(probs, pi, T):
     """
     computes alphas using forward algorithm
+
+    :returns: alphas (one row per state) and scaling factors
     """
-    n = len(T)
-    m = len(probs[0])
-    alphas = [[0. for _ in range(m)] for _ in range(n)]
-    scalars = [0. for _ in range(m)]
-
-    # initialize alpha for each state
-    for i in range(n):
-        alphas[i][0] = pi[i] * probs[i][0]
-        scalars[0] += alphas[i][0]
-    for i in range(n):
-        alphas[i][0] /= scalars[0]
-    for k in range(1, m):
-        for i in range(n):
-            for j in range(n):
-                # all transition probabilities to become "i" times previous alpha
-                alphas[i][k] += alphas[j][k-1] * T[j][i]
-            # times probablity to belong to this states
-            alphas[i][k] *= probs[i][k]
-            scalars[k] += alphas[i][k]
-        for i in range(n):
-            alphas[i][k] /= scalars[k]
-    return alphas, scalars
+    alphas, scalars = _forward(np.asarray(probs, dtype=float).T[:, None],
+                               np.asarray(pi, dtype=float),
+                               np.asarray(T, dtype=float))
+    return alphas[:, 0].T, scalars[:, 0]
+
 
 def get_beta(probs, T, scalars):
     """
     computes betas using backward algorithm
     """
-    n = len(T)
-    m = len(probs[0])
-    # intialize beta at 1.0
-    betas = [[0. for _ in range(m - 1)] + [1.0] for _ in range(n)]
-    for k in range(-2, -m - 1, -1):
-        for i in range(n):
-            for j in range(n):
-                betas[i][k] += betas[j][k + 1] * probs[j][k + 1] * T[i][j]
-            betas[i][k] /= scalars[k + 1]
-    return betas
+    probs = np.asarray(probs, dtype=float)
+    betas = _backward(probs.T[:, None], np.asarray(T, dtype=float),
+                      np.asarray(scalars, dtype=float)[:, None],
+                      np.array([probs.shape[1]]))
+    return betas[:, 0].T
+
+
+def get_eta(probs, T, alphas, betas):
+    """
+    for Baum-Welch: probability of being in states i and j at times t and t+1
+
+    :returns: array with dimensions state i, state j, time
+    """
+    etas = _eta(np.asarray(probs, dtype=float).T[:, None],
+                np.asarray(T, dtype=float),
+                np.asarray(alphas, dtype=float).T[:, None],
+                np.asarray(betas, dtype=float).T[:, None])
+    return etas[:, 0].transpose(1, 2, 0)
+
+
+def get_gamma(T, alphas, betas):
+    """
+    for Baum-Welch: probability of being in state i at time t
+    """
+    return np.asarray(alphas) * np.asarray(betas)
+
+
+def baum_welch_optimization(x, lengths, pi, T, E):
+    """
+    implementation of the baum-welch algorithm, on a batch of sequences
+
+    :param x: array of observations (time, sequence), padded after the end of
+       each sequence
+    :param lengths: array with the length of each sequence
+    :param pi: array of initial probabilities
+    :param T: array of transition probabilities
+    :param E: array of emissions (mean and variance of each state)
+
+    :returns: the accumulated initial probabilities, transitions, emissions and
+       state occupancies (corrector), to be passed to update_parameters
+    """
+    valid = np.arange(x.shape[0])[:, None] < lengths
+    probs = np.where(valid[:, :, None], _emissions(x, E), 1.)
+    alphas, scalars = _forward(probs, pi, T)
+    betas  = _backward(probs, T, scalars, lengths)
+    etas   = _eta(probs, T, alphas, betas)
+    etas   = np.where(valid[1:, :, None, None], etas, 0.)
+    gammas = np.where(valid[:, :, None], alphas * betas, 0.)
+
+    new_pi = etas[0].sum(axis=(0, 2))
+    new_T = etas.sum(axis=(0, 1))
+    corrector = gammas.sum(axis=(0, 1))
+    new_E = np.empty_like(E)
+    new_E[:, 0] = (gammas * x[:, :, None]).sum(axis=(0, 1))
+    new_E[:, 1] = (gammas * (x[:, :, None] - E[:, 0])**2).sum(axis=(0, 1))
+    return new_pi, new_T, new_E, corrector
+
 
+def update_parameters(corrector, pi, new_pi, T, new_T, E, new_E):
+    """
+    final round of the baum-welch
+
+    pi, T and E are updated in place.
+
+    :returns: the maximum change of the parameters
+    """
+    ### update initial probabilities
+    new_pi = new_pi / new_pi.sum()
+    delta = np.abs(new_pi - np.asarray(pi, dtype=float)).max()
+    pi[:] = new_pi.tolist()
+    ### update transitions
+    new_T = new_T / new_T.sum(axis=1)[:, None]
+    delta = max(delta, np.abs(new_T - np.asarray(T, dtype=float)).max())
+    for i in range(len(T)):
+        T[i][:] = new_T[i].tolist()
+    ### update emissions (means and stdevs)
+    for i in np.flatnonzero(corrector > 0.):
+        new_E[i] /= corrector[i]
+        delta = max(delta, abs(new_E[i][0] - E[i][0]),
+                    abs(new_E[i][1] - E[i][1]))
+        E[i][0] = new_E[i][0]
+        E[i][1] = new_E[i][1]
+    return delta
+
+
+def train(pi, T, E, observations, verbose=False, threshold=1e-6, n_iter=1000):
+    """
+    Baum-Welch training of a Gaussian HMM. pi, T and E are updated in place.
+
+    :param pi: initial probabilities of each state
+    :param T: transition probabilities between states
+    :param E: emissions, mean and variance of each state
+    :param observations: list of sequences of observations
+    :param False verbose:
+    :param 1e-6 threshold: stop when parameters change less than this
+    :param 1000 n_iter: maximum number of iterations
+    """
+    lengths = np.array([len(obs) for obs in observations])
+    x = np.zeros((lengths.max(), len(observations)))
+    for h, obs in enumerate(observations):
+        x[:len(obs), h] = obs
+    delta = float('inf')
+    for it in range(n_iter):
+        new_pi, new_T, new_E, corrector = baum_welch_optimization(
+            x, lengths, np.asarray(pi, dtype=float),
+            np.asarray(T, dtype=float), np.asarray(E, dtype=float))
+        delta = update_parameters(corrector, pi, new_pi, T, new_T, E, new_E)
+        if verbose:
+            print("\rTraining: %03i/%04i (diff: %.8f)" % (it, n_iter, delta), end=' ')
+            sys.stdout.flush()
+        if delta <= threshold:
+            break
+    if verbose:
+        print("\n")
@@ -0,0 +1,162 @@
+"""
+Markov clustering (MCL) of weighted graphs [vanDongen2000]_.
+
+The graph is stored as a column stochastic scipy sparse matrix. At each
+iteration the matrix is expanded (multiplied by itself), inflated (entries
+raised to a power and columns normalized) and pruned, by blocks of columns that
+can be processed in parallel threads (scipy sparse products release the GIL).
+
+Default parameters follow the ones of the mcl program (http://micans.org/mcl/).
+"""
+
+from multiprocessing.dummy import Pool as ThreadPool
+from warnings              import warn
+
+import numpy as np
+from scipy.sparse          import csc_matrix, diags, hstack
+from scipy.sparse.csgraph  import connected_components
+
+
+def _columns(matrix):
+    """
+    :returns: the column of each stored value of a CSC matrix
+    """
+    return np.repeat(np.arange(matrix.shape[1]), np.diff(matrix.indptr))
+
+
+def _column_max(matrix, cols):
+    colmax = np.zeros(matrix.shape[1])
+    np.maximum.at(colmax, cols, matrix.data)
+    return colmax
+
+
+def _normalize(matrix):
+    """
+    Divide each column of a CSC matrix by its sum (in place)
+    """
+    sums = np.asarray(matrix.sum(axis=0)).ravel()
+    sums[sums == 0] = 1.
+    matrix.data /= np.repeat(sums, np.diff(matrix.indptr))
+    return matrix
+
+
+def _prune(matrix, threshold, select):
+    """
+    Remove the values of a CSC matrix below threshold, keeping at most the
+    select largest values of each column (and at least the largest one), and
+    normalize the columns again.
+    """
+    cols = _columns(matrix)
+    keep = matrix.data >= threshold
+    keep |= matrix.data == _column_max(matrix, cols)[cols]
+    if select and len(cols) and np.diff(matrix.indptr).max() > select:
+        order = np.lexsort((-matrix.data, cols))
+        rank = np.empty(len(order), dtype=int)
+        rank[order] = np.arange(len(order)) - matrix.indptr[cols[order]]
+        keep &= rank < select
+    matrix = csc_matrix((matrix.data[keep], (matrix.indices[keep], cols[keep])),
+                        shape=matrix.shape)
+    return _normalize(matrix)
+
+
+def mcl_options(mclargs):
+    """
+    Convert command line arguments of the mcl program to the parameters of
+    :func:`pytadbit.utils.mcl.markov_clustering`. Only inflation ('-I'),
+    pre-inflation ('-pi'), pruning ('-P') and selection ('-S') are used.
+
+    :param mclargs: list of arguments (i.e,: ['-pi', '10', '-I', '2.0'])
+
+    :returns: a dictionary of parameters
+    """
+    options = {}
+    mclargs = list(mclargs or [])
+    while mclargs:
+        arg = mclargs.pop(0)
+        if arg == '-I':
+            options['inflation'] = float(mclargs.pop(0))
+        elif arg == '-pi':
+            options['pre_inflation'] = float(mclargs.pop(0))
+        elif arg == '-P':
+            options['prune'] = 1. / float(mclargs.pop(0))
+        elif arg == '-S':
+            options['select'] = int(mclargs.pop(0))
+        else:
+            if mclargs and not mclargs[0].startswith('-'):
+                arg += ' ' + mclargs.pop(0)
+            warn('WARNING: mcl argument %s not used' % arg)
+    return options
+
+
+def markov_clustering(matrix, inflation=2.0, expansion=2, pre_inflation=1.0,
+                      loops=True, prune=1 / 4000., select=500, max_iter=100,
+                      tolerance=1e-4, n_cpus=1):
+    """
+    Markov clustering of an undirected weighted graph.
+
+    :param matrix: square matrix (numpy array or scipy sparse matrix) with the
+       weights of the edges between nodes (non-negative similarities)
+    :param 2.0 inflation: power to which the values are raised at each
+       iteration, higher values give smaller clusters
+    :param 2 expansion: power to which the matrix is raised at each iteration
+    :param 1.0 pre_inflation: power to which the weights are raised before
+       clustering
+    :param True loops: add to each node an edge to itself, with the weight of
+       its strongest edge
+    :param 1/4000. prune: values below this threshold are removed after each
+       iteration
+    :param 500 select: maximum number of values kept in each column after each
+       iteration
+    :param 100 max_iter: maximum number of iterations
+    :param 1e-4 tolerance: stop when all columns are converged within this
+       tolerance (largest value equal to the sum of the squared values)
+    :param 1 n_cpus: number of threads used to process blocks of columns
+
+    :returns: a list of clusters (lists of node indexes), the more populated
+       first
+    """
+    matrix = csc_matrix(matrix, dtype=float, copy=True)
+    matrix = matrix.maximum(matrix.T).tocsc()
+    matrix = (matrix - diags(matrix.diagonal())).tocsc()
+    matrix.eliminate_zeros()
+    nnodes = matrix.shape[0]
+    if not nnodes:
+        return []
+    if pre_inflation != 1:
+        matrix.data **= pre_inflation
+    if loops:
+        colmax = _column_max(matrix, _columns(matrix))
+        colmax[colmax == 0] = 1.
+        matrix = (matrix + diags(colmax)).tocsc()
+    _normalize(matrix)
+
+    bounds = np.linspace(0, nnodes, min(max(n_cpus, 1), nnodes) + 1).astype(int)
+    bounds = list(zip(bounds[:-1], bounds[1:]))
+
+    def iterate(block):
+        beg, end = block
+        sub = matrix[:, beg:end]
+        for _ in range(expansion - 1):
+            sub = matrix.dot(sub)
+        sub = sub.tocsc()
+        sub.data **= inflation
+        return _prune(_normalize(sub), prune, select)
+
+    pool = ThreadPool(len(bounds)) if len(bounds) > 1 else None
+    for _ in range(max_iter):
+        blocks = pool.map(iterate, bounds) if pool else [iterate(bounds[0])]
+        matrix = hstack(blocks, format='csc')
+        cols = _columns(matrix)
+        sumsq = np.bincount(cols, weights=matrix.data**2, minlength=nnodes)
+        if np.max(_column_max(matrix, cols) - sumsq) < tolerance:
+            break
+    if pool:
+        pool.close()
+        pool.join()
+
+    # nodes attracted by the same nodes are in the same cluster
+    _, labels = connected_components(matrix, directed=False)
+    clusters = {}
+    for node, label in enumerate(labels):
+        clusters.setdefault(label, []).append(node)
+    return sorted(clusters.values(), key=lambda x: (-len(x), x[0]))
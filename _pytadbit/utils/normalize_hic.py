@@ -68,7 +68,9 @@ from __future__ import print_function
 from subprocess import Popen, PIPE
 from os import path
 
+import numpy as np
 from numpy import genfromtxt
+from scipy.sparse import coo_matrix, csr_matrix, diags
 
 from pytadbit.utils.file_handling import which
 
@@ -133,58 +135,13 @@ def oneD(tmp_dir='.', form='tot ~ s(map) + s(cg) + s(res)', p_fit=None,
     return biases_oneD
 
 
-def _update_S(W):
-    S = {}
-    meanS = 0.0
-    for bin1 in W:
-        S[bin1] = sum(W[bin1].values())
-        meanS += S[bin1]
-    meanS /= len(W)
-    return S, meanS
-
-
-def _updateDB(S, meanS, B):
-    DB = {}
-    for bin1 in S:
-        DB[bin1] = float(S[bin1]) / meanS
-        B[bin1] *= DB[bin1]
-    return DB
-
-
-def _update_W(W, DB):
-    for bin1 in W:
-        DBbin1 = DB[bin1]
-        W1 = W[bin1]
-        for bin2 in W1:
-            try:
-                W1[bin2] /= DBbin1 * DB[bin2]
-            except ZeroDivisionError: # whole row is empty
-                continue
-
-
-def copy_matrix(hic_data, bads):
-    W = {}
-    N = len(hic_data)
-    for k, v in hic_data.items():
-        i, j = divmod(k, N)
-        if i in bads or j in bads:
-            continue
-        try:
-            W[i][j] = v
-        except KeyError:
-            W[i] = {}
-            W[i][j] = v
-    return W
-
-
 def iterative(hic_data, bads=None, iterations=0, max_dev=0.00001,
               verbose=False, **kwargs):
     """
     Implementation of iterative correction Imakaev 2012
 
-    :param hic_data: dictionary containing the interaction data
+    :param hic_data: HiC_data object containing the interaction data
     :param None bads: dictionary with column not to be considered
-    :param None remove: columns not to consider
     :param 0 iterations: number of iterations to do (99 if a fully smoothed
        matrix with no visibility differences between columns is desired)
     :param 0.00001 max_dev: maximum difference allowed between a row and the
@@ -193,42 +150,103 @@ def iterative(hic_data, bads=None, iterations=0, max_dev=0.00001,
     """
     if verbose:
         print('iterative correction')
-    size = len(hic_data)
-    if not bads:
-        bads = {}
-    remove = [i in bads for i in range(size)]
-    remove = remove or tuple([int(hic_data[i+i*size]==0) for i in range(size)])
+        print("  - copying matrix")
+    W = hic_data.get_hic_data_as_csr()
+    return iterative_sparse(W, bads=bads, iterations=iterations,
+                            max_dev=max_dev, verbose=verbose)[0]
+
+
+def iterative_from_pixels(pixels, size, bads=None, iterations=0,
+                          max_dev=0.00001, verbose=False):
+    """
+    Iterative correction from chunks of pixels, without loading a HiC_data
+    object.
 
+    :param pixels: iterable of (rows, columns, values) numpy arrays (e.g. read
+       chunk by chunk from disk). Values of repeated cells are summed.
+    :param size: number of bins of the matrix
+    :param None bads: dictionary with column not to be considered
+    :param 0 iterations: number of iterations to do
+    :param 0.00001 max_dev: maximum difference allowed between a row and the
+       mean value of all raws
+
+    :returns: a vector of biases (length equal to the size of the matrix), and
+       the list of maximum deviations found at each iteration
+    """
     if verbose:
-        print("  - copying matrix")
+        print('iterative correction')
+        print("  - loading pixels")
+    rows, cols, vals = [], [], []
+    for row, col, val in pixels:
+        rows.append(np.asarray(row, dtype=np.int32))
+        cols.append(np.asarray(col, dtype=np.int32))
+        vals.append(np.asarray(val, dtype=np.float64))
+    if rows:
+        rows, cols, vals = (np.concatenate(rows), np.concatenate(cols),
+                            np.concatenate(vals))
+    else:
+        rows = cols = np.zeros(0, dtype=np.int32)
+        vals = np.zeros(0)
+    W = coo_matrix((vals, (rows, cols)), shape=(size, size)).tocsr()
+    return iterative_sparse(W, bads=bads, iterations=iterations,
+                            max_dev=max_dev, verbose=verbose)
+
 
-    W = copy_matrix(hic_data, bads)
-    B = dict([(b, 1.) for b in W])
-    if len(B) == 0:
+def iterative_sparse(W, bads=None, iterations=0, max_dev=0.00001,
+                     verbose=False):
+    """
+    Iterative correction on a scipy sparse matrix, each iteration being a
+    sparse matrix-vector product.
+
+    :param W: scipy sparse matrix (is not modified)
+    :param None bads: dictionary with column not to be considered
+    :param 0 iterations: number of iterations to do
+    :param 0.00001 max_dev: maximum difference allowed between a row and the
+       mean value of all raws
+
+    :returns: a vector of biases (length equal to the size of the matrix), and
+       the list of maximum deviations found at each iteration
+    """
+    size = W.shape[0]
+    W = csr_matrix(W, dtype=np.float64, copy=True)
+    if bads:
+        good = np.ones(size)
+        good[[b for b in bads if b < size]] = 0
+        # remove bad rows and columns
+        W = (diags(good) * W * diags(good)).tocsr()
+        W.eliminate_zeros()
+    # only rows with interactions are considered
+    valid = np.diff(W.indptr) > 0
+    nvalid = valid.sum()
+    if nvalid == 0:
         raise ZeroDivisionError('ERROR: normalization failed, all bad columns')
+    rows = np.repeat(np.arange(size), np.diff(W.indptr))
+    cols = W.indices
+    B = np.ones(size)
+    ones = np.ones(size)
+    devs = []
     if verbose:
         print("  - computing biases")
     for it in range(iterations + 1):
-        S, meanS = _update_S(W)
-        DB = _updateDB(S, meanS, B)
+        S = W.dot(ones)
+        meanS = S.sum() / nvalid
+        DB = S / meanS
+        B *= DB
         if iterations == 0: # exit before, we do not need to update W
             break
-        _update_W(W, DB)
-        S = sorted(S.values())
-        dev = max(abs(S[0]  / meanS - 1), abs(S[-1] / meanS - 1))
+        scale = DB[rows] * DB[cols]
+        scale[scale == 0] = 1  # whole row is empty
+        W.data /= scale
+        Smin = S[valid].min()
+        Smax = S[valid].max()
+        dev = max(abs(Smin / meanS - 1), abs(Smax / meanS - 1))
+        devs.append(dev)
         if verbose:
-            print('   %15.3f %15.3f %15.3f %4s %9.5f' % (S[0], meanS, S[-1], it, dev))
+            print('   %15.3f %15.3f %15.3f %4s %9.5f' % (Smin, meanS, Smax, it, dev))
         if dev < max_dev:
             break
-    for i in range(size):
-        try:
-            if B[i]:
-                B[i] *= meanS**.5
-            else:
-                B[i] = 1.
-        except KeyError:
-            B[i] = 1.
-    return B
+    B = np.where(valid & (B != 0), B * meanS**.5, 1.)
+    return dict(enumerate(B.tolist())), devs
 
 
 def expected(hic_data, bads=None, signal_to_noise=0.05, inter_chrom=False, **kwargs):
@@ -218,6 +218,50 @@ def calinski_harabasz(scores, clusters):
             (within_cluster / (nmodels - len(cluster_list))))
 
 
+def calinski_harabasz_cuts(scores, clust):
+    """
+    CH score (see :func:`pytadbit.utils.tadmaths.calinski_harabasz`) of the
+    clusters obtained after each merge of a hierarchical clustering. The sums
+    of squared scores between clusters are updated at each merge instead of
+    being computed again for each cut.
+
+    :param scores: square matrix with the score between each pair of models
+    :param clust: linkage matrix of the hierarchical clustering of the models
+       (as returned by :func:`scipy.cluster.hierarchy.linkage`)
+
+    :returns: an array with the CH score of each cut, one per row of the linkage
+       matrix
+    """
+    sums = np.array(scores, dtype=float)**2
+    np.fill_diagonal(sums, 0)
+    nmodels = len(sums)
+    sizes = np.ones(nmodels, dtype=int)
+    active = np.ones(nmodels, dtype=bool)
+    # row of each cluster in sums (merged clusters take the row of the first)
+    slots = list(range(nmodels))
+    ch_scores = np.zeros(len(clust))
+    for step, (cl1, cl2) in enumerate(clust[:, :2].astype(int)):
+        sl1, sl2 = slots[cl1], slots[cl2]
+        sums[sl1] += sums[sl2]
+        sums[:, sl1] += sums[:, sl2]
+        sizes[sl1] += sizes[sl2]
+        active[sl2] = False
+        slots.append(sl1)
+        big = np.flatnonzero(active & (sizes > 1))
+        nclust = len(big)
+        if nclust <= 1:
+            continue
+        size = sizes[big].astype(float)
+        means = sums[np.ix_(big, big)] / np.outer(size, size)
+        within_cluster = (means.diagonal() * size / (size - 1)).sum()
+        between_cluster = ((means.sum() - means.trace()) / 2 /
+                           ((nclust - 1.0) / 2))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ch_scores[step] = ((between_cluster / (nclust - 1)) /
+                               (within_cluster / (size.sum() - nclust)))
+    return ch_scores
+
+
 def mean_none(values):
     """
     Calculates the mean of a list of values without taking into account the None
@@ -10,6 +10,8 @@ from warnings  import catch_warnings, simplefilter
 from itertools import combinations
 from math      import pi, sqrt, cos, sin, acos
 from copy      import deepcopy
+from multiprocessing.dummy import Pool as ThreadPool
+import multiprocessing as mu
 
 import numpy as np
 from numpy.random import shuffle as np_shuffle
@@ -18,7 +20,7 @@ from matplotlib import pyplot as plt
 import matplotlib.gridspec as gridspec
 from matplotlib import rcParams
 
-from pytadbit.eqv_rms_drms import rmsdRMSD_wrapper
+from pytadbit.eqv_rms_drms import rmsdRMSD_tile_wrapper
 from pytadbit.consistency import consistency_wrapper
 from pytadbit.utils.extraviews import tadbit_savefig
 
@@ -247,6 +249,129 @@ def distance(part1, part2):
                 (part1[2] - part2[2])**2)
 
 
+# maximum number of distances (models times particle pairs) computed at once
+DISTANCES_BLOCK = 2**22
+
+
+def _pairs(nloci, pairs=None):
+    """
+    :returns: particle indexes (rows and columns) of the upper triangle of a
+       matrix, restricted to the True values of pairs
+    """
+    rows, cols = np.triu_indices(nloci, 1)
+    if pairs is not None:
+        keep = np.asarray(pairs, dtype=bool)[rows, cols]
+        rows, cols = rows[keep], cols[keep]
+    return rows, cols
+
+
+def _pair_square_distances(coords, rows, cols):
+    """
+    :returns: array (models, pairs) of squared distances between particles
+       rows and cols of each model
+    """
+    dists = (coords[:, rows, 0] - coords[:, cols, 0])**2
+    dists += (coords[:, rows, 1] - coords[:, cols, 1])**2
+    dists += (coords[:, rows, 2] - coords[:, cols, 2])**2
+    return dists
+
+
+def _map_blocks(func, starts, n_cpus):
+    """
+    Apply func to each block start, with a pool of threads if n_cpus > 1
+    (numpy releases the GIL).
+    """
+    starts = list(starts)
+    if n_cpus > 1 and len(starts) > 1:
+        pool = ThreadPool(min(n_cpus, len(starts)))
+        results = pool.map(func, starts)
+        pool.close()
+        pool.join()
+        return results
+    return [func(beg) for beg in starts]
+
+
+def contact_frequencies(coords, cutoffs, pairs=None, n_cpus=1,
+                        block=DISTANCES_BLOCK):
+    """
+    Frequency, over an ensemble of models, of each pair of particles being
+    closer than given distances. Models are processed by blocks, and all
+    cutoffs are applied in a single pass over the distances of each block.
+
+    :param coords: array of coordinates (models, particles, 3)
+    :param cutoffs: list of squared distance cutoffs
+    :param None pairs: boolean array (particles, particles) with the pairs of
+       particles to consider (all by default)
+    :param 1 n_cpus: number of threads used to process blocks of models
+    :param DISTANCES_BLOCK block: maximum number of distances computed at once
+
+    :returns: a list with one symmetric array (particles, particles) of
+       frequencies per cutoff (zero in the diagonal and for excluded pairs)
+    """
+    nmodels, nloci = coords.shape[:2]
+    rows, cols = _pairs(nloci, pairs)
+    npairs = len(rows)
+    order = np.argsort(cutoffs, kind='mergesort')
+    sorted_cutoffs = np.asarray(cutoffs, dtype=float)[order]
+    ncuts = len(sorted_cutoffs)
+    step = max(1, block // max(1, npairs))
+    offset = np.arange(npairs)
+
+    def count(beg):
+        dists = _pair_square_distances(coords[beg:beg + step], rows, cols)
+        # first cutoff greater or equal to each distance
+        idx = np.searchsorted(sorted_cutoffs, dists, side='left')
+        idx *= npairs
+        idx += offset
+        return np.bincount(idx.ravel(),
+                           minlength=(ncuts + 1) * npairs).reshape(-1, npairs)
+
+    counts = np.zeros((ncuts + 1, npairs), dtype=np.int64)
+    for sub in _map_blocks(count, range(0, nmodels, step), n_cpus):
+        counts += sub
+    # pairs closer than each cutoff are the ones below it or any smaller one
+    counts = counts[:ncuts].cumsum(axis=0)
+    matrices = [None] * ncuts
+    for k, pos in enumerate(order):
+        matrix = np.zeros((nloci, nloci))
+        matrix[rows, cols] = counts[k] / float(nmodels)
+        matrix[cols, rows] = matrix[rows, cols]
+        matrices[pos] = matrix
+    return matrices
+
+
+def median_distances(coords, pairs=None, n_cpus=1, block=DISTANCES_BLOCK):
+    """
+    Median, over an ensemble of models, of the distance between each pair of
+    particles. Pairs are processed by blocks, with all models at once.
+
+    :param coords: array of coordinates (models, particles, 3)
+    :param None pairs: boolean array (particles, particles) with the pairs of
+       particles to consider (all by default)
+    :param 1 n_cpus: number of threads used to process blocks of pairs
+    :param DISTANCES_BLOCK block: maximum number of distances computed at once
+
+    :returns: a symmetric array (particles, particles) of median distances
+       (zero in the diagonal and NaN for excluded pairs)
+    """
+    nmodels, nloci = coords.shape[:2]
+    rows, cols = _pairs(nloci, pairs)
+    step = max(1, block // max(1, nmodels))
+
+    def median(beg):
+        dists = _pair_square_distances(coords, rows[beg:beg + step],
+                                       cols[beg:beg + step])
+        return np.median(np.sqrt(dists), axis=0)
+
+    matrix = np.full((nloci, nloci), np.nan)
+    np.fill_diagonal(matrix, 0.)
+    if len(rows):
+        matrix[rows, cols] = np.concatenate(
+            _map_blocks(median, range(0, len(rows), step), n_cpus))
+        matrix[cols, rows] = matrix[rows, cols]
+    return matrix
+
+
 def angle_between_3_points(point1, point2, point3):
     """
     Calculates the angle between 3 particles
@@ -297,9 +422,9 @@ def angle_between_3_points(point1, point2, point3):
 def calc_consistency(models, nloci, zeros, dcutoff=200):
     combines = list(combinations(models, 2))
     parts = [0 for _ in range(nloci)]
-    for pm in consistency_wrapper([model['x'] for model in models],
-                                  [model['y'] for model in models],
-                                  [model['z'] for model in models],
+    for pm in consistency_wrapper([list(model['x']) for model in models],
+                                  [list(model['y']) for model in models],
+                                  [list(model['z']) for model in models],
                                   zeros,
                                   nloci, dcutoff, list(range(len(models))),
                                   len(models)):
@@ -308,8 +433,140 @@ def calc_consistency(models, nloci, zeros, dcutoff=200):
     return [float(p)/len(combines) * 100 for p in parts]
 
 
+# number of models per tile in the all against all comparison of models
+COMPARISON_TILE = 100
+
+
+def _compare_tile(args):
+    """
+    Compare models of two groups (or of one group between them if the second
+    is None).
+
+    :returns: array (pairs, 3) with the number of equivalent positions, the
+       RMSD and the dRMSD of each pair of models
+    """
+    coords1, coords2, dcutoff = args
+    same = coords2 is None
+    xs1, ys1, zs1 = coords1.transpose(2, 0, 1).tolist()
+    if same:
+        xs2, ys2, zs2 = [], [], []
+    else:
+        xs2, ys2, zs2 = coords2.transpose(2, 0, 1).tolist()
+    return np.array(rmsdRMSD_tile_wrapper(xs1, ys1, zs1, xs2, ys2, zs2,
+                                          coords1.shape[1], dcutoff,
+                                          int(same)),
+                    dtype=np.float32).reshape(-1, 3)
+
+
+def compare_models(coords, dcutoff=200, n_cpus=1, tile=COMPARISON_TILE):
+    """
+    All against all comparison of models: each pair of models is aligned,
+    and compared by its RMSD, its dRMSD and its number of equivalent
+    positions. The comparison is split in tiles of models, computed in
+    parallel.
+
+    :param coords: array of coordinates (models, particles, 3) of the
+       particles to compare
+    :param 200 dcutoff: distance in nanometer from which it is considered
+       that two particles are separated.
+    :param 1 n_cpus: number of processes used to compare tiles of models
+    :param COMPARISON_TILE tile: number of models per tile
+
+    :returns: an array (3, models, models) with the number of equivalent
+       positions, the RMSD and the dRMSD of each pair of models (zero in the
+       diagonal)
+    """
+    coords = np.asarray(coords, dtype=float)
+    nmodels = coords.shape[0]
+    starts = list(range(0, nmodels, tile))
+    tiles = [(i, j) for i in starts for j in starts if j >= i]
+    jobs = ((coords[i:i + tile], None if i == j else coords[j:j + tile],
+             dcutoff) for i, j in tiles)
+    if n_cpus > 1 and len(tiles) > 1:
+        pool = mu.Pool(min(n_cpus, len(tiles)))
+        results = pool.imap(_compare_tile, jobs)
+    else:
+        pool = None
+        results = (_compare_tile(job) for job in jobs)
+    comparison = np.zeros((3, nmodels, nmodels), dtype=np.float32)
+    for (i, j), values in zip(tiles, results):
+        if i == j:
+            rows, cols = np.triu_indices(min(tile, nmodels - i), 1)
+        else:
+            rows, cols = np.indices((min(tile, nmodels - i),
+                                     min(tile, nmodels - j))).reshape(2, -1)
+        rows = rows + i
+        cols = cols + j
+        comparison[:, rows, cols] = values.T
+        comparison[:, cols, rows] = values.T
+    if pool:
+        pool.close()
+        pool.join()
+    return comparison
+
+
+def score_matrix(comparison, what='score', normed=True):
+    """
+    Square matrix of the scores of the comparison between models (see
+    :func:`pytadbit.utils.three_dim_stats.calc_eqv_rmsd`), with zeros in the
+    diagonal.
+
+    :param comparison: array (3, models, models) as returned by
+       :func:`pytadbit.utils.three_dim_stats.compare_models`
+    :param 'score' what: values to return. Can be one of 'score', 'rmsd',
+       'drmsd' or 'eqv'
+    :param True normed: normalize result by maximum value (only applies to rmsd
+       and drmsd)
+
+    :returns: an array (models, models)
+    """
+    what = what.lower()
+    if not what in ['score', 'rmsd', 'drmsd', 'eqv']:
+        raise NotImplementedError("Only 'score', 'rmsd', 'drmsd' or 'eqv' " +
+                                  "features are available\n")
+    nmodels = comparison.shape[1]
+    rows, cols = np.triu_indices(nmodels, 1)
+    eqvs, rmsds, drmsds = (comparison[k][rows, cols].astype(float)
+                           for k in range(3))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if what == 'rmsd':
+            values = 1 - rmsds / rmsds.max() if normed else rmsds
+        elif what == 'drmsd':
+            values = 1 - drmsds / drmsds.max() if normed else drmsds
+        elif what == 'eqv':
+            values = eqvs
+        else:
+            values = eqvs * drmsds / rmsds * (rmsds.max() / drmsds.max())
+    matrix = np.zeros((nmodels, nmodels))
+    matrix[rows, cols] = values
+    matrix[cols, rows] = values
+    return matrix
+
+
+def comparison_scores(comparison, what='score', normed=True):
+    """
+    Scores of the comparison between models, as returned by
+    :func:`pytadbit.utils.three_dim_stats.calc_eqv_rmsd`.
+
+    :param comparison: array (3, models, models) as returned by
+       :func:`pytadbit.utils.three_dim_stats.compare_models`
+    :param 'score' what: values to return. Can be one of 'score', 'rmsd',
+       'drmsd' or 'eqv'
+    :param True normed: normalize result by maximum value (only applies to rmsd
+       and drmsd)
+
+    :returns: a dictionary with the score of each pair of models (both ways)
+    """
+    matrix = score_matrix(comparison, what, normed)
+    rows, cols = np.triu_indices(len(matrix), 1)
+    values = matrix[rows, cols].tolist()
+    scores = dict(zip(zip(rows.tolist(), cols.tolist()), values))
+    scores.update(zip(zip(cols.tolist(), rows.tolist()), values))
+    return scores
+
+
 def calc_eqv_rmsd(models, beg, end, zeros, dcutoff=200, one=False, what='score',
-                  normed=True):
+                  normed=True, n_cpus=1):
     """
     Calculates the RMSD, dRMSD, the number of equivalent positions and a score
     combining these three measures. The measure are done between a group of
@@ -327,6 +584,7 @@ def calc_eqv_rmsd(models, beg, end, zeros, dcutoff=200, one=False, what='score',
        'drmsd' or 'eqv'
     :param True normed: normalize result by maximum value (only applies to rmsd
        and drmsd)
+    :param 1 n_cpus: number of processes used to compare tiles of models
 
     :returns: a score of each pairwise comparison according to:
 
@@ -339,28 +597,20 @@ def calc_eqv_rmsd(models, beg, end, zeros, dcutoff=200, one=False, what='score',
        pairwise model comparison.
 
     """
-    what = what.lower()
-    if not what in ['score', 'rmsd', 'drmsd', 'eqv']:
-        raise NotImplementedError("Only 'score', 'rmsd', 'drmsd' or 'eqv' " +
-                                  "features are available\n")
     # remove particles with zeros from calculation
-    x = []
-    y = []
-    z = []
-    for m in range(len(models)):
-        x.append([models[m]['x'][i] for i in range(beg, end) if zeros[i]])
-        y.append([models[m]['y'][i] for i in range(beg, end) if zeros[i]])
-        z.append([models[m]['z'][i] for i in range(beg, end) if zeros[i]])
-    zeros = tuple([True for _ in range(len(x[0]))])
-    scores = rmsdRMSD_wrapper(x, y, z, zeros, len(zeros),
-                              dcutoff, list(range(len(models))), len(models),
-                              int(one), what, int(normed))
-    return scores
+    keep = [i for i in range(beg, end) if zeros[i]]
+    coords = np.array([[[models[m][axis][i] for axis in 'xyz'] for i in keep]
+                       for m in range(len(models))], dtype=float)
+    comparison = compare_models(coords, dcutoff, n_cpus=n_cpus)
+    if one:
+        return float(comparison[2, 0, 1])
+    return comparison_scores(comparison, what, normed)
 
 
 def dihedral(a, b, c, d, e):
     """
-    Calculates dihedral angle between 4 points in 3D (array with x,y,z)
+    Calculates dihedral angle between 4 points in 3D (array with x,y,z), or
+    between several sets of points (arrays with one row of x,y,z per set)
     """
     v1 = getNormedVector(b - a)
     v2 = getNormedVector(b - c)
@@ -368,20 +618,20 @@ def dihedral(a, b, c, d, e):
     v3 = getNormedVector(c - e)
     v1v2 = np.cross(v1, v2)
     v3v4 = np.cross(v3, v4)
-    sign = 1 if np.linalg.det([v2, v1v2, v3v4]) < 0 else -1
+    sign = np.where(np.linalg.det(np.stack([v2, v1v2, v3v4], axis=-2)) < 0,
+                    1, -1)
     angle = getAngle(v1v2, v3v4)
     return sign * angle
 
 
 def getNormedVector(dif):
-    return (dif) / np.linalg.norm(dif)
+    return (dif) / np.linalg.norm(dif, axis=-1)[..., None]
 
 
 def getAngle(v1v2, v2v3):
     return np.rad2deg(
-        np.arccos(np.dot(
-            v1v2   / np.linalg.norm(v1v2),
-            v2v3.T / np.linalg.norm(v2v3)))
+        np.arccos((v1v2 / np.linalg.norm(v1v2, axis=-1)[..., None] *
+                   v2v3 / np.linalg.norm(v2v3, axis=-1)[..., None]).sum(axis=-1))
         )
 
 
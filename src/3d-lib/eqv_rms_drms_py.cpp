@@ -206,10 +206,107 @@ static PyObject* rmsdRMSD_wrapper(PyObject* self, PyObject* args)
   return py_result;
 }
  
+/* The function doc string */
+PyDoc_STRVAR(rmsdRMSD_tile_wrapper__doc__,
+"Compare each model of a first group to each model of a second group, \n\
+returning the number of equivalent positions, the RMSD and the dRMSD of \n\
+each comparison (not normalized).\n\
+   :param xs_a: list of lists of x coordinates of the first group\n\
+   :param ys_a: list of lists of y coordinates of the first group\n\
+   :param zs_a: list of lists of z coordinates of the first group\n\
+   :param xs_b: list of lists of x coordinates of the second group\n\
+   :param ys_b: list of lists of y coordinates of the second group\n\
+   :param zs_b: list of lists of z coordinates of the second group\n\
+   :param size: number of particles\n\
+   :param dcutoff: distance cutoff to consider 2 particles as equivalent \n\
+      in position (nm)\n\
+   :param same: if 1 the second group is ignored, and models of the first \n\
+      group are compared between them (each pair once)\n\
+\n\
+   :returns: a list of tuples (equivalent positions, RMSD, dRMSD), ordered \n\
+      by model of the first group and then by model of the second group.\n\
+");
+
+static float*** read_models(PyObject *py_xs, PyObject *py_ys, PyObject *py_zs,
+                            int nmodels, int size)
+{
+  float ***xyzn;
+  xyzn = new float **[nmodels];
+  for (int j=0; j<nmodels; j++){
+    xyzn[j] = new float *[size];
+    for (int i=0; i<size; i++){
+      xyzn[j][i] = new float[3];
+      xyzn[j][i][0] = PyFloat_AsDouble(PyList_GET_ITEM(PyList_GET_ITEM(py_xs, j), i));
+      xyzn[j][i][1] = PyFloat_AsDouble(PyList_GET_ITEM(PyList_GET_ITEM(py_ys, j), i));
+      xyzn[j][i][2] = PyFloat_AsDouble(PyList_GET_ITEM(PyList_GET_ITEM(py_zs, j), i));
+    }
+  }
+  return xyzn;
+}
+
+static void free_models(float ***xyzn, int nmodels, int size)
+{
+  for (int j=0; j<nmodels; j++){
+    for (int i=0; i<size; i++)
+      delete[] xyzn[j][i];
+    delete[] xyzn[j];
+  }
+  delete[] xyzn;
+}
+
+static PyObject* rmsdRMSD_tile_wrapper(PyObject* self, PyObject* args)
+{
+  PyObject *py_xs1, *py_ys1, *py_zs1;
+  PyObject *py_xs2, *py_ys2, *py_zs2;
+  int size;
+  float thres;
+  int same;
+
+  if (!PyArg_ParseTuple(args, "O!O!O!O!O!O!ifi",
+			&PyList_Type, &py_xs1, &PyList_Type, &py_ys1,
+			&PyList_Type, &py_zs1, &PyList_Type, &py_xs2,
+			&PyList_Type, &py_ys2, &PyList_Type, &py_zs2,
+			&size, &thres, &same))
+    return NULL;
+
+  int nmodels1 = PyList_GET_SIZE(py_xs1);
+  int nmodels2 = same ? nmodels1 : PyList_GET_SIZE(py_xs2);
+  int *zeros = new int[size];
+  for (int i=0; i<size; i++)
+    zeros[i] = 1;
+  float ***xyzn1 = read_models(py_xs1, py_ys1, py_zs1, nmodels1, size);
+  float ***xyzn2 = same ? xyzn1 : read_models(py_xs2, py_ys2, py_zs2, nmodels2, size);
+
+  float rms;
+  float drms;
+  int   eqv;
+  PyObject *py_result = PyList_New(0);
+  PyObject *py_subresult;
+  for (int j=0; j<nmodels1; j++){
+    for (int jj=same ? j + 1 : 0; jj<nmodels2; jj++){
+      rms = 0;
+      drms = 0;
+      eqv = 0;
+      rmsdRMSD(xyzn1[j], xyzn2[jj], zeros, size, thres, eqv, rms, drms);
+      py_subresult = Py_BuildValue("(idd)", eqv, (double)rms, (double)drms);
+      PyList_Append(py_result, py_subresult);
+      Py_DECREF(py_subresult);
+    }
+  }
+
+  free_models(xyzn1, nmodels1, size);
+  if (!same)
+    free_models(xyzn2, nmodels2, size);
+  delete[] zeros;
+  return py_result;
+}
+
 static PyMethodDef Eqv_rms_drmsMethods[] =
   {
     {"rmsdRMSD_wrapper", rmsdRMSD_wrapper, METH_VARARGS, 
     rmsdRMSD_wrapper__doc__},
+    {"rmsdRMSD_tile_wrapper", rmsdRMSD_tile_wrapper, METH_VARARGS,
+    rmsdRMSD_tile_wrapper__doc__},
     {NULL, NULL, 0, NULL}
   };
 
@@ -13,8 +13,11 @@ matplotlib.use('Agg')
 import unittest
 from pytadbit                             import Chromosome, load_chromosome
 from pytadbit                             import tadbit, batch_tadbit
+from pytadbit                             import HiC_data
 from pytadbit.tad_clustering.tad_cmo      import optimal_cmo
 from pytadbit.modelling.structuralmodels        import load_structuralmodels
+from pytadbit.parsers.models_parser       import append_models, move_models
+from pytadbit.parsers.models_parser       import remove_models
 from pytadbit.modelling.impmodel                import load_impmodel_from_cmm
 from pytadbit.eqv_rms_drms                import rmsdRMSD_wrapper
 from pytadbit.parsers.genome_parser       import parse_fasta
@@ -24,12 +27,12 @@ from pytadbit.mapping.analyze             import hic_map, plot_distance_vs_inter
 from pytadbit.mapping.analyze             import insert_sizes, plot_iterative_mapping
 from pytadbit.mapping.analyze             import correlate_matrices, eig_correlate_matrices
 from pytadbit.mapping.filter              import filter_reads, apply_filter
+from pytadbit.mapping.filter              import load_filter_mask
 
 from random                               import random, seed
-from os                                   import system, path, chdir, environ
+from os                                   import system, path, chdir, environ, listdir
 from re                                   import finditer
 from warnings                             import warn, catch_warnings, simplefilter
-from distutils.spawn                      import find_executable
 
 import sys
 
@@ -352,6 +355,40 @@ class TestTadbit(unittest.TestCase):
         self.assertEqual(len(hic_data.compartments[None]), 39)
         # self.assertEqual(round(hic_data.compartments[None][24]["dens"], 5),
         #                  0.75434)
+        # correlation matrix written in double precision, compared to the
+        # numpy.corrcoef of the full observed/expected matrix
+        from numpy import corrcoef, isnan
+        system("rm -rf lala-cmprts~; mkdir lala-cmprts~")
+        hic_data.find_compartments(label_compartments="cluster", n_cpus=2,
+                                   savecorr="lala-cmprts~",
+                                   savedata="lala-cmprts~/cmprts.tsv")
+        size = len(hic_data)
+        matrix = [[float(hic_data[i, j]) / hic_data.expected[abs(j - i)]
+                   / hic_data.bias[i] / hic_data.bias[j]
+                   for i in range(size)] for j in range(size)]
+        for i in range(size):
+            for j in range(i + 1, size):
+                matrix[i][j] = matrix[j][i]
+        matrix = corrcoef(matrix)
+        matrix[isnan(matrix)] = 0
+        with open("lala-cmprts~/None_corr-matrix.tsv") as fh:
+            next(fh)
+            corr = [[float(v) for v in l.split()[2:]] for l in fh]
+        self.assertEqual(len(corr), size)
+        self.assertTrue(all(abs(v - matrix[i][j]) < 1e-12
+                            for i in range(size) for j, v in enumerate(corr[i])))
+        with open("lala-cmprts~/cmprts.tsv") as fh:
+            self.assertEqual(next(fh), "## CHR None\tEigenvector: 1\n")
+            self.assertEqual(next(fh), "#\tstart\tend\trich in A\ttype\n")
+            cmprts = [l.rstrip("\n").split("\t") for l in fh]
+        self.assertEqual(len(cmprts), len(hic_data.compartments[None]))
+        self.assertEqual([c[1:3] for c in cmprts[:3]],
+                         [["1", "1"], ["2", "3"], ["4", "5"]])
+        self.assertEqual(cmprts, [
+            ["None", str(c["start"] + 1), str(c["end"] + 1),
+             "%.2f" % c.get("dens", float("nan")), c.get("type", "")]
+            for c in hic_data.compartments[None]])
+        system("rm -rf lala-cmprts~")
         if CHKTIME:
             print("10", time() - t0)
 
@@ -518,14 +555,43 @@ class TestTadbit(unittest.TestCase):
         else:
             refmodels_path = PATH + "/models_py3.pick"
         models = load_structuralmodels(refmodels_path)
-        if find_executable("mcl"):
-            models.cluster_models(method="mcl", fact=0.9, verbose=False,
-                                  dcutoff=200)
-            self.assertTrue(5 <= len(list(models.clusters.keys())) <= 7)
+        models.cluster_models(method="mcl", fact=0.9, verbose=False,
+                              dcutoff=200)
+        self.assertTrue(5 <= len(list(models.clusters.keys())) <= 7)
         models.cluster_models(method="ward", verbose=False, dcutoff=200)
         self.assertTrue(2 <= len(list(models.clusters.keys())) <= 3)
         d = models.cluster_analysis_dendrogram()
         self.assertEqual(d["icoord"], [[5., 5., 15., 15.]])
+        # columnar format
+        def same_models(models1, models2):
+            self.assertEqual(models2.clusters, models1.clusters)
+            self.assertEqual(models2.description, models1.description)
+            self.assertEqual(len(models2), len(models1))
+            for m1, m2 in zip(models1, models2):
+                self.assertEqual((m2['rand_init'], m2['objfun']),
+                                 (m1['rand_init'], m1['objfun']))
+                for k in 'xyz':
+                    self.assertEqual(list(m2[k]), list(m1[k]))
+            self.assertEqual(models2.get_contact_matrix(cutoff=200),
+                             models1.get_contact_matrix(cutoff=200))
+            self.assertEqual(models2.median_3d_dist(3, 12, plot=False),
+                             models1.median_3d_dist(3, 12, plot=False))
+        models.save_models("lolo_models", format='npy')
+        models2 = load_structuralmodels("lolo_models")
+        same_models(models, models2)
+        self.assertEqual(append_models("lolo_models", models, silent=True), 0)
+        # saved over the directory they are loaded from
+        models2.save_models("lolo_models", format='npy')
+        same_models(models, load_structuralmodels("lolo_models"))
+        models2.save_models("lolo_models")
+        same_models(models, load_structuralmodels("lolo_models"))
+        models.save_models("lolo_models2", format='npy')
+        models.save_models("lolo_models", format='npy')
+        move_models("lolo_models2", "lolo_models")
+        self.assertFalse(path.exists("lolo_models2"))
+        same_models(models, load_structuralmodels("lolo_models"))
+        remove_models("lolo_models")
+        self.assertFalse(path.exists("lolo_models"))
         # align models
         m1, m2 = models.align_models(models=[1,2])
         nrmsd = (sum([((m1[0][i] - m2[0][i])**2 + (m1[1][i] - m2[1][i])**2 + (m1[2][i] - m2[2][i])**2)**.5
@@ -753,9 +819,32 @@ class TestTadbit(unittest.TestCase):
             from pytadbit.mapping import get_intersection
             get_intersection("lala1-%s~" % (ali), "lala2-%s~" % (ali),
                              "lala-%s~" % (ali))
-            # FILTER
+            # FILTER, writing also the IDs of the filtered reads in the same
+            # pass, with duplicates at the borders of the shards
+            for ncpus in [1, 13]:
+                masked = filter_reads(
+                    "lala-%s~" % (ali), output="lala-ids-%s~" % (ali),
+                    verbose=False, ncpus=ncpus, text_output=True)
+                mask, index = load_filter_mask(
+                    "lala-%s~" % (ali), "lala-ids-%s~_filters.npy" % (ali))
+                mask = mask.tolist()
+                with open("lala-%s~" % (ali), "rb") as fh:
+                    fh.seek(index[0])
+                    reads = [l.split(b"\t", 1)[0] + b"\n" for l in fh]
+                for k in range(1, 11):
+                    with open(masked[k]["fnam"], "rb") as fh:
+                        ids = fh.read()
+                    self.assertEqual(ids, b"".join(
+                        r for r, f in zip(reads, mask) if f & (1 << (k - 1))))
+                    self.assertEqual(ids.count(b"\n"), masked[k]["reads"])
             masked = filter_reads("lala-%s~" % (ali), verbose=False,
                                   fast=(ali=="map"))
+            self.assertEqual(mask, load_filter_mask("lala-%s~" % (ali))[0].tolist())
+            # files of read IDs written by default, as formerly
+            for k in range(1, 11):
+                with open(masked[k]["fnam"], "rb") as fh:
+                    self.assertEqual(fh.read().count(b"\n"), masked[k]["reads"])
+            system("rm -rf lala-ids-%s~*" % (ali))
             self.assertEqual(masked[1]["reads"], 1000)
             self.assertEqual(masked[2]["reads"], 1000)
             self.assertEqual(masked[3]["reads"], 1000)
@@ -793,6 +882,10 @@ class TestTadbit(unittest.TestCase):
         # slowest part of the all test:
         hic_data2 = read_matrix("lala-map.tsv~", resolution=10000)
         self.assertEqual(hic_data1, hic_data2)
+        hic_data1.write_matrix("lala-map.npz~", format="npz")
+        hic_data2 = read_matrix("lala-map.npz~")
+        self.assertEqual(hic_data1, hic_data2)
+        self.assertEqual(hic_data1.sections, hic_data2.sections)
         # vals = plot_distance_vs_interactions(hic_data1)
 
         # self.assertEqual([round(i, 2) if str(i)!="nan" else 0.0 for i in
@@ -904,6 +997,1486 @@ class TestTadbit(unittest.TestCase):
             print("13", time() - t0)
 
 
+    def test_22_hic_data_storage(self):
+        """
+        array-backed HiC_data behaving as a dictionary
+        """
+        if ONLY and not "22" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from numpy import array, isnan, nan_to_num
+        # half matrix is copied to the other side
+        hic = HiC_data([(1, 3), (10, 5)], 4)
+        self.assertEqual([hic[0, 1], hic[1, 0], hic[2, 2]], [3, 3, 5])
+        self.assertEqual(list(hic.items()), [(1, 3), (4, 3), (10, 5)])
+        self.assertEqual(len(hic), 4)
+        # stored zeros are copied too, as with the former dictionary
+        self.assertEqual(list(HiC_data([(1, 3), (2, 0.)], 4).items()),
+                         [(1, 3), (2, 0.), (4, 3), (8, 0.)])
+        self.assertEqual((4 in hic, 5 in hic), (True, False))
+        hic[3, 3] += 1
+        hic[3, 3] += 1
+        self.assertEqual(hic.get(15), 2)
+        self.assertEqual(hic.sum(), 13)
+        hic.update_from_arrays([15, 15, 0], [1, 1, 2], add=True)
+        self.assertEqual((hic[3, 3], hic[0, 0]), (4, 2))
+        hic.bias = dict((i, 2.) for i in range(4))
+        self.assertEqual(hic.sum(bias=hic.bias), 4.25)
+        self.assertEqual(hic, HiC_data(dict(hic.items()), 4))
+        # asymmetric matrix is summed
+        hic = HiC_data([(1, 3), (4, 2)], 4)
+        self.assertEqual(dict(hic.items()), {1: 5, 4: 5})
+        # matrix extraction
+        self.assertEqual(hic.get_matrix(focus=(1, 2)), [[0, 5], [5, 0]])
+        hic.bias = dict((i, 2.) for i in range(4))
+        hic.bads = {0: True}
+        self.assertEqual(hic.get_matrix(focus=(1, 2), normalized=True,
+                                        as_array=True).tolist(),
+                         [[0., 1.25], [1.25, 0.]])
+        self.assertEqual(list(hic.yield_matrix(focus=(1, 2))), [[0, 0], [5, 0]])
+        self.assertEqual(hic.get_matrix(sparse=True).nnz, 2)
+        self.assertEqual(hic.get_matrix(masked=True).dtype, array([1]).dtype)
+        # empty cells of float matrices are integers, as with dictionaries
+        hic = HiC_data([(1, 3), (4, 3), (10, 1.5)], 4)
+        self.assertEqual([[type(v).__name__ for v in l] for l in hic.get_matrix()],
+                         [["int", "float", "int", "int"],
+                          ["float", "int", "int", "int"],
+                          ["int", "int", "float", "int"],
+                          ["int", "int", "int", "int"]])
+        self.assertEqual((hic.get_matrix(diagonal=False)[2][2],
+                          hic.get_matrix(diagonal=False)[0][1]), (1, 3.))
+        # rows without bias are not-a-number, empty cells included
+        hic.bias = {0: 1., 1: float("nan"), 2: 2., 3: 1.}
+        for matrix in [hic.get_matrix(normalized=True, as_array=True),
+                       array(list(hic.yield_matrix(normalized=True)))]:
+            self.assertEqual(isnan(matrix).tolist(),
+                             [[False, True, False, False], [True] * 4,
+                              [False, True, False, False],
+                              [False, True, False, False]])
+            self.assertEqual(nan_to_num(matrix).tolist(),
+                             [[0., 0., 0., 0.], [0., 0., 0., 0.],
+                              [0., 0., .375, 0.], [0., 0., 0., 0.]])
+        # HiC_data pickled as a dictionary by former versions
+        from pickle import dumps, loads
+        former = (b"\x80\x02cpytadbit.hic_data\nHiC_data\nq\x00)\x81q\x01(K"
+                  b"\x01K\x03K\x04K\x03K\nK\x05u}q\x02(X\x0f\x00\x00\x00_HiC_d"
+                  b"ata__sizeq\x03K\x04X\x06\x00\x00\x00_size2q\x04K\x10X\x04"
+                  b"\x00\x00\x00biasq\x05NX\x04\x00\x00\x00badsq\x06}q\x07K\x00"
+                  b"\x88sX\x0b\x00\x00\x00chromosomesq\x08NX\x08\x00\x00\x00sec"
+                  b"tionsq\tNX\x0b\x00\x00\x00section_posq\n}q\x0bX\n\x00\x00"
+                  b"\x00resolutionq\x0cK\x01X\x08\x00\x00\x00expectedq\rNX\r\x00"
+                  b"\x00\x00symmetricizedq\x0e\x89X\x0c\x00\x00\x00compartmentsq"
+                  b"\x0f}q\x10ub.")
+        hic = loads(former)
+        self.assertEqual(list(hic.items()), [(1, 3), (4, 3), (10, 5)])
+        self.assertEqual((len(hic), hic[2, 2], hic.bads), (4, 5, {0: True}))
+        hic[3, 3] = 1
+        self.assertEqual(hic.get_matrix(), [[0, 3, 0, 0], [3, 0, 0, 0],
+                                            [0, 0, 5, 0], [0, 0, 0, 1]])
+        hic2 = loads(dumps(hic))
+        self.assertEqual((hic2, hic2.bads, len(hic2)), (hic, {0: True}, 4))
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("22", time() - t0)
+
+    def test_23_bin_features(self):
+        """
+        GC content and RE sites per bin, as computed bin by bin
+        """
+        if ONLY and not "23" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from argparse import Namespace
+        from pytadbit.tools.tadbit_normalize import load_bin_features
+        seed(3)
+        genome = OrderedDict((crm, "".join("ACGTN"[int(random() * 4.05)]
+                                           for _ in range(size)))
+                             for crm, size in (("chr1", 23456), ("chr2", 7000)))
+        system("rm -rf lala-bins~ && mkdir -p lala-bins~/04_normalization")
+        with open("lala-bins~/genome.fa", "w") as out:
+            for crm in genome:
+                out.write(">%s\n%s\n" % (crm, genome[crm]))
+        with open("lala-bins~/mappability.bedGraph", "w") as out:
+            for crm in genome:
+                for pos in range(0, len(genome[crm]), 1000):
+                    out.write("%s\t%d\t%d\t1\n" % (crm, pos, min(
+                        pos + 1000, len(genome[crm]))))
+        opts = Namespace(fasta="lala-bins~/genome.fa", reso=2000, renz="MboI",
+                         mappability="lala-bins~/mappability.bedGraph",
+                         workdir="lala-bins~", cpus=1)
+        re_site = RESTRICTION_ENZYMES["MboI"].replace("|", "")
+        gc_content = []
+        n_rsites = []
+        for crm in genome:
+            seq = genome[crm]
+            for pos in range(0, len(seq), opts.reso):
+                sub = seq[pos:pos + opts.reso]
+                try:
+                    gc_content.append(float(sub.count("G") + sub.count("C")) /
+                                      (len(sub) - sub.count("N")))
+                except ZeroDivisionError:
+                    gc_content.append(float("nan"))
+            for pos in range(200, len(seq) + 200, opts.reso):
+                n_rsites.append(seq[pos - 200:pos + opts.reso + 200].count(re_site))
+        # computed, then loaded from the cache
+        for _ in range(2):
+            mappability, gc, rsites = load_bin_features(opts, list(genome))
+            self.assertEqual(rsites, n_rsites)
+            self.assertEqual(len(gc), len(gc_content))
+            self.assertTrue(all(abs(a - b) < 1e-12 for a, b in zip(gc, gc_content)))
+            self.assertEqual(len(mappability), len(gc_content))
+        self.assertEqual(len([f for f in listdir("lala-bins~/04_normalization")
+                              if f.startswith("bin_features_")]), 1)
+        system("rm -rf lala-bins~")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("23", time() - t0)
+
+    def test_24_ice_from_bam(self):
+        """
+        ICE biases computed from the chunks of the BAM, as from the full matrix
+        """
+        if ONLY and not "24" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from pytadbit.tools.tadbit_normalize import read_bam
+        from pytadbit.parsers.hic_parser import load_hic_data_from_bam
+        system("rm -rf lala-ice~ && mkdir -p lala-ice~")
+        generate_random_bam("lala-ice~/lala.bam", [95000, 61000], 10000)
+        # many reads span the borders of the 9 chunks
+        biases, _, badcol, _, _ = read_bam(
+            "lala-ice~/lala.bam", 0, 1000, min_count=5, normalization="ICE",
+            ncpus=1, outdir="lala-ice~", max_njobs=7, cistrans_filter=False)
+        hic_data = load_hic_data_from_bam(
+            "lala-ice~/lala.bam", 1000, filter_exclude=0, tmpdir="lala-ice~",
+            ncpus=1, nchunks=7, verbose=False)
+        hic_data.bads = badcol
+        hic_data.normalize_hic(iterations=100, max_dev=0.000001, silent=True)
+        self.assertEqual(len(biases), len(hic_data))
+        self.assertTrue(all(abs(biases[k] - hic_data.bias[k]) < 1e-9
+                            for k in range(len(hic_data)) if not k in badcol))
+        system("rm -rf lala-ice~")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("24", time() - t0)
+
+    def test_25_re_sites_index(self):
+        """
+        persistent index of RE sites, and RE sites of GEM3 reads
+        """
+        if ONLY and not "25" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from pickle import dumps, loads
+        from pytadbit.mapping.restriction_enzymes import re_sites_index
+        from pysam import AlignmentFile
+        from pytadbit.parsers.sam_parser import parse_gem_3c
+        seed(5)
+        genome = OrderedDict((crm, "".join("ACGT"[int(random() * 4)]
+                                           for _ in range(size)))
+                             for crm, size in (("chr1", 30000), ("chr2", 12000)))
+        system("rm -rf lala-re~ && mkdir -p lala-re~")
+        frags = re_sites_index("MboI", genome)
+        old_frags = map_re_sites("MboI", genome)
+        for crm in genome:
+            self.assertEqual(frags[crm].tolist(), sorted(
+                set([1] + sum(old_frags[crm].values(), []) + [len(genome[crm])])))
+        # saved, then loaded memory mapped
+        for _ in range(2):
+            cached = re_sites_index("MboI", genome, cache="lala-re~/genome")
+            self.assertEqual(list(cached), list(genome))
+            for crm in genome:
+                self.assertEqual(cached[crm].tolist(), frags[crm].tolist())
+        self.assertTrue(len(dumps(cached)) < 1000)
+        self.assertEqual(loads(dumps(cached))["chr2"].tolist(),
+                         frags["chr2"].tolist())
+        # same lengths, other sequence
+        genome["chr2"] = genome["chr2"][::-1]
+        cached = re_sites_index("MboI", genome, cache="lala-re~/genome")
+        self.assertEqual(cached["chr2"].tolist(),
+                         re_sites_index("MboI", genome)["chr2"].tolist())
+        genome["chr2"] = genome["chr2"][::-1]
+        cached = re_sites_index("MboI", genome, cache="lala-re~/genome")
+        # RE sites of GEM3 reads, found for blocks of reads
+        generate_random_gem3_sam("lala-re~/reads.sam", genome, 3000)
+        parse_gem_3c("lala-re~/reads.sam", "lala-re~/reads.tsv",
+                     dict((crm, len(genome[crm])) for crm in genome),
+                     cached, False, True)
+        with open("lala-re~/reads.tsv") as f_lala:
+            lines = [l.split() for l in f_lala if not l.startswith("#")]
+        self.assertEqual(len(lines), 8723)
+        self.assertEqual(lines[0], ["read000750#10/10", "0", "chr1", "1", "1",
+                                    "34", "1", "291", "0", "chr1", "656", "1",
+                                    "49", "623", "932"])
+        # closest RE sites of each read end, as found by the previous parser
+        sites = dict((crm, sorted(set([1] + sum(old_frags[crm].values(), []) +
+                                      [len(genome[crm])])))
+                     for crm in genome)
+        for line in lines:
+            for crm, pos, prev_re, next_re in (line[2:4] + line[6:8],
+                                               line[9:11] + line[13:15]):
+                pos = int(pos)
+                self.assertEqual(int(prev_re), max(s for s in sites[crm]
+                                                   if s <= pos))
+                self.assertEqual(int(next_re), min(s for s in sites[crm]
+                                                   if s > pos))
+        # sorted by position of the first, then of the second read end
+        self.assertEqual(
+            [(int(l[1]), int(l[3]), int(l[8]), int(l[10])) for l in lines],
+            sorted((int(l[1]), int(l[3]), int(l[8]), int(l[10])) for l in lines))
+        # reads with at least 2 mapped ends on known chromosomes
+        mapped = {}
+        for read in AlignmentFile("lala-re~/reads.sam"):
+            if (read.is_paired and not read.is_unmapped and read.mapq >= 4 and
+                read.reference_name in genome):
+                mapped[read.query_name] = mapped.get(read.query_name, 0) + 1
+        read_ids = set(l[0].split("#")[0] for l in lines)
+        self.assertEqual(len(read_ids), 2170)
+        self.assertTrue(all(mapped[k] > 1 for k in read_ids))
+        system("rm -rf lala-re~")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("25", time() - t0)
+
+    def test_26_reads_parser(self):
+        """
+        binning of the reads of a TSV file, compared to the former line by line
+        parser
+        """
+        if ONLY and not "26" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from numpy import frombuffer, uint8
+        from pytadbit.parsers.hic_parser import _parse_ints, _tsv_fields
+        data = frombuffer(b"a\t-12\t0\t\t7\n\t345\t-0\tb\t9\n", dtype=uint8)
+        fields = _tsv_fields(data, [1, 2, 4])
+        self.assertEqual(_parse_ints(data, *fields[0]).tolist(), [-12, 345])
+        self.assertEqual(_parse_ints(data, *fields[1]).tolist(), [0, 0])
+        self.assertEqual(_parse_ints(data, *fields[2]).tolist(), [7, 9])
+        self.assertRaises(Exception, _tsv_fields, data, [5])
+        self.assertRaises(Exception, _tsv_fields, data, [1], min_fields=6)
+        self.assertRaises(Exception, _parse_ints, data, *_tsv_fields(data, [3]))
+        self.assertRaises(Exception, _parse_ints, data, *_tsv_fields(data, [0]))
+        seed(3)
+        header = "# CRM chr1\t1000\n# CRM chr2\t700\n# some comment\n"
+        reads = [generate_read_line(i) for i in range(500)]
+        cases = {
+            "plain"   : header + "".join(reads),
+            "crlf"    : (header + "".join(reads)).replace("\n", "\r\n"),
+            "no-eol"  : header + "".join(reads)[:-1],
+            "neg"     : (header + "".join(reads[:100]) +
+                         generate_read_line(900, ps1=-5) + "".join(reads[100:])),
+            "unknown" : (header + "".join(reads[:100]) +
+                         generate_read_line(901, cr1="chrU") +
+                         generate_read_line(902, cr1="chr2", ps1=990) +
+                         "".join(reads[100:])),
+            "empty"   : (header + "".join(reads[:100]) +
+                         generate_read_line(903, ps2="") + "".join(reads[100:])),
+            "text"    : (header + "".join(reads[:100]) +
+                         generate_read_line(904, ps2="12a") + "".join(reads[100:])),
+            "short"   : (header + "".join(reads[:100]) +
+                         "\t".join(generate_read_line(905).split("\t")[:9]) +
+                         "\n" + "".join(reads[100:])),
+            "comment" : header + "".join(reads[:100]) + "# lala\n" + "".join(reads[100:]),
+            "blank"   : header + "".join(reads[:100]) + "\n" + "".join(reads[100:])}
+        for case, text in cases.items():
+            with open("lala-reads~", "wb") as out:
+                out.write(text.encode())
+            try:
+                expected = load_reads_line_by_line("lala-reads~", 100)
+            except ValueError:
+                expected = None
+            for ncpus in [1, 3]:
+                if expected is None:
+                    self.assertRaises(Exception, load_hic_data_from_reads,
+                                      "lala-reads~", 100, ncpus=ncpus)
+                    continue
+                hic_data = load_hic_data_from_reads("lala-reads~", 100,
+                                                    ncpus=ncpus)
+                self.assertEqual(sorted((int(k), int(v))
+                                        for k, v in hic_data.items()),
+                                 expected, case)
+        system("rm -rf lala-reads~")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("26", time() - t0)
+
+    def test_27_bam_pixels(self):
+        """
+        matrices binned from the pixels of the chunks of a BAM, compared to
+        the reads counted one by one
+        """
+        if ONLY and not "27" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from pickle import dump
+        from pytadbit.parsers.hic_bam_parser import get_matrix
+        from pytadbit.parsers.hic_parser import load_hic_data_from_bam
+        system("rm -rf lala-px~ && mkdir -p lala-px~")
+        generate_random_bam("lala-px~/lala.bam", [95000, 61000], 10000)
+        counts = count_bam_pixels("lala-px~/lala.bam", 1000)
+        self.assertEqual(sum(counts.values()), 20000)
+        # the former merge of the chunks replaced the pixels of the bins at
+        # their borders instead of summing them
+        for ncpus, nchunks in [(1, 7), (2, 20)]:
+            dico = get_matrix("lala-px~/lala.bam", 1000, filter_exclude=0,
+                              ncpus=ncpus, nchunks=nchunks, tmpdir="lala-px~",
+                              clean=True)
+            self.assertEqual(dico, counts)
+        hic_data = load_hic_data_from_bam(
+            "lala-px~/lala.bam", 1000, filter_exclude=0, tmpdir="lala-px~",
+            ncpus=1, nchunks=7, verbose=False)
+        self.assertEqual(dict(((k // len(hic_data), k % len(hic_data)), v)
+                              for k, v in hic_data.items()), counts)
+        # sub-matrix between two regions
+        dico = get_matrix("lala-px~/lala.bam", 1000, filter_exclude=0,
+                          region1="chr1", start1=20000, end1=60000,
+                          region2="chr2", start2=5000, end2=40000, ncpus=1,
+                          nchunks=7, tmpdir="lala-px~", clean=True)
+        self.assertEqual(dico, dict(((i - 20, j - 96 - 5), v)
+                                    for (i, j), v in counts.items()
+                                    if 20 <= i < 60 and 101 <= j < 136))
+        # normalized, without the bad columns
+        biases = {"biases": dict((i, 0.5 + (i % 7) / 7.) for i in range(158)),
+                  "badcol": {3: 0, 100: 0}, "resolution": 1000,
+                  "decay": {"chr2": dict((d, 2. / (d + 1)) for d in range(62))}}
+        with open("lala-px~/biases.pickle", "wb") as out:
+            dump(biases, out)
+        dico = get_matrix("lala-px~/lala.bam", 1000, filter_exclude=0,
+                          biases="lala-px~/biases.pickle", normalization="norm",
+                          ncpus=1, nchunks=7, tmpdir="lala-px~", clean=True)
+        expected = dict(((i, j), float(v) / biases["biases"][i]
+                         / biases["biases"][j])
+                        for (i, j), v in counts.items()
+                        if not (i in biases["badcol"] or j in biases["badcol"]))
+        self.assertEqual(sorted(dico), sorted(expected))
+        self.assertTrue(all(abs(dico[k] - expected[k]) < 1e-9 for k in dico))
+        dico = get_matrix("lala-px~/lala.bam", 1000, filter_exclude=0,
+                          biases="lala-px~/biases.pickle", region1="chr2",
+                          normalization="decay", ncpus=1, nchunks=7,
+                          tmpdir="lala-px~", clean=True)
+        expected = dict(((i - 96, j - 96), float(v) / biases["biases"][i]
+                         / biases["biases"][j] / biases["decay"]["chr2"][abs(i - j)])
+                        for (i, j), v in counts.items()
+                        if i >= 96 and j >= 96 and i != 100 and j != 100)
+        self.assertEqual(sorted(dico), sorted(expected))
+        self.assertTrue(all(abs(dico[k] - expected[k]) < 1e-9 for k in dico))
+        system("rm -rf lala-px~")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("27", time() - t0)
+
+    def test_28_matrix_cache(self):
+        """
+        matrices read from the cache of binned BAMs, at the same or at a
+        coarser resolution, compared to the ones read from the BAM
+        """
+        if ONLY and not "28" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        import sqlite3 as lite
+        from pytadbit.parsers.hic_bam_parser import get_matrix
+
+        def cached():
+            con = lite.connect("lala-cache~/trace.db")
+            entries = con.execute(
+                "select Resolution, Filter from CACHED_MATRICEs").fetchall()
+            con.close()
+            return sorted(entries)
+
+        system("rm -rf lala-cache~ && mkdir -p lala-cache~")
+        generate_random_bam("lala-cache~/lala.bam", [95000, 61000], 10000)
+        for _ in range(2):
+            dico = get_matrix("lala-cache~/lala.bam", 1000, filter_exclude=0,
+                              ncpus=1, nchunks=7, tmpdir="lala-cache~",
+                              clean=True, cache_dir="lala-cache~")
+            self.assertEqual(dico, count_bam_pixels("lala-cache~/lala.bam", 1000))
+            self.assertEqual(cached(), [(1000, 0)])
+        # coarser resolutions, projected from the cached matrix
+        for reso, kwargs in [(5000, {}), (2000, {"region1": "chr2"}),
+                             (3000, {"region1": "chr1", "start1": 9000,
+                                     "end1": 60000, "region2": "chr2"})]:
+            dico = get_matrix("lala-cache~/lala.bam", reso, filter_exclude=0,
+                              ncpus=1, nchunks=7, tmpdir="lala-cache~",
+                              clean=True, cache_dir="lala-cache~", **kwargs)
+            self.assertEqual(cached(), [(1000, 0)])
+            self.assertEqual(dico, get_matrix(
+                "lala-cache~/lala.bam", reso, filter_exclude=0, ncpus=1,
+                nchunks=7, tmpdir="lala-cache~", clean=True, **kwargs))
+        self.assertEqual(get_matrix(
+            "lala-cache~/lala.bam", 5000, filter_exclude=0, ncpus=1, nchunks=7,
+            tmpdir="lala-cache~", clean=True),
+                         count_bam_pixels("lala-cache~/lala.bam", 5000))
+        # other filters are not read from the cache, too large matrices are
+        # not stored
+        get_matrix("lala-cache~/lala.bam", 1000, filter_exclude=1, ncpus=1,
+                   nchunks=7, tmpdir="lala-cache~", clean=True,
+                   cache_dir="lala-cache~")
+        self.assertEqual(cached(), [(1000, 0), (1000, 1)])
+        get_matrix("lala-cache~/lala.bam", 500, filter_exclude=0, ncpus=1,
+                   nchunks=7, tmpdir="lala-cache~", clean=True,
+                   cache_dir="lala-cache~", cache_size=1000)
+        self.assertEqual(cached(), [(1000, 0), (1000, 1)])
+        self.assertEqual(len(listdir("lala-cache~/_cached_matrices")), 2)
+        system("rm -rf lala-cache~")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("28", time() - t0)
+
+    def test_29_cooler_pyramid(self):
+        """
+        multi-resolution cooler summed from the finest matrix, compared to the
+        reads counted one by one at each resolution
+        """
+        if ONLY and not "29" in ONLY:
+            return
+        try:
+            import h5py
+        except ImportError:
+            print("ERROR: h5py not found, skipping test\n")
+            return
+        if CHKTIME:
+            t0 = time()
+        from pytadbit.parsers.hic_bam_parser import write_cooler_pyramid
+        from pytadbit.parsers.cooler_parser import cooler_pixels
+        system("rm -rf lala-cool~ && mkdir -p lala-cool~")
+        lengths = [95000, 61000]
+        generate_random_bam("lala-cool~/lala.bam", lengths, 10000)
+        write_cooler_pyramid("lala-cool~/lala.bam", [5000, 1000, 2000],
+                             "lala-cool~/lala.mcool", filter_exclude=0,
+                             normalize=True, min_count=10, ncpus=1, nchunks=7,
+                             tmpdir="lala-cool~", verbose=False)
+        for reso in [1000, 2000, 5000]:
+            # cooler bins end at the end of the chromosome, the extra bin of
+            # TADbit goes into the last one
+            nbins = [-(-l // reso) for l in lengths]
+            first = lengths[0] // reso + 1
+
+            def cool_bin(b):
+                if b < first:
+                    return min(b, nbins[0] - 1)
+                return nbins[0] + min(b - first, nbins[1] - 1)
+
+            expected = {}
+            for (i, j), v in count_bam_pixels("lala-cool~/lala.bam",
+                                              reso).items():
+                i, j = cool_bin(i), cool_bin(j)
+                if i <= j:
+                    expected[i, j] = expected.get((i, j), 0) + v
+            found = {}
+            for bins1, bins2, counts in cooler_pixels("lala-cool~/lala.mcool",
+                                                      reso, chunksize=100):
+                for i, j, v in zip(bins1.tolist(), bins2.tolist(),
+                                   counts.tolist()):
+                    self.assertFalse((i, j) in found)
+                    found[i, j] = v
+            self.assertEqual(found, expected)
+            # balanced matrix
+            with h5py.File("lala-cool~/lala.mcool", "r") as f:
+                weights = f["resolutions"][str(reso)]["bins"]["weight"][:]
+            self.assertEqual(len(weights), sum(nbins))
+            sums = [0.] * len(weights)
+            for (i, j), v in expected.items():
+                sums[i] += v * weights[i] * weights[j]
+                if i != j:
+                    sums[j] += v * weights[i] * weights[j]
+            sums = [s for s, w in zip(sums, weights) if w]
+            self.assertTrue(len(sums) > len(weights) // 2)
+            self.assertTrue(max(sums) - min(sums) < 1e-4 * max(sums))
+        system("rm -rf lala-cool~")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("29", time() - t0)
+
+    def test_30_apply_filter_mask(self):
+        """
+        reads filtered with the bitmask, as with the files of read IDs
+        """
+        if ONLY and not "30" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from pytadbit.utils.file_handling import which
+        from pytadbit.parsers.hic_bam_parser import get_filter_mask
+        from pytadbit.parsers.hic_bam_parser import bed2D_to_BAMhic
+        generate_random_intersection()
+        seed(1)
+        same_seed = 13436 == int(random()*100000)
+        masked = filter_reads("lala-map~", output="lala-flt~", verbose=False,
+                              text_output=True)
+        by_mask = dict((k, {"name": masked[k]["name"],
+                            "mask": masked[k]["mask"]}) for k in range(1, 11))
+        by_ids = dict((k, {"name": masked[k]["name"],
+                           "fnam": masked[k]["fnam"]}) for k in range(1, 11))
+        self.assertEqual(get_filter_mask("lala-map~", by_mask),
+                         "lala-flt~_filters.npy")
+        self.assertEqual(get_filter_mask("lala-map~", by_ids), None)
+        # reads with (reverse) or without an ID in the files of the filters,
+        # with the counts and reads of the former apply_filter
+        with open("lala-map~") as fh:
+            lines = fh.readlines()
+        header = [l for l in lines if l.startswith("#")]
+        reads = lines[len(header):]
+        for filters, reverse, num, first, last in [
+                ([1], False, 5000, "lala02.000000000226", "lala03.000000000194"),
+                ([1], True, 1000, "lala01.000000000395", "lala01.000000000263"),
+                ([1, 2, 3, 4, 6, 7, 8, 9, 10], False, 471,
+                 "lala05.000000001034", "lala05.000000000176"),
+                ([1, 2, 3, 4, 6, 7, 8, 9, 10], True, 5529,
+                 "lala02.000000000226", "lala03.000000000194"),
+                ([5, 9], False, 4121, "lala02.000000000226", "lala03.000000000194"),
+                ([5, 9], True, 1879, "lala05.100000001713", "lala04.000000000928"),
+                (None, False, 435, "lala05.000000001034", "lala05.000000000176"),
+                (None, True, 5565, "lala02.000000000226", "lala03.000000000194")]:
+            removed = set()
+            for k in filters or by_ids:
+                with open(by_ids[k]["fnam"]) as fh:
+                    removed.update(l.strip() for l in fh)
+            expected = header + [l for l in reads
+                                 if (l.split("\t", 1)[0] in removed) == reverse]
+            for masks in (by_mask, by_ids):
+                count = apply_filter("lala-map~", "lala-flt.tsv~", masks,
+                                     filters=filters, reverse=reverse,
+                                     verbose=False)
+                with open("lala-flt.tsv~") as fh:
+                    lines = fh.readlines()
+                self.assertEqual(lines, expected)
+                self.assertEqual(count, len(lines) - len(header))
+                if same_seed:
+                    self.assertEqual((count, lines[len(header)].split("\t")[0],
+                                      lines[-1].split("\t")[0]),
+                                     (num, first, last))
+        if which("samtools"):
+            import pysam
+            flags = []
+            for masks in (by_mask, by_ids):
+                bed2D_to_BAMhic("lala-map~", False, 1, "lala-flt~", "mid",
+                                masked=masks)
+                bam = pysam.AlignmentFile("lala-flt~.bam")
+                flags.append(sorted((r.query_name, r.flag) for r in bam))
+                bam.close()
+            self.assertEqual(flags[0], flags[1])
+        else:
+            print("ERROR: samtools not found, skipping BAM test\n")
+        system("rm -rf lala-flt~* lala-flt.tsv~")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("30", time() - t0)
+
+    def test_31_intersection(self):
+        """
+        intersection of read-ends with multiple contacts, against the former
+        implementation (same lines, now sorted numerically by coordinates)
+        """
+        if ONLY and not "31" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from pytadbit.mapping import get_intersection
+        generate_random_intersection()
+        generate_read_ends("lala-ends1~", "lala-ends2~",
+                           [400000, 300000, 150000], 3000)
+        # contacts of a read-end on 4 fragments (one of them on both sides)
+        contacts = [("chr1", "334", "chr3", "41381"),
+                    ("chr1", "334", "chr3", "118361"),
+                    ("chr1", "334", "chr3", "124385"),
+                    ("chr3", "41381", "chr3", "118361"),
+                    ("chr3", "41381", "chr3", "124385"),
+                    ("chr3", "118361", "chr3", "124385")]
+        for fnames, count, multiples, nlines, read, pairs in [
+            (("lala-ends1~", "lala-ends2~"), 2705,
+             {2: 430, 3: 292, 4: 137, 5: 15, 6: 11}, 6688, "lala.000481",
+             contacts),
+            (("lala1-map~", "lala2-map~"), 6000, {}, 6000, "lala02.000000000226",
+             [("chr1", "951", "chr1", "974")])]:
+            reads = []
+            for fname in fnames:
+                with open(fname) as fh:
+                    reads.append(set(l.split("\t", 1)[0] for l in fh
+                                     if not l.startswith("#")))
+            for kwargs in [{}, dict(ncpus=3, buffer_size=200, max_open_files=3),
+                           dict(buffer_size=50, max_open_files=2)]:
+                result = get_intersection(fnames[0], fnames[1], "lala-int~",
+                                          **kwargs)
+                self.assertEqual(result, (count, multiples))
+                with open("lala-int~") as fh:
+                    lines = fh.readlines()
+                chrom_start = {}
+                total = 0
+                for l in lines:
+                    if l.startswith("# CRM "):
+                        crm, size = l.split()[2:]
+                        chrom_start[crm] = total
+                        total += int(size)
+                lines = [l.split("\t") for l in lines if not l.startswith("#")]
+                self.assertEqual(len(lines), nlines)
+                # reads with both ends mapped, as formerly
+                self.assertEqual(set(l[0].split("#")[0] for l in lines),
+                                 reads[0] & reads[1])
+                self.assertEqual(sorted((l[1], l[2], l[7], l[8]) for l in lines
+                                        if l[0].split("#")[0] == read),
+                                 sorted(pairs))
+                coords = [(chrom_start[l[1]] + int(l[2]),
+                           chrom_start[l[7]] + int(l[8])) for l in lines]
+                self.assertEqual(coords, sorted(coords))
+        system("rm -rf lala-ends1~ lala-ends2~ lala-int~")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("31", time() - t0)
+
+    def test_32_topdom(self):
+        """
+        TopDom domains and scores against the former implementation
+        """
+        if ONLY and not "32" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from pytadbit.tadbit import TopDom
+
+        def topdom(hic_data, window_size):
+            ret = TopDom(hic_data, window_size=window_size)
+            return ([ret[k]["start"] for k in sorted(ret)],
+                    [ret[k]["end"] for k in sorted(ret)],
+                    dict((k, ret[k]["tag"]) for k in ret
+                         if ret[k]["tag"] != "domain"),
+                    [round(ret[k]["score"], 4) for k in sorted(ret)])
+        # matrix with TADs, empty bins and no interaction beyond 50 bins
+        seed(11)
+        size = 400
+        hic_data = HiC_data([], size=size)
+        tads = [0]
+        while tads[-1] < size:
+            tads.append(tads[-1] + 5 + int(random() * 30))
+        tad = dict((b, t) for t in range(len(tads) - 1)
+                   for b in range(tads[t], tads[t + 1]))
+        empty = set(range(50, 55)) | set(int(random() * size) for _ in range(10))
+        for i in range(size):
+            for j in range(i, min(size, i + 50)):
+                if i in empty or j in empty:
+                    continue
+                val = int(random() * 200. / (j - i + 1) ** 1.2 *
+                          (3 if tad[i] == tad[j] else 1))
+                if val:
+                    hic_data[i, j] = hic_data[j, i] = val
+        # same domains and scores as formerly
+        for window, domains in [
+            (2, ([0, 18, 50, 55, 85, 89, 109, 233, 237, 240, 264, 284, 294, 332,
+                  344, 347],
+                 [17, 50, 55, 84, 88, 108, 232, 236, 239, 263, 283, 293, 331, 343,
+                  346, 400],
+                 {50: "gap"},
+                 [0.7096, 0.6125, 10, 0.5073, 0.4476, 0.5598, 0.5748, 0.6095,
+                  0.7419, 0.6244, 0.6084, 0.5825, 0.5364, 0.5289, 0.8286, 0.5455])),
+            (5, ([0, 39, 50, 55, 69, 71, 89, 109, 131, 141, 159, 161, 184, 209,
+                  212, 219, 233, 240, 259, 269, 294, 300, 334, 367, 391],
+                 [38, 50, 55, 68, 70, 88, 108, 130, 140, 158, 160, 183, 208, 211,
+                  218, 232, 239, 258, 268, 293, 299, 333, 366, 390, 400],
+                 {50: "gap"},
+                 [0.6725, 0.7553, 10, 0.7084, 0.2305, 0.4645, 0.5862, 0.7015,
+                  0.4497, 0.604, 0.0651, 0.7586, 0.4455, 0.0655, 0.6537, 0.477,
+                  0.403, 0.6954, 0.6448, 0.6366, 0.276, 0.5092, 0.5769, 0.4157,
+                  0.6166])),
+            (8, ([0, 18, 39, 50, 55, 71, 89, 109, 131, 141, 161, 163, 184, 209,
+                  211, 219, 233, 240, 269, 294, 300, 334, 367, 391],
+                 [17, 38, 50, 55, 70, 88, 108, 130, 140, 160, 162, 183, 208, 210,
+                  218, 232, 239, 268, 293, 299, 333, 366, 390, 400],
+                 {50: "gap", 161: "boundary", 209: "boundary"},
+                 [0.8498, 0.7495, 0.6886, 10, 0.7296, 0.472, 0.5186, 0.7269,
+                  0.485, 0.6219, 0.0115, 0.7962, 0.5813, 0.0004, 0.4718, 0.2822,
+                  0.1428, 0.7088, 0.55, 0.0381, 0.6946, 0.5849, 0.5198, 0.5618]))]:
+            self.assertEqual(topdom(hic_data, window), domains)
+        for crm, domains in [
+            ("A", ([0, 5, 14, 34, 50, 61], [4, 13, 33, 49, 60, 100], {},
+                   [0.6829, 0.5102, 0.5802, 0.5655, 0.4759, 0.5271])),
+            ("B", ([0, 5, 36, 42, 50, 54, 79], [4, 35, 41, 49, 53, 78, 100], {},
+                   [0.5419, 0.5396, 0.7396, 0.5733, 0.259, 0.5348, 0.4598])),
+            ("C", ([0, 6, 14, 54, 91, 97], [5, 13, 53, 90, 96, 100], {},
+                   [0.5144, 0.5334, 0.5168, 0.5523, 0.4337, 0.3388])),
+            ("D", ([0, 5, 14, 38, 40, 43, 97], [4, 13, 38, 40, 42, 96, 100],
+                   {38: "gap"},
+                   [0.6248, 0.5365, 0.5774, 10, 0.5662, 0.495, 0.3365]))]:
+            hic_data = read_matrix(PATH + "/20Kb/chrT/chrT_%s.tsv" % crm)
+            self.assertEqual(topdom(hic_data, 5), domains)
+        result = tadbit(PATH + "/20Kb/chrT/chrT_A.tsv", use_topdom=True,
+                        verbose=False)
+        self.assertEqual(result, {"start": [0, 5, 14, 34, 50, 61],
+                                  "end"  : [4, 13, 33, 49, 60, 100],
+                                  "score": [-9, -6, -7, -7, -5, -6],
+                                  "tag"  : ["domain"] * 6})
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("32", time() - t0)
+
+    def test_33_insulation_score(self):
+        """
+        insulation scores and deltas against the former implementation
+        """
+        if ONLY and not "33" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from numpy import allclose, errstate, log2, mean
+        from pytadbit.tadbit import insulation_score
+
+        def insulation(hic_data, dist, end, normalize, delta):
+            # direct computation, as formerly
+            matrix = hic_data.get_matrix(normalized=True, as_array=True)
+            insul = {}
+            deltas = {}
+            for crm, (beg, fin) in hic_data.section_pos.items():
+                decay = hic_data.expected
+                if crm in decay:
+                    decay = decay[crm]
+                values = {}
+                for pos in range(beg + end, fin - end):
+                    values[pos] = sum(matrix[i, j] / decay[j - i]
+                                      for i in range(pos - end, pos - dist + 1)
+                                      if not i in hic_data.bads
+                                      for j in range(pos + dist, pos + end + 1)
+                                      if not j in hic_data.bads)
+                if normalize and values:
+                    total = sum(values.values()) / len(values) or float("nan")
+                    with errstate(divide="ignore"):
+                        values = dict((pos, log2(val / total))
+                                      for pos, val in values.items())
+                # deltas at the beginning of a chromosome also use the scores
+                # at the end of the previous one
+                insul.update(values)
+                for pos in values:
+                    ups = [insul[pos - delta + spos] for spos in range(delta)
+                           if pos - delta + spos in insul]
+                    dws = [insul[pos + delta - spos] for spos in range(delta)
+                           if pos + delta - spos in insul]
+                    with catch_warnings():
+                        simplefilter("ignore")
+                        deltas[pos] = mean(ups) - mean(dws)
+            return insul, deltas
+
+        def assert_close(values, expected):
+            self.assertEqual(sorted(values), sorted(expected))
+            self.assertTrue(allclose([values[k] for k in sorted(values)],
+                                     [expected[k] for k in sorted(values)],
+                                     rtol=1e-9, atol=0, equal_nan=True))
+
+        def assert_saved(fname, values, dists):
+            with open(fname) as fh:
+                self.assertEqual(next(fh), "# CRM\tCOORD\t1-3\t0-2\t2-6\t1-10\n")
+                lines = [l.split() for l in fh]
+            self.assertEqual([(l[0], l[1]) for l in lines],
+                             [(crm, "%d-%d" % (pos * 1000 + 1, pos * 1000 + 1000))
+                              for crm in chroms for pos in range(chroms[crm])])
+            for pos, line in enumerate(lines):
+                assert_close(dict(zip(dists, map(float, line[2:]))),
+                             dict((d, values[d].get(pos, float("nan")))
+                                  for d in dists))
+        seed(12)
+        chroms = OrderedDict([("chr1", 180), ("chr2", 120), ("chr3", 9),
+                              ("chr4", 150)])
+        size = sum(chroms.values())
+        hic_data = HiC_data([], size=size, chromosomes=chroms, resolution=1000)
+        beg = 0
+        for length in chroms.values():
+            for i in range(beg, beg + length):
+                for j in range(i, min(beg + length, i + 40)):
+                    val = int(random() * 200. / (j - i + 1))
+                    if val:
+                        hic_data[i, j] = hic_data[j, i] = val
+            beg += length
+        for _ in range(200):
+            i, j = int(random() * size), int(random() * size)
+            hic_data[i, j] = hic_data[j, i] = 1
+        hic_data.bads.update({5: True, 200: True, 201: True})
+        hic_data.normalize_hic(silent=True)
+        hic_data.normalize_expected()
+        dists = [(1, 3), (0, 2), (2, 6), (1, 10)]
+        for normalize, delta in [(False, 3), (True, 12)]:
+            expected = dict((dist, insulation(hic_data, dist[0], dist[1],
+                                              normalize, delta))
+                            for dist in dists)
+            for n_cpus in [1, 2]:
+                insul, deltas = insulation_score(
+                    hic_data, dists, normalize=normalize, resolution=1000,
+                    delta=delta, silent=True, savedata="lala-ins~",
+                    savedeltas="lala-del~", n_cpus=n_cpus)
+                for dist in dists:
+                    assert_close(insul[dist], expected[dist][0])
+                    assert_close(deltas[dist], expected[dist][1])
+                assert_saved("lala-ins~", insul, dists)
+                assert_saved("lala-del~", deltas, dists)
+        system("rm -rf lala-ins~ lala-del~")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("33", time() - t0)
+
+    def test_34_reproducibility(self):
+        """
+        SCC, Spearman by distance and spectral reproducibility against the
+        former implementation
+        """
+        if ONLY and not "34" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from scipy.stats import spearmanr
+        from pytadbit.mapping.analyze import scc, get_reproducibility
+
+        def rounded(vals):
+            if isinstance(vals, (list, tuple)):
+                return [rounded(v) for v in vals]
+            return round(float(vals), 6)
+
+        def spearmans(hic_data1, hic_data2, intra, normalized, bads):
+            # direct computation, diagonal by diagonal
+            matrix1 = hic_data1.get_matrix(normalized=normalized, as_array=True)
+            matrix2 = hic_data2.get_matrix(normalized=normalized, as_array=True)
+            sections = (hic_data1.section_pos.values() if intra else
+                        [(0, len(hic_data1))])
+            corrs = []
+            for dist in range(1, 21):
+                pos = [(j, j + dist) for beg, end in sections
+                       for j in range(beg, end - dist)
+                       if not j in bads and not j + dist in bads]
+                corrs.append(spearmanr([matrix1[i, j] for i, j in pos],
+                                       [matrix2[i, j] for i, j in pos])[0])
+            return corrs
+        chroms = OrderedDict([("chr1", 130), ("chr2", 75), ("chr3", 3),
+                              ("chr4", 95)])
+        size = sum(chroms.values())
+        sections = {}
+        for crm in chroms:
+            for i in range(chroms[crm]):
+                sections[(crm, i)] = len(sections)
+        hic_datas = []
+        for num in (1, 2):
+            seed(num)
+            hic_data = HiC_data([], size=size, chromosomes=chroms,
+                                resolution=1000, dict_sec=sections)
+            for i in range(size):
+                for j in range(i, size):
+                    val = int(random() * 60. / (j - i + 1) ** 1.2)
+                    if val:
+                        hic_data[i, j] = hic_data[j, i] = val
+            hic_datas.append(hic_data)
+        hic_data1, hic_data2 = hic_datas
+        hic_data1.bads = {4: True, 100: True}
+        hic_data2.bads = {100: True, 150: True, 206: True}
+        for hic_data in hic_datas:
+            hic_data.bias = dict((i, 0.5 + random()) for i in range(size))
+        for intra, normalized, scc_std in [(False, False, [0.023154, 0.012881]),
+                                           (False, True , [0.01771, 0.013273]),
+                                           (True , False, [0.026558, 0.012244]),
+                                           (True , True , [0.027051, 0.014299])]:
+            corr = correlate_matrices(hic_data1, hic_data2, intra=intra,
+                                      normalized=normalized, max_dist=20,
+                                      get_bads=True)
+            self.assertEqual(rounded(corr[0]), rounded(spearmans(
+                hic_data1, hic_data2, intra, normalized, corr[4])))
+            self.assertEqual(corr[1], list(range(1, 21)))
+            self.assertEqual(rounded(corr[2:4]), scc_std)
+            self.assertEqual(sorted(corr[4]), [4, 100, 150, 206])
+        for normalized, score in [(False, 0.735917), (True, 0.588366)]:
+            self.assertEqual(round(get_reproducibility(
+                hic_data1, hic_data2, 20, normalized=normalized,
+                verbose=False), 6), score)
+        ecorr = eig_correlate_matrices(hic_data1, hic_data2, nvect=4)
+        self.assertEqual([[round(v, 4) for v in l] for l in ecorr],
+                         [[0.9716, 0.1644, 0.0886, 0.0269],
+                          [0.1753, 0.9344, 0.2425, 0.0286],
+                          [0.0396, 0.2566, 0.9534, 0.0092],
+                          [0.0376, 0.0248, 0.0152, 0.971]])
+        matrix1 = hic_data1.get_matrix(focus="chr1")
+        matrix2 = hic_data2.get_matrix(focus="chr1")
+        self.assertEqual(rounded(scc(matrix1, matrix2)), [0.0, 0.0])
+        self.assertEqual(rounded(scc(matrix1, matrix2, max_dist=10, min_dist=0)),
+                         [0.068514, 0.028533])
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("34", time() - t0)
+
+    def test_35_hmm(self):
+        """
+        Baum-Welch training and Viterbi paths against the former
+        implementation
+        """
+        if ONLY and not "35" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from random import gauss
+        from numpy import array, errstate, log
+        from pytadbit.utils.hmm import train, gaussian_prob, best_path
+
+        def rounded(vals):
+            return [rounded(v) if hasattr(v, "__len__") else round(float(v), 6)
+                    for v in vals]
+
+        def viterbi(probs, pi, T):
+            # direct computation, the first state is kept in case of ties
+            with errstate(divide="ignore"):
+                log_probs, log_pi, log_T = log(probs), log(pi), log(T)
+            scores = log_pi + log_probs[:, 0]
+            backs = []
+            for k in range(1, log_probs.shape[1]):
+                trans = scores[:, None] + log_T
+                backs.append(trans.argmax(axis=0))
+                scores = trans.max(axis=0) + log_probs[:, k]
+            path = [int(scores.argmax())]
+            for back in backs[::-1]:
+                path.insert(0, int(back[path[0]]))
+            return path, scores.max()
+        seed(15)
+        observations = []
+        for length in (120, 75, 3, 200):
+            state = 0
+            obs = []
+            for _ in range(length):
+                if random() < 0.08:
+                    state = 1 - state
+                obs.append(gauss(0.6 if state else -0.4, 0.3))
+            observations.append(obs)
+        for n, params, probs in [
+            (2, [[1.0, 0.0],
+                 [[0.943865, 0.056135], [0.088546, 0.911454]],
+                 [[-0.413641, 0.094734], [0.596197, 0.070156]]],
+             [-41.36187, -30.402317, -4.47112, -89.337344]),
+            (3, [[0.264297, 0.735703, 0.0],
+                 [[0.94945, 0.007343, 0.043207], [0.0, 0.901008, 0.098992],
+                  [0.070564, 0.02375, 0.905686]],
+                 [[-0.47298, 0.093098], [-0.28226, 0.064143],
+                  [0.596029, 0.069564]]],
+             [-39.216172, -29.141277, -5.562351, -88.944213])]:
+            pi = [1. / n] * n
+            T = array([[0.9 if i == j else 0.1 / (n - 1) for i in range(n)]
+                       for j in range(n)])
+            E = array([[-1. + 2. * i / (n - 1), 1. / n] for i in range(n)])
+            train(pi, T, E, observations, threshold=1e-6, n_iter=1000)
+            self.assertEqual(rounded([pi, T, E]), params)
+            paths = []
+            for obs in observations:
+                probs_obs = gaussian_prob(obs, E)
+                path, prob = best_path(probs_obs, pi, T)
+                expected, expected_prob = viterbi(array(probs_obs), array(pi), T)
+                self.assertEqual(list(path), expected)
+                self.assertAlmostEqual(prob, expected_prob, places=9)
+                paths.append(round(float(prob), 6))
+            self.assertEqual(paths, probs)
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("35", time() - t0)
+
+    def test_36_cooler_reader(self):
+        """
+        cooler read by chunks and by region, compared to the former reader
+        """
+        if ONLY and not "36" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        try:
+            import h5py
+        except ImportError:
+            print("ERROR: h5py not found, skipping test\n")
+            return
+        from numpy import allclose
+        from pytadbit.parsers.cooler_parser import parse_cooler, cooler_pixels
+        seed(16)
+        chroms = OrderedDict([("chr1", 90), ("chr2", 45), ("chr3", 60)])
+        sections = {}
+        for crm in chroms:
+            for i in range(chroms[crm]):
+                sections[(crm, i)] = len(sections)
+        size = len(sections)
+        hic_data = HiC_data([], size=size, chromosomes=chroms, resolution=1000,
+                            dict_sec=sections)
+        for i in range(size):
+            for j in range(i, size):
+                val = int(random() * 40. / (j - i + 1))
+                if val:
+                    hic_data[i, j] = hic_data[j, i] = val
+        hic_data.bias = dict((i, 0.5 + random()) for i in range(size))
+        hic_data.bads = {3: True, 100: True}
+        system("rm -rf lala.mcool~")
+        hic_data.write_cooler("lala.mcool~", normalized=True)
+        # whole matrix, as read by the former parser: counts, or counts
+        # multiplied by the weights of the file (zero for bad columns)
+        weights = [0 if i in hic_data.bads else 1 / hic_data.bias[i]
+                   for i in range(size)]
+        for hic in (True, False):
+            hic_cool = read_matrix("lala.mcool~", hic=hic, resolution=1000)
+            keys = [k for k, _ in hic_data.items()]
+            self.assertEqual([k for k, _ in hic_cool.items()], keys)
+            if hic:
+                self.assertEqual(dict(hic_cool.items()), dict(hic_data.items()))
+            else:
+                self.assertTrue(allclose(
+                    [v for _, v in hic_cool.items()],
+                    [v * weights[k // size] * weights[k % size]
+                     for k, v in hic_data.items()], rtol=1e-12, atol=0))
+            self.assertEqual(len(hic_cool), size)
+            self.assertEqual(dict(hic_cool.chromosomes), dict(chroms))
+            self.assertEqual(hic_cool.sections, sections)
+        # upper half of the matrix, by column
+        items, weights_cool, size_cool, header = parse_cooler(
+            "lala.mcool~", 1000, True, raw_values=True)
+        self.assertEqual(sorted((int(k), float(v)) for k, v in items),
+                         sorted((j * size + i, float(hic_data[i, j]))
+                                for i in range(size) for j in range(i, size)
+                                if hic_data[i, j]))
+        self.assertTrue(allclose(weights_cool, weights, rtol=1e-12, atol=0))
+        self.assertEqual((size_cool, list(header.items())),
+                         (size, list(chroms.items())))
+        # regions, compared to the whole matrix
+        for hic in (True, False):
+            hic_cool = read_matrix("lala.mcool~", hic=hic, resolution=1000)
+            for region, focus in [("chr2", (91, 135)),
+                                  (("chr1", 20000, 60000), (21, 60)),
+                                  (("chr3", 59500, None), (195, 195))]:
+                hic_region = read_matrix("lala.mcool~", hic=hic,
+                                         resolution=1000, region=region)
+                self.assertEqual(hic_region.get_matrix(),
+                                 hic_cool.get_matrix(focus=focus))
+        # pixels read by small chunks
+        pixels = []
+        for bins1, bins2, counts in cooler_pixels("lala.mcool~", 1000,
+                                                  region="chr3", chunksize=100):
+            self.assertTrue(len(counts) <= 100)
+            pixels.extend(zip(bins1.tolist(), bins2.tolist(), counts.tolist()))
+        self.assertEqual(pixels, [(i - 135, j - 135, hic_data[i, j])
+                                  for i in range(135, size)
+                                  for j in range(i, size) if hic_data[i, j]])
+        system("rm -rf lala.mcool~")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("36", time() - t0)
+
+    def test_37_npz_matrix(self):
+        """
+        matrices written in npz format, compared to the text format read by
+        the former reader
+        """
+        if ONLY and not "37" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        seed(17)
+        chroms = OrderedDict([("chr1", 50), ("chr2", 30), ("chr3", 40)])
+        sections = {}
+        for crm in chroms:
+            for i in range(chroms[crm]):
+                sections[(crm, i)] = len(sections)
+        size = len(sections)
+        hic_data = HiC_data([], size=size, chromosomes=chroms, resolution=1000,
+                            dict_sec=sections)
+        for i in range(size):
+            for j in range(i, size):
+                val = int(random() * 30. / (j - i + 1))
+                if val:
+                    hic_data[i, j] = hic_data[j, i] = val
+        hic_data.bias = dict((i, 0.5 + random()) for i in range(size))
+        for focus in (None, "chr2"):
+            hic_data.write_matrix("lala.txt~", focus=focus)
+            hic_text = read_matrix("lala.txt~", resolution=1000)
+            self.assertEqual(hic_text.get_matrix(),
+                             hic_data.get_matrix(focus=focus))
+            for writer in (hic_data.write_matrix, hic_data.write_coord_table):
+                writer("lala.npz~", focus=focus, format="npz")
+                hic_npz = read_matrix("lala.npz~")
+                self.assertEqual(hic_npz, hic_text)
+                self.assertEqual((hic_npz.sections, hic_npz.chromosomes,
+                                  hic_npz.resolution),
+                                 (hic_text.sections, hic_text.chromosomes,
+                                  hic_text.resolution))
+        # without diagonal
+        hic_data.write_matrix("lala.txt~", focus=(11, 70), diagonal=False)
+        hic_data.write_matrix("lala.npz~", focus=(11, 70), diagonal=False,
+                              format="npz")
+        self.assertEqual(read_matrix("lala.npz~").get_matrix(),
+                         read_matrix("lala.txt~", resolution=1000).get_matrix())
+        # normalized values and masked columns are kept as they are
+        hic_data.bads = {3: True, 60: True}
+        hic_data.write_matrix("lala.npz~", normalized=True, format="npz")
+        hic_npz = read_matrix("lala.npz~")
+        self.assertEqual(hic_npz.bads, hic_data.bads)
+        self.assertTrue(all(abs(v1 - v2) <= 1e-12 * abs(v2)
+                            for row1, row2 in zip(
+                                hic_npz.get_matrix(),
+                                hic_data.get_matrix(normalized=True))
+                            for v1, v2 in zip(row1, row2)))
+        hic_data.write_matrix("lala.npz~", format="npz")
+        self.assertEqual(read_matrix("lala.npz~"), hic_data)
+        system("rm -rf lala.txt~ lala.npz~")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("37", time() - t0)
+
+    def test_38_genome_cache(self):
+        """
+        genome loaded from the binary cache, compared to the parsed FASTA and
+        to the sequences written
+        """
+        if ONLY and not "38" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from pickle import dumps, loads
+        from pytadbit.parsers.genome_parser import get_gc_content, CachedGenome
+        system("rm -rf lala-genome~; mkdir lala-genome~")
+        fasta = "lala-genome~/genome.fa"
+        seed(20)
+        sequences = OrderedDict()
+        with open(fasta, "w") as out:
+            for crm, length in [("chr1", 25000), ("chr2", 12345), ("chrM", 300),
+                                ("chr3", 18000)]:
+                out.write(">%s some description\n" % crm)
+                seq = "".join("ACGTacgtN"[int(random() * (9 if random() < 0.3
+                                                          else 4))]
+                              for _ in range(length))
+                for beg in range(0, length, 60):
+                    out.write(seq[beg:beg + 60] + "\n")
+                sequences[crm] = seq.upper()
+        genome = parse_fasta(fasta, save_cache=False, verbose=False)
+        self.assertEqual(list(genome.items()), list(sequences.items()))
+        self.assertEqual(listdir("lala-genome~"), ["genome.fa"])
+        parse_fasta(fasta, verbose=False)
+        cached = parse_fasta(fasta, verbose=False)
+        self.assertTrue(isinstance(cached, CachedGenome))
+        self.assertEqual(list(cached.items()), list(genome.items()))
+        self.assertEqual(list(loads(dumps(cached)).items()),
+                         list(genome.items()))
+        self.assertEqual(list(parse_fasta(fasta, verbose=False,
+                                          only_length=True).items()),
+                         [("chr1", 25000), ("chr2", 12345), ("chrM", 300),
+                          ("chr3", 18000)])
+        # same output as on the parsed FASTA: RE sites before each GATC,
+        # and GC over ACGT by bin
+        frags = map_re_sites("DpnII", cached, frag_chunk=1000)
+        self.assertEqual(frags, map_re_sites("DpnII", genome, frag_chunk=1000))
+        self.assertEqual(frags["chrM"], {0: [1, 150, 277, 300]})
+        for crm, seq in sequences.items():
+            self.assertEqual(
+                set(pos for sites in frags[crm].values() for pos in sites),
+                set([1, len(seq)] + [m.start() + 1
+                                     for m in finditer("GATC", seq)]))
+        gc_content = []
+        for crm, seq in sequences.items():
+            for beg in range(0, len(seq), 1000):
+                bin_seq = seq[beg:beg + 1000]
+                gc_content.append(float(bin_seq.count("G") + bin_seq.count("C")) /
+                                  sum(bin_seq.count(n) for n in "ACGT"))
+        self.assertEqual([round(v, 10) for v in get_gc_content(cached, 1000)],
+                         [round(v, 10) for v in gc_content])
+        # filters applied on the cache
+        for kwargs in [dict(chr_filter=["chr1", "chr3"]),
+                       dict(chr_regexp="chr[0-9]")]:
+            self.assertEqual(
+                list(parse_fasta(fasta, verbose=False, **kwargs).items()),
+                list(parse_fasta(fasta, verbose=False, save_cache=False,
+                                 reload_cache=True, **kwargs).items()))
+        # genome cached as text by former versions
+        system("rm -f lala-genome~/genome.fa_genome.TADbit*")
+        with open("lala-genome~/genome.fa_genome.TADbit", "w") as out:
+            for crm in genome:
+                out.write(">%s\n%s\n" % (crm, genome[crm]))
+        self.assertEqual(list(parse_fasta(fasta, verbose=False).items()),
+                         list(genome.items()))
+        system("rm -rf lala-genome~")
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("38", time() - t0)
+
+    def test_39_models_arrays(self):
+        """
+        analyses of models stored in a single array, against the former
+        implementation
+        """
+        if ONLY and not "39" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from pickle import load
+        from numpy import (arccos, array, cross, degrees, dot, isnan, median,
+                           nan, nanmean, nanmedian, nanstd, ones, pi, sqrt)
+        from numpy.linalg import det, norm, svd
+        if sys.version_info[0] < 3:
+            refmodels_path = PATH + "/models.pick"
+        else:
+            refmodels_path = PATH + "/models_py3.pick"
+        models = load_structuralmodels(refmodels_path)
+        raw = load(open(refmodels_path, "rb"))["models"]
+        nums = list(range(len(models)))
+        for n in nums:
+            for k in ("x", "y", "z"):
+                self.assertEqual(list(models[n][k]), list(raw[n][k]))
+            for k in ("objfun", "index", "rand_init", "cluster"):
+                self.assertEqual(models[n][k], raw[n][k])
+        self.assertEqual(models[models[3]["rand_init"]]["objfun"],
+                         models[3]["objfun"])
+        self.assertEqual([m["rand_init"] for m in models][:5],
+                         ["4", "24", "36", "28", "25"])
+        # direct computations from the pickled coordinates
+        coords = array([[raw[n]["x"], raw[n]["y"], raw[n]["z"]] for n in nums])
+        dists = sqrt(((coords[:, :, :, None] -
+                       coords[:, :, None, :])**2).sum(axis=1))
+        self.assertEqual(models._get_interactions(nums, 300),
+                         ((dists < 300).sum(axis=2) - 1).T.tolist())
+        density = models._get_density(nums, 2, False)
+        self.assertEqual(density[:2], [[None] * len(nums)] * 2)
+        self.assertTrue(abs(array(density[2:]) - 2 * 20000 * 2. / (
+            dists[:, range(0, 17), range(2, 19)] +
+            dists[:, range(2, 19), range(4, 21)]).T).max() < 1e-9)
+        self.assertEqual(models.median_3d_dist(3, 17, plot=False, median=False),
+                         dists[:, 2, 16].tolist())
+        self.assertEqual(round(models.median_3d_dist(1, 15, plot=False), 4),
+                         1498.3945)
+        # angles of the triangle from the medians of the square distances
+        a2, b2, c2 = [median(dists[:, i, j]**2)
+                      for i, j in ((8, 14), (1, 14), (1, 8))]
+        g = arccos((a2 - b2 + c2) / (2 * sqrt(a2 * c2)))
+        h = arccos((a2 + b2 - c2) / (2 * sqrt(a2 * b2)))
+        self.assertTrue(abs(array(models.angle_between_3_particles(
+            2, 9, 15, all_angles=True)) - [g, h, pi - g - h]).max() < 1e-9)
+        dihedrals = []
+        for m in nums:
+            pa, pb, pc, pd, pe = coords[m].T[[2, 4, 6, 7, 9]]
+            n1 = cross(pb - pa, pb - pc)
+            n2 = cross(pc - pe, pd - pc)
+            angle = degrees(arccos(dot(n1, n2) / norm(n1) / norm(n2)))
+            dihedrals.append(angle if det([pb - pc, n1, n2]) < 0 else -angle)
+        self.assertTrue(abs(array(models.dihedral_angle(3, 5, 7, 8, 10, nums)) -
+                            dihedrals).max() < 1e-9)
+        for signed in [True, False]:
+            angles = ones((21, len(nums))) * nan
+            for m in nums:
+                for r in range(15):
+                    pa, pb, pc = coords[m].T[[r, r + 3, r + 6]]
+                    angles[r + 3, m] = degrees(arccos(
+                        dot(pa - pb, pc - pb) / norm(pa - pb) / norm(pc - pb)))
+                    # sign as formerly, without parenthesis around differences
+                    if signed and cross(pa - pb / norm(pa - pb),
+                                        pa - pc / norm(pa - pc)).sum() < 0:
+                        angles[r + 3, m] *= -1
+            radsk, errorp, _ = models.walking_angle(plot=False, signed=signed)
+            step1 = median(angles, axis=1)
+            step3 = [nanmedian(nanmean(angles[i:i + 3], axis=0))
+                     for i in range(19)]
+            self.assertEqual(radsk[3][0], None)
+            for vals, ref in [(radsk[1], step1), (radsk[3][1:], step3),
+                              (errorp[1], step1 + 2 * nanstd(angles, axis=1))]:
+                vals = array(vals, dtype=float)
+                self.assertEqual(isnan(vals).tolist(), isnan(ref).tolist())
+                self.assertTrue((abs(vals - ref)[~isnan(vals)] < 1e-9).all())
+        self.assertEqual(models.centroid_model(), 2)
+        # first model centered, others superimposed on it (Kabsch)
+        first = coords[0] - coords[0].mean(axis=1)[:, None]
+        aligned = array(models.align_models())
+        self.assertTrue(abs(aligned[0] - first).max() < 1e-9)
+        for n in nums[1:]:
+            other = coords[n] - coords[n].mean(axis=1)[:, None]
+            u, _, vt = svd(other.dot(first.T))
+            if det(u.dot(vt)) < 0:
+                vt[2] *= -1
+            self.assertTrue(abs(aligned[n] - vt.T.dot(u.T).dot(other)).max() < 1e-2)
+        models.define_best_models(10)
+        self.assertEqual([m["rand_init"] for m in models],
+                         ["4", "24", "36", "28", "25", "40", "2", "19", "1",
+                          "34"])
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("39", time() - t0)
+
+    def test_40_models_contacts(self):
+        """
+        contact and distance matrices of models computed by blocks, against
+        the former implementation
+        """
+        if ONLY and not "40" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from pickle import load
+        from numpy import array, eye, median, ones, sqrt, triu
+        from scipy.stats import kendalltau, pearsonr, spearmanr
+        if sys.version_info[0] < 3:
+            refmodels_path = PATH + "/models.pick"
+        else:
+            refmodels_path = PATH + "/models_py3.pick"
+        models = load_structuralmodels(refmodels_path)
+        raw = load(open(refmodels_path, "rb"))
+        # direct computation from the pickled coordinates: fraction of models
+        # with the particles closer than the cutoff (none on the diagonal)
+        coords = array([[raw["models"][n][k] for k in ("x", "y", "z")]
+                        for n in range(len(models))])
+        sqdists = ((coords[:, :, :, None] - coords[:, :, None, :])**2).sum(axis=1)
+
+        def contacts(cutoff, nums=None):
+            return ((sqdists[nums or slice(None)] <= cutoff**2).mean(axis=0) *
+                    (1 - eye(models.nloci)))
+        for n_cpus in [1, 2]:
+            matrices = models.get_contact_matrix(cutoff=[300, 500, 800],
+                                                 n_cpus=n_cpus)
+            self.assertEqual(sorted(matrices), [90000, 250000, 640000])
+            for cutoff in [300, 500, 800]:
+                self.assertTrue((abs(array(matrices[cutoff**2]) -
+                                     contacts(cutoff)) < 1e-12).all())
+            self.assertTrue((abs(array(models.get_contact_matrix(
+                cutoff=400, show_bad_columns=False, n_cpus=n_cpus)) -
+                                 contacts(400)) < 1e-12).all())
+            self.assertTrue((abs(array(models.get_contact_matrix(
+                models=[1, 3, 5], cutoff=600, n_cpus=n_cpus)) -
+                                 contacts(600, [1, 3, 5])) < 1e-12).all())
+            # the former implementation ignored the distance parameter
+            for nums in [None, [0, 2, 4, 6]]:
+                dists = median(sqrt(sqdists[nums or slice(None)]), axis=0)
+                self.assertTrue((abs(array(models.get_contact_matrix(
+                    models=nums, distance=True, n_cpus=n_cpus)) - dists)
+                                 < 1e-6).all())
+        # pairs above the diagonal with interactions in the original data
+        oridata = array(raw["original_data"], dtype=float)
+        modeled = contacts(400)
+        for off_diag, corr, func, value in [
+                (1, "spearman", spearmanr, 0.734642),
+                (1, "pearson", pearsonr, 0.715585),
+                (1, "kendall", kendalltau, 0.592292),
+                (3, "spearman", spearmanr, 0.548787)]:
+            wpairs = triu(ones(oridata.shape, dtype=bool), off_diag) & (oridata > 0)
+            result = models.correlate_with_real_data(cutoff=400, corr=corr,
+                                                     off_diag=off_diag)
+            self.assertEqual(round(result[0], 6), value)
+            self.assertAlmostEqual(result[0],
+                                   func(modeled[wpairs], oridata[wpairs])[0], 9)
+        self.assertEqual(round(models.correlate_with_real_data(
+            cutoff=400, corr="logpearson")[0], 6), 0.708726)
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("40", time() - t0)
+
+    def test_41_models_comparison(self):
+        """
+        comparison of models by tiles, and cached comparisons, against the
+        former implementation
+        """
+        if ONLY and not "41" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from itertools import combinations
+        from pickle import load
+        from numpy import array, sqrt, triu_indices
+        from numpy.linalg import det, svd
+        from pytadbit.utils.three_dim_stats import calc_eqv_rmsd, compare_models
+        if sys.version_info[0] < 3:
+            refmodels_path = PATH + "/models.pick"
+        else:
+            refmodels_path = PATH + "/models_py3.pick"
+        models = load_structuralmodels(refmodels_path)
+        raw = load(open(refmodels_path, "rb"))["models"]
+        coords = array([[raw[n][k] for k in ("x", "y", "z")]
+                        for n in range(len(models))])
+        pairs = list(combinations(range(len(models)), 2))
+
+        def compare(beg, end, dcutoff):
+            # direct computation: second model superimposed on the first one
+            # (Kabsch), square deviations of particles, and distance matrices
+            eqvs, rmsds, drmsds, sqdevs = [], [], [], []
+            for i, j in pairs:
+                one, two = [c[:, beg:end] - c[:, beg:end].mean(axis=1)[:, None]
+                            for c in coords[[i, j]]]
+                u, _, vt = svd(two.dot(one.T))
+                if det(u.dot(vt)) < 0:
+                    vt[2] *= -1
+                sqdev = ((vt.T.dot(u.T).dot(two) - one)**2).sum(axis=0)
+                sqdevs.append(sqdev)
+                one, two = [sqrt(((c[:, :, None] - c[:, None, :])**2).sum(axis=0))[
+                    triu_indices(end - beg, 1)] for c in (one, two)]
+                eqvs.append((sqdev < dcutoff**2).sum())
+                rmsds.append(sqrt(sqdev.mean()))
+                drmsds.append(sqrt(((one - two)**2).mean()))
+            return array(eqvs), array(rmsds), array(drmsds), array(sqdevs)
+
+        # former scores were computed in simple precision
+        for beg, end, dcutoff in [(0, 21, 200), (3, 17, 350)]:
+            eqvs, rmsds, drmsds, _ = compare(beg, end, dcutoff)
+            for what, values in [
+                    ("score", eqvs * drmsds / rmsds * rmsds.max() / drmsds.max()),
+                    ("rmsd", 1 - rmsds / rmsds.max()),
+                    ("drmsd", 1 - drmsds / drmsds.max()),
+                    ("eqv", eqvs)]:
+                scores = calc_eqv_rmsd(models._StructuralModels__models, beg, end,
+                                       models._zeros, dcutoff, what=what)
+                self.assertEqual(len(scores), 2 * len(pairs))
+                for (i, j), value in zip(pairs, values):
+                    self.assertEqual(scores[i, j], scores[j, i])
+                    self.assertTrue(abs(scores[i, j] - value) <= 1e-3 +
+                                    1e-5 * abs(value))
+        self.assertEqual(round(calc_eqv_rmsd({0: models[0], 1: models[4]}, 0, 21,
+                                             models._zeros, one=True), 3),
+                         32.796)
+        # tiles of models (models are aligned in place, as formerly, so the
+        # order of the comparisons changes the last digits)
+        comparison = compare_models(models._coords, 200)
+        tiled = compare_models(models._coords, 200, n_cpus=2, tile=4)
+        self.assertEqual(comparison[0].tolist(), tiled[0].tolist())
+        self.assertTrue((abs(comparison - tiled) <= 1e-5 * comparison).all())
+        # clustering, and comparisons reused
+        clusters300 = {
+            1: ["4", "24", "36", "28", "25", "40", "2", "19", "1", "34", "23",
+                "35", "39", "14", "10", "21", "15"],
+            2: ["18", "7", "11", "12", "30", "31", "29", "20"]}
+        models.cluster_models(dcutoff=300, method="ward", verbose=False)
+        self.assertEqual(dict(models.clusters), clusters300)
+        counts, objfuns, matrix = models._build_distance_matrix(3)
+        self.assertEqual(counts, {1: 17, 2: 8})
+        self.assertEqual(dict((c, round(o, 6)) for c, o in objfuns.items()),
+                         {1: 0.395178, 2: 1.835198})
+        # dRMSD between the best models of each cluster ("4" and "18")
+        self.assertEqual(matrix[0][0], 0.)
+        self.assertEqual(matrix[1], [0., 0.])
+        self.assertAlmostEqual(matrix[0][1], compare(0, 21, 300)[2][pairs.index(
+            (0, [m["rand_init"] for m in models].index("18")))], 3)
+        self.assertEqual(list(models._comparisons), [(0, 21, 300.)])
+        models.cluster_models(dcutoff=300, method="ward", verbose=False,
+                              n_cpus=2)
+        self.assertEqual(dict(models.clusters), clusters300)
+        self.assertEqual(list(models._comparisons), [(0, 21, 300.)])
+        models.cluster_models(dcutoff=200, method="ward", verbose=False)
+        self.assertEqual(dict(models.clusters), {
+            1: ["4", "24", "28", "40", "2", "1", "35", "14", "11", "10", "21",
+                "15", "31"],
+            2: ["36", "25", "19", "34", "18", "23", "39", "7", "12", "30", "29",
+                "20"]})
+        self.assertEqual(sorted(models._comparisons),
+                         [(0, 21, 200.), (0, 21, 300.)])
+        # options of the former external MCL program are ignored
+        for kwargs, nwarns in [({}, 0), (dict(mcl_bin="/usr/bin/mcl"), 1),
+                               (dict(tmp_file="lala-mcl~"), 1)]:
+            with catch_warnings(record=True) as warns:
+                simplefilter("always")
+                models.cluster_models(dcutoff=200, method="ward",
+                                      verbose=False, **kwargs)
+            self.assertEqual(len([w for w in warns if issubclass(
+                w.category, DeprecationWarning)]), nwarns)
+        # percentage of pairs of models with each particle superimposed closer
+        # than the cutoff
+        sqdevs = compare(0, 21, 0)[3]
+        consistency = models.model_consistency(cutoffs=(100, 200, 300),
+                                               plot=False)
+        self.assertEqual(sorted(consistency), [100, 200, 300])
+        for cutoff in [100, 200, 300]:
+            self.assertTrue((abs(array(consistency[cutoff]) - 100 * (
+                sqdevs < cutoff**2).mean(axis=0)) < 1e-9).all())
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print("41", time() - t0)
+
+
 def generate_random_ali(ali="map"):
     # VARIABLES
     num_crms      = 9
@@ -1146,6 +2719,201 @@ def generate_random_ali(ali="map"):
     return genome
 
 
+def generate_random_bam(fname, lengths, npairs, read_len=50, reso=1000):
+    """
+    TADbit-like BAM, with both ends of each pair, many of them starting right
+    before the border of a bin
+    """
+    import pysam
+    seed(7)
+    header = {"HD": {"VN": "1.0", "SO": "coordinate"},
+              "SQ": [{"SN": "chr%d" % (i + 1), "LN": l}
+                     for i, l in enumerate(lengths)]}
+    reads = []
+    for n in range(npairs):
+        ends = []
+        for _ in range(2):
+            crm = int(random() * len(lengths))
+            if random() < 0.3:
+                pos = max(0, int(random() * (lengths[crm] // reso)) * reso -
+                          int(random() * read_len) - 1)
+            else:
+                pos = int(random() * (lengths[crm] - read_len))
+            ends.append((crm, pos))
+        for (crm1, pos1), (crm2, pos2) in (ends, ends[::-1]):
+            reads.append((crm1, pos1, crm2, pos2, n))
+    reads.sort()
+    with pysam.AlignmentFile(fname, "wb", header=header) as out:
+        for crm1, pos1, crm2, pos2, n in reads:
+            read = pysam.AlignedSegment()
+            read.query_name = "lala.%012d" % n
+            read.query_sequence = "A" * read_len
+            read.flag = 0
+            read.reference_id = crm1
+            read.reference_start = pos1
+            read.mapping_quality = 60
+            read.cigartuples = [(0, read_len)]
+            read.next_reference_id = crm2
+            read.next_reference_start = pos2
+            out.write(read)
+    pysam.index(fname)
+
+
+def generate_random_gem3_sam(fname, genome, nreads):
+    """
+    GEM3-like SAM, sorted by read name, with supplementary alignments and
+    reads mapped on an unknown chromosome
+    """
+    import pysam
+    seed(11)
+    crms = list(genome)
+    header = {"HD": {"VN": "1.0", "SO": "queryname"},
+              "SQ": [{"SN": crm, "LN": len(genome[crm])} for crm in crms] +
+                    [{"SN": "chrU", "LN": 5000}]}
+    with pysam.AlignmentFile(fname, "w", header=header) as out:
+        for n in range(nreads):
+            reads = []
+            for mate in (64, 128):
+                for k in range(1 + int(random() * 2.5)):
+                    tid = int(random() * (len(crms) + 0.3))
+                    length = 5000 if tid == len(crms) else len(genome[crms[tid]])
+                    len_seq = 20 + int(random() * 40)
+                    pos = int(random() * (length - 10))
+                    len_seq = min(len_seq, length - pos)
+                    read = pysam.AlignedSegment()
+                    read.query_name = "read%06d" % n
+                    read.query_sequence = "A" * len_seq
+                    read.flag = (1 | mate | (16 if random() < .5 else 0) |
+                                 (2048 if k else 0))
+                    read.reference_id = tid
+                    read.reference_start = pos
+                    read.mapping_quality = 60 if random() > 0.05 else 1
+                    read.cigartuples = [(0, len_seq)]
+                    reads.append(read)
+            for read in reads:
+                out.write(read)
+
+
+def generate_read_line(num, cr1=None, ps1=None, cr2=None, ps2=None):
+    cr1 = cr1 or ("chr1", "chr2")[int(random() * 2)]
+    cr2 = cr2 or ("chr1", "chr2")[int(random() * 2)]
+    ps1 = int(random() * 700) if ps1 is None else ps1
+    ps2 = int(random() * 700) if ps2 is None else ps2
+    return "\t".join(str(v) for v in ("lala%d" % num, cr1, ps1, 1, 50, 0, 200,
+                                      cr2, ps2, 0, 50, 0, 200)) + "\n"
+
+
+def load_reads_line_by_line(fnam, resolution):
+    """
+    interactions counted by the former parser of
+    pytadbit.parsers.hic_parser.load_hic_data_from_reads, as sorted (pixel,
+    count)
+    """
+    sections = OrderedDict()
+    fhandler = open(fnam)
+    line = next(fhandler)
+    while line.startswith("#"):
+        if line.startswith("# CRM "):
+            crm, clen = line[6:].split()
+            sections[crm] = int(clen) // resolution + 1
+        line = next(fhandler)
+    size = sum(sections.values())
+    dict_sec = {}
+    for crm in sections:
+        for i in range(sections[crm]):
+            dict_sec[(crm, i)] = len(dict_sec)
+    counts = {}
+    try:
+        while True:
+            _, cr1, ps1, _, _, _, _, cr2, ps2, _ = line.split("\t", 9)
+            # the former parser binned twice the first read (bin // resolution)
+            # when only the second one was out of the chromosomes
+            try:
+                bin1 = dict_sec[(cr1, int(ps1) // resolution)]
+                bin2 = dict_sec[(cr2, int(ps2) // resolution)]
+            except KeyError:
+                bin1 = int(ps1) // resolution
+                bin2 = int(ps2) // resolution
+            for pix in (bin1 * size + bin2, bin2 * size + bin1):
+                counts[pix] = counts.get(pix, 0) + 1
+            line = next(fhandler)
+    except StopIteration:
+        pass
+    fhandler.close()
+    return sorted(counts.items())
+
+
+def count_bam_pixels(fname, resolution):
+    """
+    interactions between the bins of the full genome, counted read by read
+    """
+    import pysam
+    bam = pysam.AlignmentFile(fname)
+    offsets = [0]
+    for length in bam.lengths:
+        offsets.append(offsets[-1] + length // resolution + 1)
+    counts = {}
+    for read in bam:
+        pix = (offsets[read.reference_id] +
+               (read.reference_start + 1) // resolution,
+               offsets[read.next_reference_id] +
+               (read.next_reference_start + 1) // resolution)
+        counts[pix] = counts.get(pix, 0) + 1
+    bam.close()
+    return counts
+
+
+def generate_read_ends(fname1, fname2, lengths, nreads, reso=5000):
+    """
+    files of read-ends as generated by parse_map, with multiple contacts
+    (several fragments on a read-end), some falling in the same RE fragment,
+    and reads mapped on one side only
+    """
+    seed(13)
+    header = "".join("# CRM chr%d\t%d\n" % (i + 1, l)
+                     for i, l in enumerate(lengths))
+    out1 = open(fname1, "w")
+    out2 = open(fname2, "w")
+    for out in (out1, out2):
+        out.write("# MAPPED READ ENDS (strictly unique)\n" + header)
+    for num in range(nreads):
+        for out in (out1, out2):
+            if random() < 0.05:
+                continue
+            frags = []
+            for _ in range(1 if random() < 0.8 else int(random() * 3) + 2):
+                crm = int(random() * len(lengths))
+                if frags and random() < 0.3:  # in the same RE fragment
+                    crm = int(frags[-1][1][3:]) - 1
+                    pos = int(frags[-1][5]) + int(random() * reso)
+                else:
+                    pos = int(random() * (lengths[crm] - reso))
+                beg = pos // reso * reso
+                frags.append(("lala.%06d" % num, "chr%d" % (crm + 1), str(pos),
+                              str(int(random() * 2)), str(20 + int(random() * 30)),
+                              str(beg), str(beg + reso)))
+            out.write("|||".join("\t".join(f) for f in frags) + "\n")
+    out1.close()
+    out2.close()
+
+
+def generate_random_intersection():
+    """
+    read-ends and their intersection as generated in test_18 (these files are
+    removed in test_19)
+    """
+    if path.exists("lala-map~"):
+        return
+    from pytadbit.parsers.map_parser import parse_map
+    from pytadbit.mapping import get_intersection
+    seed(1)
+    random()
+    genome = generate_random_ali("map")
+    parse_map(["test_read1.map~"], ["test_read2.map~"], "./lala1-map~",
+              "./lala2-map~", genome, re_name="DPNII", mapper="GEM")
+    get_intersection("lala1-map~", "lala2-map~", "lala-map~")
+
+
 if __name__ == "__main__":
     if len(sys.argv) > 1:
         CHKTIME = bool(int(sys.argv.pop()))